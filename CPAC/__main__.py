@@ -21,6 +21,7 @@ import click
 #     cpac group isc
 #         cpac group isc <pipeline config>
 # cpac utils
+#     cpac utils profile_imports [<modules>...]
 #     cpac utils data_config
 #         cpac utils data_config new_template
 #         cpac utils data_config build <data settings file>
@@ -342,6 +343,18 @@ def crash(crash_file):
         from nipype.scripts.crash_files import display_crash_file
         display_crash_file(crash_file, False, False, None)
 
+@utils.command()
+@click.argument('modules', nargs=-1)
+@click.option('--top', default=20)
+def profile_imports(modules, top=20):
+    from CPAC.utils.import_profiler import run_profile
+    for module in modules or ('CPAC.__main__', 'CPAC.utils',
+                              'CPAC.pipeline.cpac_runner'):
+        print(module)
+        print(run_profile(module, top))
+        print('')
+
+
 @utils.group()
 def data_config():
     pass
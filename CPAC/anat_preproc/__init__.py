@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
 
-from CPAC.anat_preproc.anat_preproc import create_anat_preproc
-from CPAC.anat_preproc.lesion_preproc import create_lesion_preproc
+from CPAC.utils.lazy_import import lazy_module
+
+lazy_module(__name__, {
+    'create_anat_preproc': ('CPAC.anat_preproc.anat_preproc',
+                            'create_anat_preproc'),
+    'create_lesion_preproc': ('CPAC.anat_preproc.lesion_preproc',
+                              'create_lesion_preproc'),
+})
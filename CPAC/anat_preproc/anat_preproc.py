@@ -401,12 +401,26 @@ def create_anat_preproc(method='afni', already_skullstripped=False, c=None, wf_n
             model = nn.Sequential(train_model, nn.Softmax2d())
 
             # create a node called unet_mask
-            unet_mask = pe.Node(util.Function(input_names=['model', 'cimg_in'], 
+            unet_mask = pe.Node(util.Function(input_names=['model', 'cimg_in',
+                                                           'worker',
+                                                           'num_threads',
+                                                           'batch_size'],
                                               output_names=['out_path'],
                                               function=predict_volumes),                        
                                 name='unet_mask')
             
             unet_mask.inputs.model = model
+            unet_mask.inputs.batch_size = \
+                int(getattr(c, 'unet_batch_size', 1))
+
+            # the prediction runs in its own process, on its own threads,
+            # which the MultiProc plugin reserves for the node
+            if getattr(c, 'unet_worker_process', False):
+                unet_mask.inputs.worker = True
+                unet_mask.n_procs = min(int(getattr(c, 'unet_num_threads', 1)),
+                                        int(c.maxCoresPerParticipant))
+                unet_mask.inputs.num_threads = unet_mask.n_procs
+
             preproc.connect(anat_reorient, 'out_file', unet_mask, 'cimg_in')
 
             """
@@ -1,7 +1,11 @@
-from .pipeline import joint_mask, \
-                      nifti_cwas, \
-                      create_cwas
+from CPAC.utils.lazy_import import lazy_module, lazy_attributes
+
+lazy_module(__name__, lazy_attributes('CPAC.cwas.pipeline', [
+    'joint_mask',
+    'nifti_cwas',
+    'create_cwas',
+]))
 
 __all__ = ['create_cwas',
            'joint_mask',
-           'nifti_cwas']
\ No newline at end of file
+           'nifti_cwas']
@@ -4,8 +4,9 @@ import nibabel as nb
 import numpy as np
 import pandas as pd
 
-from CPAC.cwas.mdmr import mdmr
+from CPAC.cwas.mdmr import hat_bank, mdmr_blocked
 from CPAC.utils import correlation
+from CPAC.utils.utils import zscore
 
 from CPAC.pipeline.cpac_ga_model_generator import (create_merge_mask,
                                                    create_merged_copefile)
@@ -39,10 +40,37 @@ def joint_mask(subjects, mask_file=None):
     return mask_file
 
 
-def calc_mdmrs(D, regressor, cols, permutations):
+def calc_mdmrs(D, regressor, cols, permutations, random_state=None,
+               cache_dir=None, precision='float64', block_size=100,
+               voxel_block_size=1000):
     cols = np.array(cols, dtype=np.int32)
-    F_set, p_set = mdmr(D, regressor, cols, permutations)
-    return F_set, p_set
+
+    # distances may be a memory-mapped .npy, consumed voxel_block_size
+    # voxels at a time with the same permutations
+    if isinstance(D, str):
+        D = np.load(D, mmap_mode='r')
+
+    # without a seed, draw one so that all the voxel blocks share the
+    # same permutations, but do not cache them
+    if random_state is None:
+        random_state = np.random.randint(np.iinfo(np.int32).max)
+        cache_dir = None
+
+    X1 = np.hstack((np.ones((regressor.shape[0], 1)), regressor))
+    bank = hat_bank(X1, cols + 1, permutations, seed=random_state,
+                    cache_dir=cache_dir, dtype=precision)
+
+    F_set = []
+    p_set = []
+    for start in range(0, D.shape[0], voxel_block_size):
+        F, p = mdmr_blocked(np.asarray(D[start:start + voxel_block_size]),
+                            regressor, cols, permutations,
+                            seed=random_state, block_size=block_size,
+                            dtype=precision, bank=bank)
+        F_set.append(F)
+        p_set.append(p)
+
+    return np.concatenate(F_set), np.concatenate(p_set)
 
 
 def calc_subdists(subjects_data, voxel_range):
@@ -61,44 +89,166 @@ def calc_subdists(subjects_data, voxel_range):
     return D
 
 
-def calc_cwas(subjects_data, regressor, regressor_selected_cols, permutations, voxel_range):
-    D = calc_subdists(subjects_data, voxel_range)
+def subdists_block_size(subjects, voxels, memory_gb, itemsize=8):
+    """
+    Number of seed voxels of calc_subdists_blocked whose seed maps fit in a
+    memory budget
+
+    Parameters
+    ----------
+    subjects : integer
+    voxels : integer
+        Number of voxels in the mask
+    memory_gb : float
+        Memory budget of the seed maps, in GB
+    itemsize : integer
+        Bytes of a value of the seed maps
+
+    Returns
+    -------
+    block_size : integer
+
+    """
+    # a seed map per subject, and the temporary of its matrix product
+    per_seed = 2 * itemsize * subjects * voxels
+    return max(int(memory_gb * 1024 ** 3 // per_seed), 1)
+
+
+def calc_subdists_blocked(subjects_data, voxel_range, block_size=None,
+                          out_file=None, dtype=np.float64, z_scored=False,
+                          memory_gb=0.25):
+    """
+    Computes the same subject distances as calc_subdists, for block_size seed
+    voxels at a time
+
+    Each subject is z-scored once, the seed maps of a block are computed
+    with a single matrix product per subject, and the seed's connection to
+    itself is masked out of the profile correlations instead of being
+    deleted from a copy of the profiles. The seed maps keep the floating
+    point type of subjects_data.
+
+    Parameters
+    ----------
+    subjects_data : ndarray
+        (subjects, voxels, timepoints) data
+    voxel_range : ndarray
+        Indexes of the seed voxels
+    block_size : integer
+        Number of seed voxels computed at once, by default as many as
+        memory_gb allows
+    out_file : string
+        Path of a .npy file the distances are written into as a memory-mapped
+        array; the distances are kept in memory if None
+    dtype : numpy dtype
+        Type of the distances
+    z_scored : boolean
+        Whether the voxel timeseries of subjects_data are already z-scored
+    memory_gb : float
+        Memory budget of the seed maps of a block, in GB
+
+    Returns
+    -------
+    D : ndarray
+        (len(voxel_range), subjects, subjects) distances, memory-mapped from
+        out_file when it is given
+
+    """
+    subjects, voxels, timepoints = subjects_data.shape
+    voxel_range = np.asarray(voxel_range, dtype=int)
+    n_seeds = len(voxel_range)
+    data_dtype = np.result_type(subjects_data.dtype, np.float32)
+
+    if out_file:
+        D = np.lib.format.open_memmap(out_file, mode='w+', dtype=dtype,
+                                      shape=(n_seeds, subjects, subjects))
+    else:
+        D = np.zeros((n_seeds, subjects, subjects), dtype=dtype)
+
+    if z_scored:
+        Z = subjects_data
+    else:
+        Z = np.array([zscore(np.asarray(subjects_data[si], dtype=data_dtype),
+                             1)
+                      for si in range(subjects)])
+
+    if block_size is None:
+        block_size = subdists_block_size(subjects, voxels, memory_gb,
+                                         np.dtype(data_dtype).itemsize)
+    block_size = max(int(block_size), 1)
+    for start in range(0, n_seeds, block_size):
+        seeds = voxel_range[start:start + block_size]
+        block = np.arange(len(seeds))
+
+        # (seeds, subjects, voxels) Fisher-z transformed seed maps
+        profiles = np.empty((len(seeds), subjects, voxels), dtype=data_dtype)
+        for si in range(subjects):
+            profiles[:, si, :] = Z[si, seeds].dot(Z[si].T)
+        profiles /= timepoints
+        np.clip(profiles, -0.9999, 0.9999, out=profiles)
+        np.arctanh(profiles, out=profiles)
+
+        # mask the self-connection of each seed, and center the maps on
+        # the other voxels
+        profiles[block, :, seeds] = 0.0
+        n = voxels - 1
+
+        means = profiles.sum(axis=2, dtype=np.float64) / n
+        profiles -= means[:, :, np.newaxis].astype(data_dtype)
+        profiles[block, :, seeds] = 0.0
+
+        cov = np.empty((len(seeds), subjects, subjects))
+        for b in block:
+            cov[b] = profiles[b].dot(profiles[b].T)
+        var = np.copy(cov[:, np.arange(subjects), np.arange(subjects)])
+        std = np.sqrt(np.where(var > 0, var, np.inf))
+
+        r = cov / std[:, :, np.newaxis] / std[:, np.newaxis, :]
+        r = np.clip(r, -1.0, 1.0)
+
+        D[start:start + len(seeds)] = np.sqrt(2.0 * (1.0 - r))
+
+    if out_file:
+        D.flush()
+
+    return D
+
+
+def calc_cwas(subjects_data, regressor, regressor_selected_cols, permutations,
+              voxel_range, random_state=None, cache_dir=None,
+              precision='float64', subdists_file=None, z_scored=False,
+              block_size=None):
+    D = calc_subdists_blocked(subjects_data, voxel_range,
+                              block_size=block_size, out_file=subdists_file,
+                              z_scored=z_scored)
     F_set, p_set = calc_mdmrs(
-        D, regressor, regressor_selected_cols, permutations)
+        D, regressor, regressor_selected_cols, permutations,
+        random_state=random_state, cache_dir=cache_dir, precision=precision)
     return F_set, p_set
 
 
-def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
-               columns_string, permutations, voxel_range):
+def load_cwas_regressor(regressor_file, participant_column, columns_string,
+                        subject_ids):
     """
-    Performs CWAS for a group of subjects
-    
+    Reads the regressor file and orders its rows like the subjects
+
     Parameters
     ----------
-    subjects : dict of strings:strings
-        A length `N` dict of id and file paths of the nifti files of subjects
-    mask_file : string
-        Path to a mask file in nifti format
     regressor_file : string
         file path to regressor CSV or TSV file (phenotypic info)
+    participant_column : string
+        name of the participant ID column of the regressor file
     columns_string : string
         comma-separated string of regressor labels
-    permutations : integer
-        Number of pseudo f values to sample using a random permutation test
-    voxel_range : ndarray
-        Indexes from range of voxels (inside the mask) to perform cwas on.
-        Index ordering is based on the np.where(mask) command
-    
+    subject_ids : list of strings
+        IDs of the subjects, in the order of their data
+
     Returns
     -------
-    F_file : string
-        .npy file of pseudo-F statistic calculated for every voxel
-    p_file : string
-        .npy file of significance probabilities of pseudo-F values
-    voxel_range : tuple
-        Passed on by the voxel_range provided in parameters, used to make parallelization
-        easier
-        
+    regressor : ndarray
+        (subjects, regressors) matrix
+    regressor_selected_cols : ndarray
+        indexes of the regressors of interest
+
     """
     try:
         regressor_data = pd.read_table(regressor_file,
@@ -119,17 +269,14 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
     if participant_column in columns_string:
         raise ValueError('Participant column can not be a regressor.')
 
-    subject_ids = list(subjects.keys())
-    subject_files = list(subjects.values())
-
     # check for inconsistency with leading zeroes
     # (sometimes, the sub_ids from individual will be something like
     #  '0002601' and the phenotype will have '2601')
-    for index, row in regressor_data.iterrows():
-        pheno_sub_id = str(row[participant_column])
-        for sub_id in subject_ids:
-            if str(sub_id).lstrip('0') == str(pheno_sub_id):
-                regressor_data.at[index, participant_column] = str(sub_id)
+    stripped_ids = dict((str(sub_id).lstrip('0'), str(sub_id))
+                        for sub_id in subject_ids)
+    regressor_data[participant_column] = \
+        regressor_data[participant_column].astype(str).map(
+            lambda pheno_sub_id: stripped_ids.get(pheno_sub_id, pheno_sub_id))
 
     regressor_data.index = regressor_data[participant_column]
 
@@ -157,19 +304,118 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
     elif len(regressor.shape) != 2:
         raise ValueError('Bad regressor shape: %s' % str(regressor.shape))
 
-    if len(subject_files) != regressor.shape[0]:
-        raise ValueError('Number of subjects does not match regressor size')
+    return regressor, regressor_selected_cols
+
+
+def load_cwas_subjects(subject_files, mask_file, out_file=None,
+                       z_scored=False):
+    """
+    Loads the in-mask timeseries of every subject into one array
+
+    Parameters
+    ----------
+    subject_files : list of strings
+        nifti files of the subjects
+    mask_file : string
+        Path to a mask file in nifti format
+    out_file : string
+        Path of a .npy file the data is written into as a memory-mapped
+        array, so it can be shared between processes; the data is kept in
+        memory if None
+    z_scored : boolean
+        z-score each voxel timeseries while loading
 
+    Returns
+    -------
+    subjects_data : ndarray
+        (subjects, voxels, timepoints) data, float32 for single precision or
+        integer images
+
+    """
     mask = nb.load(mask_file).get_data().astype('bool')
     mask_indices = np.where(mask)
 
-    subjects_data = np.array([
-        nb.load(subject_file).get_data().astype('float64')[mask_indices].T
-        for subject_file in subject_files
-    ])
+    subjects_data = None
+    for si, subject_file in enumerate(subject_files):
+        img = nb.load(subject_file)
+        dtype = np.result_type(img.get_data_dtype(), np.float32)
+        data = np.asarray(img.get_data()[mask_indices], dtype=dtype)
+        if z_scored:
+            data = zscore(data, 1)
+
+        if subjects_data is None:
+            shape = (len(subject_files),) + data.shape
+            if out_file:
+                subjects_data = np.lib.format.open_memmap(
+                    out_file, mode='w+', dtype=dtype, shape=shape)
+            else:
+                subjects_data = np.zeros(shape, dtype=dtype)
+
+        subjects_data[si] = data
+
+    if out_file:
+        subjects_data.flush()
+
+    return subjects_data
+
+
+def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
+               columns_string, permutations, voxel_range, random_state=None,
+               mdmr_cache_dir=None, precision='float64'):
+    """
+    Performs CWAS for a group of subjects
+    
+    Parameters
+    ----------
+    subjects : dict of strings:strings
+        A length `N` dict of id and file paths of the nifti files of subjects
+    mask_file : string
+        Path to a mask file in nifti format
+    regressor_file : string
+        file path to regressor CSV or TSV file (phenotypic info)
+    columns_string : string
+        comma-separated string of regressor labels
+    permutations : integer
+        Number of pseudo f values to sample using a random permutation test
+    voxel_range : ndarray
+        Indexes from range of voxels (inside the mask) to perform cwas on.
+        Index ordering is based on the np.where(mask) command
+    random_state : integer
+        Seed of the permutations. When given, batches use the same
+        permutations and share the permuted hat matrices
+    mdmr_cache_dir : string
+        Directory where the permuted hat matrices are cached
+    precision : string
+        'float32' or 'float64', precision of the MDMR computations
+    
+    Returns
+    -------
+    F_file : string
+        .npy file of pseudo-F statistic calculated for every voxel
+    p_file : string
+        .npy file of significance probabilities of pseudo-F values
+    voxel_range : tuple
+        Passed on by the voxel_range provided in parameters, used to make parallelization
+        easier
+        
+    """
+    subject_ids = list(subjects.keys())
+    subject_files = list(subjects.values())
+
+    regressor, regressor_selected_cols = load_cwas_regressor(
+        regressor_file, participant_column, columns_string, subject_ids)
+
+    if len(subject_files) != regressor.shape[0]:
+        raise ValueError('Number of subjects does not match regressor size')
+
+    subjects_data = load_cwas_subjects(subject_files, mask_file)
 
     F_set, p_set = calc_cwas(subjects_data, regressor, regressor_selected_cols,
-                             permutations, voxel_range)
+                             permutations, voxel_range,
+                             random_state=random_state,
+                             cache_dir=mdmr_cache_dir, precision=precision,
+                             subdists_file=os.path.join(os.getcwd(),
+                                                        'subdists.npy'))
 
     cwd = os.getcwd()
     F_file = os.path.join(cwd, 'pseudo_F.npy')
@@ -181,6 +427,190 @@ def nifti_cwas(subjects, mask_file, regressor_file, participant_column,
     return F_file, p_file, voxel_range
 
 
+def cwas_batch_size(subjects, voxels, timepoints, memory_gb, processes,
+                    block_size=1, itemsize=8):
+    """
+    Number of voxels of a CWAS batch so that the batches running in parallel
+    stay within a memory budget
+
+    Parameters
+    ----------
+    subjects : integer
+    voxels : integer
+        Number of voxels in the mask
+    timepoints : integer
+    memory_gb : float
+        Memory budget shared by all the processes, in GB
+    processes : integer
+        Number of batches running at the same time
+    block_size : integer
+        Number of seed voxels of calc_subdists_blocked
+    itemsize : integer
+        Bytes of a value of the subject data
+
+    Returns
+    -------
+    batch_size : integer
+
+    """
+    budget = memory_gb * 1024 ** 3 / float(max(processes, 1))
+
+    # the blocked seed maps and permuted hat matrices are a fixed cost,
+    # the distance and Gower matrices (twice) grow with the batch
+    fixed = itemsize * block_size * subjects * (2 * voxels + timepoints) + \
+        8 * 100 * subjects ** 2
+    per_voxel = 8 * 3 * subjects ** 2
+
+    batch_size = int((budget - fixed) // per_voxel)
+    return int(np.clip(batch_size, 1, voxels))
+
+
+def cwas_batch_worker(args):
+    """
+    Runs CWAS on a batch of voxels of the shared, memory-mapped subject data
+    and writes its results into the shared output arrays
+    """
+    (data_file, F_file, p_file, regressor, regressor_selected_cols,
+     permutations, voxel_range, random_state, cache_dir, precision,
+     block_size) = args
+
+    subjects_data = np.load(data_file, mmap_mode='r')
+
+    F_set, p_set = calc_cwas(subjects_data, regressor, regressor_selected_cols,
+                             permutations, voxel_range,
+                             random_state=random_state, cache_dir=cache_dir,
+                             precision=precision, z_scored=True,
+                             block_size=block_size)
+
+    F_out = np.load(F_file, mmap_mode='r+')
+    p_out = np.load(p_file, mmap_mode='r+')
+    F_out[voxel_range] = F_set
+    p_out[voxel_range] = p_set
+    F_out.flush()
+    p_out.flush()
+
+    return len(voxel_range)
+
+
+def parallel_cwas(subjects, mask_file, regressor_file, participant_column,
+                  columns_string, permutations, processes=1, memory_gb=4.0,
+                  random_state=None, mdmr_cache_dir=None,
+                  precision='float64'):
+    """
+    Performs CWAS for a group of subjects, loading and z-scoring their data
+    once into a memory-mapped array shared by a pool of processes that each
+    run batches of voxels
+
+    The batch size is chosen so that the running batches stay within
+    memory_gb, and every batch writes its pseudo-F and p values straight
+    into preallocated output arrays.
+
+    Parameters
+    ----------
+    subjects : dict of strings:strings
+        A length `N` dict of id and file paths of the nifti files of subjects
+    mask_file : string
+        Path to a mask file in nifti format
+    regressor_file : string
+        file path to regressor CSV or TSV file (phenotypic info)
+    participant_column : string
+        name of the participant ID column of the regressor file
+    columns_string : string
+        comma-separated string of regressor labels
+    permutations : integer
+        Number of pseudo f values to sample using a random permutation test
+    processes : integer
+        Number of batches computed at the same time
+    memory_gb : float
+        Memory budget of the batches, in GB
+    random_state : integer
+        Seed of the permutations
+    mdmr_cache_dir : string
+        Directory where the permuted hat matrices are cached
+    precision : string
+        'float32' or 'float64', precision of the MDMR computations
+
+    Returns
+    -------
+    F_file : string
+        nifti file of the pseudo-F statistic
+    p_file : string
+        nifti file of the significance probabilities
+    log_p_file : string
+        nifti file of the -log10 significance probabilities
+
+    """
+    from multiprocessing import Pool
+
+    subject_ids = list(subjects.keys())
+    subject_files = list(subjects.values())
+
+    regressor, regressor_selected_cols = load_cwas_regressor(
+        regressor_file, participant_column, columns_string, subject_ids)
+
+    if len(subject_files) != regressor.shape[0]:
+        raise ValueError('Number of subjects does not match regressor size')
+
+    cwd = os.getcwd()
+    data_file = os.path.join(cwd, 'subjects_data.npy')
+    # the z-scored data of the subjects is only needed by the batches, and
+    # is removed even if one of them fails
+    try:
+        subjects_data = load_cwas_subjects(subject_files, mask_file,
+                                           out_file=data_file, z_scored=True)
+        n_subjects, voxels, timepoints = subjects_data.shape
+        itemsize = subjects_data.dtype.itemsize
+        del subjects_data
+
+        # every batch has to use the same permutations, computed once here
+        if random_state is None:
+            random_state = np.random.randint(np.iinfo(np.int32).max)
+        if not mdmr_cache_dir:
+            mdmr_cache_dir = os.path.join(cwd, 'mdmr_cache')
+        X1 = np.hstack((np.ones((n_subjects, 1)), regressor))
+        hat_bank(X1, regressor_selected_cols + 1, permutations,
+                 seed=random_state, cache_dir=mdmr_cache_dir, dtype=precision)
+
+        F_npy = os.path.join(cwd, 'pseudo_F.npy')
+        p_npy = os.path.join(cwd, 'significance_p.npy')
+        np.lib.format.open_memmap(F_npy, mode='w+', dtype=np.float64,
+                                  shape=(voxels,)).flush()
+        np.lib.format.open_memmap(p_npy, mode='w+', dtype=np.float64,
+                                  shape=(voxels,)).flush()
+
+        processes = max(int(processes), 1)
+
+        # a quarter of the budget of a process goes to the seed maps of its
+        # subject distances, the rest to the distances of its batch
+        block_size = subdists_block_size(n_subjects, voxels,
+                                         memory_gb / float(processes) / 4,
+                                         itemsize)
+        batch_size = cwas_batch_size(n_subjects, voxels, timepoints, memory_gb,
+                                     processes, block_size, itemsize)
+        batches = [np.arange(start, min(start + batch_size, voxels))
+                   for start in range(0, voxels, batch_size)]
+
+        jobs = [(data_file, F_npy, p_npy, regressor, regressor_selected_cols,
+                 permutations, voxel_range, random_state, mdmr_cache_dir,
+                 precision, block_size) for voxel_range in batches]
+
+        if processes > 1:
+            pool = Pool(processes)
+            try:
+                pool.map(cwas_batch_worker, jobs, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                cwas_batch_worker(job)
+    finally:
+        if os.path.isfile(data_file):
+            os.remove(data_file)
+
+    return write_cwas_volumes(np.load(F_npy), np.load(p_npy), mask_file)
+
+
 def create_cwas_batches(mask_file, batches):
     mask = nb.load(mask_file).get_data().astype('bool')
     voxels = mask.sum(dtype=int)
@@ -202,14 +632,18 @@ def merge_cwas_batches(cwas_batches, mask_file):
     _, _, voxel_range = zip(*cwas_batches)
     voxels = np.array(np.concatenate(voxel_range))
 
-    mask_image = nb.load(mask_file)
-
     F_set = np.zeros_like(voxels, dtype=np.float64)
     p_set = np.zeros_like(voxels, dtype=np.float64)
     for F_file, p_file, voxel_range in cwas_batches:
         F_set[voxel_range] = np.load(F_file)
         p_set[voxel_range] = np.load(p_file)
 
+    return write_cwas_volumes(F_set, p_set, mask_file)
+
+
+def write_cwas_volumes(F_set, p_set, mask_file):
+    mask_image = nb.load(mask_file)
+
     log_p_set = -np.log10(p_set)
 
     F_vol = volumize(mask_image, F_set)
@@ -107,3 +107,145 @@ def mdmr(D, X, columns, permutations):
 
     return F_perms[0, :], p_vals
 
+
+def gower_batch(Ds, dtype=np.float64):
+    # double-centering of -0.5 * D ** 2 for a stack of distance matrices,
+    # same as gower() applied to each of them
+    A = -0.5 * (np.asarray(Ds, dtype=dtype) ** 2)
+    G = A - A.mean(axis=1, keepdims=True) \
+          - A.mean(axis=2, keepdims=True) \
+          + A.mean(axis=(1, 2), keepdims=True)
+    return G
+
+def permutation_indexes(subjects, permutations, seed=None):
+    # the first row is the unpermuted design
+    rng = np.random.RandomState(seed) if seed is not None else np.random
+    indexes = np.zeros((permutations + 1, subjects), dtype=int)
+    indexes[0, :] = range(subjects)
+    for i in range(1, permutations + 1):
+        indexes[i, :] = rng.permutation(subjects)
+    return indexes
+
+def gen_h2_factors(x, cols, perms, dtype=np.float64):
+    # H2 = H(permuted design) - H(other columns) is the projection onto the
+    # permuted columns orthogonalized against the other columns, so it can be
+    # kept as an orthonormal (subjects, len(cols)) factor Q with H2 = Q Q'
+    nperms, nobs = perms.shape
+    other_cols = [i for i in range(x.shape[1]) if i not in cols]
+    IHj = np.eye(nobs, nobs) - hat(x[:, other_cols])
+
+    factors = np.zeros((nperms, nobs, len(cols)), dtype=dtype)
+    for i in range(nperms):
+        Q, _ = np.linalg.qr(IHj.dot(x[perms[i, :]][:, cols]))
+        factors[i] = Q
+    return factors
+
+def hat_bank_key(x, cols, permutations, seed, dtype):
+    import hashlib
+    h = hashlib.sha1()
+    h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    h.update(np.asarray(cols, dtype=np.int64).tobytes())
+    h.update(str((x.shape, permutations, seed, np.dtype(dtype).name))
+             .encode('utf-8'))
+    return h.hexdigest()
+
+def hat_bank(x, cols, permutations, seed=None, cache_dir=None,
+             dtype=np.float64):
+    # factors of the permuted H2 matrices, computed once per design and seed
+    # and shared on disk between voxel batches
+    import os
+    import tempfile
+
+    subjects = x.shape[0]
+
+    if seed is None or not cache_dir:
+        perms = permutation_indexes(subjects, permutations, seed)
+        return gen_h2_factors(x, cols, perms, dtype)
+
+    bank_file = os.path.join(cache_dir, 'mdmr_hat_bank_%s.npy' %
+                             hat_bank_key(x, cols, permutations, seed, dtype))
+
+    if not os.path.exists(bank_file):
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+        perms = permutation_indexes(subjects, permutations, seed)
+        factors = gen_h2_factors(x, cols, perms, dtype)
+
+        # write to a temporary file first, so that concurrent batches
+        # never load a partially written bank
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, factors)
+        os.rename(tmp_file, bank_file)
+
+        return factors
+
+    return np.load(bank_file, mmap_mode='r')
+
+def mdmr_blocked(D, X, columns, permutations, seed=None, block_size=100,
+                 dtype=np.float64, cache_dir=None, bank=None):
+    """
+    Same statistics as mdmr, but the permuted hat matrices are kept as a
+    bank of (subjects, len(columns)) factors (cached in cache_dir when a
+    seed is given) and the pseudo-F values are computed for block_size
+    permutations at a time, so that only block_size dense H2 matrices are
+    held in memory. A bank already returned by hat_bank for the same design
+    can be given to skip its computation.
+    """
+
+    check_rank(X)
+
+    subjects = X.shape[0]
+    if subjects != D.shape[1]:
+        raise Exception("# of subjects incompatible between X and D")
+
+    voxels = D.shape[0]
+    dtype = np.dtype(dtype)
+
+    Gs = gower_batch(D, dtype).reshape((voxels, subjects ** 2))
+
+    X1 = np.hstack((np.ones((subjects, 1)), X))
+    columns = np.asarray(columns).copy() + 1
+    other_columns = [i for i in range(X1.shape[1]) if i not in columns]
+
+    regressors = X1.shape[1]
+    df_among = len(columns)
+    df_resid = subjects - regressors
+
+    # SS_resid = tr(G) - tr(Hj G) - tr(H2 G), where Hj does not depend on
+    # the permutation
+    trace_G = np.trace(Gs.reshape((voxels, subjects, subjects)),
+                       axis1=1, axis2=2)
+    SS_other = Gs.dot(hat(X1[:, other_columns]).astype(dtype).flatten())
+
+    if bank is None:
+        bank = hat_bank(X1, columns, permutations, seed=seed,
+                        cache_dir=cache_dir, dtype=dtype)
+
+    block_size = max(int(block_size), 1)
+
+    F = None
+    greater = np.zeros(voxels, dtype=int)
+    for start in range(0, permutations + 1, block_size):
+        factors = np.asarray(bank[start:start + block_size], dtype=dtype)
+        H2s = np.einsum('pic,pjc->pij', factors, factors) \
+                .reshape((factors.shape[0], subjects ** 2))
+
+        SS_among = H2s.dot(Gs.T)
+        SS_resid = trace_G - SS_other - SS_among
+        F_block = (SS_among / df_among) / (SS_resid / df_resid)
+
+        if F is None:
+            F = F_block[0, :].copy()
+            F_block = F_block[1:, :]
+
+        greater += (F_block >= F).sum(axis=0)
+
+    p_vals = greater.astype('float') / permutations
+
+    return F, p_vals
@@ -11,10 +11,12 @@ from .cwas import (
     create_cwas_batches,
     merge_cwas_batches,
     nifti_cwas,
+    parallel_cwas,
 )
 
 
-def create_cwas(name='cwas', working_dir=None, crash_dir=None):
+def create_cwas(name='cwas', working_dir=None, crash_dir=None,
+                shared_memory=False):
     """
     Connectome Wide Association Studies
     
@@ -24,6 +26,10 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
     ----------
     name : string, optional
         Name of the workflow.
+    shared_memory : boolean, optional
+        Run every voxel batch in a single node, from a process pool sharing
+        the subject data loaded once into a memory-mapped array, instead of
+        one MapNode job per batch.
         
     Returns
     -------
@@ -47,6 +53,13 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
             Number of permutation samples to draw from the pseudo F distribution
         inputspec.parallel_nodes : integer
             Number of nodes to create and potentially parallelize over
+        inputspec.random_state : integer (optional)
+            Seed of the permutations; the permuted hat matrices are then
+            computed once and shared between batches
+        inputspec.precision : string (optional)
+            'float32' or 'float64' (default) MDMR precision
+        inputspec.memory_gb : float (optional)
+            Memory budget of the batches when using shared_memory
         
     Workflow Outputs::
 
@@ -95,7 +108,10 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                                                        'participant_column',
                                                        'columns',
                                                        'permutations',
-                                                       'parallel_nodes']),
+                                                       'parallel_nodes',
+                                                       'random_state',
+                                                       'precision',
+                                                       'memory_gb']),
                         name='inputspec')
 
     outputspec = pe.Node(util.IdentityInterface(fields=['F_map',
@@ -103,6 +119,66 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                                                         'neglog_p_map']),
                          name='outputspec')
 
+    jmask = pe.Node(Function(input_names=['subjects',
+                                          'mask_file'],
+                             output_names=['joint_mask'],
+                             function=joint_mask,
+                             as_module=True),
+                    name='joint_mask')
+
+    #Compute the joint mask
+    workflow.connect(inputspec, 'subjects',
+                     jmask, 'subjects')
+    workflow.connect(inputspec, 'roi',
+                     jmask, 'mask_file')
+
+    if shared_memory:
+        pcwas = pe.Node(Function(input_names=['subjects',
+                                              'mask_file',
+                                              'regressor_file',
+                                              'participant_column',
+                                              'columns_string',
+                                              'permutations',
+                                              'processes',
+                                              'memory_gb',
+                                              'random_state',
+                                              'mdmr_cache_dir',
+                                              'precision'],
+                                 output_names=['F_file',
+                                               'p_file',
+                                               'neglog_p_file'],
+                                 function=parallel_cwas,
+                                 as_module=True),
+                        name='cwas_volumes')
+        pcwas.inputs.mdmr_cache_dir = os.path.join(working_dir, 'mdmr_cache')
+
+        workflow.connect(jmask, 'joint_mask',
+                         pcwas, 'mask_file')
+        workflow.connect(inputspec, 'subjects',
+                         pcwas, 'subjects')
+        workflow.connect(inputspec, 'regressor',
+                         pcwas, 'regressor_file')
+        workflow.connect(inputspec, 'participant_column',
+                         pcwas, 'participant_column')
+        workflow.connect(inputspec, 'columns',
+                         pcwas, 'columns_string')
+        workflow.connect(inputspec, 'permutations',
+                         pcwas, 'permutations')
+        workflow.connect(inputspec, 'parallel_nodes',
+                         pcwas, 'processes')
+        workflow.connect(inputspec, 'memory_gb',
+                         pcwas, 'memory_gb')
+        workflow.connect(inputspec, 'random_state',
+                         pcwas, 'random_state')
+        workflow.connect(inputspec, 'precision',
+                         pcwas, 'precision')
+
+        workflow.connect(pcwas, 'F_file', outputspec, 'F_map')
+        workflow.connect(pcwas, 'p_file', outputspec, 'p_map')
+        workflow.connect(pcwas, 'neglog_p_file', outputspec, 'neglog_p_map')
+
+        return workflow
+
     ccb = pe.Node(Function(input_names=['mask_file',
                                         'batches'],
                            output_names='batch_list',
@@ -116,19 +192,16 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                                              'participant_column',
                                              'columns_string',
                                              'permutations',
-                                             'voxel_range'],
+                                             'voxel_range',
+                                             'random_state',
+                                             'mdmr_cache_dir',
+                                             'precision'],
                                 output_names=['result_batch'],
                                 function=nifti_cwas,
                                 as_module=True),
                        name='cwas_batch',
                        iterfield='voxel_range')
-
-    jmask = pe.Node(Function(input_names=['subjects',
-                                          'mask_file'],
-                             output_names=['joint_mask'],
-                             function=joint_mask,
-                             as_module=True),
-                    name='joint_mask')
+    ncwas.inputs.mdmr_cache_dir = os.path.join(working_dir, 'mdmr_cache')
 
     mcwasb = pe.Node(Function(input_names=['cwas_batches',
                                            'mask_file'],
@@ -139,12 +212,6 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                               as_module=True),
                      name='cwas_volumes')
 
-    #Compute the joint mask
-    workflow.connect(inputspec, 'subjects',
-                     jmask, 'subjects')
-    workflow.connect(inputspec, 'roi',
-                     jmask, 'mask_file')
-
     #Create batches based on the joint mask
     workflow.connect(jmask, 'joint_mask',
                      ccb, 'mask_file')
@@ -164,6 +231,10 @@ def create_cwas(name='cwas', working_dir=None, crash_dir=None):
                      ncwas, 'participant_column')
     workflow.connect(inputspec, 'columns',
                      ncwas, 'columns_string')
+    workflow.connect(inputspec, 'random_state',
+                     ncwas, 'random_state')
+    workflow.connect(inputspec, 'precision',
+                     ncwas, 'precision')
 
     workflow.connect(ccb, 'batch_list',
                      ncwas, 'voxel_range')
@@ -0,0 +1,104 @@
+import os
+import tempfile
+import numpy as np
+from CPAC.cwas.mdmr import mdmr, mdmr_blocked, gower, gower_batch
+
+
+def _distances(voxels=6, subjects=20, timepoints=15):
+    np.random.seed(7)
+    profiles = np.random.randn(voxels, subjects, timepoints)
+    D = np.zeros((voxels, subjects, subjects))
+    for v in range(voxels):
+        D[v] = np.sqrt(2.0 * (1.0 - np.corrcoef(profiles[v])))
+    X = np.random.randn(subjects, 3)
+    return D, X
+
+
+def test_gower_batch():
+    D, _ = _distances()
+    G = gower_batch(D)
+    for v in range(D.shape[0]):
+        np.testing.assert_allclose(G[v], gower(D[v]), atol=1e-12)
+
+
+def test_mdmr_blocked():
+    D, X = _distances()
+    columns = np.array([0, 2])
+
+    np.random.seed(42)
+    F, p = mdmr(D, X, columns, 50)
+
+    for block_size in [1, 7, 100]:
+        F_blocked, p_blocked = mdmr_blocked(D, X, columns, 50, seed=42,
+                                            block_size=block_size)
+        np.testing.assert_allclose(F_blocked, F, rtol=1e-8)
+        np.testing.assert_allclose(p_blocked, p)
+
+
+def test_mdmr_blocked_cache():
+    D, X = _distances()
+    columns = np.array([1])
+    cache_dir = tempfile.mkdtemp()
+
+    F, p = mdmr_blocked(D, X, columns, 30, seed=3, cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+
+    F_cached, p_cached = mdmr_blocked(D[:3], X, columns, 30, seed=3,
+                                      cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 1
+    np.testing.assert_allclose(F_cached, F[:3])
+    np.testing.assert_allclose(p_cached, p[:3])
+
+    F_single, _ = mdmr_blocked(D, X, columns, 30, seed=3,
+                               dtype=np.float32, cache_dir=cache_dir)
+    assert F_single.dtype == np.float32
+    assert len(os.listdir(cache_dir)) == 2
+    np.testing.assert_allclose(F_single, F, rtol=1e-3)
+
+
+def test_calc_subdists_blocked():
+    from CPAC.cwas.cwas import calc_subdists, calc_subdists_blocked, \
+        subdists_block_size
+
+    np.random.seed(11)
+    subjects_data = np.random.randn(5, 40, 25)
+    subjects_data[2, 7] = 1.0
+    voxel_range = np.array([0, 3, 7, 8, 21, 39])
+
+    D = calc_subdists(subjects_data, voxel_range)
+
+    out_file = os.path.join(tempfile.mkdtemp(), 'subdists.npy')
+    for block_size in [1, 4, 10]:
+        D_blocked = calc_subdists_blocked(subjects_data, voxel_range,
+                                          block_size=block_size,
+                                          out_file=out_file)
+        np.testing.assert_allclose(np.load(out_file), D, atol=1e-6)
+        np.testing.assert_allclose(D_blocked, D, atol=1e-6)
+
+    # the block size fits the seed maps in the memory budget
+    np.testing.assert_allclose(
+        calc_subdists_blocked(subjects_data, voxel_range,
+                              memory_gb=4 * 2 * 8 * 5 * 40 / 1024. ** 3),
+        D, atol=1e-6
+    )
+    assert subdists_block_size(5, 40, 4 * 2 * 8 * 5 * 40 / 1024. ** 3) == 4
+
+    # single precision data is not copied to double precision
+    D_single = calc_subdists_blocked(subjects_data.astype(np.float32),
+                                     voxel_range, block_size=4)
+    np.testing.assert_allclose(D_single, D, atol=1e-5)
+
+
+def test_calc_mdmrs_voxel_blocks():
+    from CPAC.cwas.cwas import calc_mdmrs
+
+    D, X = _distances()
+    d_file = os.path.join(tempfile.mkdtemp(), 'subdists.npy')
+    np.save(d_file, D)
+
+    F, p = mdmr_blocked(D, X, np.array([0]), 20, seed=5)
+    F_file, p_file = calc_mdmrs(d_file, X, [0], 20, random_state=5,
+                                voxel_block_size=4)
+
+    np.testing.assert_allclose(F_file, F)
+    np.testing.assert_allclose(p_file, p)
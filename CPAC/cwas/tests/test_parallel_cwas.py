@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import nibabel as nb
+import pytest
+from CPAC.cwas.cwas import nifti_cwas, parallel_cwas, load_cwas_regressor
+
+
+def _write_inputs(out_dir, subjects=8):
+    np.random.seed(0)
+
+    subject_files = {}
+    for i in range(subjects):
+        subject_file = os.path.join(out_dir, 'sub%d.nii.gz' % i)
+        nb.Nifti1Image(np.random.randn(4, 4, 3, 20),
+                       np.eye(4)).to_filename(subject_file)
+        subject_files['%04d' % (i + 1)] = subject_file
+
+    mask = np.ones((4, 4, 3))
+    mask[0, 0, :] = 0
+    mask_file = os.path.join(out_dir, 'mask.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+
+    regressor_file = os.path.join(out_dir, 'regressor.csv')
+    with open(regressor_file, 'w') as f:
+        f.write('age,sex,participant\n')
+        for i in range(subjects):
+            f.write('%f,%d,%d\n' % (np.random.rand(), i % 2, i + 1))
+
+    return subject_files, mask_file, regressor_file
+
+
+def test_load_cwas_regressor(tmpdir):
+    out_dir = str(tmpdir)
+    subjects, _, regressor_file = _write_inputs(out_dir)
+    subject_ids = ['0003', '0001', '0002']
+
+    regressor, cols = load_cwas_regressor(regressor_file, 'participant',
+                                          'sex', subject_ids)
+
+    np.testing.assert_array_equal(regressor[:, 1], [0, 0, 1])
+    np.testing.assert_array_equal(cols, [1])
+
+
+def test_parallel_cwas(tmpdir, monkeypatch):
+    out_dir = str(tmpdir)
+    monkeypatch.chdir(out_dir)
+    subjects, mask_file, regressor_file = _write_inputs(out_dir)
+    voxels = int(nb.load(mask_file).get_data().sum())
+
+    F_npy, p_npy, _ = nifti_cwas(subjects, mask_file, regressor_file,
+                                 'participant', 'sex', 30,
+                                 np.arange(voxels), random_state=9)
+    F, p = np.load(F_npy), np.load(p_npy)
+
+    for processes, memory_gb in [(1, 4.0), (2, 1e-4)]:
+        F_file, p_file, log_p_file = parallel_cwas(
+            subjects, mask_file, regressor_file, 'participant', 'sex', 30,
+            processes=processes, memory_gb=memory_gb, random_state=9)
+
+        mask = nb.load(mask_file).get_data().astype(bool)
+        np.testing.assert_allclose(nb.load(F_file).get_data()[mask], F)
+        np.testing.assert_allclose(nb.load(p_file).get_data()[mask], p)
+        assert not os.path.exists(os.path.join(out_dir, 'subjects_data.npy'))
+
+
+def test_parallel_cwas_failed_batch(tmpdir, monkeypatch):
+    from CPAC.cwas import cwas
+
+    out_dir = str(tmpdir)
+    monkeypatch.chdir(out_dir)
+    subjects, mask_file, regressor_file = _write_inputs(out_dir)
+
+    def failed_batch(args):
+        raise MemoryError('batch failed')
+
+    monkeypatch.setattr(cwas, 'cwas_batch_worker', failed_batch)
+
+    # the z-scored data is removed even when a batch fails
+    with pytest.raises(MemoryError):
+        parallel_cwas(subjects, mask_file, regressor_file, 'participant',
+                      'sex', 30, random_state=9)
+    assert not os.path.exists(os.path.join(out_dir, 'subjects_data.npy'))
+
+
+def test_cwas_workflow_hat_bank_cache(tmpdir, monkeypatch):
+    from CPAC.cwas import mdmr
+    from CPAC.cwas.pipeline import create_cwas
+
+    out_dir = str(tmpdir)
+    subjects, mask_file, regressor_file = _write_inputs(out_dir)
+
+    calls = []
+    gen_h2_factors = mdmr.gen_h2_factors
+
+    def counted_gen_h2_factors(*args, **kwargs):
+        calls.append(args)
+        return gen_h2_factors(*args, **kwargs)
+
+    monkeypatch.setattr(mdmr, 'gen_h2_factors', counted_gen_h2_factors)
+
+    work_dir = os.path.join(out_dir, 'work')
+    workflow = create_cwas('cwas', work_dir, os.path.join(out_dir, 'crash'))
+    workflow.inputs.inputspec.roi = mask_file
+    workflow.inputs.inputspec.subjects = subjects
+    workflow.inputs.inputspec.regressor = regressor_file
+    workflow.inputs.inputspec.participant_column = 'participant'
+    workflow.inputs.inputspec.columns = 'sex'
+    workflow.inputs.inputspec.permutations = 30
+    workflow.inputs.inputspec.parallel_nodes = 3
+    workflow.inputs.inputspec.random_state = 9
+    workflow.inputs.inputspec.precision = 'float64'
+    workflow.run(plugin='Linear')
+
+    # the three batches of voxels share the hat bank of the seed
+    assert len(calls) == 1
+    assert len(os.listdir(os.path.join(work_dir, 'mdmr_cache'))) == 1
@@ -3,7 +3,11 @@ from generate_motion_statistics import (motion_power_statistics,
                                         calculate_FD_J,
                                         gen_motion_parameters,
                                         gen_power_parameters,
-                                        calculate_DVARS)
+                                        calculate_DVARS,
+                                        calculate_motion_statistics,
+                                        framewise_displacement_power,
+                                        framewise_displacement_jenkinson,
+                                        streaming_DVARS)
 
 __all__ = [
     'motion_power_statistics',
@@ -11,5 +15,9 @@ __all__ = [
     'calculate_FD_J',
     'gen_motion_parameters',
     'gen_power_parameters',
-    'calculate_DVARS'
+    'calculate_DVARS',
+    'calculate_motion_statistics',
+    'framewise_displacement_power',
+    'framewise_displacement_jenkinson',
+    'streaming_DVARS'
 ]
\ No newline at end of file
@@ -190,88 +190,32 @@ def motion_power_statistics(name='motion_stats'):
                                                         'motion_params']),
                          name='outputspec')
 
-    cal_DVARS = pe.Node(Function(input_names=['rest',
-                                              'mask'],
-                                 output_names=['out_file'],
-                                 function=calculate_DVARS,
-                                 as_module=True),
-                        name='cal_DVARS')
-
-    # calculate mean DVARS
-    wf.connect(input_node, 'motion_correct', cal_DVARS, 'rest')
-    wf.connect(input_node, 'mask', cal_DVARS, 'mask')
-
-    wf.connect(cal_DVARS, 'out_file',
-               output_node, 'DVARS_1D')
-
-    # Calculating mean Framewise Displacement as per power et al., 2012
-    calculate_FDP = pe.Node(Function(input_names=['in_file'],
-                                     output_names=['out_file'],
-                                     function=calculate_FD_P,
-                                     as_module=True),
-                            name='calculate_FD')
-
-    wf.connect(input_node, 'movement_parameters',
-               calculate_FDP, 'in_file')
-    wf.connect(calculate_FDP, 'out_file',
-               output_node, 'FDP_1D')
-
-    # Calculating mean Framewise Displacement as per jenkinson et al., 2002
-    calculate_FDJ = pe.Node(Function(input_names=['in_file'],
-                                     output_names=['out_file'],
-                                     function=calculate_FD_J,
-                                     as_module=True),
-                            name='calculate_FDJ')
-
-    wf.connect(input_node, 'transformations',
-               calculate_FDJ, 'in_file')
-    wf.connect(calculate_FDJ, 'out_file',
-               output_node, 'FDJ_1D')
-
-    calc_motion_parameters = pe.Node(Function(input_names=["subject_id",
-                                                           "scan_id",
-                                                           "movement_parameters",
-                                                           "max_displacement"],
-                                              output_names=['out_file'],
-                                              function=gen_motion_parameters,
+    # FD (Power and Jenkinson), DVARS and the summary parameters are
+    # computed together, reading each input once
+    calc_motion_statistics = pe.Node(Function(input_names=['subject_id',
+                                                           'scan_id',
+                                                           'movement_parameters',
+                                                           'max_displacement',
+                                                           'transformations',
+                                                           'motion_correct',
+                                                           'mask'],
+                                              output_names=['FDP_1D',
+                                                            'FDJ_1D',
+                                                            'DVARS_1D',
+                                                            'power_params',
+                                                            'motion_params'],
+                                              function=calculate_motion_statistics,
                                               as_module=True),
-                                     name='calc_motion_parameters')
-
-    wf.connect(input_node, 'subject_id',
-               calc_motion_parameters, 'subject_id')
-    wf.connect(input_node, 'scan_id',
-               calc_motion_parameters, 'scan_id')
-    wf.connect(input_node, 'movement_parameters',
-               calc_motion_parameters, 'movement_parameters')
-    wf.connect(input_node, 'max_displacement',
-               calc_motion_parameters, 'max_displacement')
-
-    wf.connect(calc_motion_parameters, 'out_file',
-               output_node, 'motion_params')
-
-    calc_power_parameters = pe.Node(Function(input_names=["subject_id",
-                                                          "scan_id",
-                                                          "fdp",
-                                                          "fdj",
-                                                          "dvars"],
-                                             output_names=['out_file'],
-                                             function=gen_power_parameters,
-                                             as_module=True),
-                                    name='calc_power_parameters')
-
-    wf.connect(input_node, 'subject_id',
-               calc_power_parameters, 'subject_id')
-    wf.connect(input_node, 'scan_id',
-               calc_power_parameters, 'scan_id')
-    wf.connect(cal_DVARS, 'out_file',
-               calc_power_parameters, 'dvars')
-    wf.connect(calculate_FDP, 'out_file',
-               calc_power_parameters, 'fdp')
-    wf.connect(calculate_FDJ, 'out_file',
-               calc_power_parameters, 'fdj')
-
-    wf.connect(calc_power_parameters, 'out_file',
-               output_node, 'power_params')
+                                     name='calc_motion_statistics')
+
+    for field in ['subject_id', 'scan_id', 'movement_parameters',
+                  'max_displacement', 'transformations', 'motion_correct',
+                  'mask']:
+        wf.connect(input_node, field, calc_motion_statistics, field)
+
+    for field in ['FDP_1D', 'FDJ_1D', 'DVARS_1D', 'power_params',
+                  'motion_params']:
+        wf.connect(calc_motion_statistics, field, output_node, field)
 
     return wf
 
@@ -382,13 +326,39 @@ def gen_motion_parameters(subject_id, scan_id, movement_parameters,
 
     mot = np.genfromtxt(movement_parameters).T
 
-    # Relative RMS of translation
-    rms = np.sqrt(mot[3] ** 2 + mot[4] ** 2 + mot[5] ** 2)
-
     # remove any other information other than matrix from
     # max displacement file. AFNI adds information to the file
     maxdisp = np.loadtxt(max_displacement)
 
+    return write_motion_parameters(subject_id, scan_id, mot, maxdisp)
+
+
+def write_motion_parameters(subject_id, scan_id, mot, maxdisp):
+    """
+    Method to write the movement parameters
+
+    Parameters
+    ----------
+    subject_id : string
+        subject name or id
+    scan_id : string
+        scan name or id
+    mot : ndarray
+        six movement/motion parameters (3 Rotations, 3 Translations) in
+        rows, one column per volume
+    maxdisp : ndarray
+        maximum displacement (in mm) for brain voxels in each volume
+
+    Returns
+    -------
+    out_file : string
+        path to csv file containing various motion parameters
+
+    """
+
+    # Relative RMS of translation
+    rms = np.sqrt(mot[3] ** 2 + mot[4] ** 2 + mot[5] ** 2)
+
     abs_relative = lambda v: np.abs(np.diff(v))
     max_relative = lambda v: np.max(abs_relative(v))
     avg_relative = lambda v: np.mean(abs_relative(v))
@@ -472,6 +442,34 @@ def gen_power_parameters(subject_id, scan_id, fdp, fdj, dvars):
     fdj_data = np.loadtxt(fdj)
     dvars_data = np.loadtxt(dvars)
 
+    return write_power_parameters(subject_id, scan_id,
+                                  fdp_data, fdj_data, dvars_data)
+
+
+def write_power_parameters(subject_id, scan_id, fdp_data, fdj_data,
+                           dvars_data):
+    """
+    Method to write the Power parameters for scrubbing
+
+    Parameters
+    ----------
+    subject_id : string
+        subject name or id
+    scan_id : string
+        scan name or id
+    fdp_data : ndarray
+        framewise displacement (FD as per power et al., 2012)
+    fdj_data : ndarray
+        framewise displacement (FD as per jenkinson et al., 2002)
+    dvars_data : ndarray
+        DVARS
+
+    Returns
+    -------
+    out_file : string (csv file)
+        path to csv file containing all the pow parameters
+    """
+
     # Mean (across time/frames) of the absolute values
     # for Framewise Displacement (FD)
     meanFD_Power  = np.mean(fdp_data)
@@ -542,3 +540,182 @@ def calculate_DVARS(rest, mask):
     out_file = os.path.join(os.getcwd(), 'DVARS.txt')
     np.savetxt(out_file, dvars)
     return out_file
+
+
+def framewise_displacement_power(motion_params):
+    """
+    Method to calculate Framewise Displacement (FD) as per Power et al., 2012
+
+    Parameters
+    ----------
+    motion_params : ndarray
+        six movement parameters (3 Rotations in degrees, 3 Translations in
+        mm) in columns, one row per volume
+
+    Returns
+    -------
+    fd : ndarray
+        Frame-wise displacement of each volume, 0 for the first one
+
+    """
+
+    motion_params = np.atleast_2d(motion_params)
+
+    displacement = np.abs(np.diff(motion_params, axis=0))
+
+    fd = np.zeros(motion_params.shape[0])
+    fd[1:] = displacement[:, 3:6].sum(1) + \
+        (50 * np.pi / 180) * displacement[:, 0:3].sum(1)
+
+    return fd
+
+
+def framewise_displacement_jenkinson(transformations, rmax=80.0):
+    """
+    Method to calculate framewise displacement as per Jenkinson et al. 2002,
+    for all the volumes at once
+
+    Parameters
+    ----------
+    transformations : ndarray
+        first three rows of the 4x4 volume alignment matrices, flattened,
+        one row per volume
+    rmax : float
+        radius (in mm) of the sphere representing the brain, as in FSL
+
+    Returns
+    -------
+    fd : ndarray
+        Frame-wise displacement of each volume, 0 for the first one
+
+    """
+
+    transformations = np.atleast_2d(transformations)
+
+    T_rb = np.zeros((transformations.shape[0], 4, 4))
+    T_rb[:, :3, :] = transformations[:, :12].reshape(-1, 3, 4)
+    T_rb[:, 3, 3] = 1.0
+
+    # relative transformation between each pair of consecutive volumes
+    M = np.einsum('tij,tjk->tik', T_rb[1:], np.linalg.inv(T_rb[:-1]))
+    M -= np.eye(4)
+
+    A = M[:, 0:3, 0:3]
+    b = M[:, 0:3, 3]
+
+    fd = np.zeros(T_rb.shape[0])
+    fd[1:] = np.sqrt(
+        (rmax * rmax / 5) * np.square(A).sum(axis=(1, 2)) +
+        np.square(b).sum(1)
+    )
+
+    return fd
+
+
+def streaming_DVARS(rest, mask):
+    """
+    Method to calculate DVARS as per power's method, reading the functional
+    data one volume at a time, so only two volumes of the brain voxels are
+    held in memory
+
+    Parameters
+    ----------
+    rest : string (nifti file)
+        path to motion correct functional data
+    mask : string (nifti file)
+        path to brain only mask for functional data
+
+    Returns
+    -------
+    dvars : ndarray
+        DVARS of each volume but the first one
+    """
+
+    # keep the file open, so consecutive volumes of gzipped images are
+    # decompressed in a single pass
+    rest_img = nb.load(rest, keep_file_open=True)
+    mask_data = nb.load(mask).get_data().astype('bool')
+
+    if rest_img.shape[:3] != mask_data.shape:
+        raise ValueError('The data in {0} and {1} do not have a consistent '
+                         'shape'.format(rest, mask))
+
+    dvars = np.zeros(rest_img.shape[3] - 1)
+
+    previous = np.asarray(rest_img.dataobj[..., 0])[mask_data]
+    previous = previous.astype(np.float64)
+
+    for t in range(1, rest_img.shape[3]):
+        current = np.asarray(rest_img.dataobj[..., t])[mask_data]
+        current = current.astype(np.float64)
+
+        # root mean square of the relative intensity change inside the mask
+        dvars[t - 1] = np.sqrt(np.mean(np.square(current - previous)))
+
+        previous = current
+
+    return dvars
+
+
+def calculate_motion_statistics(subject_id, scan_id, movement_parameters,
+                                max_displacement, transformations,
+                                motion_correct, mask):
+    """
+    Method to calculate FD (Power and Jenkinson), DVARS, and the motion and
+    Power parameters together, reading each input a single time
+
+    Parameters
+    ----------
+    subject_id : string
+        subject name or id
+    scan_id : string
+        scan name or id
+    movement_parameters : string
+        path of 1D file containing six movement/motion parameters(3 Translation,
+        3 Rotations) in different columns (roll pitch yaw dS  dL  dP)
+    max_displacement : string
+        path of file with maximum displacement (in mm) for brain voxels in each volume
+    transformations : string
+        matrix transformations from volume alignment file path
+    motion_correct : string (nifti file)
+        path to motion correct functional data
+    mask : string (nifti file)
+        path to brain only mask for functional data
+
+    Returns
+    -------
+    fdp_file : string
+        Frame-wise displacement (Power) file path
+    fdj_file : string
+        Frame-wise displacement (Jenkinson) file path
+    dvars_file : string
+        DVARS file path
+    power_params : string
+        path to csv file containing all the pow parameters
+    motion_params : string
+        path to csv file containing various motion parameters
+
+    """
+
+    mot = np.genfromtxt(movement_parameters)
+    maxdisp = np.loadtxt(max_displacement)
+
+    fdp = framewise_displacement_power(mot)
+    fdj = framewise_displacement_jenkinson(np.genfromtxt(transformations))
+    dvars = streaming_DVARS(motion_correct, mask)
+
+    fdp_file = os.path.join(os.getcwd(), 'FD.1D')
+    np.savetxt(fdp_file, fdp)
+
+    fdj_file = os.path.join(os.getcwd(), 'FD_J.1D')
+    np.savetxt(fdj_file, fdj, fmt='%.8f')
+
+    dvars_file = os.path.join(os.getcwd(), 'DVARS.txt')
+    np.savetxt(dvars_file, dvars)
+
+    power_params = write_power_parameters(subject_id, scan_id,
+                                          fdp, fdj, dvars)
+    motion_params = write_motion_parameters(subject_id, scan_id,
+                                            np.atleast_2d(mot).T, maxdisp)
+
+    return fdp_file, fdj_file, dvars_file, power_params, motion_params
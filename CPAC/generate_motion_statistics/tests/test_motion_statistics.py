@@ -0,0 +1,90 @@
+import os
+import numpy as np
+import nibabel as nb
+
+from CPAC.generate_motion_statistics.generate_motion_statistics import (
+    calculate_DVARS,
+    calculate_FD_J,
+    calculate_FD_P,
+    calculate_motion_statistics,
+    gen_motion_parameters,
+    gen_power_parameters
+)
+
+
+def rotation(angles):
+    rx, ry, rz = angles
+    Rx = np.array([[1, 0, 0],
+                   [0, np.cos(rx), -np.sin(rx)],
+                   [0, np.sin(rx), np.cos(rx)]])
+    Ry = np.array([[np.cos(ry), 0, np.sin(ry)],
+                   [0, 1, 0],
+                   [-np.sin(ry), 0, np.cos(ry)]])
+    Rz = np.array([[np.cos(rz), -np.sin(rz), 0],
+                   [np.sin(rz), np.cos(rz), 0],
+                   [0, 0, 1]])
+    return Rx.dot(Ry).dot(Rz)
+
+
+def motion_data(dl_dir, shape=(10, 9, 8), timepoints=50, seed=42):
+
+    rng = np.random.RandomState(seed)
+
+    movement = np.cumsum(rng.randn(timepoints, 6) * 0.05, axis=0)
+    transformations = np.array([
+        np.hstack([rotation(np.radians(m[:3])), m[3:, np.newaxis]]).ravel()
+        for m in movement
+    ])
+    maxdisp = np.abs(rng.randn(timepoints))
+
+    data = (rng.randn(*(shape + (timepoints,))) * 10 + 100)
+    data = data.astype(np.float32)
+    mask = (rng.rand(*shape) > 0.3).astype(np.int16)
+
+    paths = {}
+    for name, values in [('movement', movement),
+                         ('transformations', transformations),
+                         ('maxdisp', maxdisp)]:
+        paths[name] = os.path.join(dl_dir, '{0}.1D'.format(name))
+        np.savetxt(paths[name], values)
+
+    paths['functional'] = os.path.join(dl_dir, 'functional.nii.gz')
+    paths['mask'] = os.path.join(dl_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(paths['functional'])
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(paths['mask'])
+
+    return paths
+
+
+def reference_statistics(paths):
+    fdp = calculate_FD_P(paths['movement'])
+    fdj = calculate_FD_J(paths['transformations'])
+    dvars = calculate_DVARS(paths['functional'], paths['mask'])
+    power_params = gen_power_parameters('sub-1', 'rest', fdp, fdj, dvars)
+    motion_params = gen_motion_parameters('sub-1', 'rest',
+                                          paths['movement'],
+                                          paths['maxdisp'])
+
+    return [np.loadtxt(fdp), np.loadtxt(fdj), np.loadtxt(dvars),
+            open(power_params).read(), open(motion_params).read()]
+
+
+def test_calculate_motion_statistics(tmpdir, monkeypatch):
+
+    # the statistics are written in the working directory
+    monkeypatch.chdir(str(tmpdir))
+
+    paths = motion_data(str(tmpdir))
+    expected = reference_statistics(paths)
+
+    out_files = calculate_motion_statistics(
+        'sub-1', 'rest', paths['movement'], paths['maxdisp'],
+        paths['transformations'], paths['functional'], paths['mask']
+    )
+
+    for out_file, reference in zip(out_files[:3], expected[:3]):
+        assert np.allclose(np.loadtxt(out_file), reference, rtol=1e-5)
+
+    for out_file, reference in zip(out_files[3:], expected[3:]):
+        assert open(out_file).read() == reference
+
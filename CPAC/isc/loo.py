@@ -0,0 +1,200 @@
+import numpy as np
+
+
+def normalize(X):
+    # divides centered (voxels, timepoints, subjects) data by its norm in
+    # place, so that the dot product of two normalized timeseries is their
+    # correlation; constant timeseries are set to zero, as
+    # CPAC.utils.zscore does
+    norm = np.sqrt(np.einsum('vts,vts->vs', X, X))[:, np.newaxis, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        X /= norm
+    X[np.broadcast_to(norm == 0, X.shape)] = 0.0
+    return X
+
+
+def loo_zscores(D):
+    """
+    Normalizes every subject's timeseries and the matching leave-one-out
+    timeseries once
+
+    The mean of the other subjects is proportional to the sum of all the
+    subjects minus the left-out subject, and correlations do not depend on
+    that scale, so the leave-one-out timeseries are derived from the group
+    sum of the centered data.
+
+    Parameters
+    ----------
+    D : ndarray
+        (voxels, timepoints, subjects) data
+
+    Returns
+    -------
+    Zx : ndarray
+        (voxels, timepoints, subjects) normalized subject timeseries
+    Zy : ndarray
+        (voxels, timepoints, subjects) normalized leave-one-out timeseries
+
+    """
+    Zx = np.array(D, dtype=np.float64)
+    Zx -= Zx.mean(axis=1, keepdims=True)
+
+    Zy = Zx.sum(axis=2, keepdims=True) - Zx
+
+    return normalize(Zx), normalize(Zy)
+
+
+def isc_loo(D, collapse_subj=True):
+    """
+    Leave-one-out inter-subject correlation of every voxel
+
+    Parameters
+    ----------
+    D : ndarray
+        (voxels, timepoints, subjects) data
+    collapse_subj : boolean
+        Average the correlations over the subjects
+
+    Returns
+    -------
+    ISC : ndarray
+        (voxels,) correlations, or (subjects, voxels) if not collapse_subj
+
+    """
+    Zx, Zy = loo_zscores(D)
+    ISC = np.clip(np.einsum('vts,vts->sv', Zx, Zy), -1.0, 1.0)
+
+    if collapse_subj:
+        return ISC.mean(axis=0)
+
+    return ISC
+
+
+def isfc_loo_tiles(Zx, Zy, collapse_subj=True, block_size=None):
+    """
+    Yields the leave-one-out inter-subject functional correlations tile by
+    tile, from the output of loo_zscores
+
+    Every tile is symmetrized like CPAC.utils.correlation(symmetric=True).
+    Collapsed tiles are computed with a single product over all the
+    subjects' timepoints.
+
+    Parameters
+    ----------
+    Zx, Zy : ndarray
+        Output of loo_zscores
+    collapse_subj : boolean
+        Average the correlations over the subjects
+    block_size : integer
+        Number of voxels in the rows and columns of a tile; all the voxels
+        if None
+
+    Yields
+    ------
+    rows : slice
+    columns : slice
+    tile : ndarray
+        (rows, columns) correlations, or (rows, columns, subjects) if not
+        collapse_subj
+
+    """
+    n_vox, n_time, n_subj = Zx.shape
+
+    if not block_size:
+        block_size = n_vox
+
+    def products(rows, columns):
+        if collapse_subj:
+            return Zx[rows].reshape((-1, n_time * n_subj)).dot(
+                Zy[columns].reshape((-1, n_time * n_subj)).T) / n_subj
+        return np.einsum('its,jts->ijs', Zx[rows], Zy[columns])
+
+    for row_start in range(0, n_vox, block_size):
+        rows = slice(row_start, min(row_start + block_size, n_vox))
+        for column_start in range(0, n_vox, block_size):
+            columns = slice(column_start,
+                            min(column_start + block_size, n_vox))
+
+            tile = products(rows, columns)
+            if rows == columns:
+                tile = (tile + np.swapaxes(tile, 0, 1)) / 2
+            else:
+                tile = (tile + np.swapaxes(products(columns, rows),
+                                           0, 1)) / 2
+
+            yield rows, columns, np.clip(tile, -1.0, 1.0)
+
+
+def isfc_loo(D, collapse_subj=True, block_size=None, out_file=None):
+    """
+    Leave-one-out inter-subject functional correlation between every pair of
+    voxels, computed tile by tile
+
+    Parameters
+    ----------
+    D : ndarray
+        (voxels, timepoints, subjects) data
+    collapse_subj : boolean
+        Average the correlations over the subjects
+    block_size : integer
+        Number of voxels in the rows and columns of a tile
+    out_file : string
+        Path of a .npy file the correlations are written into as a
+        memory-mapped array; kept in memory if None
+
+    Returns
+    -------
+    ISFC : ndarray
+        (voxels, voxels) correlations, or (voxels, voxels, subjects) if not
+        collapse_subj
+
+    """
+    Zx, Zy = loo_zscores(D)
+    n_vox, _, n_subj = Zx.shape
+
+    shape = (n_vox, n_vox) if collapse_subj else (n_vox, n_vox, n_subj)
+    if out_file:
+        ISFC = np.lib.format.open_memmap(out_file, mode='w+',
+                                         dtype=np.float64, shape=shape)
+    else:
+        ISFC = np.zeros(shape)
+
+    for rows, columns, tile in isfc_loo_tiles(Zx, Zy, collapse_subj,
+                                              block_size):
+        ISFC[rows, columns] = tile
+
+    if out_file:
+        ISFC.flush()
+
+    return ISFC
+
+
+def isfc_loo_null(D, collapse_subj=True, block_size=None):
+    """
+    Minimum and maximum leave-one-out inter-subject functional correlation,
+    without storing the correlation matrix
+
+    Parameters
+    ----------
+    D : ndarray
+        (voxels, timepoints, subjects) data
+    collapse_subj : boolean
+        Average the correlations over the subjects
+    block_size : integer
+        Number of voxels in the rows and columns of a tile
+
+    Returns
+    -------
+    min_null : float
+    max_null : float
+
+    """
+    Zx, Zy = loo_zscores(D)
+
+    min_null = 1
+    max_null = -1
+    for _, _, tile in isfc_loo_tiles(Zx, Zy, collapse_subj, block_size):
+        min_null = min(np.min(tile), min_null)
+        max_null = max(np.max(tile), max_null)
+
+    return min_null, max_null
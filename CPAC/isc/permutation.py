@@ -0,0 +1,239 @@
+import numpy as np
+
+from CPAC.utils import check_random_state
+
+from .loo import isc_loo, isfc_loo_null
+
+
+def permutation_random_state(random_state, permutation):
+    """
+    Random state of a single permutation, so that a permutation draws the
+    same phases whichever batch or process computes it
+
+    Parameters
+    ----------
+    random_state : integer or None
+        Seed shared by all the permutations
+    permutation : integer
+        Index of the permutation
+
+    Returns
+    -------
+    random_state : np.random.RandomState
+
+    """
+    if random_state is None:
+        return check_random_state(None)
+    return np.random.RandomState([int(random_state), int(permutation)])
+
+
+def phase_shifts(n_vox, n_time, n_subj, random_state):
+    # same draw as CPAC.isc.utils.phase_randomize, for the positive
+    # frequencies between DC and Nyquist
+    n_freq = (n_time - 1) // 2
+    return random_state.rand(n_vox, n_freq, n_subj) * 2 * np.pi
+
+
+def phase_randomize_spectrum(F, n_time, random_states):
+    """
+    Phase-randomizes precomputed real FFTs for several random states at once
+
+    Parameters
+    ----------
+    F : ndarray
+        (voxels, frequencies, subjects) output of np.fft.rfft(D, axis=1)
+    n_time : integer
+        Number of timepoints of D
+    random_states : list of np.random.RandomState
+        One random state per randomization
+
+    Returns
+    -------
+    D : ndarray
+        (randomizations, voxels, timepoints, subjects) randomized data
+
+    """
+    n_vox, _, n_subj = F.shape
+    n_freq = (n_time - 1) // 2
+
+    randomized = np.empty((len(random_states),) + F.shape, dtype=F.dtype)
+    randomized[:] = F
+    for i, random_state in enumerate(random_states):
+        shift = phase_shifts(n_vox, n_time, n_subj, random_state)
+        randomized[i, :, 1:n_freq + 1, :] *= np.exp(1j * shift)
+
+    return np.fft.irfft(randomized, n=n_time, axis=2)
+
+
+def permutation_batch_size(voxels, timepoints, subjects, memory_gb,
+                           processes=1, permutations=None):
+    """
+    Number of permutations randomized at once so that the processes running
+    permutation_null stay within a memory budget
+
+    Parameters
+    ----------
+    voxels : integer
+        Number of voxels in the mask
+    timepoints : integer
+    subjects : integer
+    memory_gb : float
+        Memory budget shared by all the processes, in GB
+    processes : integer
+        Number of processes running at the same time
+    permutations : integer
+        Number of permutations of a process, the largest useful batch
+
+    Returns
+    -------
+    batch_size : integer
+
+    """
+    budget = memory_gb * 1024 ** 3 / float(max(processes, 1))
+    frequencies = timepoints // 2 + 1
+
+    # the spectrum of the data and the leave-one-out correlations of a
+    # randomization are a fixed cost, the randomized spectra, their complex
+    # copy in the inverse FFT and the randomized data grow with the batch
+    fixed = voxels * subjects * (16 * frequencies + 8 * 3 * timepoints)
+    per_permutation = voxels * subjects * (16 * 2 * frequencies +
+                                           8 * timepoints)
+
+    batch_size = int((budget - fixed) // per_permutation)
+    return int(np.clip(batch_size, 1, max(permutations or batch_size, 1)))
+
+
+def permutation_null(D, masked, permutations, collapse_subj=True,
+                     random_state=0, method='isc', batch_size=None,
+                     block_size=None, memory_gb=4.0):
+    """
+    Minimum and maximum ISC (or ISFC) of phase-randomized data, for a list
+    of permutations
+
+    The real FFT of the data is computed once, and batch_size permutations
+    are inverse transformed and reduced to their null values at a time.
+
+    Parameters
+    ----------
+    D : ndarray
+        (voxels, timepoints, subjects) data
+    masked : ndarray
+        Boolean mask of the voxels to include
+    permutations : list of integers
+        Indexes of the permutations
+    collapse_subj : boolean
+        Average the correlations over the subjects
+    random_state : integer or None
+        Seed shared by all the permutations
+    method : string
+        'isc' or 'isfc'
+    batch_size : integer
+        Number of permutations randomized at once, by default as many as
+        memory_gb allows
+    block_size : integer
+        ISFC tile size
+    memory_gb : float
+        Memory budget of the randomized data, in GB
+
+    Returns
+    -------
+    min_null : ndarray
+    max_null : ndarray
+
+    """
+    D = np.asarray(D)[masked]
+    n_vox, n_time, n_subj = D.shape
+
+    F = np.fft.rfft(D, axis=1)
+    del D
+
+    permutations = list(permutations)
+    min_null = np.zeros(len(permutations))
+    max_null = np.zeros(len(permutations))
+
+    if batch_size is None:
+        batch_size = permutation_batch_size(n_vox, n_time, n_subj, memory_gb,
+                                            permutations=len(permutations))
+    batch_size = max(int(batch_size), 1)
+    for start in range(0, len(permutations), batch_size):
+        batch = permutations[start:start + batch_size]
+        randomized = phase_randomize_spectrum(
+            F, n_time,
+            [permutation_random_state(random_state, p) for p in batch]
+        )
+
+        for i in range(len(batch)):
+            if method == 'isfc':
+                min_null[start + i], max_null[start + i] = \
+                    isfc_loo_null(randomized[i], collapse_subj, block_size)
+            else:
+                ISC_null = isc_loo(randomized[i], collapse_subj)
+                min_null[start + i] = min(np.min(ISC_null), 1)
+                max_null[start + i] = max(np.max(ISC_null), -1)
+
+    return min_null, max_null
+
+
+def _permutation_null_worker(args):
+    data_file, masked = args[:2]
+    return permutation_null(np.load(data_file, mmap_mode='r'), masked,
+                            *args[2:])
+
+
+def parallel_permutation_null(data_file, masked, permutations,
+                              collapse_subj=True, random_state=0,
+                              method='isc', batch_size=None, block_size=None,
+                              processes=1, memory_gb=4.0):
+    """
+    Runs permutation_null over a pool of processes, each computing a share
+    of the permutations from the memory-mapped data file
+
+    Parameters
+    ----------
+    data_file : string
+        .npy file of the (voxels, timepoints, subjects) data
+    processes : integer
+        Number of processes
+    memory_gb : float
+        Memory budget shared by all the processes, in GB
+
+    See permutation_null for the other parameters.
+
+    Returns
+    -------
+    min_null : ndarray
+    max_null : ndarray
+
+    """
+    from multiprocessing import Pool
+
+    permutations = list(permutations)
+    processes = max(min(int(processes), len(permutations)), 1)
+
+    # permutations are seeded by index, so a fixed random state is needed
+    # to get the same nulls whatever the number of processes
+    if random_state is None:
+        random_state = np.random.randint(np.iinfo(np.int32).max)
+
+    shares = [permutations[i::processes] for i in range(processes)]
+    jobs = [(data_file, masked, share, collapse_subj, random_state, method,
+             batch_size, block_size, memory_gb / float(processes))
+            for share in shares]
+
+    if processes > 1:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_permutation_null_worker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_permutation_null_worker(job) for job in jobs]
+
+    min_null = np.zeros(len(permutations))
+    max_null = np.zeros(len(permutations))
+    for i, (share_min, share_max) in enumerate(results):
+        min_null[i::processes] = share_min
+        max_null[i::processes] = share_max
+
+    return min_null, max_null
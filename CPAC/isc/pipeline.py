@@ -29,6 +29,8 @@ from CPAC.isc.isfc import (
     isfc_permutation,
 )
 
+from CPAC.isc.permutation import parallel_permutation_null
+
 
 def _permutations(perm):
     return range(perm)
@@ -162,13 +164,27 @@ def node_isc_permutation(permutation, D, masked, collapse_subj=True, random_stat
     return permutation, min_null, max_null
 
 
-def node_isfc(D, std=None, collapse_subj=True):
-    D = np.load(D)
+def node_isc_permutations(permutations, D, masked, collapse_subj=True,
+                          random_state=0, processes=1, memory_gb=4.0):
+    masked = np.load(masked)
+    min_null, max_null = parallel_permutation_null(D, masked,
+                                                   _permutations(permutations),
+                                                   collapse_subj,
+                                                   random_state,
+                                                   method='isc',
+                                                   processes=processes,
+                                                   memory_gb=memory_gb)
+    return list(min_null), list(max_null)
 
-    ISFC, ISFC_mask = isfc(D, std, collapse_subj)
 
+def node_isfc(D, std=None, collapse_subj=True, block_size=None):
+    D = np.load(D)
+
+    # ISFC is written tile by tile into a memory-mapped file
     f = os.path.abspath('./isfc.npy')
-    np.save(f, ISFC)
+    ISFC, ISFC_mask = isfc(D, std, collapse_subj, block_size=block_size,
+                           out_file=f)
+    del ISFC
 
     f_mask = os.path.abspath('./isfc_mask.npy')
     np.save(f_mask, ISFC_mask)
@@ -184,18 +200,36 @@ def node_isfc_significance(ISFC, min_null, max_null, two_sided=False):
     return f
 
 
-def node_isfc_permutation(permutation, D, masked, collapse_subj=True, random_state=0):
+def node_isfc_permutation(permutation, D, masked, collapse_subj=True, random_state=0,
+                          block_size=None):
     D = np.load(D)
     masked = np.load(masked)
     permutation, min_null, max_null = isfc_permutation(permutation,
                                                        D,
                                                        masked,
                                                        collapse_subj,
-                                                       random_state)
+                                                       random_state,
+                                                       block_size)
     return permutation, min_null, max_null
 
 
-def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
+def node_isfc_permutations(permutations, D, masked, collapse_subj=True,
+                           random_state=0, block_size=None, processes=1,
+                           memory_gb=4.0):
+    masked = np.load(masked)
+    min_null, max_null = parallel_permutation_null(D, masked,
+                                                   _permutations(permutations),
+                                                   collapse_subj,
+                                                   random_state,
+                                                   method='isfc',
+                                                   block_size=block_size,
+                                                   processes=processes,
+                                                   memory_gb=memory_gb)
+    return list(min_null), list(max_null)
+
+
+def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None,
+               memory_gb=4.0):
     """
     Inter-Subject Correlation
     
@@ -203,6 +237,8 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
     ----------
     name : string, optional
         Name of the workflow.
+    memory_gb : float, optional
+        Memory of the permutations, which are batched to fit in it.
         
     Returns
     -------
@@ -247,7 +283,8 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
             'collapse_subj',
             'std',
             'two_sided',
-            'random_state'
+            'random_state',
+            'processes'
         ]),
         name='inputspec'
     )
@@ -281,17 +318,20 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
                                 as_module=True),
                        name='ISC')
 
-    permutations_node = pe.MapNode(Function(input_names=['permutation',
-                                                         'D',
-                                                         'masked',
-                                                         'collapse_subj',
-                                                         'random_state'],
-                                            output_names=['permutation',
-                                                          'min_null',
-                                                          'max_null'],
-                                            function=node_isc_permutation,
-                                            as_module=True),
-                                   name='ISC_permutation', iterfield='permutation')
+    permutations_node = pe.Node(Function(input_names=['permutations',
+                                                      'D',
+                                                      'masked',
+                                                      'collapse_subj',
+                                                      'random_state',
+                                                      'processes',
+                                                      'memory_gb'],
+                                         output_names=['min_null',
+                                                       'max_null'],
+                                         function=node_isc_permutations,
+                                         as_module=True),
+                                name='ISC_permutation',
+                                mem_gb=memory_gb)
+    permutations_node.inputs.memory_gb = memory_gb
 
     significance_node = pe.Node(Function(input_names=['ISC',
                                                       'min_null',
@@ -313,7 +353,8 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
         (data_node, permutations_node, [('D', 'D')]),
         (isc_node, permutations_node, [('masked', 'masked')]),
         (inputspec, permutations_node, [('collapse_subj', 'collapse_subj')]),
-        (inputspec, permutations_node, [(('permutations', _permutations), 'permutation')]),
+        (inputspec, permutations_node, [('permutations', 'permutations')]),
+        (inputspec, permutations_node, [('processes', 'processes')]),
         (inputspec, permutations_node, [('random_state', 'random_state')]),
 
         (permutations_node, significance_node, [('min_null', 'min_null')]),
@@ -335,7 +376,7 @@ def create_isc(name='isc', output_dir=None, working_dir=None, crash_dir=None):
 
 
 def create_isfc(name='isfc', output_dir=None, working_dir=None,
-                crash_dir=None):
+                crash_dir=None, memory_gb=4.0):
     """
     Inter-Subject Functional Correlation
     
@@ -343,6 +384,8 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
     ----------
     name : string, optional
         Name of the workflow.
+    memory_gb : float, optional
+        Memory of the permutations, which are batched to fit in it.
         
     Returns
     -------
@@ -388,7 +431,9 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
             'collapse_subj',
             'std',
             'two_sided',
-            'random_state'
+            'random_state',
+            'block_size',
+            'processes'
         ]),
         name='inputspec'
     )
@@ -413,23 +458,28 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
 
     isfc_node = pe.Node(Function(input_names=['D',
                                              'std',
-                                             'collapse_subj'],
+                                             'collapse_subj',
+                                             'block_size'],
                                 output_names=['ISFC', 'masked'],
                                 function=node_isfc,
                                 as_module=True),
                        name='ISFC')
 
-    permutations_node = pe.MapNode(Function(input_names=['permutation',
-                                                         'D',
-                                                         'masked',
-                                                         'collapse_subj',
-                                                         'random_state'],
-                                            output_names=['permutation',
-                                                          'min_null',
-                                                          'max_null'],
-                                            function=node_isfc_permutation,
-                                            as_module=True),
-                                   name='ISFC_permutation', iterfield='permutation')
+    permutations_node = pe.Node(Function(input_names=['permutations',
+                                                      'D',
+                                                      'masked',
+                                                      'collapse_subj',
+                                                      'random_state',
+                                                      'block_size',
+                                                      'processes',
+                                                      'memory_gb'],
+                                         output_names=['min_null',
+                                                       'max_null'],
+                                         function=node_isfc_permutations,
+                                         as_module=True),
+                                name='ISFC_permutation',
+                                mem_gb=memory_gb)
+    permutations_node.inputs.memory_gb = memory_gb
 
     significance_node = pe.Node(Function(input_names=['ISFC',
                                                       'min_null',
@@ -444,6 +494,7 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
         (inputspec, data_node, [('subjects', 'subjects')]),
         (inputspec, isfc_node, [('collapse_subj', 'collapse_subj')]),
         (inputspec, isfc_node, [('std', 'std')]),
+        (inputspec, isfc_node, [('block_size', 'block_size')]),
         (data_node, isfc_node, [('D', 'D')]),
 
         (isfc_node, significance_node, [('ISFC', 'ISFC')]),
@@ -451,8 +502,10 @@ def create_isfc(name='isfc', output_dir=None, working_dir=None,
         (data_node, permutations_node, [('D', 'D')]),
         (isfc_node, permutations_node, [('masked', 'masked')]),
         (inputspec, permutations_node, [('collapse_subj', 'collapse_subj')]),
-        (inputspec, permutations_node, [(('permutations', _permutations), 'permutation')]),
+        (inputspec, permutations_node, [('permutations', 'permutations')]),
+        (inputspec, permutations_node, [('processes', 'processes')]),
         (inputspec, permutations_node, [('random_state', 'random_state')]),
+        (inputspec, permutations_node, [('block_size', 'block_size')]),
 
         (permutations_node, significance_node, [('min_null', 'min_null')]),
         (permutations_node, significance_node, [('max_null', 'max_null')]),
@@ -0,0 +1,132 @@
+import os
+import tempfile
+import numpy as np
+import pytest
+from CPAC.utils import correlation
+from CPAC.isc.isc import isc, isc_permutation
+from CPAC.isc.isfc import isfc, isfc_permutation
+from CPAC.isc.utils import phase_randomize
+
+
+def _loo_correlations(D, **kwargs):
+    # reference leave-one-out correlations, z-scoring every left-out mean
+    n_subj = D.shape[2]
+    group_sum = np.add.reduce(D, axis=2)
+    return np.array([
+        correlation(D[:, :, s], (group_sum - D[:, :, s]) / (n_subj - 1),
+                    **kwargs)
+        for s in range(n_subj)
+    ])
+
+
+def _data():
+    np.random.seed(4)
+    D = np.random.uniform(size=(30, 50, 6))
+    D[3, :, 2] = 1.0
+    return D
+
+
+@pytest.mark.parametrize('collapse_subj', [True, False])
+def test_isc(collapse_subj):
+    D = _data()
+    reference = _loo_correlations(D, match_rows=True)
+    if collapse_subj:
+        reference = reference.mean(axis=0)
+
+    ISC, masked = isc(D, collapse_subj=collapse_subj)
+
+    np.testing.assert_allclose(ISC, reference, atol=1e-12)
+    assert masked.all()
+
+
+@pytest.mark.parametrize('collapse_subj', [True, False])
+@pytest.mark.parametrize('block_size', [None, 7])
+def test_isfc(collapse_subj, block_size):
+    D = _data()
+    reference = np.moveaxis(_loo_correlations(D, symmetric=True), 0, -1)
+    if collapse_subj:
+        reference = reference.mean(axis=-1)
+
+    out_file = os.path.join(tempfile.mkdtemp(), 'isfc.npy')
+    ISFC, _ = isfc(D, collapse_subj=collapse_subj, block_size=block_size,
+                   out_file=out_file)
+
+    np.testing.assert_allclose(np.load(out_file), reference, atol=1e-12)
+
+
+@pytest.mark.parametrize('collapse_subj', [True, False])
+def test_permutations(collapse_subj):
+    D = _data()
+    masked = np.ones(D.shape[0], dtype=bool)
+    masked[5] = False
+
+    randomized = phase_randomize(D[masked], 3)
+
+    ISC = _loo_correlations(randomized, match_rows=True)
+    ISFC = _loo_correlations(randomized, symmetric=True)
+    if collapse_subj:
+        ISC = ISC.mean(axis=0)
+        ISFC = ISFC.mean(axis=0)
+
+    _, min_null, max_null = isc_permutation(0, D, masked, collapse_subj, 3)
+    np.testing.assert_allclose([min_null, max_null], [ISC.min(), ISC.max()])
+
+    _, min_null, max_null = isfc_permutation(0, D, masked, collapse_subj, 3,
+                                             block_size=4)
+    np.testing.assert_allclose([min_null, max_null],
+                               [ISFC.min(), ISFC.max()])
+
+
+def test_phase_randomize_spectrum():
+    from CPAC.isc.permutation import phase_randomize_spectrum
+
+    for n_time in [50, 51]:
+        D = np.random.uniform(size=(10, n_time, 4))
+        F = np.fft.rfft(D, axis=1)
+
+        randomized = phase_randomize_spectrum(
+            F, n_time, [np.random.RandomState(s) for s in [1, 2]]
+        )
+
+        for i, s in enumerate([1, 2]):
+            np.testing.assert_allclose(randomized[i],
+                                       phase_randomize(D, s), atol=1e-12)
+
+
+@pytest.mark.parametrize('method', ['isc', 'isfc'])
+def test_permutation_null(method):
+    from CPAC.isc.permutation import permutation_null, \
+                                     permutation_random_state, \
+                                     parallel_permutation_null
+
+    D = _data()
+    masked = np.ones(D.shape[0], dtype=bool)
+
+    min_null, max_null = permutation_null(D, masked, range(5),
+                                          random_state=8, method=method,
+                                          batch_size=2)
+
+    permutation = isc_permutation if method == 'isc' else isfc_permutation
+    for p in range(5):
+        _, min_p, max_p = permutation(
+            p, D, masked, True, permutation_random_state(8, p))
+        np.testing.assert_allclose([min_null[p], max_null[p]], [min_p, max_p])
+
+    data_file = os.path.join(tempfile.mkdtemp(), 'data.npy')
+    np.save(data_file, D)
+    parallel_min, parallel_max = parallel_permutation_null(
+        data_file, masked, range(5), random_state=8, method=method,
+        processes=2)
+    np.testing.assert_allclose(parallel_min, min_null)
+    np.testing.assert_allclose(parallel_max, max_null)
+
+
+def test_permutation_batch_size():
+    from CPAC.isc.permutation import permutation_batch_size
+
+    # 10k voxels, 200 timepoints and 30 subjects take about 1.3 GB per
+    # randomization, on top of 1.8 GB for the spectrum and the correlations
+    assert permutation_batch_size(10000, 200, 30, 2.0) == 1
+    assert permutation_batch_size(10000, 200, 30, 16.0) == 10
+    assert permutation_batch_size(10000, 200, 30, 16.0, processes=2) == 4
+    assert permutation_batch_size(100, 200, 30, 16.0, permutations=5) == 5
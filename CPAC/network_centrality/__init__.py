@@ -1,5 +1,6 @@
 from utils import convert_pvalue_to_r,\
-                  merge_lists
+                  merge_lists,\
+                  calc_centrality
 
-__all__ = ['convert_pvalue_to_r']
+__all__ = ['convert_pvalue_to_r', 'calc_centrality']
 
@@ -2,7 +2,8 @@ from nipype.interfaces.afni.preprocess import DegreeCentrality, ECM, LFCD
 
 
 def create_centrality_wf(wf_name, method_option, threshold_option,
-                         threshold, num_threads=1, memory_gb=1.0):
+                         threshold, num_threads=1, memory_gb=1.0,
+                         native=False):
     """
     Function to create the afni-based centrality workflow
 
@@ -20,6 +21,9 @@ def create_centrality_wf(wf_name, method_option, threshold_option,
         the number of threads to utilize for centrality computation
     memory_gb : float (optional); default=1.0
         the amount of memory the centrality calculation will take (GB)
+    native : boolean (optional); default=False
+        compute the centrality in process with NumPy, in blocks fitting in
+        memory_gb, instead of with AFNI
 
     Returns
     -------
@@ -48,6 +52,58 @@ def create_centrality_wf(wf_name, method_option, threshold_option,
 
     input_node.inputs.threshold = threshold
 
+    output_node = pe.Node(util.IdentityInterface(fields=['outfile_list',
+                                                         'oned_output']),
+                          name='outputspec')
+
+    if native:
+        if threshold_option == 'sparsity' and method_option == 'lfcd':
+            raise Exception('Sparsity thresholding is not supported for lFCD')
+
+        calc_centrality_node = \
+            pe.Node(util.Function(input_names=['in_file',
+                                               'template',
+                                               'method_option',
+                                               'threshold_option',
+                                               'threshold',
+                                               'memory_gb'],
+                                  output_names=['outfile_list'],
+                                  function=utils.calc_centrality),
+                    name='calc_centrality', mem_gb=memory_gb)
+
+        calc_centrality_node.inputs.method_option = method_option
+        calc_centrality_node.inputs.memory_gb = memory_gb
+
+        centrality_wf.connect(input_node, 'in_file',
+                              calc_centrality_node, 'in_file')
+        centrality_wf.connect(input_node, 'template',
+                              calc_centrality_node, 'template')
+
+        # Significance thresholds are converted to correlation thresholds
+        if threshold_option == 'significance':
+            convert_thr_node = pe.Node(util.Function(input_names=['datafile',
+                                                                  'p_value',
+                                                                  'two_tailed'],
+                                                     output_names=['rvalue_threshold'],
+                                                     function=utils.convert_pvalue_to_r),
+                                       name='convert_threshold')
+            centrality_wf.connect(input_node, 'in_file',
+                                  convert_thr_node, 'datafile')
+            centrality_wf.connect(input_node, 'threshold',
+                                  convert_thr_node, 'p_value')
+            centrality_wf.connect(convert_thr_node, 'rvalue_threshold',
+                                  calc_centrality_node, 'threshold')
+            calc_centrality_node.inputs.threshold_option = 'correlation'
+        else:
+            centrality_wf.connect(input_node, 'threshold',
+                                  calc_centrality_node, 'threshold')
+            calc_centrality_node.inputs.threshold_option = threshold_option
+
+        centrality_wf.connect(calc_centrality_node, 'outfile_list',
+                              output_node, 'outfile_list')
+
+        return centrality_wf
+
     # Degree centrality
     if method_option == 'degree':
         afni_centrality_node = \
@@ -126,10 +182,6 @@ def create_centrality_wf(wf_name, method_option, threshold_option,
     centrality_wf.connect(afni_centrality_node, 'out_file',
                           sep_subbriks_node, 'nifti_file')
 
-    output_node = pe.Node(util.IdentityInterface(fields=['outfile_list',
-                                                         'oned_output']),
-                          name='outputspec')
-
     centrality_wf.connect(sep_subbriks_node, 'output_niftis',
                           output_node, 'outfile_list')
 
@@ -125,7 +125,9 @@ def connect_centrality_workflow(workflow, c, strat, num_strat,
     afni_centrality_wf = \
         create_centrality_wf(wf_name, method_option,
                              threshold_option,
-                             threshold, num_threads, memory)
+                             threshold, num_threads, memory,
+                             native=getattr(c, 'nativeNetworkCentrality',
+                                            False))
 
     workflow.connect(resample_functional_to_template, 'out_file',
                      afni_centrality_wf, 'inputspec.in_file')
@@ -0,0 +1,201 @@
+import os
+import itertools
+import numpy as np
+import nibabel as nb
+import pytest
+
+from CPAC.network_centrality.utils import (
+    calc_centrality,
+    convert_pvalue_to_r,
+    local_fcd,
+    mask_neighbors,
+    load_centrality_data,
+    sparsity_pairs
+)
+
+
+@pytest.fixture
+def dl_dir(tmpdir, monkeypatch):
+    # the centralities are written in the working directory
+    monkeypatch.chdir(str(tmpdir))
+    return str(tmpdir)
+
+
+def centrality_data(dl_dir, shape=(10, 9, 8), timepoints=120, factors=3,
+                    seed=42):
+
+    rng = np.random.RandomState(seed)
+
+    # a few shared signals, so the voxels have a structured connectivity
+    signals = rng.randn(factors, timepoints)
+    loadings = rng.randn(*(shape + (factors,)))
+    data = loadings.dot(signals) + rng.randn(*(shape + (timepoints,))) * 2
+    data = (data + 100).astype(np.float32)
+
+    mask = rng.rand(*shape) > 0.2
+    # a voxel without any variance
+    data[np.nonzero(mask)[0][0], np.nonzero(mask)[1][0],
+         np.nonzero(mask)[2][0]] = 100
+
+    in_file = os.path.join(dl_dir, 'functional.nii.gz')
+    template = os.path.join(dl_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(in_file)
+    nb.Nifti1Image(mask.astype(np.int16), np.eye(4)).to_filename(template)
+
+    return data, mask, in_file, template
+
+
+def reference_adjacency(data, mask, threshold_option, threshold):
+    timeseries = data[mask].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.nan_to_num(np.corrcoef(timeseries))
+    np.fill_diagonal(r, -np.inf)
+
+    if threshold_option == 'sparsity':
+        upper = r[np.triu_indices(len(r), 1)]
+        n_keep = int(threshold / 100.0 * len(upper))
+        threshold = np.sort(upper)[-n_keep] - 1e-12
+
+    connected = r > threshold
+    return connected, np.where(connected, r, 0)
+
+
+def reference_eigenvector(adjacency):
+    values, vectors = np.linalg.eigh(adjacency)
+    return np.abs(vectors[:, np.argmax(values)])
+
+
+def reference_lfcd(data, mask, threshold):
+    timeseries = data[mask].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.nan_to_num(np.corrcoef(timeseries))
+
+    index = -np.ones(mask.shape, dtype=int)
+    index[mask] = np.arange(mask.sum())
+    coordinates = np.transpose(np.nonzero(mask))
+
+    binarize = np.zeros(len(timeseries))
+    weighted = np.zeros(len(timeseries))
+    for seed in range(len(timeseries)):
+        visited = set([seed])
+        queue = [seed]
+        while queue:
+            voxel = queue.pop()
+            for offset in itertools.product((-1, 0, 1), repeat=3):
+                neighbor = coordinates[voxel] + offset
+                if np.any(neighbor < 0) or \
+                        np.any(neighbor >= mask.shape):
+                    continue
+                neighbor = index[tuple(neighbor)]
+                if neighbor < 0 or neighbor in visited:
+                    continue
+                visited.add(neighbor)
+                if r[seed, neighbor] > threshold:
+                    binarize[seed] += 1
+                    weighted[seed] += r[seed, neighbor]
+                    queue.append(neighbor)
+
+    return binarize, weighted
+
+
+def centralities(outfile_list, mask):
+    return [nb.load(f).get_data()[mask] for f in outfile_list]
+
+
+def test_load_centrality_data(dl_dir):
+
+    data, mask, in_file, template = centrality_data(dl_dir)
+
+    z, _, _ = load_centrality_data(in_file, template)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = np.nan_to_num(np.corrcoef(data[mask].astype(np.float64)))
+    np.fill_diagonal(r, 0)
+
+    product = z.dot(z.T)
+    np.fill_diagonal(product, 0)
+    assert np.allclose(product, r)
+
+
+def test_degree_centrality(dl_dir):
+
+    data, mask, in_file, template = centrality_data(dl_dir)
+
+    for threshold_option, threshold in [('correlation', 0.3),
+                                        ('sparsity', 5.)]:
+        # a small budget, so the correlations are computed in several blocks
+        binarize, weighted = centralities(
+            calc_centrality(in_file, template, 'degree', threshold_option,
+                            threshold, memory_gb=0.002),
+            mask
+        )
+        connected, adjacency = reference_adjacency(data, mask,
+                                                   threshold_option,
+                                                   threshold)
+        assert np.allclose(binarize, connected.sum(axis=1))
+        assert np.allclose(weighted, adjacency.sum(axis=1), atol=1e-4)
+
+
+def test_eigenvector_centrality(dl_dir):
+
+    data, mask, in_file, template = centrality_data(dl_dir)
+
+    for threshold_option, threshold, memory_gb in [
+            ('correlation', 0.3, 1.),
+            ('sparsity', 5., 1.),
+            # too many connections for the sparse adjacency
+            ('correlation', 0.1, 0.002)]:
+        binarize, weighted = centralities(
+            calc_centrality(in_file, template, 'eigenvector',
+                            threshold_option, threshold,
+                            memory_gb=memory_gb),
+            mask
+        )
+        connected, adjacency = reference_adjacency(data, mask,
+                                                   threshold_option,
+                                                   threshold)
+        assert np.allclose(binarize,
+                           reference_eigenvector(connected.astype(float)),
+                           atol=1e-4)
+        assert np.allclose(weighted, reference_eigenvector(adjacency),
+                           atol=1e-4)
+
+
+def test_lfcd(dl_dir):
+
+    data, mask, in_file, template = centrality_data(dl_dir)
+
+    binarize, weighted = centralities(
+        calc_centrality(in_file, template, 'lfcd', 'correlation', 0.3,
+                        memory_gb=0.002),
+        mask
+    )
+    expected_binarize, expected_weighted = reference_lfcd(data, mask, 0.3)
+    assert np.allclose(binarize, expected_binarize)
+    assert np.allclose(weighted, expected_weighted, atol=1e-4)
+
+
+def test_convert_pvalue_to_r(dl_dir):
+
+    _, _, in_file, _ = centrality_data(dl_dir, timepoints=50)
+    r_value = convert_pvalue_to_r(in_file, 0.001)
+    assert 0.4 < r_value < 0.45
+
+
+
+def test_sparsity_pairs(dl_dir):
+
+    _, _, in_file, template = centrality_data(dl_dir)
+    z, _, _ = load_centrality_data(in_file, template)
+
+    r = z.dot(z.T)
+    upper = np.triu_indices(len(r), 1)
+    n_keep = int(0.01 * len(upper[0]))
+    expected = np.argsort(-r[upper])[:n_keep]
+
+    # the first block has more pairs than are kept
+    for block_size in (50, 200, len(r)):
+        rows, columns, values = sparsity_pairs(z, 0.01, block_size)
+        assert len(values) == n_keep
+        assert sorted(zip(rows, columns)) == \
+            sorted(zip(upper[0][expected], upper[1][expected]))
+        assert np.allclose(values, r[rows, columns])
@@ -28,9 +28,8 @@ def convert_pvalue_to_r(datafile, p_value, two_tailed=False):
     if two_tailed:
         p_value = p_value / 2
 
-    # Load in data and number of time pts
-    img = nb.load(datafile).get_data()
-    t_pts = img.shape[-1]
+    # Number of time pts, from the header
+    t_pts = nb.load(datafile).shape[-1]
 
     # N-2 degrees of freedom with Pearson correlation (two sample means)
     deg_freedom = t_pts-2
@@ -175,3 +174,621 @@ def check_centrality_params(method_option, threshold_option, threshold):
 
     # Return valid method and threshold options
     return method_option, threshold_option
+
+
+# Number of rows of the correlation blocks fitting in the memory budget
+def centrality_block_size(n_voxels, n_timepoints, memory_gb):
+    '''
+    Method to size the row blocks of the voxel correlation matrix, so that
+    the z-scored timeseries, a correlation block and its temporaries take
+    at most half of the memory budget, the other half being left for the
+    sparse adjacency
+
+    Parameters
+    ----------
+    n_voxels : integer
+        number of voxels in the mask
+    n_timepoints : integer
+        number of timepoints
+    memory_gb : float
+        memory budget (GB)
+
+    Returns
+    -------
+    block_size : integer
+        number of rows of the correlation blocks
+    '''
+
+    budget = memory_gb * 1024.0 ** 3 / 2
+    data_bytes = n_voxels * n_timepoints * 8.0
+
+    # float64 correlations, their float64 partitioned copy (sparsity) or
+    # temporaries, and boolean threshold mask
+    row_bytes = n_voxels * 17.0
+
+    if budget - data_bytes < row_bytes:
+        err_msg = 'The centrality memory budget of %.2f GB is too small ' \
+                  'for %d voxels and %d timepoints; increase ' \
+                  'memoryAllocatedForDegreeCentrality in the pipeline ' \
+                  'config' % (memory_gb, n_voxels, n_timepoints)
+        raise MemoryError(err_msg)
+
+    return int(min(n_voxels, (budget - data_bytes) // row_bytes))
+
+
+# Load the z-scored timeseries of the voxels in a mask
+def load_centrality_data(in_file, template):
+    '''
+    Method to load the voxel timeseries inside the centrality mask, z-scored
+    so that their dot products are their Pearson correlations. The image is
+    read one volume at a time, so the whole 4D image is never in memory
+
+    Parameters
+    ----------
+    in_file : string
+        filepath to the functional image, in the space of the mask
+    template : string
+        filepath to the centrality mask
+
+    Returns
+    -------
+    data : numpy.ndarray
+        z-scored timeseries of the voxels (voxels x timepoints), zero for
+        voxels without any variance
+    mask : numpy.ndarray
+        boolean mask
+    affine : numpy.ndarray
+        affine of the functional image
+    '''
+
+    import nibabel as nb
+    import numpy as np
+
+    mask = nb.load(template).get_data().astype('bool')
+
+    # keep the file open, so consecutive volumes of gzipped images are
+    # decompressed in a single pass
+    img = nb.load(in_file, keep_file_open=True)
+
+    if img.shape[:3] != mask.shape:
+        err_msg = 'The functional image (%s) and the centrality mask (%s) ' \
+                  'do not have the same dimensions' % (in_file, template)
+        raise Exception(err_msg)
+
+    data = np.empty((mask.sum(), img.shape[3]))
+    for t in range(img.shape[3]):
+        data[:, t] = np.asarray(img.dataobj[..., t])[mask]
+
+    data -= data.mean(axis=1)[:, np.newaxis]
+    norms = np.sqrt(np.sum(data ** 2, axis=1))
+    norms[norms == 0] = np.inf
+    data /= norms[:, np.newaxis]
+
+    return data, mask, img.affine
+
+
+# Correlation row blocks of the thresholded adjacency
+def correlation_blocks(data, block_size, upper=False):
+    '''
+    Generator of the row blocks of the voxel correlation matrix, without the
+    self-correlations
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    block_size : integer
+        number of rows of the blocks
+    upper : boolean (optional); default=False
+        yield the upper triangle only, i.e. the correlations of the rows
+        with the columns after them, as the first column index and the
+        block, the other entries being -inf
+
+    Yields
+    ------
+    start : integer
+        index of the first row of the block
+    offset : integer
+        index of the first column of the block
+    block : numpy.ndarray
+        correlations (rows x columns)
+    '''
+
+    import numpy as np
+
+    n_voxels = data.shape[0]
+
+    for start in range(0, n_voxels, block_size):
+        stop = min(start + block_size, n_voxels)
+        offset = start if upper else 0
+
+        block = np.dot(data[start:stop], data[offset:].T)
+
+        rows = np.arange(stop - start)
+        if upper:
+            block[np.tril_indices(stop - start)] = -np.inf
+        else:
+            block[rows, rows + start] = -np.inf
+
+        yield start, offset, block
+
+
+# Pairs of voxels whose correlation is above a threshold
+def threshold_pairs(data, r_value, block_size, max_pairs=None):
+    '''
+    Method to gather the sparse adjacency of the voxels whose correlation is
+    above a threshold, one correlation block at a time
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    r_value : float
+        correlation threshold
+    block_size : integer
+        number of rows of the correlation blocks
+    max_pairs : integer (optional); default=None
+        maximum number of pairs to gather
+
+    Returns
+    -------
+    pairs : tuple
+        row indices, column indices (after the rows) and correlations of the
+        pairs above the threshold, or None if there are more than max_pairs
+    '''
+
+    import numpy as np
+
+    rows, columns, values = [], [], []
+    n_pairs = 0
+
+    for start, offset, block in correlation_blocks(data, block_size,
+                                                   upper=True):
+        i, j = np.nonzero(block > r_value)
+        n_pairs += len(i)
+        if max_pairs is not None and n_pairs > max_pairs:
+            return None
+        rows.append((i + start).astype(np.int32))
+        columns.append((j + offset).astype(np.int32))
+        values.append(block[i, j])
+
+    return np.concatenate(rows), np.concatenate(columns), \
+        np.concatenate(values)
+
+
+# Pairs of voxels with the highest correlations
+def sparsity_pairs(data, sparsity, block_size):
+    '''
+    Method to gather the sparse adjacency of the fraction of voxel pairs
+    with the highest correlations, keeping a running selection of the best
+    pairs while going through the correlation blocks
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    sparsity : float
+        fraction of the pairs of voxels to keep, in (0, 1]
+    block_size : integer
+        number of rows of the correlation blocks
+
+    Returns
+    -------
+    pairs : tuple
+        row indices, column indices (after the rows) and correlations of the
+        kept pairs
+    '''
+
+    import numpy as np
+
+    n_voxels = data.shape[0]
+    n_keep = max(int(sparsity * n_voxels * (n_voxels - 1) / 2), 1)
+
+    rows = np.empty(0, dtype=np.int32)
+    columns = np.empty(0, dtype=np.int32)
+    values = np.empty(0)
+    r_value = -np.inf
+
+    for start, offset, block in correlation_blocks(data, block_size,
+                                                   upper=True):
+        # only the n_keep highest correlations of a block can be kept, so
+        # the pairs below them are never gathered
+        threshold = -np.inf
+        if block.size > n_keep:
+            threshold = np.partition(block, block.size - n_keep,
+                                     axis=None)[block.size - n_keep]
+        if threshold > r_value:
+            i, j = np.nonzero(block >= threshold)
+        else:
+            i, j = np.nonzero(block > r_value)
+        rows = np.concatenate([rows, (i + start).astype(np.int32)])
+        columns = np.concatenate([columns, (j + offset).astype(np.int32)])
+        values = np.concatenate([values, block[i, j]])
+
+        if len(values) > n_keep:
+            keep = np.argpartition(-values, n_keep - 1)[:n_keep]
+            rows, columns, values = rows[keep], columns[keep], values[keep]
+            r_value = values.min()
+
+    return rows, columns, values
+
+
+# Degree centrality of a sparse adjacency
+def pairs_degree(pairs, n_voxels):
+    '''
+    Method to calculate the binarized and weighted degree centrality from
+    the pairs of an adjacency
+
+    Parameters
+    ----------
+    pairs : tuple
+        row indices, column indices and correlations of the pairs
+    n_voxels : integer
+        number of voxels
+
+    Returns
+    -------
+    binarize : numpy.ndarray
+        number of connections of each voxel
+    weighted : numpy.ndarray
+        sum of the correlations of the connections of each voxel
+    '''
+
+    import numpy as np
+
+    rows, columns, values = pairs
+    ends = np.concatenate([rows, columns])
+
+    binarize = np.bincount(ends, minlength=n_voxels).astype(np.float64)
+    weighted = np.bincount(ends, weights=np.concatenate([values, values]),
+                           minlength=n_voxels)
+
+    return binarize, weighted
+
+
+# Degree centrality from the correlation blocks
+def degree_centrality(data, r_value, block_size):
+    '''
+    Method to calculate the binarized and weighted degree centrality of the
+    voxels, counting the connections above a correlation threshold one
+    correlation block at a time, without storing the adjacency
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    r_value : float
+        correlation threshold
+    block_size : integer
+        number of rows of the correlation blocks
+
+    Returns
+    -------
+    binarize : numpy.ndarray
+        number of connections of each voxel
+    weighted : numpy.ndarray
+        sum of the correlations of the connections of each voxel
+    '''
+
+    import numpy as np
+
+    binarize = np.zeros(data.shape[0])
+    weighted = np.zeros(data.shape[0])
+
+    for start, _, block in correlation_blocks(data, block_size):
+        connected = block > r_value
+        stop = start + block.shape[0]
+        binarize[start:stop] = connected.sum(axis=1)
+        block[~connected] = 0
+        weighted[start:stop] = block.sum(axis=1)
+
+    return binarize, weighted
+
+
+# Leading eigenvector by power iteration
+def power_iteration(matvec, n_voxels, max_iter=1000, tolerance=1e-6):
+    '''
+    Method to calculate the leading eigenvector of a non-negative symmetric
+    matrix by power iteration, shifting the matrix by the identity so that
+    its leading eigenvalue is also the largest in magnitude
+
+    Parameters
+    ----------
+    matvec : function
+        product of the matrix with a vector
+    n_voxels : integer
+        dimension of the matrix
+    max_iter : integer (optional); default=1000
+        maximum number of iterations
+    tolerance : float (optional); default=1e-6
+        convergence threshold on the norm of the change of the eigenvector
+
+    Returns
+    -------
+    eigenvector : numpy.ndarray
+        unit norm leading eigenvector
+    '''
+
+    import numpy as np
+
+    eigenvector = np.ones(n_voxels) / np.sqrt(n_voxels)
+
+    for _ in range(max_iter):
+        update = matvec(eigenvector) + eigenvector
+        update /= np.linalg.norm(update)
+        change = np.linalg.norm(update - eigenvector)
+        eigenvector = update
+        if change < tolerance:
+            break
+
+    return eigenvector
+
+
+# Eigenvector centrality from the adjacency or the correlation blocks
+def eigenvector_centrality(data, threshold_option, threshold, block_size,
+                           max_pairs):
+    '''
+    Method to calculate the binarized and weighted eigenvector centrality of
+    the voxels. The thresholded adjacency is kept as a sparse matrix when
+    it has at most max_pairs connections; otherwise the products with the
+    adjacency are computed one correlation block at a time, at each
+    iteration
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    threshold_option : string
+        'sparsity' or 'correlation'
+    threshold : float
+        sparsity fraction or correlation threshold
+    block_size : integer
+        number of rows of the correlation blocks
+    max_pairs : integer
+        maximum number of connections of the sparse adjacency
+
+    Returns
+    -------
+    binarize : numpy.ndarray
+        eigenvector centrality of the binarized adjacency
+    weighted : numpy.ndarray
+        eigenvector centrality of the adjacency weighted by the correlations
+    '''
+
+    import numpy as np
+    import scipy.sparse
+
+    n_voxels = data.shape[0]
+
+    if threshold_option == 'sparsity':
+        pairs = sparsity_pairs(data, threshold, block_size)
+    else:
+        pairs = threshold_pairs(data, threshold, block_size, max_pairs)
+
+    centralities = []
+    for binarize in (True, False):
+        if pairs is not None:
+            rows, columns, values = pairs
+            if binarize:
+                values = np.ones(len(values))
+            adjacency = scipy.sparse.coo_matrix(
+                (np.concatenate([values, values]),
+                 (np.concatenate([rows, columns]),
+                  np.concatenate([columns, rows]))),
+                shape=(n_voxels, n_voxels)
+            ).tocsr()
+            matvec = adjacency.dot
+        else:
+            def matvec(vector, binarize=binarize):
+                product = np.empty(n_voxels)
+                for start, _, block in correlation_blocks(data, block_size):
+                    connected = block > threshold
+                    if binarize:
+                        block = connected.astype(np.float64)
+                    else:
+                        block[~connected] = 0
+                    product[start:start + block.shape[0]] = \
+                        np.dot(block, vector)
+                return product
+
+        centralities.append(np.abs(power_iteration(matvec, n_voxels)))
+
+    return centralities[0], centralities[1]
+
+
+# Neighbours of the voxels in a mask
+def mask_neighbors(mask):
+    '''
+    Method to list the face, edge and corner neighbours of the voxels in a
+    mask
+
+    Parameters
+    ----------
+    mask : numpy.ndarray
+        3D boolean mask
+
+    Returns
+    -------
+    neighbors : numpy.ndarray
+        indices of the 26 neighbours of each voxel, in the order of the
+        voxels in the mask (voxels x 26), -1 for the neighbours outside of
+        the mask
+    '''
+
+    import itertools
+    import numpy as np
+
+    index = -np.ones(np.array(mask.shape) + 2, dtype=np.int64)
+    index[1:-1, 1:-1, 1:-1][mask] = np.arange(mask.sum())
+
+    x, y, z = np.nonzero(mask)
+    offsets = [o for o in itertools.product((-1, 0, 1), repeat=3)
+               if o != (0, 0, 0)]
+
+    return np.column_stack([index[x + 1 + dx, y + 1 + dy, z + 1 + dz]
+                            for dx, dy, dz in offsets])
+
+
+# Local functional connectivity density
+def local_fcd(data, neighbors, r_value, block_size):
+    '''
+    Method to calculate the binarized and weighted local functional
+    connectivity density (lFCD) of the voxels: the cluster of each seed
+    voxel is grown from the seed to the neighbours whose correlation with
+    the seed is above the threshold, as a flood fill of blocks of seeds at
+    once
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        z-scored timeseries (voxels x timepoints)
+    neighbors : numpy.ndarray
+        neighbours of the voxels, see mask_neighbors
+    r_value : float
+        correlation threshold
+    block_size : integer
+        number of seeds grown at once
+
+    Returns
+    -------
+    binarize : numpy.ndarray
+        number of voxels in the cluster of each seed, besides the seed
+    weighted : numpy.ndarray
+        sum of the correlations of the cluster voxels with each seed
+    '''
+
+    import numpy as np
+
+    n_voxels = data.shape[0]
+    binarize = np.zeros(n_voxels)
+    weighted = np.zeros(n_voxels)
+
+    for start in range(0, n_voxels, block_size):
+        seeds = np.arange(start, min(start + block_size, n_voxels))
+
+        # (seed, voxel) pairs, as seed * n_voxels + voxel codes
+        visited = seeds * n_voxels + seeds
+        front_seeds, front_voxels = seeds, seeds
+
+        while len(front_seeds):
+            candidates = neighbors[front_voxels]
+            candidate_seeds = np.repeat(front_seeds, candidates.shape[1])
+            candidates = candidates.ravel()
+            inside = candidates >= 0
+
+            codes = np.unique(candidate_seeds[inside] * n_voxels +
+                              candidates[inside])
+            codes = codes[~np.in1d(codes, visited, assume_unique=True)]
+            visited = np.concatenate([visited, codes])
+
+            candidate_seeds = codes // n_voxels
+            candidates = codes % n_voxels
+            correlations = np.einsum('ij,ij->i', data[candidate_seeds],
+                                     data[candidates])
+
+            connected = correlations > r_value
+            front_seeds = candidate_seeds[connected]
+            front_voxels = candidates[connected]
+
+            binarize += np.bincount(front_seeds, minlength=n_voxels)
+            weighted += np.bincount(front_seeds,
+                                    weights=correlations[connected],
+                                    minlength=n_voxels)
+
+    return binarize, weighted
+
+
+# Calculate centrality in process
+def calc_centrality(in_file, template, method_option, threshold_option,
+                    threshold, memory_gb=1.0):
+    '''
+    Method to calculate the degree centrality, eigenvector centrality or
+    lFCD of the voxels in a mask, with NumPy, as the AFNI
+    3dDegreeCentrality, 3dECM and 3dLFCD commands do. The voxel
+    correlations are computed in row blocks sized to fit the memory budget
+
+    Parameters
+    ----------
+    in_file : string
+        filepath to the functional image, in the space of the mask
+    template : string
+        filepath to the centrality mask
+    method_option : string
+        'degree', 'eigenvector', or 'lfcd'
+    threshold_option : string
+        'sparsity' or 'correlation' (significance thresholds are converted
+        to correlation thresholds beforehand)
+    threshold : float
+        sparsity percentage of the voxel pairs to keep, as for AFNI, or
+        correlation threshold
+    memory_gb : float (optional); default=1.0
+        memory budget (GB)
+
+    Returns
+    -------
+    outfile_list : list
+        filepaths to the binarized and weighted centrality images
+    '''
+
+    import os
+    import numpy as np
+    import nibabel as nb
+    from CPAC.network_centrality.utils import (
+        centrality_block_size,
+        degree_centrality,
+        eigenvector_centrality,
+        load_centrality_data,
+        local_fcd,
+        mask_neighbors,
+        pairs_degree,
+        sparsity_pairs
+    )
+
+    data, mask, affine = load_centrality_data(in_file, template)
+    n_voxels = data.shape[0]
+
+    block_size = centrality_block_size(n_voxels, data.shape[1], memory_gb)
+
+    if threshold_option == 'sparsity':
+        threshold = threshold / 100.0
+
+    # the other half of the budget holds the sparse adjacency, as the pairs
+    # and their symmetric sparse matrix
+    max_pairs = int(memory_gb * 1024.0 ** 3 / 2 / 48)
+
+    if method_option == 'degree':
+        if threshold_option == 'sparsity':
+            centralities = pairs_degree(
+                sparsity_pairs(data, threshold, block_size), n_voxels
+            )
+        else:
+            centralities = degree_centrality(data, threshold, block_size)
+        out_names = ('degree_centrality_binarize',
+                     'degree_centrality_weighted')
+
+    elif method_option == 'eigenvector':
+        centralities = eigenvector_centrality(data, threshold_option,
+                                              threshold, block_size,
+                                              max_pairs)
+        out_names = ('eigenvector_centrality_binarize',
+                     'eigenvector_centrality_weighted')
+
+    elif method_option == 'lfcd':
+        if threshold_option == 'sparsity':
+            raise Exception('Sparsity thresholding is not supported for lFCD')
+        centralities = local_fcd(data, mask_neighbors(mask), threshold,
+                                 block_size)
+        out_names = ('lfcd_binarize', 'lfcd_weighted')
+
+    else:
+        raise Exception('Method option: %s not supported' % method_option)
+
+    outfile_list = []
+    for centrality, out_name in zip(centralities, out_names):
+        centrality_map = np.zeros(mask.shape, dtype=np.float32)
+        centrality_map[mask] = centrality
+        out_file = os.path.join(os.getcwd(), out_name + '.nii.gz')
+        nb.Nifti1Image(centrality_map, affine).to_filename(out_file)
+        outfile_list.append(out_file)
+
+    return outfile_list
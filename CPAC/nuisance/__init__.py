@@ -1,27 +1,39 @@
-from .utils import (
-    find_offending_time_points,
-    temporal_variance_mask,
-    generate_summarize_tissue_mask,
-    NuisanceRegressor
-)
+from CPAC.utils.lazy_import import lazy_module, lazy_attributes
 
-from .nuisance import (
-    create_nuisance_workflow
-)
+_attributes = lazy_attributes('CPAC.nuisance.utils', [
+    'find_offending_time_points',
+    'temporal_variance_mask',
+    'generate_summarize_tissue_mask',
+    'NuisanceRegressor',
+])
+
+_attributes.update(lazy_attributes('CPAC.nuisance.nuisance', [
+    'create_nuisance_workflow',
+    'has_voxel_nuisance_regressors',
+    'native_nuisance_regression_batch',
+    'nuisance_regression_batch_mem_gb',
+]))
+
+_attributes.update(lazy_attributes('CPAC.nuisance.bandpass', [
+    'bandpass_voxels',
+]))
 
-from .bandpass import (
-    bandpass_voxels
-)
+_attributes.update(lazy_attributes('CPAC.nuisance.utils.compcor', [
+    'calc_compcor_components_chunked',
+    'cosine_filter',
+]))
 
-from .utils.compcor import (
-    cosine_filter
-)
+lazy_module(__name__, _attributes)
 
 __all__ = [
     'create_nuisance_workflow',
+    'has_voxel_nuisance_regressors',
+    'native_nuisance_regression_batch',
+    'nuisance_regression_batch_mem_gb',
     'find_offending_time_points',
     'temporal_variance_mask',
     'generate_summarize_tissue_mask',
     'bandpass_voxels',
+    'calc_compcor_components_chunked',
     'cosine_filter'
 ]
\ No newline at end of file
@@ -5,10 +5,129 @@ import nibabel as nb
 from scipy.fftpack import fft, ifft
 
 
-def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
+def ideal_bandpass_mask(sample_length, sample_period, bandpass_freqs):
+    """
+    Builds the frequency mask of the ideal bandpass filter, for the real FFT
+    of a timeseries zero-padded to the next power of two.
+
+    Parameters
+    ----------
+    sample_length : int
+        Number of timepoints.
+    sample_period : float
+        Length of sampling period in seconds.
+    bandpass_freqs : tuple
+        Tuple containing the bandpass frequencies. (LowCutoff_HighPass HighCutoff_LowPass)
+
+    Returns
+    -------
+    padded_length : int
+        Length of the zero-padded timeseries.
+    freq_mask : ndarray
+        Boolean mask of the padded_length // 2 + 1 real FFT frequencies
+        to keep.
+
+    """
+
+    # Derived from YAN Chao-Gan 120504 based on REST.
+    sample_freq = 1. / sample_period
+    padded_length = int(2**np.ceil(np.log2(sample_length)))
+
+    LowCutoff, HighCutoff = bandpass_freqs
+
+    if (LowCutoff is None):  # No lower cutoff (low-pass filter)
+        low_cutoff_i = 0
+    elif (LowCutoff > sample_freq / 2.):
+        # Cutoff beyond fs/2 (all-stop filter)
+        low_cutoff_i = int(padded_length / 2)
+    else:
+        low_cutoff_i = np.ceil(
+            LowCutoff * padded_length * sample_period).astype('int')
+
+    if (HighCutoff > sample_freq / 2. or HighCutoff is None):
+        # Cutoff beyond fs/2 or unspecified (become a highpass filter)
+        high_cutoff_i = int(padded_length / 2)
+    else:
+        high_cutoff_i = np.fix(
+            HighCutoff * padded_length * sample_period).astype('int')
+
+    # the negative frequencies of the full FFT mask mirror the positive ones,
+    # so only the positive half is needed with the real FFT
+    freq_mask = np.zeros(padded_length // 2 + 1, dtype='bool')
+    freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
+
+    return padded_length, freq_mask
+
+
+def ideal_bandpass(data, sample_period, bandpass_freqs):
+    """
+    Performs ideal bandpass filtering on a single time-series.
+
+    Parameters
+    ----------
+    data : ndarray
+        Time-series.
+    sample_period : float
+        Length of sampling period in seconds.
+    bandpass_freqs : tuple
+        Tuple containing the bandpass frequencies. (LowCutoff_HighPass HighCutoff_LowPass)
+
+    Returns
+    -------
+    data_bp : ndarray
+        Filtered time-series.
+
+    """
+
+    # Derived from YAN Chao-Gan 120504 based on REST.
+    sample_freq = 1. / sample_period
+    sample_length = data.shape[0]
+
+    data_p = np.zeros(int(2**np.ceil(np.log2(sample_length))))
+    data_p[:sample_length] = data
+
+    LowCutoff, HighCutoff = bandpass_freqs
+
+    if (LowCutoff is None):  # No lower cutoff (low-pass filter)
+        low_cutoff_i = 0
+    elif (LowCutoff > sample_freq / 2.):
+        # Cutoff beyond fs/2 (all-stop filter)
+        low_cutoff_i = int(data_p.shape[0] / 2)
+    else:
+        low_cutoff_i = np.ceil(
+            LowCutoff * data_p.shape[0] * sample_period).astype('int')
+
+    if (HighCutoff > sample_freq / 2. or HighCutoff is None):
+        # Cutoff beyond fs/2 or unspecified (become a highpass filter)
+        high_cutoff_i = int(data_p.shape[0] / 2)
+    else:
+        high_cutoff_i = np.fix(
+            HighCutoff * data_p.shape[0] * sample_period).astype('int')
+
+    freq_mask = np.zeros_like(data_p, dtype='bool')
+    freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
+    freq_mask[
+        data_p.shape[0] -
+        high_cutoff_i:data_p.shape[0] + 1 - low_cutoff_i
+    ] = True
+
+    f_data = fft(data_p)
+    f_data[freq_mask != True] = 0.
+    data_bp = np.real_if_close(ifft(f_data)[:sample_length])
+
+    return data_bp
+
+
+def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None,
+                    chunk_size=5000):
     """
     Performs ideal bandpass filtering on each voxel time-series.
-    
+
+    The frequency mask is built once, and the demeaned time-series are
+    filtered chunk_size voxels at a time with real FFTs along the time
+    axis, writing the results back in place into a float32 copy of the
+    image, so only one chunk is held in double precision.
+
     Parameters
     ----------
     realigned_file : string
@@ -18,58 +137,20 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
     sample_period : float, optional
         Length of sampling period in seconds.  If not specified,
         this value is read from the nifti file provided.
-        
+    chunk_size : int, optional
+        Number of voxels filtered at once.
+
     Returns
     -------
     bandpassed_file : string
         Path of filtered output (nifti file).
-    
-    """
 
-    def ideal_bandpass(data, sample_period, bandpass_freqs):
-        # Derived from YAN Chao-Gan 120504 based on REST.
-        sample_freq = 1. / sample_period
-        sample_length = data.shape[0]
-
-        data_p = np.zeros(int(2**np.ceil(np.log2(sample_length))))
-        data_p[:sample_length] = data
-
-        LowCutoff, HighCutoff = bandpass_freqs
-
-        if (LowCutoff is None):  # No lower cutoff (low-pass filter)
-            low_cutoff_i = 0
-        elif (LowCutoff > sample_freq / 2.):
-            # Cutoff beyond fs/2 (all-stop filter)
-            low_cutoff_i = int(data_p.shape[0] / 2)
-        else:
-            low_cutoff_i = np.ceil(
-                LowCutoff * data_p.shape[0] * sample_period).astype('int')
-
-        if (HighCutoff > sample_freq / 2. or HighCutoff is None):
-            # Cutoff beyond fs/2 or unspecified (become a highpass filter)
-            high_cutoff_i = int(data_p.shape[0] / 2)
-        else:
-            high_cutoff_i = np.fix(
-                HighCutoff * data_p.shape[0] * sample_period).astype('int')
-
-        freq_mask = np.zeros_like(data_p, dtype='bool')
-        freq_mask[low_cutoff_i:high_cutoff_i + 1] = True
-        freq_mask[
-            data_p.shape[0] -
-            high_cutoff_i:data_p.shape[0] + 1 - low_cutoff_i
-        ] = True
-
-        f_data = fft(data_p)
-        f_data[freq_mask != True] = 0.
-        data_bp = np.real_if_close(ifft(f_data)[:sample_length])
-
-        return data_bp
+    """
 
     nii = nb.load(realigned_file)
-    data = nii.get_data().astype('float64')
-    mask = (data != 0).sum(-1) != 0
-    Y = data[mask].T
-    Yc = Y - np.tile(Y.mean(0), (Y.shape[0], 1))
+    data = nii.get_fdata(caching='unchanged', dtype=np.float32)
+    mask = (data != 0).any(axis=-1)
+    mask_indices = np.where(mask)
 
     if not sample_period:
         hdr = nii.get_header()
@@ -78,13 +159,27 @@ def bandpass_voxels(realigned_file, bandpass_freqs, sample_period=None):
         if sample_period > 20.0:
             sample_period /= 1000.0
 
-    Y_bp = np.zeros_like(Y)
-    for j in range(Y.shape[1]):
-        Y_bp[:, j] = ideal_bandpass(Yc[:, j], sample_period, bandpass_freqs)
+    sample_length = data.shape[-1]
+    padded_length, freq_mask = ideal_bandpass_mask(sample_length,
+                                                   sample_period,
+                                                   bandpass_freqs)
+
+    voxels = len(mask_indices[0])
+    chunk_size = max(int(chunk_size), 1)
+    for start in range(0, voxels, chunk_size):
+        chunk = tuple(i[start:start + chunk_size] for i in mask_indices)
+
+        Y = data[chunk].astype('float64')
+        Y -= Y.mean(axis=1, keepdims=True)
+
+        f_data = np.fft.rfft(Y, n=padded_length, axis=1)
+        f_data[:, ~freq_mask] = 0.
+        data[chunk] = np.fft.irfft(f_data, n=padded_length,
+                                   axis=1)[:, :sample_length]
 
-    data[mask] = Y_bp.T
-    img = nb.Nifti1Image(data, header=nii.get_header(),
-                         affine=nii.get_affine())
+    hdr = nii.get_header().copy()
+    hdr.set_data_dtype(np.float32)
+    img = nb.Nifti1Image(data, header=hdr, affine=nii.get_affine())
     bandpassed_file = os.path.join(os.getcwd(),
                                    'bandpassed_demeaned_filtered.nii.gz')
     img.to_filename(bandpassed_file)
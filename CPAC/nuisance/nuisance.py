@@ -11,6 +11,7 @@ from nipype.interfaces import afni
 
 import CPAC
 import CPAC.utils as utils
+from CPAC.utils import slab_dataobj
 from CPAC.utils.interfaces.function import Function
 from CPAC.utils.interfaces.masktool import MaskTool
 from CPAC.utils.interfaces.pc import PC
@@ -24,6 +25,7 @@ from CPAC.nuisance.utils import (
 
 from CPAC.nuisance.utils.compcor import (
     calc_compcor_components,
+    calc_compcor_components_chunked,
     cosine_filter,
     TR_string_to_float)
 
@@ -38,24 +40,23 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.ants as ants
 
 
-def gather_nuisance(functional_file_path,
-                    selector,
-                    grey_matter_summary_file_path=None,
-                    white_matter_summary_file_path=None,
-                    csf_summary_file_path=None,
-                    acompcor_file_path=None,
-                    tcompcor_file_path=None,
-                    global_summary_file_path=None,
-                    motion_parameters_file_path=None,
-                    custom_file_paths=None,
-                    censor_file_path=None):
+def compile_nuisance_regressors(functional_file_path,
+                                selector,
+                                grey_matter_summary_file_path=None,
+                                white_matter_summary_file_path=None,
+                                csf_summary_file_path=None,
+                                acompcor_file_path=None,
+                                tcompcor_file_path=None,
+                                global_summary_file_path=None,
+                                motion_parameters_file_path=None,
+                                custom_file_paths=None,
+                                censor_file_path=None):
     """
-    Gathers the various nuisance regressors together into a single tab separated values file that is an appropriate for
-    input into 3dTproject
+    Gathers the various nuisance regressors together into an in-memory design. Spike regressors are not expanded
+    into one column per censored volume, but returned as the indices of the volumes they regress out.
 
     :param functional_file_path: path to file that the regressors are being calculated for, is used to calculate
            the length of the regressors for error checking and in particular for calculating spike regressors
-    :param output_file_path: path to output TSV that will contain the various nuisance regressors as columns
     :param grey_matter_summary_file_path: path to TSV that includes summary of grey matter time courses, e.g. output of
         mask_summarize_time_course
     :param white_matter_summary_file_path: path to TSV that includes summary of white matter time courses, e.g. output
@@ -72,7 +73,8 @@ def gather_nuisance(functional_file_path,
     :param custom_file_paths: path to CSV/TSV files to use as regressors
     :param censor_file_path: path to TSV with a single column with 1's for indices that should be retained and 0's
               for indices that should be censored
-    :return:
+    :return: tuple of the regressor column names, the regressors as a (time points, regressors) array, the indices
+        of the spike regressors volumes, and the number of time points
     """
 
     # Basic checks for the functional image
@@ -126,6 +128,7 @@ def gather_nuisance(functional_file_path,
     # Compile regressors into a matrix
     column_names = []
     nuisance_regressors = []
+    spike_indices = np.array([], dtype=int)
 
     for regressor_type in regressors_order:
 
@@ -264,68 +267,101 @@ def gather_nuisance(functional_file_path,
             raise ValueError("Regressor type Censor specified in selectors but "
                              "the corresponding file was not found!")
 
-        try:
-            censor_volumes = np.loadtxt(regressor_file)
-        except:
-            raise ValueError("Could not read regressor {0} from {1}."
-                             .format(regressor_type, regressor_file))
+        spike_indices = censor_file_indices(
+            regressor_file,
+            regressor_length,
+            selector.get('number_of_previous_trs_to_censor', 0),
+            selector.get('number_of_subsequent_trs_to_censor', 0)
+        )
 
-        if (len(censor_volumes.shape) > 1 and censor_volumes.shape[1] > 1) or \
-           not np.all(np.isin(censor_volumes, [0, 1])):
+    if nuisance_regressors:
+        nuisance_regressors = np.array(nuisance_regressors).T
+    else:
+        nuisance_regressors = np.zeros((regressor_length, 0))
 
-            raise ValueError(
-                "Invalid format for censor file {0}, should be a single "
-                "column containing 1s for volumes to keep and 0s for volumes "
-                "to censor.".format(regressor_file)
-            )
+    return column_names, nuisance_regressors, spike_indices, regressor_length
 
-        censor_volumes = censor_volumes.flatten()
-        censor_indices = np.where(censor_volumes == 0)[0]
 
-        out_of_range_censors = censor_indices >= regressor_length
-        if np.any(out_of_range_censors):
-            raise ValueError(
-                "Censor volumes {0} are out of range"
-                "on censor file {1}, calculated "
-                "regressor length is {2}".format(
-                    censor_indices[out_of_range_censors],
-                    regressor_file,
-                    regressor_length
-                )
-            )
+def censor_file_indices(censor_file_path, regressor_length,
+                        previous_trs_to_censor=0,
+                        subsequent_trs_to_censor=0):
+    """
+    Reads the volumes to censor from a censor file, extending each censored volume with its previous and
+    subsequent volumes.
+
+    :param censor_file_path: path to TSV with a single column with 1's for indices that should be retained and 0's
+              for indices that should be censored
+    :param regressor_length: number of volumes of the functional file
+    :param previous_trs_to_censor: number of previous volumes to censor
+    :param subsequent_trs_to_censor: number of subsequent volumes to censor
+    :return: sorted array of the indices of the censored volumes
+    """
 
-        if len(censor_indices) > 0:
+    try:
+        censor_volumes = np.loadtxt(censor_file_path)
+    except:
+        raise ValueError("Could not read regressor {0} from {1}."
+                         .format('Censor', censor_file_path))
 
-            # if number_of_previous_trs_to_censor and number_of_subsequent_trs_to_censor
-            # are not set, assume they should be zero
-            previous_trs_to_censor = \
-                selector.get('number_of_previous_trs_to_censor', 0)
+    if (len(censor_volumes.shape) > 1 and censor_volumes.shape[1] > 1) or \
+       not np.all(np.isin(censor_volumes, [0, 1])):
 
-            subsequent_trs_to_censor = \
-                selector.get('number_of_subsequent_trs_to_censor', 0)
+        raise ValueError(
+            "Invalid format for censor file {0}, should be a single "
+            "column containing 1s for volumes to keep and 0s for volumes "
+            "to censor.".format(censor_file_path)
+        )
 
-            spike_regressors = np.zeros(regressor_length)
+    censor_volumes = censor_volumes.flatten()
+    censor_indices = np.where(censor_volumes == 0)[0]
+
+    out_of_range_censors = censor_indices >= regressor_length
+    if np.any(out_of_range_censors):
+        raise ValueError(
+            "Censor volumes {0} are out of range"
+            "on censor file {1}, calculated "
+            "regressor length is {2}".format(
+                censor_indices[out_of_range_censors],
+                censor_file_path,
+                regressor_length
+            )
+        )
 
-            for censor_index in censor_indices:
+    # if number_of_previous_trs_to_censor and number_of_subsequent_trs_to_censor
+    # are not set, assume they should be zero
+    censored = np.zeros(regressor_length, dtype=bool)
+    for censor_index in censor_indices:
+        censor_begin_index = max(censor_index - (previous_trs_to_censor or 0), 0)
+        censor_end_index = min(censor_index + (subsequent_trs_to_censor or 0),
+                               regressor_length - 1)
+        censored[censor_begin_index:censor_end_index + 1] = True
 
-                censor_begin_index = censor_index - previous_trs_to_censor
-                if censor_begin_index < 0:
-                    censor_begin_index = 0
+    return np.where(censored)[0]
 
-                censor_end_index = censor_index + subsequent_trs_to_censor
-                if censor_end_index >= regressor_length:
-                    censor_end_index = regressor_length - 1
 
-                spike_regressors[censor_begin_index:censor_end_index + 1] = 1
+def write_nuisance_regressors(column_names, nuisance_regressors,
+                              spike_indices, regressor_length):
+    """
+    Writes the nuisance regressors, with one column per spike regressor, into a single tab separated values file that
+    is appropriate for input into 3dTproject
+
+    :param column_names: names of the regressor columns
+    :param nuisance_regressors: (time points, regressors) array
+    :param spike_indices: indices of the spike regressors volumes
+    :param regressor_length: number of time points
+    :return: path to the regressors file, or None if there are no regressors
+    """
 
-            for censor_index in np.where(spike_regressors == 1)[0]:
+    spikes = np.zeros((regressor_length, len(spike_indices)))
+    spikes[spike_indices, np.arange(len(spike_indices))] = 1
 
-                column_names.append("SpikeRegression{0}".format(censor_index))
-                spike_regressor_index = np.zeros(regressor_length)
-                spike_regressor_index[censor_index] = 1
-                nuisance_regressors.append(spike_regressor_index.flatten())
+    column_names = list(column_names) + [
+        "SpikeRegression{0}".format(censor_index)
+        for censor_index in spike_indices
+    ]
+    nuisance_regressors = np.hstack([nuisance_regressors, spikes])
 
-    if len(nuisance_regressors) == 0:
+    if nuisance_regressors.shape[1] == 0:
         return None
 
     # Compile columns into regressor file
@@ -338,15 +374,690 @@ def gather_nuisance(functional_file_path,
         ofd.write("# Nuisance regressors:\n")
         ofd.write("# " + "\t".join(column_names) + "\n")
 
-        nuisance_regressors = np.array(nuisance_regressors)
-        np.savetxt(ofd, nuisance_regressors.T, fmt='%.18f', delimiter='\t')
+        np.savetxt(ofd, nuisance_regressors, fmt='%.18f', delimiter='\t')
 
     return output_file_path
 
 
+def gather_nuisance(functional_file_path,
+                    selector,
+                    grey_matter_summary_file_path=None,
+                    white_matter_summary_file_path=None,
+                    csf_summary_file_path=None,
+                    acompcor_file_path=None,
+                    tcompcor_file_path=None,
+                    global_summary_file_path=None,
+                    motion_parameters_file_path=None,
+                    custom_file_paths=None,
+                    censor_file_path=None):
+    """
+    Gathers the various nuisance regressors together into a single tab separated values file that is an appropriate for
+    input into 3dTproject
+
+    :param functional_file_path: path to file that the regressors are being calculated for, is used to calculate
+           the length of the regressors for error checking and in particular for calculating spike regressors
+    :param selector: NuisanceRegressor describing the regressors to gather, see compile_nuisance_regressors for the
+        remaining parameters
+    :return: path to the regressors file
+    """
+
+    column_names, nuisance_regressors, spike_indices, regressor_length = \
+        compile_nuisance_regressors(
+            functional_file_path, selector,
+            grey_matter_summary_file_path=grey_matter_summary_file_path,
+            white_matter_summary_file_path=white_matter_summary_file_path,
+            csf_summary_file_path=csf_summary_file_path,
+            acompcor_file_path=acompcor_file_path,
+            tcompcor_file_path=tcompcor_file_path,
+            global_summary_file_path=global_summary_file_path,
+            motion_parameters_file_path=motion_parameters_file_path,
+            custom_file_paths=custom_file_paths,
+            censor_file_path=censor_file_path
+        )
+
+    return write_nuisance_regressors(column_names, nuisance_regressors,
+                                     spike_indices, regressor_length)
+
+
+def nuisance_design(nuisance_regressors, regressor_length, polort=0):
+    """
+    Builds the nuisance design matrix, with the Legendre polynomials up to degree polort that 3dTproject adds
+    followed by the nuisance regressors.
+
+    :param nuisance_regressors: (time points, regressors) array
+    :param regressor_length: number of time points
+    :param polort: degree of the polynomials
+    :return: (time points, polynomials + regressors) design matrix
+    """
+
+    polynomials = np.polynomial.legendre.legvander(
+        np.linspace(-1, 1, regressor_length), polort or 0
+    )
+
+    return np.hstack([polynomials, nuisance_regressors])
+
+
+def nuisance_basis(design, tolerance=1e-10):
+    """
+    Computes an orthonormal basis of the space spanned by the design, with a QR factorization, falling back to an
+    SVD if the design is rank deficient.
+
+    :param design: (time points, regressors) design matrix
+    :param tolerance: relative tolerance to consider a regressor as linearly dependent
+    :return: (time points, rank) orthonormal basis
+    """
+
+    Q, R = np.linalg.qr(design)
+
+    diagonal = np.abs(np.diag(R))
+    if diagonal.size and diagonal.min() > tolerance * diagonal.max():
+        return Q
+
+    U, S, _ = np.linalg.svd(design, full_matrices=False)
+    return U[:, S > tolerance * S.max()]
+
+
+def censor_interpolation(regressor_length, spike_indices=None,
+                         censor_indices=None, censor_method=None):
+    """
+    Works out which volumes are fitted by the nuisance regression, given the spike regressors and the censoring
+    method.
+
+    :param regressor_length: number of time points
+    :param spike_indices: indices of the volumes with spike regressors
+    :param censor_indices: indices of the censored volumes
+    :param censor_method: 'Kill', 'Zero' or 'Interpolate', how to handle the censored volumes
+    :return: tuple of the indices of the fitted volumes, the indices of the interpolated and of the valid volumes,
+        and the (interpolated, valid) linear interpolation weights, None if no volume is interpolated
+    """
+
+    if censor_method not in (None, 'Kill', 'Zero', 'Interpolate'):
+        raise ValueError("Improper censoring method specified ({0}), should be "
+                         "one of Kill, Zero or Interpolate.".format(censor_method))
+
+    excluded = np.zeros(regressor_length, dtype=bool)
+    if spike_indices is not None:
+        excluded[spike_indices] = True
+
+    censored = np.zeros(regressor_length, dtype=bool)
+    if censor_method and censor_indices is not None:
+        censored[censor_indices] = True
+
+    if censor_method != 'Interpolate':
+        excluded |= censored
+
+    kept = np.where(~excluded)[0]
+
+    # censored volumes are linearly interpolated from the nearest kept
+    # volumes, with the same weights for every voxel
+    if censor_method == 'Interpolate' and censored.any():
+        interpolated_volumes = np.where(censored)[0]
+        valid_volumes = np.where(~censored)[0]
+        interpolation = np.column_stack([
+            np.interp(interpolated_volumes, valid_volumes, weights)
+            for weights in np.eye(len(valid_volumes))
+        ])
+    else:
+        interpolated_volumes = valid_volumes = interpolation = None
+
+    return kept, interpolated_volumes, valid_volumes, interpolation
+
+
+def regress_nuisance(functional_file_path, nuisance_regressors,
+                     functional_brain_mask_file_path=None,
+                     spike_indices=None, censor_indices=None,
+                     censor_method=None, polort=0, chunk_size=10000):
+    """
+    Regresses the nuisance regressors out of each voxel time series, as 3dTproject with the -ort, -polort, -censor
+    and -cenmode options.
+
+    The design is factorized once per scan, and the image is projected one slab of about chunk_size voxels at a
+    time. Spike regressors are not added to the design: regressing a volume out with its own spike regressor is
+    the same as excluding it from the fit and zeroing its residual.
+
+    :param functional_file_path: path to the functional nifti file
+    :param nuisance_regressors: (time points, regressors) array
+    :param functional_brain_mask_file_path: path to the brain mask, voxels outside of the mask are set to zero
+    :param spike_indices: indices of the volumes with spike regressors
+    :param censor_indices: indices of the censored volumes
+    :param censor_method: 'Kill', 'Zero' or 'Interpolate', how to handle the censored volumes
+    :param polort: degree of the polynomials to regress out
+    :param chunk_size: approximate number of voxels projected at once
+    :return: path to the residuals nifti file
+    """
+
+    functional_image = nb.load(functional_file_path)
+    functional_data = slab_dataobj(functional_image)
+    shape = functional_image.shape
+    regressor_length = shape[3]
+
+    if functional_brain_mask_file_path:
+        mask = nb.load(functional_brain_mask_file_path).get_data() > 0
+        if mask.shape[:3] != shape[:3]:
+            raise ValueError("The data in {0} and {1} do not have a consistent shape"
+                             .format(functional_file_path,
+                                     functional_brain_mask_file_path))
+    else:
+        mask = np.ones(shape[:3], dtype=bool)
+
+    kept, interpolated_volumes, valid_volumes, interpolation = \
+        censor_interpolation(regressor_length, spike_indices,
+                             censor_indices, censor_method)
+
+    design = nuisance_design(nuisance_regressors, regressor_length, polort)
+    Q = nuisance_basis(design[kept])
+
+    output_volumes = kept if censor_method == 'Kill' else np.arange(regressor_length)
+    residuals = np.zeros(shape[:3] + (len(output_volumes),), dtype=np.float32)
+
+    slab = max(int(chunk_size) // (shape[0] * shape[1]), 1)
+    for z0 in range(0, shape[2], slab):
+        z1 = min(z0 + slab, shape[2])
+
+        slab_mask = mask[:, :, z0:z1]
+        if not slab_mask.any():
+            continue
+
+        Y = np.asarray(functional_data[:, :, z0:z1, :])[slab_mask]
+        Y = Y.astype(np.float64)
+
+        if interpolation is not None:
+            Y[:, interpolated_volumes] = \
+                Y[:, valid_volumes].dot(interpolation.T)
+
+        Y_kept = Y[:, kept]
+        Y_kept -= Y_kept.dot(Q).dot(Q.T)
+
+        if censor_method == 'Kill':
+            Y = Y_kept
+        else:
+            Y[:] = 0
+            Y[:, kept] = Y_kept
+
+        slab_residuals = residuals[:, :, z0:z1]
+        slab_residuals[slab_mask] = Y
+
+    header = functional_image.get_header().copy()
+    header.set_data_dtype(np.float32)
+    residual_file_path = os.path.join(os.getcwd(), 'residuals.nii.gz')
+    nb.Nifti1Image(residuals, header=header,
+                   affine=functional_image.get_affine()).to_filename(residual_file_path)
+
+    return residual_file_path
+
+
+def nuisance_strategy(functional_file_path,
+                      selector,
+                      grey_matter_summary_file_path=None,
+                      white_matter_summary_file_path=None,
+                      csf_summary_file_path=None,
+                      acompcor_file_path=None,
+                      tcompcor_file_path=None,
+                      global_summary_file_path=None,
+                      motion_parameters_file_path=None,
+                      custom_file_paths=None,
+                      censor_file_path=None):
+    """
+    Gathers the nuisance regressors and the censoring of a selector into the arguments of regress_nuisance.
+
+    :param functional_file_path: path to the functional nifti file
+    :param selector: NuisanceRegressor describing the regression, including the PolyOrt degree and the Censor
+        method
+    :param censor_file_path: path to TSV with a single column with 1's for indices that should be retained and 0's
+              for indices that should be censored, for any censoring method
+    :return: tuple of the regressor column names and a dictionary with the nuisance_regressors, spike_indices,
+        censor_indices, censor_method and polort of the regression
+    """
+
+    column_names, nuisance_regressors, spike_indices, regressor_length = \
+        compile_nuisance_regressors(
+            functional_file_path, selector,
+            grey_matter_summary_file_path=grey_matter_summary_file_path,
+            white_matter_summary_file_path=white_matter_summary_file_path,
+            csf_summary_file_path=csf_summary_file_path,
+            acompcor_file_path=acompcor_file_path,
+            tcompcor_file_path=tcompcor_file_path,
+            global_summary_file_path=global_summary_file_path,
+            motion_parameters_file_path=motion_parameters_file_path,
+            custom_file_paths=custom_file_paths,
+            censor_file_path=censor_file_path
+        )
+
+    censor_method = None
+    censor_indices = None
+    if selector.get('Censor') and \
+            selector['Censor'].get('method') != 'SpikeRegression':
+        if not censor_file_path:
+            raise ValueError("Censoring specified in selectors but the "
+                             "censor file was not found!")
+        censor_method = selector['Censor']['method']
+        censor_indices = censor_file_indices(censor_file_path,
+                                             regressor_length)
+
+    polort = (selector.get('PolyOrt') or {}).get('degree') or 0
+
+    return column_names, {
+        'nuisance_regressors': nuisance_regressors,
+        'spike_indices': spike_indices,
+        'censor_indices': censor_indices,
+        'censor_method': censor_method,
+        'polort': polort,
+    }
+
+
+def native_nuisance_regression(functional_file_path,
+                               selector,
+                               functional_brain_mask_file_path=None,
+                               grey_matter_summary_file_path=None,
+                               white_matter_summary_file_path=None,
+                               csf_summary_file_path=None,
+                               acompcor_file_path=None,
+                               tcompcor_file_path=None,
+                               global_summary_file_path=None,
+                               motion_parameters_file_path=None,
+                               custom_file_paths=None,
+                               censor_file_path=None,
+                               chunk_size=10000):
+    """
+    Gathers the nuisance regressors and regresses them out of the functional image in process, keeping the design
+    in memory instead of handing it to 3dTproject through a text file.
+
+    :param functional_file_path: path to the functional nifti file
+    :param selector: NuisanceRegressor describing the regression, including the PolyOrt degree and the Censor
+        method
+    :param functional_brain_mask_file_path: path to the brain mask
+    :param censor_file_path: path to TSV with a single column with 1's for indices that should be retained and 0's
+              for indices that should be censored, for any censoring method
+    :param chunk_size: approximate number of voxels projected at once
+    :return: paths to the regressors file (for reference, None if there are no regressors) and the residuals
+    """
+
+    from CPAC.nuisance.nuisance import (
+        nuisance_strategy,
+        regress_nuisance,
+        write_nuisance_regressors
+    )
+
+    column_names, strategy = nuisance_strategy(
+        functional_file_path, selector,
+        grey_matter_summary_file_path=grey_matter_summary_file_path,
+        white_matter_summary_file_path=white_matter_summary_file_path,
+        csf_summary_file_path=csf_summary_file_path,
+        acompcor_file_path=acompcor_file_path,
+        tcompcor_file_path=tcompcor_file_path,
+        global_summary_file_path=global_summary_file_path,
+        motion_parameters_file_path=motion_parameters_file_path,
+        custom_file_paths=custom_file_paths,
+        censor_file_path=censor_file_path
+    )
+
+    residual_file_path = regress_nuisance(
+        functional_file_path,
+        functional_brain_mask_file_path=functional_brain_mask_file_path,
+        chunk_size=chunk_size,
+        **strategy
+    )
+
+    regressors_file_path = write_nuisance_regressors(
+        column_names, strategy['nuisance_regressors'],
+        strategy['spike_indices'],
+        strategy['nuisance_regressors'].shape[0]
+    )
+
+    return regressors_file_path, residual_file_path
+
+
+def save_nuisance_design(functional_file_path,
+                         selector,
+                         grey_matter_summary_file_path=None,
+                         white_matter_summary_file_path=None,
+                         csf_summary_file_path=None,
+                         acompcor_file_path=None,
+                         tcompcor_file_path=None,
+                         global_summary_file_path=None,
+                         motion_parameters_file_path=None,
+                         custom_file_paths=None,
+                         censor_file_path=None):
+    """
+    Gathers the nuisance regressors and the censoring of a selector and saves them, so the regressions of all the
+    selectors of a scan can be performed together by native_nuisance_regression_batch.
+
+    :param functional_file_path: path to the functional nifti file
+    :param selector: NuisanceRegressor describing the regression, including the PolyOrt degree and the Censor
+        method
+    :param censor_file_path: path to TSV with a single column with 1's for indices that should be retained and 0's
+              for indices that should be censored, for any censoring method
+    :return: paths to the regressors file (for reference, None if there are no regressors) and the design file
+    """
+
+    import os
+    import numpy as np
+    from CPAC.nuisance.nuisance import (
+        nuisance_strategy,
+        write_nuisance_regressors
+    )
+
+    column_names, strategy = nuisance_strategy(
+        functional_file_path, selector,
+        grey_matter_summary_file_path=grey_matter_summary_file_path,
+        white_matter_summary_file_path=white_matter_summary_file_path,
+        csf_summary_file_path=csf_summary_file_path,
+        acompcor_file_path=acompcor_file_path,
+        tcompcor_file_path=tcompcor_file_path,
+        global_summary_file_path=global_summary_file_path,
+        motion_parameters_file_path=motion_parameters_file_path,
+        custom_file_paths=custom_file_paths,
+        censor_file_path=censor_file_path
+    )
+
+    design_file_path = os.path.join(os.getcwd(), 'nuisance_design.npz')
+    np.savez(
+        design_file_path,
+        nuisance_regressors=strategy['nuisance_regressors'],
+        spike_indices=strategy['spike_indices'],
+        censor_indices=(strategy['censor_indices']
+                        if strategy['censor_indices'] is not None
+                        else np.array([], dtype=int)),
+        censor_method=strategy['censor_method'] or '',
+        polort=strategy['polort']
+    )
+
+    regressors_file_path = write_nuisance_regressors(
+        column_names, strategy['nuisance_regressors'],
+        strategy['spike_indices'],
+        strategy['nuisance_regressors'].shape[0]
+    )
+
+    return regressors_file_path, design_file_path
+
+
+def load_nuisance_design(design_file_path):
+    """
+    Loads a design saved by save_nuisance_design.
+
+    :param design_file_path: path to the design file
+    :return: dictionary with the nuisance_regressors, spike_indices, censor_indices, censor_method and polort of
+        the regression
+    """
+
+    design = np.load(design_file_path)
+    censor_method = str(design['censor_method']) or None
+
+    return {
+        'nuisance_regressors': design['nuisance_regressors'],
+        'spike_indices': design['spike_indices'],
+        'censor_indices': design['censor_indices'] if censor_method else None,
+        'censor_method': censor_method,
+        'polort': int(design['polort']),
+    }
+
+
+# shape of the functional scans whose size can not be read before running
+TYPICAL_FUNCTIONAL_SHAPE = (64, 64, 40, 300)
+
+
+def regress_nuisance_strategies(functional_file_path, strategies,
+                                functional_brain_mask_file_path=None,
+                                chunk_size=10000):
+    """
+    Performs the nuisance regressions of several strategies on the same scan, as regress_nuisance for each of
+    them, reading the image once.
+
+    Strategies fitting the same volumes with the same censoring are projected together: the design columns they
+    all share (usually the polynomial trends, the motion parameters and their derivatives) are factorized once,
+    and each strategy only factorizes its own columns, orthogonalized against the shared ones. Each slab of voxels
+    is projected on the shared basis once, and the residuals of every strategy are updated from there.
+
+    :param functional_file_path: path to the functional nifti file
+    :param strategies: list of dictionaries with the nuisance_regressors, spike_indices, censor_indices,
+        censor_method and polort arguments of regress_nuisance
+    :param functional_brain_mask_file_path: path to the brain mask, voxels outside of the mask are set to zero
+    :param chunk_size: approximate number of voxels projected at once
+    :return: list of the paths to the residuals of each strategy, uncompressed nifti files written slab by slab
+    """
+
+    functional_image = nb.load(functional_file_path)
+    functional_data = slab_dataobj(functional_image)
+    shape = functional_image.shape
+    regressor_length = shape[3]
+
+    if functional_brain_mask_file_path:
+        mask = nb.load(functional_brain_mask_file_path).get_data() > 0
+        if mask.shape[:3] != shape[:3]:
+            raise ValueError("The data in {0} and {1} do not have a consistent shape"
+                             .format(functional_file_path,
+                                     functional_brain_mask_file_path))
+    else:
+        mask = np.ones(shape[:3], dtype=bool)
+
+    # strategies fitting the same volumes of the same data share a group
+    groups = []
+    for s, strategy in enumerate(strategies):
+        kept, interpolated_volumes, valid_volumes, interpolation = \
+            censor_interpolation(regressor_length,
+                                 strategy.get('spike_indices'),
+                                 strategy.get('censor_indices'),
+                                 strategy.get('censor_method'))
+        design = nuisance_design(strategy['nuisance_regressors'],
+                                 regressor_length,
+                                 strategy.get('polort', 0))[kept]
+
+        for group in groups:
+            if np.array_equal(group['kept'], kept) and \
+                    np.array_equal(group['interpolated_volumes'],
+                                   interpolated_volumes):
+                break
+        else:
+            group = {
+                'kept': kept,
+                'interpolated_volumes': interpolated_volumes,
+                'valid_volumes': valid_volumes,
+                'interpolation': interpolation,
+                'strategies': [],
+            }
+            groups.append(group)
+
+        group['strategies'].append((s, design))
+
+    for group in groups:
+        designs = [design for _, design in group['strategies']]
+
+        shared = np.array([
+            all((design == column[:, np.newaxis]).all(0).any()
+                for design in designs[1:])
+            for column in designs[0].T
+        ], dtype=bool)
+        shared_design = designs[0][:, shared]
+
+        if shared_design.shape[1]:
+            group['basis'] = nuisance_basis(shared_design)
+        else:
+            group['basis'] = np.zeros((len(group['kept']), 0))
+        Q0 = group['basis']
+
+        group['updates'] = []
+        for design in designs:
+            own = ~np.array([
+                (shared_design == column[:, np.newaxis]).all(0).any()
+                for column in design.T
+            ], dtype=bool)
+            own_design = design[:, own]
+
+            # orthogonalize twice for numerical stability, and drop the
+            # columns already spanned by the shared basis
+            own_norms = np.linalg.norm(own_design, axis=0)
+            for _ in range(2):
+                own_design = own_design - Q0.dot(Q0.T.dot(own_design))
+            independent = np.linalg.norm(own_design, axis=0) > \
+                1e-10 * np.maximum(own_norms, np.finfo(float).tiny)
+            own_design = own_design[:, independent]
+
+            if own_design.shape[1]:
+                group['updates'].append(nuisance_basis(own_design))
+            else:
+                group['updates'].append(np.zeros((len(group['kept']), 0)))
+
+    # the residuals are written to their files as they are computed, only
+    # a slab of the data is held in memory
+    residual_file_paths = [
+        os.path.join(os.getcwd(), 'residuals_{0}.nii'.format(s))
+        for s in range(len(strategies))
+    ]
+    residuals = [None] * len(strategies)
+    for group in groups:
+        for s, _ in group['strategies']:
+            output_volumes = len(group['kept']) \
+                if strategies[s].get('censor_method') == 'Kill' \
+                else regressor_length
+            residuals[s] = nifti_memmap(residual_file_paths[s],
+                                        functional_image.get_header(),
+                                        shape[:3] + (output_volumes,))
+
+    slab = max(int(chunk_size) // (shape[0] * shape[1]), 1)
+    for z0 in range(0, shape[2], slab):
+        z1 = min(z0 + slab, shape[2])
+
+        slab_mask = mask[:, :, z0:z1]
+        if not slab_mask.any():
+            continue
+
+        data = np.asarray(functional_data[:, :, z0:z1, :])[slab_mask]
+        data = data.astype(np.float64)
+
+        for group in groups:
+            Y = data
+            if group['interpolation'] is not None:
+                Y = data.copy()
+                Y[:, group['interpolated_volumes']] = \
+                    Y[:, group['valid_volumes']].dot(group['interpolation'].T)
+
+            kept = group['kept']
+            Q0 = group['basis']
+
+            Y_kept = Y[:, kept]
+            Y_kept -= Y_kept.dot(Q0).dot(Q0.T)
+
+            for (s, _), Q in zip(group['strategies'], group['updates']):
+                Y_strategy = Y_kept - Y_kept.dot(Q).dot(Q.T)
+
+                slab_residuals = residuals[s][:, :, z0:z1]
+                if slab_residuals.shape[3] == len(kept):
+                    slab_residuals[slab_mask] = Y_strategy
+                else:
+                    Y_full = np.zeros(Y.shape)
+                    Y_full[:, kept] = Y_strategy
+                    slab_residuals[slab_mask] = Y_full
+
+    for strategy_residuals in residuals:
+        strategy_residuals.flush()
+    del residuals
+
+    return residual_file_paths
+
+
+def nifti_memmap(file_path, header, shape):
+    """
+    Creates an uncompressed float32 nifti file, filled with zeros, and maps its data in memory, so that the data
+    written to the array goes to the file as it is computed.
+
+    :param file_path: path of the nifti file to create
+    :param header: header to copy the orientation and the timing of the image from
+    :param shape: shape of the image
+    :return: writable memory-mapped array of the data of the file
+    """
+
+    header = nb.Nifti1Header.from_header(header)
+    header.set_data_dtype(np.float32)
+    header.set_data_shape(shape)
+    header.set_slope_inter(1.0, 0.0)
+    # the header and the four bytes of the empty extension flag
+    offset = header.sizeof_hdr + 4
+    header.set_data_offset(offset)
+
+    dtype = header.get_data_dtype()
+    with open(file_path, 'wb') as f:
+        header.write_to(f)
+        f.write(b'\x00' * 4)
+        f.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+    return np.memmap(file_path, dtype=dtype, mode='r+', offset=offset,
+                     shape=tuple(shape), order='F')
+
+
+def nuisance_regression_batch_mem_gb(functional_file_paths, strategies):
+    """
+    Memory (GB) of the batched nuisance regression of a scan: the float32 residuals of every strategy, mapped in
+    memory until they are written, and a slab of the data.
+
+    :param functional_file_paths: paths of the scans the regression may run on, the largest local one is used
+    :param strategies: number of strategies regressed together
+    :return: memory estimate in GB, for the mem_gb of the node
+    """
+
+    volume_size = 0
+    for functional_file_path in functional_file_paths:
+        try:
+            shape = nb.load(functional_file_path).shape
+        except Exception:
+            # remote scans, or placeholders of a workflow template
+            continue
+        volume_size = max(volume_size, int(np.prod(shape)))
+
+    if not volume_size:
+        volume_size = int(np.prod(TYPICAL_FUNCTIONAL_SHAPE))
+
+    return 0.5 + strategies * volume_size * 4 / 1024. ** 3
+
+
+def native_nuisance_regression_batch(functional_file_path, design_file_paths,
+                                     functional_brain_mask_file_path=None,
+                                     chunk_size=10000):
+    """
+    Regresses the designs saved by save_nuisance_design for the selectors of a scan out of the functional image,
+    sharing the factorization of their common regressors and a single pass over the image.
+
+    :param functional_file_path: path to the functional nifti file
+    :param design_file_paths: list of paths to the design files, one per selector
+    :param functional_brain_mask_file_path: path to the brain mask
+    :param chunk_size: approximate number of voxels projected at once
+    :return: list of the paths to the residuals, in the order of the design files
+    """
+
+    from CPAC.nuisance.nuisance import (
+        load_nuisance_design,
+        regress_nuisance_strategies
+    )
+
+    if not isinstance(design_file_paths, (list, tuple)):
+        design_file_paths = [design_file_paths]
+
+    return regress_nuisance_strategies(
+        functional_file_path,
+        [load_nuisance_design(path) for path in design_file_paths],
+        functional_brain_mask_file_path=functional_brain_mask_file_path,
+        chunk_size=chunk_size
+    )
+
+
+def has_voxel_nuisance_regressors(selector):
+    """
+    Checks whether a selector has voxel-wise regressors, which are only supported by 3dTproject.
+
+    :param selector: NuisanceRegressor describing the regression
+    :return: True if any of the Custom regressors is a nifti file that is not convolved
+    """
+
+    return any(
+        custom_regressor['file'].endswith(('.nii', '.nii.gz')) and
+        not custom_regressor.get('convolve')
+        for custom_regressor in selector.get('Custom') or []
+    )
+
+
 def create_nuisance_workflow(nuisance_selectors,
                              use_ants,
-                             name='nuisance'):
+                             name='nuisance',
+                             batched=False):
     """
     Workflow for the removal of various signals considered to be noise from resting state
     fMRI data.  The residual signals for linear regression denoising is performed in a single
@@ -357,6 +1068,8 @@ def create_nuisance_workflow(nuisance_selectors,
     :param nuisance_selectors: dictionary describing nuisance regression to be performed
     :param use_ants: flag indicating whether FNIRT or ANTS is used
     :param name: Name of the workflow, defaults to 'nuisance'
+    :param batched: only build the regression design, to be regressed out along with the designs of other selectors
+        by native_nuisance_regression_batch, if the selectors have no voxel-wise regressors
     :return: nuisance : nipype.pipeline.engine.Workflow
         Nuisance workflow.
 
@@ -561,6 +1274,8 @@ def create_nuisance_workflow(nuisance_selectors,
             Path of residual file in nifti format
         outputspec.regressors_file_path : string (TSV file)
             Path of TSV file of regressors used. Column name indicates the regressors included .
+        outputspec.design_file_path : string (npz file)
+            Path of the regression design, in batched mode, instead of the residuals.
 
     Nuisance Procedure:
 
@@ -630,7 +1345,8 @@ def create_nuisance_workflow(nuisance_selectors,
     ]), name='inputspec')
 
     outputspec = pe.Node(util.IdentityInterface(fields=['residual_file_path',
-                                                        'regressors_file_path']),
+                                                        'regressors_file_path',
+                                                        'design_file_path']),
                          name='outputspec')
 
     # Resources to create regressors
@@ -1040,10 +1756,12 @@ def create_nuisance_workflow(nuisance_selectors,
 
                     compcor_node = pe.Node(Function(input_names=['data_filename',
                                                                  'num_components',
-                                                                 'mask_filename'],
+                                                                 'mask_filename',
+                                                                 'chunk_size',
+                                                                 'method'],
                                                     output_names=[
                                                         'compcor_file'],
-                                                    function=calc_compcor_components,
+                                                    function=calc_compcor_components_chunked,
                                                     imports=compcor_imports),
                                            name='{}_DetrendPC'.format(regressor_type), mem_gb=2.0)
 
@@ -1211,23 +1929,60 @@ def create_nuisance_workflow(nuisance_selectors,
                 regressor_resource[1] = \
                     pipeline_resource_pool[regressor_file_resource_key]
 
+    # Voxel-wise regressors are only supported by 3dTproject, otherwise the
+    # regression is performed in process along with building the regressors
+    has_voxel_nuisance_regressors = any(
+        regressor_node
+        for regressor_key, (regressor_arg, regressor_node, regressor_target)
+        in regressors.items()
+        if regressor_target == 'dsort'
+    )
+
+    native_regression = not has_voxel_nuisance_regressors
+
     # Build regressors and combine them into a single file
-    build_nuisance_regressors = pe.Node(Function(
-        input_names=['functional_file_path',
-                     'selector',
-                     'grey_matter_summary_file_path',
-                     'white_matter_summary_file_path',
-                     'csf_summary_file_path',
-                     'acompcor_file_path',
-                     'tcompcor_file_path',
-                     'global_summary_file_path',
-                     'motion_parameters_file_path',
-                     'custom_file_paths',
-                     'censor_file_path'],
-        output_names=['out_file'],
-        function=gather_nuisance,
-        as_module=True
-    ), name="build_nuisance_regressors")
+    gather_input_names = ['functional_file_path',
+                          'selector',
+                          'grey_matter_summary_file_path',
+                          'white_matter_summary_file_path',
+                          'csf_summary_file_path',
+                          'acompcor_file_path',
+                          'tcompcor_file_path',
+                          'global_summary_file_path',
+                          'motion_parameters_file_path',
+                          'custom_file_paths',
+                          'censor_file_path']
+
+    if native_regression and batched:
+        build_nuisance_regressors = pe.Node(Function(
+            input_names=gather_input_names,
+            output_names=['out_file', 'design_file_path'],
+            function=save_nuisance_design,
+            as_module=True
+        ), name="build_nuisance_regressors")
+
+    elif native_regression:
+        build_nuisance_regressors = pe.Node(Function(
+            input_names=gather_input_names + [
+                'functional_brain_mask_file_path'
+            ],
+            output_names=['out_file', 'residual_file_path'],
+            function=native_nuisance_regression,
+            as_module=True
+        ), name="build_nuisance_regressors")
+
+        nuisance_wf.connect(
+            inputspec, 'functional_brain_mask_file_path',
+            build_nuisance_regressors, 'functional_brain_mask_file_path'
+        )
+
+    else:
+        build_nuisance_regressors = pe.Node(Function(
+            input_names=gather_input_names,
+            output_names=['out_file'],
+            function=gather_nuisance,
+            as_module=True
+        ), name="build_nuisance_regressors")
 
     nuisance_wf.connect(
         inputspec, 'functional_file_path',
@@ -1258,14 +2013,6 @@ def create_nuisance_workflow(nuisance_selectors,
                     build_nuisance_regressors, regressor_arg
                 )
 
-    # Check for any regressors to combine into files
-    has_voxel_nuisance_regressors = any(
-        regressor_node
-        for regressor_key, (regressor_arg, regressor_node, regressor_target)
-        in regressors.items()
-        if regressor_target == 'dsort'
-    )
-
     if has_voxel_nuisance_regressors:
 
         voxel_nuisance_regressors = [
@@ -1368,6 +2115,29 @@ def create_nuisance_workflow(nuisance_selectors,
         else:
             find_censors.inputs.number_of_subsequent_trs_to_censor = 0
 
+    if nuisance_selectors.get('PolyOrt'):
+        if not nuisance_selectors['PolyOrt'].get('degree'):
+            raise ValueError("Polynomial orthogonalization requested, "
+                             "but degree not provided.")
+
+    if native_regression:
+
+        if nuisance_selectors.get('Censor'):
+            nuisance_wf.connect(find_censors, 'out_file',
+                                build_nuisance_regressors, 'censor_file_path')
+
+        if batched:
+            nuisance_wf.connect(build_nuisance_regressors, 'design_file_path',
+                                outputspec, 'design_file_path')
+        else:
+            nuisance_wf.connect(build_nuisance_regressors, 'residual_file_path',
+                                outputspec, 'residual_file_path')
+
+        nuisance_wf.connect(build_nuisance_regressors, 'out_file',
+                            outputspec, 'regressors_file_path')
+
+        return nuisance_wf
+
     # Use 3dTproject to perform nuisance variable regression
     nuisance_regression = pe.Node(interface=afni.TProject(),
                                   name='nuisance_regression')
@@ -1391,10 +2161,6 @@ def create_nuisance_workflow(nuisance_selectors,
                                 nuisance_regression, 'censor')
 
     if nuisance_selectors.get('PolyOrt'):
-        if not nuisance_selectors['PolyOrt'].get('degree'):
-            raise ValueError("Polynomial orthogonalization requested, "
-                             "but degree not provided.")
-
         nuisance_regression.inputs.polort = \
             nuisance_selectors['PolyOrt']['degree']
 
@@ -0,0 +1,40 @@
+import os
+import tempfile
+import numpy as np
+import nibabel as nb
+from CPAC.nuisance.bandpass import ideal_bandpass, bandpass_voxels
+
+
+def test_bandpass_voxels():
+
+    dl_dir = tempfile.mkdtemp()
+    os.chdir(dl_dir)
+
+    rng = np.random.RandomState(42)
+
+    for timepoints in [100, 128, 131]:
+
+        data = rng.randn(6, 5, 4, timepoints).astype('float32') + 100.
+        data[0, 0, 0] = 0.
+
+        realigned_file = os.path.join(dl_dir, 'realigned.nii.gz')
+        nb.Nifti1Image(data, np.eye(4)).to_filename(realigned_file)
+
+        for bandpass_freqs in [(0.01, 0.1), (None, 0.1), (0.01, None),
+                               (0.01, 10.)]:
+
+            bandpassed_file = bandpass_voxels(realigned_file, bandpass_freqs,
+                                              sample_period=2.0,
+                                              chunk_size=17)
+            bandpassed = nb.load(bandpassed_file).get_data()
+
+            expected = np.zeros(data.shape)
+            mask = (data != 0).any(-1)
+            Y = data[mask].astype('float64')
+            Y -= Y.mean(1, keepdims=True)
+            expected[mask] = [ideal_bandpass(y, 2.0, bandpass_freqs)
+                              for y in Y]
+
+            assert bandpassed.dtype == np.float32
+            assert np.allclose(bandpassed, expected, atol=1e-4)
+            assert np.all(bandpassed[0, 0, 0] == 0)
@@ -0,0 +1,57 @@
+import os
+import numpy as np
+import nibabel as nb
+from CPAC.nuisance.utils.compcor import (
+    calc_compcor_components,
+    calc_compcor_components_chunked
+)
+
+
+def compcor_data(dl_dir, shape, timepoints, seed=42):
+
+    rng = np.random.RandomState(seed)
+
+    sources = rng.randn(timepoints, 3)
+    data = rng.randn(shape[0] * shape[1] * shape[2], timepoints) + 100.
+    data += rng.randn(data.shape[0], 3).dot(sources.T) * 2.
+    data = data.reshape(shape + (timepoints,)).astype(np.float32)
+
+    mask = (rng.rand(*shape) > 0.5).astype(np.int16)
+    data[0, 0, 0] = 50.
+    mask[0, 0, 0] = 1
+
+    data_filename = os.path.join(dl_dir, 'data.nii.gz')
+    mask_filename = os.path.join(dl_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(data_filename)
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_filename)
+
+    return data_filename, mask_filename
+
+
+def assert_same_components(A, B):
+    assert A.shape == B.shape
+    for a, b in zip(A.T, B.T):
+        assert np.allclose(a, b, atol=1e-6) or np.allclose(a, -b, atol=1e-6)
+
+
+def test_calc_compcor_components_chunked(tmpdir, monkeypatch):
+
+    # the components are written in the working directory
+    monkeypatch.chdir(str(tmpdir))
+
+    data_filename, mask_filename = compcor_data(str(tmpdir), (10, 9, 8), 60)
+
+    expected = np.loadtxt(
+        calc_compcor_components(data_filename, 5, mask_filename)
+    )
+
+    for method in ['auto', 'eigh', 'truncated']:
+        for chunk_size in [1, 50, 10000]:
+            components = np.loadtxt(
+                calc_compcor_components_chunked(data_filename, 5,
+                                                mask_filename,
+                                                chunk_size=chunk_size,
+                                                method=method)
+            )
+            assert_same_components(components, expected)
+
@@ -117,8 +117,8 @@ def test_nuisance_workflow_type1():
         nuisance_regression_workflow.inputs.inputspec.anat_to_mni_rigid_xfm_file_path = glob.glob(preprocessed + '/anat_mni_ants_register_0/calc_ants_warp/transform1Rigid.mat')[0]
         nuisance_regression_workflow.inputs.inputspec.anat_to_mni_affine_xfm_file_path = glob.glob(preprocessed + '/anat_mni_ants_register_0/calc_ants_warp/transform2Affine.mat')[0]
         nuisance_regression_workflow.inputs.inputspec.motion_parameters_file_path = glob.glob(preprocessed + '/func_preproc_automask_0/_scan_*/func_motion_correct_A/*_calc_tshift_resample.1D')[0]
-        nuisance_regression_workflow.inputs.inputspec.dvars_file_path = glob.glob(preprocessed + '/gen_motion_stats_0/_scan_*/cal_DVARS/DVARS.*')[0]
-        nuisance_regression_workflow.inputs.inputspec.fd_j_file_path = glob.glob(preprocessed + '/gen_motion_stats_0/_scan_*/calculate_FDJ/FD_J.1D')[0]
+        nuisance_regression_workflow.inputs.inputspec.dvars_file_path = glob.glob(preprocessed + '/gen_motion_stats_0/_scan_*/calc_motion_statistics/DVARS.*')[0]
+        nuisance_regression_workflow.inputs.inputspec.fd_j_file_path = glob.glob(preprocessed + '/gen_motion_stats_0/_scan_*/calc_motion_statistics/FD_J.1D')[0]
         nuisance_regression_workflow.get_node('inputspec').iterables = ([
             ('selector', [NuisanceRegressor(selector)]),
         ])
@@ -0,0 +1,236 @@
+import os
+import pytest
+import numpy as np
+import nibabel as nb
+
+from CPAC.nuisance import NuisanceRegressor
+from CPAC.nuisance.nuisance import (
+    gather_nuisance,
+    native_nuisance_regression,
+    native_nuisance_regression_batch,
+    nuisance_strategy,
+    regress_nuisance,
+    regress_nuisance_strategies,
+    nuisance_regression_batch_mem_gb,
+    save_nuisance_design
+)
+
+
+@pytest.fixture
+def dl_dir(tmpdir, monkeypatch):
+    monkeypatch.chdir(str(tmpdir))
+    return str(tmpdir)
+
+
+def nuisance_data(dl_dir, shape=(8, 7, 6), timepoints=100, seed=42):
+
+    rng = np.random.RandomState(seed)
+
+    motion = rng.randn(timepoints, 6)
+    global_signal = rng.randn(timepoints)
+
+    data = rng.randn(*(shape + (timepoints,))) + 100.
+    data += rng.randn(*(shape + (6,))).dot(motion.T)
+    data = data.astype(np.float32)
+
+    mask = (rng.rand(*shape) > 0.2).astype(np.int16)
+
+    censors = np.ones(timepoints)
+    censors[[0, 10, 11, 50, timepoints - 1]] = 0
+
+    paths = {}
+    for name, values in [('motion', motion), ('global', global_signal),
+                         ('censors', censors)]:
+        paths[name] = os.path.join(dl_dir, '{0}.1D'.format(name))
+        np.savetxt(paths[name], values)
+
+    paths['functional'] = os.path.join(dl_dir, 'functional.nii.gz')
+    paths['mask'] = os.path.join(dl_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data, np.eye(4)).to_filename(paths['functional'])
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(paths['mask'])
+
+    return data, mask > 0, censors == 0, paths
+
+
+def reference_residuals(data, mask, design, kept):
+    # 3dTproject-style projection with the text design, one dense column
+    # per spike regressor
+    Y = data[mask].astype(np.float64)[:, kept]
+    X = design[kept]
+    betas = np.linalg.lstsq(X, Y.T, rcond=1e-10)[0]
+    return Y - X.dot(betas).T
+
+
+def selector(censor_method, previous=0, degree=2, global_signal=True):
+    regressors = {
+        'PolyOrt': {'degree': degree},
+        'Motion': {'include_delayed': True, 'include_backdiff': True},
+        'Censor': {
+            'method': censor_method,
+            'thresholds': [{'type': 'FD_J', 'value': 0.5}],
+            'number_of_previous_trs_to_censor': previous,
+        },
+    }
+    if global_signal:
+        regressors['GlobalSignal'] = {'summary': 'Mean',
+                                      'include_squared': True}
+    return NuisanceRegressor(regressors)
+
+
+def legendre(timepoints, degree):
+    return np.polynomial.legendre.legvander(
+        np.linspace(-1, 1, timepoints), degree
+    )
+
+
+def test_native_nuisance_regression(dl_dir):
+
+    data, mask, censored, paths = nuisance_data(dl_dir)
+    timepoints = data.shape[3]
+    inputs = {
+        'global_summary_file_path': paths['global'],
+        'motion_parameters_file_path': paths['motion'],
+        'censor_file_path': paths['censors'],
+    }
+
+    # spike regression, against the dense text design
+    regressors_file, residual_file = native_nuisance_regression(
+        paths['functional'], selector('SpikeRegression', previous=1),
+        functional_brain_mask_file_path=paths['mask'], chunk_size=50,
+        **inputs
+    )
+    text_design = np.loadtxt(
+        gather_nuisance(paths['functional'],
+                        selector('SpikeRegression', previous=1), **inputs)
+    )
+    assert np.allclose(np.loadtxt(regressors_file), text_design)
+
+    design = np.hstack([legendre(timepoints, 2), text_design])
+    expected = reference_residuals(data, mask, design, np.arange(timepoints))
+
+    residuals = nb.load(residual_file).get_data()
+    assert residuals.shape == data.shape
+    assert np.allclose(residuals[mask], expected, atol=1e-4)
+    assert np.all(residuals[~mask] == 0)
+
+    ort = np.loadtxt(
+        gather_nuisance(paths['functional'], selector('Kill'), **inputs)
+    )
+    design = np.hstack([legendre(timepoints, 2), ort])
+
+    # censoring by removing the volumes
+    _, residual_file = native_nuisance_regression(
+        paths['functional'], selector('Kill'),
+        functional_brain_mask_file_path=paths['mask'], **inputs
+    )
+    kept = np.where(~censored)[0]
+    residuals = nb.load(residual_file).get_data()
+    assert residuals.shape == data.shape[:3] + (len(kept),)
+    assert np.allclose(residuals[mask],
+                       reference_residuals(data, mask, design, kept),
+                       atol=1e-4)
+
+    # censoring by zeroing the volumes
+    _, residual_file = native_nuisance_regression(
+        paths['functional'], selector('Zero'),
+        functional_brain_mask_file_path=paths['mask'], **inputs
+    )
+    residuals = nb.load(residual_file).get_data()
+    assert np.all(residuals[..., censored] == 0)
+    assert np.allclose(residuals[mask][:, kept],
+                       reference_residuals(data, mask, design, kept),
+                       atol=1e-4)
+
+    # censoring by interpolating the volumes
+    _, residual_file = native_nuisance_regression(
+        paths['functional'], selector('Interpolate'),
+        functional_brain_mask_file_path=paths['mask'], **inputs
+    )
+    interpolated = data.astype(np.float64)
+    for index in np.ndindex(*data.shape[:3]):
+        interpolated[index][censored] = np.interp(
+            np.where(censored)[0], kept, interpolated[index][kept]
+        )
+    residuals = nb.load(residual_file).get_data()
+    assert np.allclose(residuals[mask],
+                       reference_residuals(interpolated, mask, design,
+                                           np.arange(timepoints)),
+                       atol=1e-4)
+
+
+def strategy_selectors():
+    return [
+        selector('Kill'),
+        selector('Kill', global_signal=False),
+        selector('Zero', degree=1),
+        selector('Interpolate'),
+        selector('Interpolate', global_signal=False),
+        selector('SpikeRegression', previous=1),
+    ]
+
+
+def test_regress_nuisance_strategies(dl_dir):
+
+    data, mask, censored, paths = nuisance_data(dl_dir)
+    inputs = {
+        'global_summary_file_path': paths['global'],
+        'motion_parameters_file_path': paths['motion'],
+        'censor_file_path': paths['censors'],
+    }
+
+    strategies = [
+        nuisance_strategy(paths['functional'], s, **inputs)[1]
+        for s in strategy_selectors()
+    ]
+
+    residual_files = regress_nuisance_strategies(
+        paths['functional'], strategies,
+        functional_brain_mask_file_path=paths['mask'], chunk_size=50
+    )
+    assert len(residual_files) == len(strategies)
+
+    # written in place, with the orientation and timing of the scan
+    functional_image = nb.load(paths['functional'])
+    for residual_file in residual_files:
+        residual_image = nb.load(residual_file)
+        assert residual_image.get_data_dtype() == np.float32
+        assert np.allclose(residual_image.affine, functional_image.affine)
+        assert residual_image.header.get_zooms()[:3] == \
+            functional_image.header.get_zooms()[:3]
+
+    for strategy, residual_file in zip(strategies, residual_files):
+        expected = nb.load(regress_nuisance(
+            paths['functional'],
+            functional_brain_mask_file_path=paths['mask'],
+            **strategy
+        )).get_data()
+        residuals = nb.load(residual_file).get_data()
+        assert residuals.shape == expected.shape
+        assert np.allclose(residuals, expected, atol=1e-4)
+
+    # the designs saved by each selector workflow
+    design_files = [
+        save_nuisance_design(paths['functional'], s, **inputs)[1]
+        for s in strategy_selectors()
+    ]
+    batch_files = native_nuisance_regression_batch(
+        paths['functional'], design_files,
+        functional_brain_mask_file_path=paths['mask']
+    )
+    for residual_file, batch_file in zip(residual_files, batch_files):
+        assert np.allclose(nb.load(batch_file).get_data(),
+                           nb.load(residual_file).get_data(), atol=1e-5)
+
+
+def test_nuisance_regression_batch_mem_gb(dl_dir):
+
+    data, mask, censored, paths = nuisance_data(dl_dir)
+    residuals_gb = data.size * 4 / 1024. ** 3
+
+    # sized from the largest readable scan
+    mem_gb = nuisance_regression_batch_mem_gb(
+        [paths['functional'], 's3://bucket/func.nii.gz'], 3)
+    assert np.isclose(mem_gb - nuisance_regression_batch_mem_gb(
+        [paths['functional']], 1), 2 * residuals_gb)
+    assert nuisance_regression_batch_mem_gb(['s3://bucket/func.nii.gz'], 3) > \
+        mem_gb
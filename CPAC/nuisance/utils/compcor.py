@@ -2,7 +2,7 @@ import os
 import scipy.signal as signal
 import nibabel as nb
 import numpy as np
-from CPAC.utils import safe_shape
+from CPAC.utils import safe_shape, slab_dataobj
 from nipype import logging
 from scipy.linalg import svd
 
@@ -58,7 +58,186 @@ def calc_compcor_components(data_filename, num_components, mask_filename):
 
     return regressor_file
 
-  
+
+def compcor_slabs(mask, chunk_size):
+    """
+    Groups the z-slices of a mask into slabs holding about chunk_size
+    voxels each.
+
+    Parameters
+    ----------
+    mask : ndarray
+        Boolean 3D mask.
+    chunk_size : int
+        Number of mask voxels per slab.
+
+    Returns
+    -------
+    slabs : list
+        List of (first, last + 1) z-slice ranges.
+
+    """
+
+    slice_voxels = mask.reshape(-1, mask.shape[2]).sum(0)
+
+    slabs = []
+    start, voxels = 0, 0
+    for z in range(mask.shape[2]):
+        voxels += slice_voxels[z]
+        if voxels >= chunk_size:
+            slabs.append((start, z + 1))
+            start, voxels = z + 1, 0
+    if start < mask.shape[2]:
+        slabs.append((start, mask.shape[2]))
+
+    return slabs
+
+
+def compcor_gram(data_filename, mask_filename, chunk_size=10000):
+    """
+    Accumulates the timepoints x timepoints Gram matrix of the detrended,
+    centered and variance-normalized tissue time-series, reading the image
+    one slab of voxels at a time.
+
+    Parameters
+    ----------
+    data_filename : string
+        Path of the functional nifti file.
+    mask_filename : string
+        Path of the tissue mask nifti file.
+    chunk_size : int, optional
+        Approximate number of mask voxels read at once.
+
+    Returns
+    -------
+    gram : ndarray
+        Gram matrix Yc Yc' of the normalized time-series.
+    voxels : int
+        Number of voxels with non-zero variance.
+
+    """
+
+    try:
+        img = nb.load(data_filename)
+    except:
+        print('Unable to load data from {0}'.format(data_filename))
+        raise
+
+    try:
+        binary_mask = nb.load(mask_filename).get_data() > 0
+    except:
+        print('Unable to load data from {0}'.format(mask_filename))
+        raise
+
+    if img.shape[:3] != binary_mask.shape[:3]:
+        raise ValueError('The data in {0} and {1} do not have a consistent shape'.format(data_filename, mask_filename))
+
+    data = slab_dataobj(img)
+
+    timepoints = img.shape[3]
+    gram = np.zeros((timepoints, timepoints))
+    voxels = 0
+
+    for z0, z1 in compcor_slabs(binary_mask, chunk_size):
+
+        slab_mask = binary_mask[:, :, z0:z1]
+        if not slab_mask.any():
+            continue
+
+        Y = np.asarray(data[:, :, z0:z1, :])[slab_mask]
+        Y = Y.astype(np.float64)
+
+        # filter out any voxels whose variance equals 0
+        Y = Y[Y.std(1) != 0, :]
+
+        Y = signal.detrend(Y, axis=1, type='linear')
+        Y -= Y.mean(1)[:, np.newaxis]
+        Y_std = Y.std(1)
+        Y = Y[Y_std != 0, :] / Y_std[Y_std != 0, np.newaxis]
+
+        gram += Y.T.dot(Y)
+        voxels += Y.shape[0]
+
+    return gram, voxels
+
+
+def calc_compcor_components_chunked(data_filename, num_components,
+                                    mask_filename, chunk_size=10000,
+                                    method='auto'):
+    """
+    Extracts the CompCor components, the first left singular vectors of the
+    detrended and normalized tissue time-series, from the eigenvectors of
+    their timepoints x timepoints Gram matrix. The image is read in slabs of
+    about chunk_size voxels, so neither the full float64 cube nor the right
+    singular vectors are ever held in memory.
+
+    Parameters
+    ----------
+    data_filename : string
+        Path of the functional nifti file.
+    num_components : int
+        Number of components to extract.
+    mask_filename : string
+        Path of the tissue mask nifti file.
+    chunk_size : int, optional
+        Approximate number of mask voxels read at once.
+    method : string, optional
+        'eigh' for the full eigendecomposition of the Gram matrix,
+        'truncated' for a Lanczos decomposition of its leading
+        num_components eigenvectors, or 'auto' to use the truncated
+        decomposition for long scans only.
+
+    Returns
+    -------
+    regressor_file : string
+        Path of the components, one per column.
+
+    """
+
+    import os
+    import numpy as np
+    from scipy.sparse.linalg import eigsh
+    from CPAC.nuisance.utils.compcor import compcor_gram
+
+    if num_components < 1:
+        raise ValueError('Improper value for num_components ({0}), should be >= 1.'.format(num_components))
+
+    if method not in ('auto', 'eigh', 'truncated'):
+        raise ValueError('Improper value for method ({0}), should be auto, eigh or truncated.'.format(method))
+
+    gram, voxels = compcor_gram(data_filename, mask_filename, chunk_size)
+
+    if not voxels:
+        err = "\n\n[!] No wm or csf signals left after removing those " \
+              "with zero variance.\n\n"
+        raise Exception(err)
+
+    timepoints = gram.shape[0]
+    num_components = min(num_components, timepoints, voxels)
+
+    if method == 'auto':
+        method = 'truncated' if timepoints > 1000 else 'eigh'
+    if num_components >= timepoints - 1:
+        method = 'eigh'
+
+    if method == 'truncated':
+        S, U = eigsh(gram, k=num_components, which='LA')
+    else:
+        S, U = np.linalg.eigh(gram)
+
+    U = U[:, np.argsort(S)[::-1][:num_components]]
+
+    # fix the arbitrary sign of each component
+    signs = np.sign(U[np.abs(U).argmax(0), np.arange(U.shape[1])])
+    U *= signs
+
+    # write out the resulting regressor file
+    regressor_file = os.path.join(os.getcwd(), 'compcor_regressors.1D')
+    np.savetxt(regressor_file, U, delimiter='\t', fmt='%16g')
+
+    return regressor_file
+
+
 # cosine_filter adapted from nipype 'https://github.com/nipy/nipype/blob/d353f0d879826031334b09d33e9443b8c9b3e7fe/nipype/algorithms/confounds.py'
 def cosine_filter(input_image_path, timestep, period_cut=128, remove_mean=True, axis=-1, failure_mode='error'):
     """
@@ -1,7 +1,12 @@
-import cpac_runner
-import cpac_group_runner
-import cpac_pipeline
-import cpac_basc_pipeline
-import cpac_cwas_pipeline
+from CPAC.utils.lazy_import import lazy_module
+
+lazy_module(__name__, dict(
+    (name, ('CPAC.pipeline.' + name, None))
+    for name in ['cpac_runner',
+                 'cpac_group_runner',
+                 'cpac_pipeline',
+                 'cpac_basc_pipeline',
+                 'cpac_cwas_pipeline']
+))
 
 __all__ = ['run']
@@ -39,16 +39,16 @@ def create_dir(dir_path, description):
 
 def create_merged_copefile(list_of_output_files, merged_outfile):
 
-    import subprocess
-
-    merge_string = ["fslmerge", "-t", merged_outfile]
-    merge_string = merge_string + list_of_output_files
+    from CPAC.pipeline.group_merge import GroupMerge
 
     try:
-        retcode = subprocess.check_output(merge_string)
+        with GroupMerge(list_of_output_files,
+                        work_dir=os.path.dirname(merged_outfile)) as merge:
+            merge.merge()
+            merge.write_merged(merged_outfile)
     except Exception as e:
-        err = "\n\n[!] Something went wrong with FSL's fslmerge during the " \
-              "creation of the 4D merged file for group analysis.\n\n" \
+        err = "\n\n[!] Something went wrong during the creation of the 4D " \
+              "merged file for group analysis.\n\n" \
               "Attempted to create file: %s\n\nLength of list of files to " \
               "merge: %d\n\nError details: %s\n\n" \
               % (merged_outfile, len(list_of_output_files), e)
@@ -59,16 +59,14 @@ def create_merged_copefile(list_of_output_files, merged_outfile):
 
 def create_merge_mask(merged_file, mask_outfile):
 
-    import subprocess
-
-    mask_string = ["fslmaths", merged_file, "-abs", "-Tmin", "-bin",
-                   mask_outfile]
+    from CPAC.pipeline.group_merge import nonzero_mask, save_mask
 
     try:
-        retcode = subprocess.check_output(mask_string)
+        mask, img = nonzero_mask(merged_file)
+        save_mask(mask, img.affine, img.header, mask_outfile)
     except Exception as e:
-        err = "\n\n[!] Something went wrong with FSL's fslmaths during the " \
-              "creation of the merged copefile group mask.\n\nAttempted to " \
+        err = "\n\n[!] Something went wrong during the creation of the " \
+              "merged copefile group mask.\n\nAttempted to " \
               "create file: %s\n\nMerged file: %s\n\nError details: %s\n\n" \
               % (mask_outfile, merged_file, e)
         raise Exception(err)
@@ -78,31 +76,31 @@ def create_merge_mask(merged_file, mask_outfile):
 
 def check_merged_file(list_of_output_files, merged_outfile):
 
-    import subprocess
+    import nibabel as nb
+    from CPAC.pipeline.group_merge import block_hash, merged_block_hashes
 
     # make sure the order is correct
-    #   we are ensuring each volume of the merge file correlates perfectly
-    #   with the output file it should correspond to
-    i = 0
-    for output_file in list_of_output_files:
-        test_string = ["3ddot", "-demean",
-                       "{0}[{1}]".format(merged_outfile, str(i)), output_file]
-
-        try:
-            retcode = subprocess.check_output(test_string)
-        except Exception as e:
-            err = "\n\n[!] Something went wrong while trying to run AFNI's " \
-                  "3ddot for the purpose of testing the merge file output." \
-                  "\n\nError details: %s\n\n" % e
-            raise Exception(err)
+    #   we are ensuring each volume of the merge file is identical to the
+    #   output file it should correspond to, comparing their hashes
+    list_of_output_files = list(list_of_output_files)
 
-        retcode = retcode.rstrip("\n").rstrip("\t")
+    try:
+        hashes = [block_hash(nb.load(output_file).dataobj)
+                  for output_file in list_of_output_files]
+        merged_hashes = merged_block_hashes(merged_outfile,
+                                            [1] * len(list_of_output_files))
+    except Exception as e:
+        err = "\n\n[!] Something went wrong while trying to read the " \
+              "merge file output for the purpose of testing it." \
+              "\n\nError details: %s\n\n" % e
+        raise Exception(err)
 
-        if retcode != "1":
+    for i, output_file in enumerate(list_of_output_files):
+        if hashes[i] != merged_hashes[i]:
             err = "\n\n[!] The volumes of the merged file do not correspond "\
                   "to the correct order of output files as described in the "\
                   "phenotype matrix. If you are seeing this error, " \
-                  "something possibly went wrong with FSL's fslmerge.\n\n" \
+                  "something possibly went wrong while merging them.\n\n" \
                   "Merged file: %s\n\nMismatch between merged file volume " \
                   "%d and derivative file %s\n\nEach volume should " \
                   "correspond to the derivative output file for each " \
@@ -110,44 +108,57 @@ def check_merged_file(list_of_output_files, merged_outfile):
                   % (merged_outfile, i, output_file)
             raise Exception(err)
 
-        i += 1
 
+def check_merged_order(list_of_output_files, merged_filepaths,
+                       merged_outfile):
 
-def calculate_measure_mean_in_df(model_df, merge_mask):
+    # make sure the output files are still in the order they were merged in
+    #   the merged volumes were checked against their output files when the
+    #   merged file was written
+    list_of_output_files = list(list_of_output_files)
 
-    import subprocess
-    import pandas as pd
+    if len(list_of_output_files) != len(merged_filepaths):
+        err = "\n\n[!] The merged file %s has %d volumes, but there are " \
+              "%d output files in the model.\n\n" \
+              % (merged_outfile, len(merged_filepaths),
+                 len(list_of_output_files))
+        raise Exception(err)
 
-    mm_dict_list = []
-    
-    for raw_file in model_df["Raw_Filepath"]:
-    
-        mask_string = ["3dmaskave", "-mask", merge_mask, raw_file]
-        
-        # calculate
-        try:
-            retcode = subprocess.check_output(mask_string)
-        except Exception as e:
-            err = "\n\n[!] AFNI's 3dMaskAve failed for raw output: %s\n" \
-                  "Error details: %s\n\n" % (raw_file, e)
-            raise Exception(err)
-        
-        # if this breaks, 3dmaskave output to STDOUT has changed
-        try:
-            mean = retcode.split(" ")[0]
-        except Exception as e:
-            err = "\n\n[!] Something went wrong with parsing the output of " \
-                  "AFNI's 3dMaskAve - this is used in calculating the " \
-                  "Measure Mean in group analysis.\n\nError details: %s\n\n" \
-                  % e
+    for i, output_file in enumerate(list_of_output_files):
+        if output_file != merged_filepaths[i]:
+            err = "\n\n[!] The volumes of the merged file do not correspond "\
+                  "to the correct order of output files as described in the "\
+                  "phenotype matrix.\n\nMerged file: %s\n\nMismatch " \
+                  "between merged file volume %d and derivative file %s" \
+                  "\n\nEach volume should correspond to the derivative " \
+                  "output file for each participant in the model.\n\n" \
+                  % (merged_outfile, i, output_file)
             raise Exception(err)
-        
-        mm_dict = {}
-        mm_dict["Raw_Filepath"] = raw_file
-        mm_dict["Measure_Mean"] = mean
-        mm_dict_list.append(mm_dict)
-        
-    mm_df = pd.DataFrame(mm_dict_list)
+
+
+def calculate_measure_mean_in_df(model_df, merge_mask, group_merge=None):
+
+    import pandas as pd
+    from CPAC.pipeline.group_merge import GroupMerge
+
+    raw_files = model_df["Raw_Filepath"].tolist()
+
+    # the raw maps are read again only if they were not kept while merging
+    try:
+        if group_merge is None:
+            with GroupMerge(raw_files, raw_files) as merge:
+                means = merge.merge().measure_means(merge_mask)
+        else:
+            means = group_merge.measure_means(merge_mask)
+            raw_files = group_merge.raw_filepaths
+    except Exception as e:
+        err = "\n\n[!] Something went wrong while calculating the Measure " \
+              "Mean of the raw outputs in group analysis.\n\nMask file: " \
+              "%s\n\nError details: %s\n\n" % (merge_mask, e)
+        raise Exception(err)
+
+    mm_df = pd.DataFrame({"Raw_Filepath": raw_files,
+                          "Measure_Mean": means})
     
     # demean!
     mm_df["Measure_Mean"] = mm_df["Measure_Mean"].astype(float)
@@ -224,71 +235,36 @@ def trim_mask(input_mask, ref_mask, output_mask_path):
     return output_mask_path
 
 
-def calculate_custom_roi_mean_in_df(model_df, roi_mask):   
+def calculate_custom_roi_mean_in_df(model_df, roi_mask, group_merge=None):
 
-    import os
-    import subprocess
     import pandas as pd
+    from CPAC.pipeline.group_merge import GroupMerge
 
-    # calculate the ROI means
-    roi_dict_list = []
-    
-    for raw_file in model_df["Raw_Filepath"]:
-        
-        roi_string = ["3dROIstats", "-mask", roi_mask, raw_file]
-
-        try:
-            retcode = subprocess.check_output(roi_string)
-        except Exception as e:
-            err = "\n\n[!] Something went wrong with running AFNI's " \
-                  "3dROIstats while calculating the custom ROI means.\n\n" \
-                  "Custom ROI mask file: %s\n\nRaw output filepath: %s\n\n" \
-                  "Error details: %s\n\n" % (roi_mask, raw_file, e)
-            raise Exception(err)
-
-        # process the output string
-        roi_means_string = str(retcode.split(raw_file)[1].rstrip("\n"))
-
-        roi_means_string_list = roi_means_string.split("\t")
-
-        # check
-        roi_means_list = []
-        for roi_mean in roi_means_string_list:
-            try:
-                roi_mean = float(roi_mean)
-            except:
-                continue
-
-            roi_means_list.append(roi_mean)
-
-        if len(roi_means_list) != retcode.count("Mean_"):
-            err = "\n\n[!] Something went wrong with parsing the output "\
-                  "of AFNI's 3dROIstats during the calculation of the " \
-                  "custom ROI means.\n\nOutput file: %s\n\nCustom ROI " \
-                  "mask file: %s\n\n3dROIstats output: %s\n\n" \
-                  % (raw_file, roi_mask, retcode)
-            raise Exception(err)
-
-        # add in the custom ROI means!
-        roi_dict = {}
-        roi_dict["Raw_Filepath"] = raw_file
+    raw_files = model_df["Raw_Filepath"].tolist()
 
-        i = 1
-        for roi_mean in roi_means_list:
-            roi_label = "Custom_ROI_Mean_%d" % i
-            roi_dict[roi_label] = roi_mean
-            i += 1
+    # calculate the ROI means, reading the raw maps again only if they were
+    # not kept while merging
+    try:
+        if group_merge is None:
+            with GroupMerge(raw_files, raw_files) as merge:
+                roi_means = merge.merge().roi_means(roi_mask)
+        else:
+            roi_means = group_merge.roi_means(roi_mask)
+            raw_files = group_merge.raw_filepaths
+    except Exception as e:
+        err = "\n\n[!] Something went wrong while calculating the custom " \
+              "ROI means.\n\nCustom ROI mask file: %s\n\n" \
+              "Error details: %s\n\n" % (roi_mask, e)
+        raise Exception(err)
 
-        roi_dict_list.append(roi_dict)
+    # add in the custom ROI means!
+    roi_df = pd.DataFrame({"Raw_Filepath": raw_files})
 
+    for i in range(roi_means.shape[1]):
+        roi_label = "Custom_ROI_Mean_%d" % (i + 1)
+        roi_df[roi_label] = roi_means[:, i]
 
-    roi_df = pd.DataFrame(roi_dict_list)
-    
-    # demean!
-    i = 1
-    for roi_mean in roi_means_list:
-        roi_label = "Custom_ROI_Mean_%d" % i
-        i += 1  
+        # demean!
         roi_df[roi_label] = roi_df[roi_label].astype(float)
         roi_df[roi_label] = roi_df[roi_label].sub(roi_df[roi_label].mean())
     
@@ -498,6 +474,7 @@ def build_feat_model(model_df, model_name, group_config_file, resource_id,
     import nipype.interfaces.utility as util
     import nipype.interfaces.io as nio
     from CPAC.pipeline.cpac_group_runner import load_config_yml
+    from CPAC.pipeline.group_merge import GroupMerge
     
     from CPAC.utils.create_group_analysis_info_files import write_design_matrix_csv, \
         write_blank_contrast_csv
@@ -648,78 +625,103 @@ def build_feat_model(model_df, model_name, group_config_file, resource_id,
             model_df[param] = model_df[param].sub(model_df[param].mean())
 
     # create 4D merged copefile, in the correct order, identical to design
-    # matrix
+    # matrix, and the merged group mask, reading each output once and
+    # keeping the raw outputs needed for the measure and custom ROI means
     merge_outfile = model_name + "_" + resource_id + "_merged.nii.gz"
     merge_outfile = os.path.join(model_path, merge_outfile)
-    merge_file = create_merged_copefile(model_df["Filepath"].tolist(),
-                                        merge_outfile)
 
-    # create merged group mask
     merge_mask_outfile = '_'.join([model_name, resource_id,
                                    "merged_mask.nii.gz"])
     merge_mask_outfile = os.path.join(model_path, merge_mask_outfile)
-    merge_mask = create_merge_mask(merge_file, merge_mask_outfile)
 
-    if "Group Mask" in group_config_obj.mean_mask:
-        mask_for_means = merge_mask
-    else:
+    raw_filepaths = None
+    if ("Measure_Mean" in design_formula) or \
+            ("Custom_ROI_Mean" in design_formula) or \
+            ("Group Mask" not in group_config_obj.mean_mask):
+        raw_filepaths = model_df["Raw_Filepath"].tolist()
+
+    # the individual masks are the masks of the raw outputs
+    individual_mask_paths = None
+    if "Group Mask" not in group_config_obj.mean_mask:
         individual_masks_dir = os.path.join(model_path,
                                             "individual_masks")
         create_dir(individual_masks_dir, "individual masks")
-        for unique_id, series_id, raw_filepath in zip(
-                model_df["participant_id"],
-                model_df["Series"], model_df["Raw_Filepath"]):
-            mask_for_means_path = os.path.join(individual_masks_dir,
-                                               "%s_%s_%s_mask.nii.gz" % (
-                                               unique_id, series_id,
-                                               resource_id))
-            mask_for_means = create_merge_mask(raw_filepath,
-                                               mask_for_means_path)
+        individual_mask_paths = [
+            os.path.join(individual_masks_dir, "%s_%s_%s_mask.nii.gz" % (
+                unique_id, series_id, resource_id))
+            for unique_id, series_id in zip(model_df["participant_id"],
+                                            model_df["Series"])
+        ]
         readme_flags.append("individual_masks")
 
-    # calculate measure means, and demean
-    if "Measure_Mean" in design_formula:
-        model_df = calculate_measure_mean_in_df(model_df, mask_for_means)
+    with GroupMerge(model_df["Filepath"].tolist(), raw_filepaths,
+                    work_dir=model_path) as group_merge:
+        try:
+            group_merge.merge(individual_mask_paths)
+            merge_file = group_merge.write_merged(merge_outfile)
+            merge_mask = group_merge.write_mask(merge_mask_outfile)
+        except Exception as e:
+            err = "\n\n[!] Something went wrong during the creation of the " \
+                  "4D merged file and the merged group mask for group " \
+                  "analysis.\n\nAttempted to create file: %s\n\nLength of " \
+                  "list of files to merge: %d\n\nError details: %s\n\n" \
+                  % (merge_outfile, len(model_df["Filepath"]), e)
+            raise Exception(err)
 
-    # calculate custom ROIs, and demean (in workflow?)
-    if "Custom_ROI_Mean" in design_formula:
+        # the volumes of the merged file are checked against the maps as it
+        # is written, only their order is left to check against the model
+        merged_filepaths = list(group_merge.filepaths)
 
-        custom_roi_mask = group_config_obj.custom_roi_mask
+        if "Group Mask" in group_config_obj.mean_mask:
+            mask_for_means = merge_mask
+        else:
+            mask_for_means = individual_mask_paths[-1]
 
-        if (custom_roi_mask == None) or (custom_roi_mask == "None") or \
-                (custom_roi_mask == "none") or (custom_roi_mask == ""):
-            err = "\n\n[!] You included 'Custom_ROI_Mean' in your design " \
-                  "formula, but you didn't supply a custom ROI mask file." \
-                  "\n\nDesign formula: %s\n\n" % design_formula
-            raise Exception(err)
+        # calculate measure means, and demean
+        if "Measure_Mean" in design_formula:
+            model_df = calculate_measure_mean_in_df(model_df, mask_for_means,
+                                                    group_merge)
 
-        # make sure the custom ROI mask file is the same resolution as the
-        # output files - if not, resample and warn the user
-        roi_mask = check_mask_file_resolution(list(model_df["Raw_Filepath"])[0],
-                                              custom_roi_mask, mask_for_means,
-                                              model_path, resource_id)
-        
+        # calculate custom ROIs, and demean (in workflow?)
+        if "Custom_ROI_Mean" in design_formula:
 
-        # trim the custom ROI mask to be within mask constraints
-        output_mask = os.path.join(model_path, "masked_%s" \
-                                   % os.path.basename(roi_mask))
-        roi_mask = trim_mask(roi_mask, mask_for_means, output_mask)
-        readme_flags.append("custom_roi_mask_trimmed")
+            custom_roi_mask = group_config_obj.custom_roi_mask
 
-        # calculate
-        model_df = calculate_custom_roi_mean_in_df(model_df, roi_mask)
+            if (custom_roi_mask == None) or (custom_roi_mask == "None") or \
+                    (custom_roi_mask == "none") or (custom_roi_mask == ""):
+                err = "\n\n[!] You included 'Custom_ROI_Mean' in your " \
+                      "design formula, but you didn't supply a custom ROI " \
+                      "mask file.\n\nDesign formula: %s\n\n" % design_formula
+                raise Exception(err)
 
-        # update the design formula
-        new_design_substring = ""
-        
-        for col in model_df.columns:
-            if "Custom_ROI_Mean_" in str(col):
-                if str(col) == "Custom_ROI_Mean_1":
-                    new_design_substring = new_design_substring + " %s" % col
-                else:
-                    new_design_substring = new_design_substring +" + %s" % col
-        design_formula = design_formula.replace("Custom_ROI_Mean",
-                                                new_design_substring)
+            # make sure the custom ROI mask file is the same resolution as the
+            # output files - if not, resample and warn the user
+            roi_mask = check_mask_file_resolution(
+                list(model_df["Raw_Filepath"])[0], custom_roi_mask,
+                mask_for_means, model_path, resource_id)
+
+
+            # trim the custom ROI mask to be within mask constraints
+            output_mask = os.path.join(model_path, "masked_%s" \
+                                       % os.path.basename(roi_mask))
+            roi_mask = trim_mask(roi_mask, mask_for_means, output_mask)
+            readme_flags.append("custom_roi_mask_trimmed")
+
+            # calculate
+            model_df = calculate_custom_roi_mean_in_df(model_df, roi_mask,
+                                                       group_merge)
+
+            # update the design formula
+            new_design_substring = ""
+
+            for col in model_df.columns:
+                if "Custom_ROI_Mean_" in str(col):
+                    if str(col) == "Custom_ROI_Mean_1":
+                        new_design_substring += " %s" % col
+                    else:
+                        new_design_substring += " + %s" % col
+            design_formula = design_formula.replace("Custom_ROI_Mean",
+                                                    new_design_substring)
 
     cat_list = []
     if "categorical" in group_config_obj.ev_selections.keys():
@@ -942,7 +944,7 @@ def build_feat_model(model_df, model_name, group_config_file, resource_id,
         print(err)
         
     # check the merged file's order
-    check_merged_file(model_df["Filepath"], merge_file)
+    check_merged_order(model_df["Filepath"], merged_filepaths, merge_file)
 
     # we must demean the categorical regressors if the Intercept/Grand Mean
     # is included in the model, otherwise FLAME produces blank outputs
@@ -101,6 +101,56 @@ def read_pheno_csv_into_df(pheno_csv, id_label=None):
     return pheno_df
 
 
+_group_derivatives = {}
+
+
+def group_derivatives(pull_func=False, r_to_z=False):
+
+    # lists the derivatives available to group analysis, from the
+    # cpac_outputs.csv resource file, which is only read and filtered once
+    #
+    # input
+    #   pull_func: include the functional timeseries
+    #   r_to_z: include the r-to-z transformed derivatives
+    #
+    # output
+    #   derivatives: list of resource names
+
+    import pandas as pd
+    import pkg_resources as p
+
+    if (pull_func, r_to_z) in _group_derivatives:
+        return list(_group_derivatives[(pull_func, r_to_z)])
+
+    keys_csv = p.resource_filename('CPAC', 'resources/cpac_outputs.csv')
+    try:
+        keys = pd.read_csv(keys_csv)
+    except Exception as e:
+        err = "\n[!] Could not access or read the cpac_outputs.csv " \
+            "resource file:\n{0}\n\nError details {1}\n".format(keys_csv, e)
+        raise Exception(err)
+
+    values = ['z-score', 'z-stat']
+    if r_to_z:
+        values.append('r-to-z')
+
+    template_derivatives = keys[(keys['Derivative'] == 'yes') &
+                                (keys['Space'] == 'template')]
+
+    derivatives = []
+    for value in values:
+        derivatives += list(
+            template_derivatives[template_derivatives['Values'] == value][
+                'Resource'])
+
+    if pull_func:
+        derivatives += list(keys[keys['Functional timeseries'] == 'yes']['Resource'])
+
+    _group_derivatives[(pull_func, r_to_z)] = derivatives
+
+    return list(derivatives)
+
+
 def gather_nifti_globs(pipeline_output_folder, resource_list, pull_func=False,
                        derivatives=None, exts=['nii', 'nii.gz']):
 
@@ -121,27 +171,7 @@ def gather_nifti_globs(pipeline_output_folder, resource_list, pull_func=False,
         raise Exception(err)
 
     if derivatives is None:
-
-        keys_csv = p.resource_filename('CPAC', 'resources/cpac_outputs.csv')
-        try:
-            keys = pd.read_csv(keys_csv)
-        except Exception as e:
-            err = "\n[!] Could not access or read the cpac_outputs.csv " \
-                "resource file:\n{0}\n\nError details {1}\n".format(keys_csv, e)
-            raise Exception(err)
-
-        derivatives = list(
-            keys[keys['Derivative'] == 'yes'][keys['Space'] == 'template'][
-                keys['Values'] == 'z-score']['Resource'])
-        derivatives = derivatives + list(
-            keys[keys['Derivative'] == 'yes'][keys['Space'] == 'template'][
-                keys['Values'] == 'z-stat']['Resource'])
-        derivatives = derivatives + list(
-            keys[keys['Derivative'] == 'yes'][keys['Space'] == 'template'][
-                keys['Values'] == 'r-to-z']['Resource'])
-
-        if pull_func:
-            derivatives = derivatives + list(keys[keys['Functional timeseries'] == 'yes']['Resource'])
+        derivatives = group_derivatives(pull_func, r_to_z=True)
 
     # remove any extra /'s
     pipeline_output_folder = pipeline_output_folder.rstrip("/")
@@ -335,24 +365,7 @@ def create_output_dict_list(nifti_globs, pipeline_output_folder,
         raise Exception(err)
 
     if derivatives is None:
-
-        keys_csv = p.resource_filename('CPAC', 'resources/cpac_outputs.csv')
-        try:
-            keys = pd.read_csv(keys_csv)
-        except Exception as e:
-            err = "\n[!] Could not access or read the cpac_outputs.csv " \
-                "resource file:\n{0}\n\nError details {1}\n".format(keys_csv, e)
-            raise Exception(err)
-
-        derivatives = list(
-            keys[keys['Derivative'] == 'yes'][keys['Space'] == 'template'][
-                keys['Values'] == 'z-score']['Resource'])
-        derivatives = derivatives + list(
-            keys[keys['Derivative'] == 'yes'][keys['Space'] == 'template'][
-                keys['Values'] == 'z-stat']['Resource'])
-
-        if pull_func:
-            derivatives = derivatives + list(keys[keys['Functional timeseries'] == 'yes']['Resource'])
+        derivatives = group_derivatives(pull_func)
 
     # remove any extra /'s
     pipeline_output_folder = pipeline_output_folder.rstrip("/")
@@ -453,6 +466,116 @@ def create_output_dict_list(nifti_globs, pipeline_output_folder,
     return output_dict_list
 
 
+def create_output_dict_list_from_catalog(pipeline_output_folder,
+                                         resource_list, get_motion=False,
+                                         get_raw_score=False, pull_func=False,
+                                         derivatives=None,
+                                         exts=['nii', 'nii.gz']):
+
+    # same as create_output_dict_list, with the output filepaths queried from
+    # the output catalog of the pipeline output folder instead of crawling
+    # the whole output directory
+
+    from CPAC.pipeline.output_catalog import query_output_catalog
+
+    if len(resource_list) == 0:
+        err = "\n\n[!] No derivatives selected!\n\n"
+        raise Exception(err)
+
+    if derivatives is None:
+        derivatives = group_derivatives(pull_func)
+
+    # remove any extra /'s
+    pipeline_output_folder = pipeline_output_folder.rstrip("/")
+
+    print "\n\nGathering the output file paths from %s..." \
+          % pipeline_output_folder
+
+    search_dirs = []
+    for derivative_name in derivatives:
+        for resource_name in resource_list:
+            if resource_name in derivative_name:
+                search_dirs.append(derivative_name)
+
+    # grab MeanFD_Jenkinson just in case
+    search_dirs += ["power_params"]
+
+    # strip the extension as create_output_dict_list does
+    strip_length = len(exts[-1])
+    exts = ['.' + ext.lstrip('.') for ext in exts]
+
+    rows = query_output_catalog(pipeline_output_folder, search_dirs)
+
+    power_params_files = {}
+    for unique_id, resource_id, series_id_string, _, filepath in rows:
+        if resource_id == "power_params" and "pow_params.txt" in filepath:
+            power_params_files[(unique_id, series_id_string)] = filepath
+
+    output_dict_list = {}
+
+    for unique_id, resource_id, series_id_string, strat_info, filepath \
+            in rows:
+
+        if not any(filepath.endswith(ext) for ext in exts):
+            continue
+
+        strat_info = strat_info[:-strip_length]
+
+        unique_resource_id = (resource_id, strat_info)
+
+        if unique_resource_id not in output_dict_list.keys():
+            output_dict_list[unique_resource_id] = []
+
+        series_id = series_id_string.replace("_scan_", "")
+        series_id = series_id.replace("_rest", "")
+
+        new_row_dict = {}
+        new_row_dict["participant_session_id"] = unique_id
+        new_row_dict["participant_id"], new_row_dict["Sessions"] = \
+            unique_id.split('_')
+
+        new_row_dict["Series"] = series_id
+        new_row_dict["Filepath"] = filepath
+
+        print('{0} - {1} - {2}'.format(unique_id, series_id,
+              resource_id))
+
+        if get_motion:
+            # if we're including motion measures
+            power_params_file = power_params_files.get(
+                (unique_id, "_scan_%s" % series_id)
+            )
+            if not power_params_file:
+                power_params_file = find_power_params_file(filepath,
+                    resource_id, series_id)
+            power_params_lines = load_text_file(power_params_file,
+                "power parameters file")
+            meanfd_p, meanfd_j, meandvars = \
+                extract_power_params(power_params_lines,
+                                     power_params_file)
+            new_row_dict["MeanFD_Power"] = meanfd_p
+            new_row_dict["MeanFD_Jenkinson"] = meanfd_j
+            new_row_dict["MeanDVARS"] = meandvars
+
+        if get_raw_score:
+            # grab raw score for measure mean just in case
+            raw_score_path = grab_raw_score_filepath(filepath,
+                                                     resource_id)
+            new_row_dict["Raw_Filepath"] = raw_score_path
+
+        # unique_resource_id is tuple (resource_id,strat_info)
+        output_dict_list[unique_resource_id].append(new_row_dict)
+
+    if len(output_dict_list) == 0:
+        err = "\n\n[!] No output filepaths found in the pipeline output " \
+              "directory provided for the derivatives selected!\n\nPipeline "\
+              "output directory provided: %s\nDerivatives selected:%s\n\n" \
+              % (pipeline_output_folder, resource_list)
+        raise Exception(err)
+
+    return output_dict_list
+
+
 def create_output_df_dict(output_dict_list, inclusion_list=None):
 
     import pandas as pd
@@ -487,26 +610,48 @@ def create_output_df_dict(output_dict_list, inclusion_list=None):
 
 def gather_outputs(pipeline_folder, resource_list, inclusion_list,
                    get_motion, get_raw_score, get_func=False, derivatives=None,
-                   exts=['nii', 'nii.gz']):
-
-    nifti_globs, search_dir = gather_nifti_globs(
-        pipeline_folder,
-        resource_list,
-        get_func,
-        derivatives,
-        exts
-    )
+                   exts=['nii', 'nii.gz'], use_catalog=True):
 
-    output_dict_list = create_output_dict_list(
-        nifti_globs,
-        pipeline_folder,
-        resource_list,
-        get_motion,
-        get_raw_score,
-        get_func,
-        derivatives,
-        exts
-    )
+    import sqlite3
+
+    output_dict_list = None
+
+    if use_catalog:
+        try:
+            output_dict_list = create_output_dict_list_from_catalog(
+                pipeline_folder,
+                resource_list,
+                get_motion,
+                get_raw_score,
+                get_func,
+                derivatives,
+                exts
+            )
+        except (sqlite3.Error, OSError, IOError) as e:
+            # e.g. a read-only output directory
+            print("Could not use the output catalog of {0}, crawling the "
+                  "output directory instead.\nError details: {1}"
+                  .format(pipeline_folder, e))
+
+    if output_dict_list is None:
+        nifti_globs, search_dir = gather_nifti_globs(
+            pipeline_folder,
+            resource_list,
+            get_func,
+            derivatives,
+            exts
+        )
+
+        output_dict_list = create_output_dict_list(
+            nifti_globs,
+            pipeline_folder,
+            resource_list,
+            get_motion,
+            get_raw_score,
+            get_func,
+            derivatives,
+            exts
+        )
 
     output_df_dict = create_output_df_dict(output_dict_list, inclusion_list)
     
@@ -1247,7 +1392,9 @@ def run_feat(group_config_file, feat=True):
 
 def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
                    regressor_file, participant_column, columns,
-                   permutations, parallel_nodes, inclusion=None):
+                   permutations, parallel_nodes, inclusion=None,
+                   shared_memory=False, memory_gb=None, random_state=None,
+                   precision='float64'):
 
     import os
     import numpy as np
@@ -1303,7 +1450,8 @@ def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
 
             cwas_wf = create_cwas(name="MDMR_{0}".format(df_scan),
                                   working_dir=working_dir,
-                                  crash_dir=crash_dir)
+                                  crash_dir=crash_dir,
+                                  shared_memory=shared_memory)
             cwas_wf.inputs.inputspec.subjects = func_paths
             cwas_wf.inputs.inputspec.roi = roi_file
             cwas_wf.inputs.inputspec.regressor = regressor_file
@@ -1311,6 +1459,13 @@ def run_cwas_group(pipeline_dir, out_dir, working_dir, crash_dir, roi_file,
             cwas_wf.inputs.inputspec.columns = columns
             cwas_wf.inputs.inputspec.permutations = permutations
             cwas_wf.inputs.inputspec.parallel_nodes = parallel_nodes
+            if memory_gb:
+                cwas_wf.inputs.inputspec.memory_gb = memory_gb
+            # the permutations of a seed are cached, and shared by the
+            # batches of voxels
+            if random_state is not None:
+                cwas_wf.inputs.inputspec.random_state = int(random_state)
+            cwas_wf.inputs.inputspec.precision = precision
             cwas_wf.run()
 
 
@@ -1335,15 +1490,24 @@ def run_cwas(pipeline_config):
     columns = pipeconfig_dct["mdmr_regressor_columns"]
     permutations = pipeconfig_dct["mdmr_permutations"]
     parallel_nodes = pipeconfig_dct["mdmr_parallel_nodes"]
+    shared_memory = pipeconfig_dct.get("mdmr_shared_memory", False)
+    memory_gb = pipeconfig_dct.get("mdmr_memory_gb")
+    random_state = pipeconfig_dct.get("mdmr_random_state")
+    precision = pipeconfig_dct.get("mdmr_precision") or 'float64'
     inclusion = pipeconfig_dct["participant_list"]
 
     if not inclusion or "None" in inclusion or "none" in inclusion:
         inclusion = None
 
+    if random_state in ("None", "none", ""):
+        random_state = None
+
     run_cwas_group(pipeline, output_dir, working_dir, crash_dir, roi_file,
                    regressor_file, participant_column, columns,
                    permutations, parallel_nodes,
-                   inclusion=inclusion)
+                   inclusion=inclusion, shared_memory=shared_memory,
+                   memory_gb=memory_gb, random_state=random_state,
+                   precision=precision)
 
 
 def find_other_res_template(template_path, new_resolution):
@@ -1725,7 +1889,7 @@ def run_basc(pipeline_config):
 def run_isc_group(pipeline_dir, out_dir, working_dir, crash_dir,
                   isc, isfc, levels=[], permutations=1000, 
                   std_filter=None, scan_inclusion=None,
-                  roi_inclusion=None, num_cpus=1):
+                  roi_inclusion=None, num_cpus=1, memory_gb=4.0):
 
     import os
     from CPAC.isc.pipeline import create_isc, create_isfc
@@ -1808,11 +1972,13 @@ def run_isc_group(pipeline_dir, out_dir, working_dir, crash_dir,
                 isc_wf = create_isc(name=it_id,
                                     output_dir=unique_out_dir,
                                     working_dir=working_dir,
-                                    crash_dir=crash_dir)
+                                    crash_dir=crash_dir,
+                                    memory_gb=memory_gb)
                 isc_wf.inputs.inputspec.subjects = func_paths
                 isc_wf.inputs.inputspec.permutations = permutations
                 isc_wf.inputs.inputspec.std = std_filter
                 isc_wf.inputs.inputspec.collapse_subj = False
+                isc_wf.inputs.inputspec.processes = num_cpus
                 isc_wf.run(plugin='MultiProc',
                            plugin_args={'n_procs': num_cpus})
 
@@ -1838,11 +2004,13 @@ def run_isc_group(pipeline_dir, out_dir, working_dir, crash_dir,
                 isfc_wf = create_isfc(name=it_id,
                                       output_dir=unique_out_dir,
                                       working_dir=working_dir,
-                                      crash_dir=crash_dir)
+                                      crash_dir=crash_dir,
+                                      memory_gb=memory_gb)
                 isfc_wf.inputs.inputspec.subjects = func_paths
                 isfc_wf.inputs.inputspec.permutations = permutations
                 isfc_wf.inputs.inputspec.std = std_filter
                 isfc_wf.inputs.inputspec.collapse_subj = False
+                isfc_wf.inputs.inputspec.processes = num_cpus
                 isfc_wf.run(plugin='MultiProc',
                             plugin_args={'n_procs': num_cpus})
 
@@ -1878,6 +2046,7 @@ def run_isc(pipeline_config):
     isc = 1 in pipeconfig_dct.get("runISC", [])
     isfc = 1 in pipeconfig_dct.get("runISFC", [])
     permutations = pipeconfig_dct.get("isc_permutations", 1000)
+    memory_gb = float(pipeconfig_dct.get("isc_memory_gb", 4.0))
     std_filter = pipeconfig_dct.get("isc_level_voxel_std_filter", None)
 
     if std_filter == 0.0:
@@ -1918,7 +2087,8 @@ def run_isc(pipeline_config):
                       isc=isc, isfc=isfc, levels=levels,
                       permutations=permutations, std_filter=std_filter,
                       scan_inclusion=scan_inclusion,
-                      roi_inclusion=roi_inclusion, num_cpus=num_cpus)
+                      roi_inclusion=roi_inclusion, num_cpus=num_cpus,
+                      memory_gb=memory_gb)
 
 
 def run_qpp(group_config_file):
@@ -1927,6 +2097,8 @@ def run_qpp(group_config_file):
 
     c = load_config_yml(group_config_file)
 
+    num_cpus = getattr(c, 'num_cpus', 1) or 1
+
     pipeline_dir = os.path.abspath(c.pipeline_dir)
     out_dir = os.path.join(c.output_dir, 'cpac_group_analysis', 'QPP',
                            os.path.basename(pipeline_dir))
@@ -2001,10 +2173,12 @@ def run_qpp(group_config_file):
             wf.inputs.inputspec.iterations = c.qpp_iterations
             wf.inputs.inputspec.correlation_threshold_iteration = c.qpp_initial_threshold_iterations
             wf.inputs.inputspec.convergence_iterations = 1
+            wf.inputs.inputspec.processes = num_cpus
 
             wf.inputs.inputspec.datasets = output_df_group.Filepath.tolist()
 
-            wf.run()
+            wf.run(plugin='MultiProc',
+                   plugin_args={'n_procs': num_cpus})
 
 
 def manage_processes(procss, output_dir, num_parallel=1):
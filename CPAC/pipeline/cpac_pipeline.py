@@ -69,7 +69,14 @@ from CPAC.registration import (
     output_func_to_standard
 )
 
-from CPAC.nuisance import create_nuisance_workflow, bandpass_voxels, NuisanceRegressor
+from CPAC.nuisance import (
+    create_nuisance_workflow,
+    has_voxel_nuisance_regressors,
+    native_nuisance_regression_batch,
+    nuisance_regression_batch_mem_gb,
+    bandpass_voxels,
+    NuisanceRegressor
+)
 from CPAC.aroma import create_aroma
 from CPAC.median_angle import create_median_angle_correction
 from CPAC.generate_motion_statistics import motion_power_statistics
@@ -85,6 +92,7 @@ from CPAC.vmhc.vmhc import create_vmhc
 from CPAC.reho.reho import create_reho
 from CPAC.alff.alff import create_alff
 from CPAC.sca.sca import create_sca, create_temporal_reg
+from CPAC.pypeer.peer import run_pypeer
 
 from CPAC.connectome.pipeline import create_connectome
 
@@ -103,9 +111,18 @@ from CPAC.utils import Configuration, Strategy, Outputs, find_files
 from CPAC.utils.interfaces.function import Function
 
 from CPAC.utils.interfaces.datasink import DataSink
+from CPAC.utils.s3_transfer import Prefetch
 
 from CPAC.qc.pipeline import create_qc_workflow
 from CPAC.qc.utils import generate_qc_pages
+from CPAC.pipeline.output_catalog import update_output_catalog
+from CPAC.pipeline.workflow_cache import (
+    bind_workflow,
+    load_workflow_template,
+    participant_template,
+    save_workflow_template,
+    workflow_template_path
+)
 
 from CPAC.utils.utils import (
     extract_one_d,
@@ -124,139 +141,51 @@ from CPAC.utils.monitoring import log_nodes_initial, log_nodes_cb
 logger = logging.getLogger('nipype.workflow')
 # config.enable_debug_mode()
 
-def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
-                  p_name=None, plugin='MultiProc', plugin_args=None, test_config=False):
+def build_workflow(sub_dict, c, run=1, p_name=None, log_dir=None,
+                   ndmg_out=False, encrypt_data=False, output_creds_path='',
+                   num_ants_cores=1):
     '''
-    Function to prepare and, optionally, run the C-PAC workflow
+    Function to build the C-PAC workflow graph of a participant
 
     Parameters
     ----------
     sub_dict : dictionary
         subject dictionary with anatomical and functional image paths
     c : Configuration object
-        CPAC pipeline configuration dictionary object
-    run : boolean
-        flag to indicate whether to run the prepared workflow
-    pipeline_timing_info : list (optional); default=None
-        list of pipeline info for reporting timing information
+        CPAC pipeline configuration dictionary object, with absolute
+        working and output directories
+    run : boolean (optional); default=1
+        flag to indicate whether the workflow will be ran, in which case
+        the output data sinks are added
     p_name : string (optional); default=None
         name of pipeline
-    plugin : string (optional); defaule='MultiProc'
-        nipype plugin to utilize when the workflow is ran
-    plugin_args : dictionary (optional); default=None
-        plugin-specific arguments for the workflow plugin
+    log_dir : string (optional); default=None
+        participant log directory, for the strategy graph
+    ndmg_out : boolean (optional); default=False
+        flag to indicate whether to write the outputs in the ndmg layout
+    encrypt_data : boolean (optional); default=False
+        flag to indicate whether to encrypt the outputs written to S3
+    output_creds_path : string (optional); default=''
+        path to the credentials of the output S3 bucket
+    num_ants_cores : integer (optional); default=1
+        number of threads of the ANTS registration nodes
 
     Returns
     -------
     workflow : nipype workflow
-        the prepared nipype workflow object containing the parameters
-        specified in the config
+        the participant workflow
+    strat_list : list
+        the pipeline strategies
+    pipeline_ids : list
+        the names of the pipeline strategies outputs
     '''
 
-    # Import packages
-    from CPAC.utils.utils import check_config_resources, check_system_deps
-    
-    # Assure that changes on config will not affect other parts
-    c = copy.copy(c)
+    from CPAC.utils.utils import check_system_deps
 
     subject_id = sub_dict['subject_id']
     if sub_dict['unique_id']:
         subject_id += "_" + sub_dict['unique_id']
 
-    log_dir = os.path.join(c.logDirectory, 'pipeline_%s' % c.pipelineName, subject_id)
-    if not os.path.exists(log_dir):
-        os.makedirs(os.path.join(log_dir))
-
-    # TODO ASH Enforce c.run_logging to be boolean
-    # TODO ASH Schema validation
-    config.update_config({
-        'logging': {
-            'log_directory': log_dir,
-            'log_to_file': bool(getattr(c, 'run_logging', True))
-        }
-    })
-    config.enable_resource_monitor()
-
-    logging.update_logging(config)
-
-    # Start timing here
-    pipeline_start_time = time.time()
-    # at end of workflow, take timestamp again, take time elapsed and check
-    # tempfile add time to time data structure inside tempfile, and increment
-    # number of subjects
-
-    # Check pipeline config resources
-    sub_mem_gb, num_cores_per_sub, num_ants_cores = \
-        check_config_resources(c)
-
-    if not plugin:
-        plugin = 'MultiProc'
-
-    if plugin_args:
-        plugin_args['memory_gb'] = sub_mem_gb
-        plugin_args['n_procs'] = num_cores_per_sub
-    else:
-        plugin_args = {'memory_gb': sub_mem_gb, 'n_procs': num_cores_per_sub}
-
-    # perhaps in future allow user to set threads maximum
-    # this is for centrality mostly
-    # import mkl
-    numThreads = '1'
-    os.environ['OMP_NUM_THREADS'] = '1'  # str(num_cores_per_sub)
-    os.environ['MKL_NUM_THREADS'] = '1'  # str(num_cores_per_sub)
-    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_ants_cores)
-
-    # TODO: TEMPORARY
-    # TODO: solve the UNet model hanging issue during MultiProc
-    if "unet" in c.skullstrip_option:
-        c.maxCoresPerParticipant = 1
-        logger.info("\n\n[!] LOCKING CPUs PER PARTICIPANT TO 1 FOR U-NET "
-                    "MODEL.\n\nThis is a temporary measure due to a known "
-                    "issue preventing Nipype's parallelization from running "
-                    "U-Net properly.\n\n")
-
-    # calculate maximum potential use of cores according to current pipeline
-    # configuration
-    max_core_usage = int(c.maxCoresPerParticipant) * \
-        int(c.numParticipantsAtOnce)
-
-    information = """
-
-    C-PAC version: {cpac_version}
-
-    Setting maximum number of cores per participant to {cores}
-    Setting number of participants at once to {participants}
-    Setting OMP_NUM_THREADS to {threads}
-    Setting MKL_NUM_THREADS to {threads}
-    Setting ANTS/ITK thread usage to {ants_threads}
-    Maximum potential number of cores that might be used during this run: {max_cores}
-
-"""
-
-    execution_info = """
-
-    End of subject workflow {workflow}
-
-    CPAC run complete:
-
-        Pipeline configuration: {pipeline}
-        Subject workflow: {workflow}
-        Elapsed run time (minutes): {elapsed}
-        Timing information saved in {log_dir}/cpac_individual_timing_{pipeline}.csv
-        System time of start:      {run_start}
-        System time of completion: {run_finish}
-
-"""
-
-    logger.info(information.format(
-        cpac_version=CPAC.__version__,
-        cores=c.maxCoresPerParticipant,
-        participants=c.numParticipantsAtOnce,
-        threads=numThreads,
-        ants_threads=c.num_ants_threads,
-        max_cores=max_core_usage
-    ))
-
     # TODO ASH temporary code, remove
     # TODO ASH maybe scheme validation/normalization
     already_skullstripped = c.already_skullstripped[0]
@@ -265,10 +194,6 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
     elif already_skullstripped == 3:
         already_skullstripped = 1
 
-    subject_info = {}
-    subject_info['subject_id'] = subject_id
-    subject_info['start_time'] = pipeline_start_time
-
     check_centrality_degree = 1 in c.runNetworkCentrality and \
                               (True in c.degWeightOptions or \
                                True in c.eigWeightOptions)
@@ -314,11 +239,6 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
             raise Exception(err_msg)
             
 
-    # absolute paths of the dirs
-    c.workingDirectory = os.path.abspath(c.workingDirectory)
-    if 's3://' not in c.outputDirectory:
-        c.outputDirectory = os.path.abspath(c.outputDirectory)
-
     # Workflow setup
     workflow_name = 'resting_preproc_' + str(subject_id)
     workflow = pe.Workflow(name=workflow_name)
@@ -367,18 +287,6 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
 
         setattr(c, key, node)
 
-    if c.reGenerateOutputs is True:
-        working_dir = os.path.join(c.workingDirectory, workflow_name)
-        erasable = list(find_files(working_dir, '*sink*')) + \
-            list(find_files(working_dir, '*link*')) + \
-            list(find_files(working_dir, '*log*'))
-
-        for f in erasable:
-            if os.path.isfile(f):
-                os.remove(f)
-            else:
-                shutil.rmtree(f)
-
     """""""""""""""""""""""""""""""""""""""""""""""""""
      PREPROCESSING
     """""""""""""""""""""""""""""""""""""""""""""""""""
@@ -440,6 +348,7 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
     if 1 in c.run_pypeer:
         templates_for_resampling.append((c.resolution_for_func_preproc, c.eye_mask_path, 'template_eye_mask', 'resolution_for_func_preproc'))
         Outputs.any.append("template_eye_mask")
+        Outputs.any.append("pypeer_outputs")
 
     # update resampled template to resource pool
     for resolution, template, template_name, tag in templates_for_resampling:
@@ -2377,9 +2286,8 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                 has_segmentation = 'seg_preproc' in nodes or 'seg_preproc_t1_template' in nodes or 'seg_preproc_epi_template' in nodes
                 use_ants = 'anat_mni_fnirt_register' not in nodes and 'anat_mni_flirt_register' not in nodes
 
-                for regressors_selector_i, regressors_selector in enumerate(c.Regressors):
-
-                    new_strat = strat.fork()
+                regressors_selectors = []
+                for regressors_selector in c.Regressors:
 
                     # to guarantee immutability
                     regressors_selector = NuisanceRegressor(
@@ -2398,10 +2306,32 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                             if reg in regressors_selector:
                                 del regressors_selector[reg]
 
+                    regressors_selectors.append(regressors_selector)
+
+                # the selectors regressed in process share a single pass
+                # over the functional image
+                batched_selectors = []
+                if getattr(c, 'batchNuisanceRegression', False):
+                    batched_selectors = [
+                        regressors_selector_i
+                        for regressors_selector_i, regressors_selector
+                        in enumerate(regressors_selectors)
+                        if not has_voxel_nuisance_regressors(regressors_selector)
+                    ]
+                    if len(batched_selectors) < 2:
+                        batched_selectors = []
+
+                batched_strats = []
+
+                for regressors_selector_i, regressors_selector in enumerate(regressors_selectors):
+
+                    new_strat = strat.fork()
+
                     nuisance_regression_workflow = create_nuisance_workflow(
                         regressors_selector,
                         use_ants=use_ants,
-                        name='nuisance_{0}_{1}'.format(regressors_selector_i, num_strat)
+                        name='nuisance_{0}_{1}'.format(regressors_selector_i, num_strat),
+                        batched=regressors_selector_i in batched_selectors
                     )
 
                     node, node_out = strat['tr']
@@ -2529,26 +2459,98 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
 
                     new_strat.append_name(nuisance_regression_workflow.name)
 
-                    new_strat.set_leaf_properties(
-                        nuisance_regression_workflow,
-                        'outputspec.residual_file_path'
-                    )
-
                     new_strat.update_resource_pool({
                         'nuisance_regression_selector': regressors_selector,
-                        
-                        'functional_nuisance_residuals': (
-                            nuisance_regression_workflow,
-                            'outputspec.residual_file_path')
-                        ,
                         'functional_nuisance_regressors': (
                             nuisance_regression_workflow,
                             'outputspec.regressors_file_path'
                         ),
                     })
 
+                    if regressors_selector_i in batched_selectors:
+                        batched_strats.append(
+                            (new_strat, nuisance_regression_workflow)
+                        )
+                    else:
+                        new_strat.set_leaf_properties(
+                            nuisance_regression_workflow,
+                            'outputspec.residual_file_path'
+                        )
+
+                        new_strat.update_resource_pool({
+                            'functional_nuisance_residuals': (
+                                nuisance_regression_workflow,
+                                'outputspec.residual_file_path'
+                            ),
+                        })
+
                     new_strat_list.append(new_strat)
 
+                if batched_strats:
+
+                    nuisance_designs = pe.Node(
+                        util.Merge(len(batched_strats)),
+                        name='nuisance_designs_{0}'.format(num_strat)
+                    )
+
+                    # the residuals of every batched strategy are mapped
+                    # in memory until they are written
+                    scan_paths = [
+                        scan['scan'] if isinstance(scan, dict) else scan
+                        for scan in sub_dict.get('func',
+                                                 sub_dict.get('rest',
+                                                              {})).values()
+                    ]
+                    batch_mem_gb = nuisance_regression_batch_mem_gb(
+                        scan_paths, len(batched_strats))
+
+                    nuisance_regression_batch = pe.Node(Function(
+                        input_names=['functional_file_path',
+                                     'design_file_paths',
+                                     'functional_brain_mask_file_path'],
+                        output_names=[
+                            'residual_file_path_{0}'.format(i)
+                            for i in range(len(batched_strats))
+                        ],
+                        function=native_nuisance_regression_batch,
+                        as_module=True
+                    ), name='nuisance_regression_batch_{0}'.format(num_strat),
+                       mem_gb=batch_mem_gb)
+
+                    node, out_file = strat.get_leaf_properties()
+                    workflow.connect(node, out_file,
+                                     nuisance_regression_batch,
+                                     'functional_file_path')
+
+                    node, out_file = strat['functional_brain_mask']
+                    workflow.connect(node, out_file,
+                                     nuisance_regression_batch,
+                                     'functional_brain_mask_file_path')
+
+                    workflow.connect(nuisance_designs, 'out',
+                                     nuisance_regression_batch,
+                                     'design_file_paths')
+
+                    for i, (new_strat, nuisance_regression_workflow) in \
+                            enumerate(batched_strats):
+
+                        workflow.connect(nuisance_regression_workflow,
+                                         'outputspec.design_file_path',
+                                         nuisance_designs,
+                                         'in{0}'.format(i + 1))
+
+                        residual_file_path = 'residual_file_path_{0}'.format(i)
+
+                        new_strat.set_leaf_properties(
+                            nuisance_regression_batch, residual_file_path
+                        )
+
+                        new_strat.update_resource_pool({
+                            'functional_nuisance_residuals': (
+                                nuisance_regression_batch, residual_file_path
+                            ),
+                        })
+
             # Be aware that this line is supposed to override the current strat_list: it is not a typo/mistake!
             # Each regressor forks the strategy, instead of reusing it, to keep the code simple
             strat_list = new_strat_list
@@ -2644,6 +2646,70 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                     output_func_to_standard( workflow, func_key, ref_key, output_name, strat, num_strat, c, input_image_type=image_type)
 
         strat_list += new_strat_list
+
+        # Inserting PyPEER, which joins the scans of the participant, on the
+        # strategies without nuisance regression
+        if 1 in c.run_pypeer:
+            for num_strat, strat in enumerate(strat_list):
+
+                if 'nuisance_regression_selector' in strat or \
+                        'functional_to_standard' not in strat:
+                    continue
+
+                joinfield = ['func_files', 'scan_labels']
+                if c.peer_scrub:
+                    joinfield.append('fd_files')
+
+                pypeer = pe.JoinNode(
+                    Function(input_names=['func_files',
+                                          'scan_labels',
+                                          'eye_mask_path',
+                                          'stim_path',
+                                          'peer_scan_names',
+                                          'data_scan_names',
+                                          'fd_files',
+                                          'gsr',
+                                          'scrub',
+                                          'scrub_thresh',
+                                          'processes'],
+                             output_names=['pypeer_outputs'],
+                             function=run_pypeer,
+                             as_module=True),
+                    joinsource='inputnode',
+                    joinfield=joinfield,
+                    name='pypeer_%d' % num_strat
+                )
+
+                processes = min(int(getattr(c, 'peer_processes', 1)),
+                                int(c.maxCoresPerParticipant))
+                pypeer.inputs.set(
+                    stim_path=c.peer_stimulus_path,
+                    peer_scan_names=c.peer_eye_scan_names,
+                    data_scan_names=c.peer_data_scan_names,
+                    gsr=c.peer_gsr,
+                    scrub=c.peer_scrub,
+                    scrub_thresh=c.peer_scrub_thresh,
+                    processes=processes
+                )
+                pypeer.n_procs = processes
+
+                node, out_file = strat['functional_to_standard']
+                workflow.connect(node, out_file, pypeer, 'func_files')
+
+                node, out_file = strat['scan_id']
+                workflow.connect(node, out_file, pypeer, 'scan_labels')
+
+                node, out_file = strat['template_eye_mask']
+                workflow.connect(node, out_file, pypeer, 'eye_mask_path')
+
+                if c.peer_scrub:
+                    node, out_file = strat['frame_wise_displacement_power']
+                    workflow.connect(node, out_file, pypeer, 'fd_files')
+
+                strat.append_name(pypeer.name)
+                strat.update_resource_pool({
+                    'pypeer_outputs': (pypeer, 'pypeer_outputs')
+                })
         
         # Derivatives
 
@@ -3437,61 +3503,9 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
 
     logger.info('\n\n' + 'Pipeline building completed.' + '\n\n')
 
-    # Run the pipeline only if the user signifies.
-    # otherwise, only construct the pipeline (above)
-    if run == 1:
-
-        try:
-            workflow.write_graph(graph2use='hierarchical')
-        except:
-            pass
-
-
-        ndmg_out = False
-        try:
-            # let's encapsulate this inside a Try..Except block so if
-            # someone doesn't have ndmg_outputs in their pipe config,
-            # it will default to the regular datasink
-            #     TODO: update this when we change to the optionals
-            #     TODO: only pipe config
-            if 1 in c.ndmg_mode:
-                ndmg_out = True
-        except:
-            pass
-
-
-        # TODO enforce value with schema validation
-        try:
-            encrypt_data = bool(c.s3Encryption[0])
-        except:
-            encrypt_data = False
-
-
-        # TODO enforce value with schema validation
-        # Extract credentials path for output if it exists
-        try:
-            # Get path to creds file
-            creds_path = ''
-            if c.awsOutputBucketCredentials:
-                creds_path = str(c.awsOutputBucketCredentials)
-                creds_path = os.path.abspath(creds_path)
-
-            if c.outputDirectory.lower().startswith('s3://'):
-                # Test for s3 write access
-                s3_write_access = \
-                    aws_utils.test_bucket_access(creds_path,
-                                                    c.outputDirectory)
-
-                if not s3_write_access:
-                    raise Exception('Not able to write to bucket!')
-
-        except Exception as e:
-            if c.outputDirectory.lower().startswith('s3://'):
-                err_msg = 'There was an error processing credentials or ' \
-                            'accessing the S3 bucket. Check and try again.\n' \
-                            'Error: %s' % e
-                raise Exception(err_msg)
+    pipeline_ids = []
 
+    if run == 1:
 
         # this section creates names for the different branched strategies.
         # it identifies where the pipeline has forked and then appends the
@@ -3525,12 +3539,6 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
 
             rp = strat.get_resource_pool()
 
-            if c.write_debugging_outputs:
-                workdir = os.path.join(c.workingDirectory, workflow_name)
-                rp_pkl = os.path.join(workdir, 'resource_pool.pkl')
-                with open(rp_pkl, 'wt') as f:
-                    pickle.dump(rp, f)
-
             output_sink_nodes = []
 
             for resource_i, resource in enumerate(sorted(rp.keys())):
@@ -3573,7 +3581,7 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                                  name='sinker_{}_{}'.format(num_strat,
                                                             resource_i))
                     ds.inputs.base_directory = c.outputDirectory
-                    ds.inputs.creds_path = creds_path
+                    ds.inputs.creds_path = output_creds_path
                     ds.inputs.encrypt_bucket_keys = encrypt_data
                     ds.inputs.parameterization = True
                     ds.inputs.regexp_substitutions = [
@@ -3717,7 +3725,7 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                         name='sinker_{}_{}'.format(num_strat, resource_i)
                     )
                     ds.inputs.base_directory = c.outputDirectory
-                    ds.inputs.creds_path = creds_path
+                    ds.inputs.creds_path = output_creds_path
                     ds.inputs.encrypt_bucket_keys = encrypt_data
                     ds.inputs.container = os.path.join(
                         'pipeline_%s' % pipeline_id, subject_id
@@ -3794,6 +3802,292 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
 
         logger.info(forks)
 
+    return workflow, strat_list, pipeline_ids
+
+
+def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
+                  p_name=None, plugin='MultiProc', plugin_args=None, test_config=False):
+    '''
+    Function to prepare and, optionally, run the C-PAC workflow
+
+    Parameters
+    ----------
+    sub_dict : dictionary
+        subject dictionary with anatomical and functional image paths
+    c : Configuration object
+        CPAC pipeline configuration dictionary object
+    run : boolean
+        flag to indicate whether to run the prepared workflow
+    pipeline_timing_info : list (optional); default=None
+        list of pipeline info for reporting timing information
+    p_name : string (optional); default=None
+        name of pipeline
+    plugin : string (optional); defaule='MultiProc'
+        nipype plugin to utilize when the workflow is ran
+    plugin_args : dictionary (optional); default=None
+        plugin-specific arguments for the workflow plugin
+
+    Returns
+    -------
+    workflow : nipype workflow
+        the prepared nipype workflow object containing the parameters
+        specified in the config
+    '''
+
+    # Import packages
+    from CPAC.utils.utils import check_config_resources, \
+        workflow_resource_demand
+    
+    # Assure that changes on config will not affect other parts
+    c = copy.copy(c)
+
+    subject_id = sub_dict['subject_id']
+    if sub_dict['unique_id']:
+        subject_id += "_" + sub_dict['unique_id']
+
+    log_dir = os.path.join(c.logDirectory, 'pipeline_%s' % c.pipelineName, subject_id)
+    if not os.path.exists(log_dir):
+        os.makedirs(os.path.join(log_dir))
+
+    # TODO ASH Enforce c.run_logging to be boolean
+    # TODO ASH Schema validation
+    config.update_config({
+        'logging': {
+            'log_directory': log_dir,
+            'log_to_file': bool(getattr(c, 'run_logging', True))
+        }
+    })
+    config.enable_resource_monitor()
+
+    logging.update_logging(config)
+
+    # Start timing here
+    pipeline_start_time = time.time()
+    # at end of workflow, take timestamp again, take time elapsed and check
+    # tempfile add time to time data structure inside tempfile, and increment
+    # number of subjects
+
+    # Check pipeline config resources
+    sub_mem_gb, num_cores_per_sub, num_ants_cores = \
+        check_config_resources(c)
+
+    if not plugin:
+        plugin = 'MultiProc'
+
+    # the participant scheduler may grant other resources than the
+    # configured ones, so explicit values are kept
+    plugin_args = dict(plugin_args or {})
+    if not plugin_args.get('memory_gb'):
+        plugin_args['memory_gb'] = sub_mem_gb
+    if not plugin_args.get('n_procs'):
+        plugin_args['n_procs'] = num_cores_per_sub
+
+    # perhaps in future allow user to set threads maximum
+    # this is for centrality mostly
+    # import mkl
+    numThreads = '1'
+    os.environ['OMP_NUM_THREADS'] = '1'  # str(num_cores_per_sub)
+    os.environ['MKL_NUM_THREADS'] = '1'  # str(num_cores_per_sub)
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(num_ants_cores)
+
+    # TODO: TEMPORARY
+    # TODO: solve the UNet model hanging issue during MultiProc
+    # the U-Net worker process does not hang, see predict_in_worker
+    if "unet" in c.skullstrip_option and \
+            not getattr(c, 'unet_worker_process', False):
+        c.maxCoresPerParticipant = 1
+        logger.info("\n\n[!] LOCKING CPUs PER PARTICIPANT TO 1 FOR U-NET "
+                    "MODEL.\n\nThis is a temporary measure due to a known "
+                    "issue preventing Nipype's parallelization from running "
+                    "U-Net properly.\n\n")
+
+    # calculate maximum potential use of cores according to current pipeline
+    # configuration
+    max_core_usage = int(c.maxCoresPerParticipant) * \
+        int(c.numParticipantsAtOnce)
+
+    information = """
+
+    C-PAC version: {cpac_version}
+
+    Setting maximum number of cores per participant to {cores}
+    Setting number of participants at once to {participants}
+    Setting OMP_NUM_THREADS to {threads}
+    Setting MKL_NUM_THREADS to {threads}
+    Setting ANTS/ITK thread usage to {ants_threads}
+    Maximum potential number of cores that might be used during this run: {max_cores}
+
+"""
+
+    execution_info = """
+
+    End of subject workflow {workflow}
+
+    CPAC run complete:
+
+        Pipeline configuration: {pipeline}
+        Subject workflow: {workflow}
+        Elapsed run time (minutes): {elapsed}
+        Timing information saved in {log_dir}/cpac_individual_timing_{pipeline}.csv
+        System time of start:      {run_start}
+        System time of completion: {run_finish}
+
+"""
+
+    logger.info(information.format(
+        cpac_version=CPAC.__version__,
+        cores=c.maxCoresPerParticipant,
+        participants=c.numParticipantsAtOnce,
+        threads=numThreads,
+        ants_threads=c.num_ants_threads,
+        max_cores=max_core_usage
+    ))
+
+    subject_info = {}
+    subject_info['subject_id'] = subject_id
+    subject_info['start_time'] = pipeline_start_time
+
+    # absolute paths of the dirs
+    c.workingDirectory = os.path.abspath(c.workingDirectory)
+    if 's3://' not in c.outputDirectory:
+        c.outputDirectory = os.path.abspath(c.outputDirectory)
+
+    workflow_name = 'resting_preproc_' + str(subject_id)
+
+    if c.reGenerateOutputs is True:
+        working_dir = os.path.join(c.workingDirectory, workflow_name)
+        erasable = list(find_files(working_dir, '*sink*')) + \
+            list(find_files(working_dir, '*link*')) + \
+            list(find_files(working_dir, '*log*'))
+
+        for f in erasable:
+            if os.path.isfile(f):
+                os.remove(f)
+            else:
+                shutil.rmtree(f)
+
+    ndmg_out = False
+    encrypt_data = False
+    creds_path = ''
+
+    if run == 1:
+
+        try:
+            # let's encapsulate this inside a Try..Except block so if
+            # someone doesn't have ndmg_outputs in their pipe config,
+            # it will default to the regular datasink
+            #     TODO: update this when we change to the optionals
+            #     TODO: only pipe config
+            if 1 in c.ndmg_mode:
+                ndmg_out = True
+        except:
+            pass
+
+
+        # TODO enforce value with schema validation
+        try:
+            encrypt_data = bool(c.s3Encryption[0])
+        except:
+            encrypt_data = False
+
+
+        # TODO enforce value with schema validation
+        # Extract credentials path for output if it exists
+        try:
+            # Get path to creds file
+            creds_path = ''
+            if c.awsOutputBucketCredentials:
+                creds_path = str(c.awsOutputBucketCredentials)
+                creds_path = os.path.abspath(creds_path)
+
+            if c.outputDirectory.lower().startswith('s3://'):
+                # Test for s3 write access
+                s3_write_access = \
+                    aws_utils.test_bucket_access(creds_path,
+                                                    c.outputDirectory)
+
+                if not s3_write_access:
+                    raise Exception('Not able to write to bucket!')
+
+        except Exception as e:
+            if c.outputDirectory.lower().startswith('s3://'):
+                err_msg = 'There was an error processing credentials or ' \
+                            'accessing the S3 bucket. Check and try again.\n' \
+                            'Error: %s' % e
+                raise Exception(err_msg)
+
+    # Download the S3 inputs of the participant while its workflow is built
+    prefetch = None
+    if run == 1 and not test_config and \
+            getattr(c, 'prefetchS3Inputs', False):
+        try:
+            prefetch = Prefetch(sub_dict, c.workingDirectory)
+        except Exception as e:
+            logger.warning('Could not prefetch the S3 inputs: %s' % e)
+
+    # Build the workflow graph. With cacheWorkflowGraph, the graph is built
+    # once per pipeline configuration and participant structure, from a
+    # data configuration entry with placeholders, and saved in the working
+    # directory; each participant only binds its own values to it
+    graph_start_time = time.time()
+
+    build_kwargs = {
+        'run': run,
+        'p_name': p_name,
+        'ndmg_out': ndmg_out,
+        'encrypt_data': encrypt_data,
+        'output_creds_path': creds_path,
+        'num_ants_cores': num_ants_cores,
+    }
+
+    if getattr(c, 'cacheWorkflowGraph', False):
+        template_sub_dict, bindings = participant_template(sub_dict)
+        template_path = workflow_template_path(
+            os.path.join(c.workingDirectory, 'workflow_templates'),
+            c, template_sub_dict, **build_kwargs
+        )
+
+        template = load_workflow_template(template_path)
+        if template is None:
+            template = build_workflow(template_sub_dict, c,
+                                      log_dir=log_dir, **build_kwargs)
+            save_workflow_template(template_path, template)
+            graph_source = 'built, template saved to %s' % template_path
+        else:
+            graph_source = 'loaded from template %s' % template_path
+
+        workflow, strat_list, pipeline_ids = template
+        bind_workflow(workflow, bindings)
+
+    else:
+        workflow, strat_list, pipeline_ids = \
+            build_workflow(sub_dict, c, log_dir=log_dir, **build_kwargs)
+        graph_source = 'built'
+
+    # written once the participant is bound, so a workflow template does not
+    # leave its placeholders in the working directory
+    if run == 1 and c.write_debugging_outputs and strat_list:
+        workdir = os.path.join(c.workingDirectory, workflow_name)
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        rp_pkl = os.path.join(workdir, 'resource_pool.pkl')
+        with open(rp_pkl, 'wt') as f:
+            pickle.dump(strat_list[-1].get_resource_pool(), f)
+
+    subject_info['graph_build_time'] = time.time() - graph_start_time
+    logger.info('Workflow graph %s in %.2fs' % (
+        graph_source, subject_info['graph_build_time']))
+
+    # Run the pipeline only if the user signifies.
+    # otherwise, only construct the pipeline (above)
+    if run == 1:
+
+        try:
+            workflow.write_graph(graph2use='hierarchical')
+        except:
+            pass
+
+
         if test_config:
 
             logger.info('This has been a test of the pipeline configuration file, the pipeline was built successfully, but was not run')
@@ -3841,19 +4135,34 @@ def prep_workflow(sub_dict, c, run, pipeline_timing_info=None,
                 else:
                     plugin_args['status_callback'] = log_nodes_cb
 
+                # the pool has to fit the largest node of the workflow,
+                # which then runs alone
+                node_cores, node_memory = workflow_resource_demand(workflow)
+                plugin_args['n_procs'] = max(plugin_args['n_procs'],
+                                             node_cores)
+                plugin_args['memory_gb'] = max(plugin_args['memory_gb'],
+                                               node_memory)
+
                 if plugin_args['n_procs'] == 1:
                     plugin = 'Linear'
 
+                if prefetch is not None:
+                    failed = prefetch.wait()
+                    if failed:
+                        logger.warning('%d S3 inputs could not be '
+                                       'prefetched' % failed)
+
                 # Actually run the pipeline now, for the current subject
                 workflow.run(plugin=plugin, plugin_args=plugin_args)
 
-                # PyPEER kick-off
-                if 1 in c.run_pypeer:
-                    from CPAC.pypeer.peer import prep_for_pypeer
-                    prep_for_pypeer(c.peer_eye_scan_names, c.peer_data_scan_names,
-                                    c.eye_mask_path, c.outputDirectory, subject_id, 
-                                    pipeline_ids, c.peer_stimulus_path, c.peer_gsr,
-                                    c.peer_scrub, c.peer_scrub_thresh)
+                # Index the participant outputs for group-level analysis
+                if not c.outputDirectory.lower().startswith('s3://'):
+                    for pip_id in sorted(set(pipeline_ids)):
+                        pipeline_base = os.path.join(c.outputDirectory,
+                                                     'pipeline_%s' % pip_id)
+                        if os.path.isdir(pipeline_base):
+                            update_output_catalog(pipeline_base,
+                                                  [subject_id])
 
                 # Dump subject info pickle file to subject log dir
                 subject_info['status'] = 'Completed'
@@ -1,4 +1,5 @@
 import os
+import math
 import time
 import warnings
 from multiprocessing import Process
@@ -166,6 +167,238 @@ def run_cpac_on_cluster(config_file, subject_list_file,
         f.write(pid)
 
 
+def parse_callback_time(timestamp):
+    '''
+    Parses the ISO timestamps nipype stores in the node runtimes.
+    '''
+
+    from datetime import datetime
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S'):
+        try:
+            return datetime.strptime(timestamp, fmt)
+        except (TypeError, ValueError):
+            pass
+
+    return None
+
+
+def callback_peak_usage(callback_file):
+    '''
+    Sweeps the node runtimes recorded in a participant's callback log and
+    returns the peak number of cores and memory (GB) used concurrently by
+    its nodes, or (None, None) if no node finished.
+
+    Measured usage (runtime_threads, runtime_memory_gb) is used when the
+    resource monitor was enabled, the node estimates otherwise.
+    '''
+
+    import json
+
+    events = []
+    with open(callback_file, 'r') as f:
+        for line in f:
+            try:
+                node = json.loads(line)
+            except ValueError:
+                continue
+
+            start = parse_callback_time(node.get('start'))
+            finish = parse_callback_time(node.get('finish'))
+            if start is None or finish is None:
+                continue
+
+            threads = node.get('runtime_threads')
+            if isinstance(threads, (int, float)):
+                threads = threads / 100.0
+            else:
+                threads = node.get('num_threads') or 1
+
+            memory = node.get('runtime_memory_gb')
+            if not isinstance(memory, (int, float)):
+                memory = node.get('estimated_memory_gb') or 0
+
+            # nodes finishing at the same time others start are not
+            # concurrent, so finishes are sorted first
+            events.append((start, 1, threads, memory))
+            events.append((finish, 0, -threads, -memory))
+
+    if not events:
+        return None, None
+
+    cores = memory = 0
+    peak_cores = peak_memory = 0
+    for _, _, threads_delta, memory_delta in sorted(events):
+        cores += threads_delta
+        memory += memory_delta
+        peak_cores = max(peak_cores, cores)
+        peak_memory = max(peak_memory, memory)
+
+    return peak_cores, peak_memory
+
+
+def participant_peak_usage(pipeline_log_dir):
+    '''
+    Returns the largest peak cores and memory (GB) observed for any
+    participant previously run by this pipeline, from the callback logs
+    under the pipeline log directory, or (None, None) if there are none.
+    '''
+
+    import glob
+
+    peak_cores = peak_memory = None
+    for callback_file in glob.glob(os.path.join(pipeline_log_dir, '*',
+                                                'callback.log')):
+        cores, memory = callback_peak_usage(callback_file)
+        if cores is None:
+            continue
+        peak_cores = max(peak_cores, cores)
+        peak_memory = max(peak_memory, memory)
+
+    return peak_cores, peak_memory
+
+
+def participant_worker(exit_pipe, target, participant, plugin_args, args):
+    '''
+    Runs a participant in a scheduled process. The write end of exit_pipe
+    is only held by this process, so it is closed, waking the scheduler
+    up, whenever the process exits.
+    '''
+
+    target(participant, plugin_args, *args)
+
+
+def schedule_participants(participants, target, args=(), cores_budget=1,
+                          memory_budget=None, cores_demand=1,
+                          memory_demand=None, pid_file=None):
+    '''
+    Runs target(participant, plugin_args, *args) in a process for each
+    participant, admitting participants while their expected usage fits in
+    the global CPU and memory budgets.
+
+    The MultiProc pool of a participant is given the resources it is
+    charged with, so the running pools never exceed the budgets.
+
+    The scheduler sleeps until a participant process exits, and then
+    admits as many pending participants as the released resources allow.
+    Once all the pending participants fit in the idle resources, these are
+    split among them, so the MultiProc pools of the last participants
+    receive the cores that would otherwise stay idle.
+
+    Parameters
+    ----------
+    participants : list
+        participants to run
+    target : function
+        function running one participant
+    args : tuple
+        extra arguments to target
+    cores_budget : int
+        number of cores shared by all participants
+    memory_budget : float
+        memory (GB) shared by all participants, None for unbounded
+    cores_demand : int
+        number of cores a participant is expected to use
+    memory_demand : float
+        memory (GB) a participant is expected to use
+    pid_file : file
+        open file to record the participant process ids into
+
+    Returns
+    -------
+    exitcodes : list
+        exit code of each participant process
+    '''
+
+    import errno
+    import select
+    from multiprocessing import Pipe
+
+    cores_budget = max(int(cores_budget), 1)
+    cores_demand = min(max(int(cores_demand), 1), cores_budget)
+    if memory_budget is None or memory_demand is None:
+        memory_budget = memory_demand = None
+    else:
+        memory_demand = min(memory_demand, memory_budget)
+
+    pending = list(enumerate(participants))
+    running = {}
+    exitcodes = [None] * len(participants)
+    free_cores, free_memory = cores_budget, memory_budget
+
+    while pending or running:
+
+        while pending:
+            n_pending = len(pending)
+
+            if free_cores < cores_demand or (
+                    memory_demand is not None and
+                    free_memory < memory_demand):
+                break
+
+            cores, memory = cores_demand, memory_demand
+            if free_cores >= n_pending * cores_demand and (
+                    memory_demand is None or
+                    free_memory >= n_pending * memory_demand):
+                cores = free_cores // n_pending
+                if memory_demand is not None:
+                    memory = free_memory / n_pending
+
+            idx, participant = pending.pop(0)
+            plugin_args = {'n_procs': cores, 'memory_gb': memory}
+
+            reader, writer = Pipe(duplex=False)
+            process = Process(target=participant_worker,
+                              args=(writer, target, participant,
+                                    plugin_args, args))
+            process.start()
+            writer.close()
+
+            if pid_file:
+                print >>pid_file, process.pid
+
+            running[reader] = (idx, process, cores, memory)
+            free_cores -= cores
+            if memory is not None:
+                free_memory -= memory
+
+        if not running:
+            break
+
+        try:
+            ready, _, _ = select.select(list(running), [], [])
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+
+        for reader in ready:
+            idx, process, cores, memory = running.pop(reader)
+            reader.close()
+            process.join()
+            exitcodes[idx] = process.exitcode
+            free_cores += cores
+            if memory is not None:
+                free_memory += memory
+
+    return exitcodes
+
+
+def run_participant(sub_dict, plugin_args, c, pipeline_timing_info, p_name,
+                    plugin, base_plugin_args, test_config):
+    '''
+    Runs a participant with the resources granted by the scheduler.
+    '''
+
+    from CPAC.pipeline.cpac_pipeline import prep_workflow
+
+    participant_plugin_args = dict(base_plugin_args or {})
+    participant_plugin_args.update(plugin_args)
+
+    prep_workflow(sub_dict, c, True, pipeline_timing_info, p_name, plugin,
+                  participant_plugin_args, test_config)
+
+
 # Run C-PAC subjects via job queue
 def run(subject_list_file, config_file=None, p_name=None, plugin=None,
         plugin_args=None, tracking=True, num_subs_at_once=None, debug=False, test_config=False):
@@ -193,17 +426,6 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
     config_file = os.path.realpath(config_file)
     if '.yaml' in subject_list_file or '.yml' in subject_list_file:
         subject_list_file = os.path.realpath(subject_list_file)
-    else:
-        from CPAC.utils.bids_utils import collect_bids_files_configs, \
-            bids_gen_cpac_sublist
-        (file_paths, config) = collect_bids_files_configs(subject_list_file,
-                                                          None)
-        sublist = bids_gen_cpac_sublist(subject_list_file, file_paths,
-                                        config, None)
-        if not sublist:
-            import sys
-            print("Did not find data in {0}".format(subject_list_file))
-            sys.exit(1)
 
     # take date+time stamp for run identification purposes
     unique_pipeline_id = strftime("%Y%m%d%H%M%S")
@@ -261,6 +483,28 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
                       "Long paths might not work in your operational system.")
         warnings.warn("Current working directory: %s" % c.workingDirectory)
 
+    if not ('.yaml' in subject_list_file or '.yml' in subject_list_file):
+        from CPAC.utils.bids_utils import collect_bids_files_configs, \
+            collect_bids_files_params, bids_gen_cpac_sublist
+        if subject_list_file.lower().startswith('s3://'):
+            (file_paths, config) = \
+                collect_bids_files_configs(subject_list_file, None)
+            sublist = bids_gen_cpac_sublist(subject_list_file, file_paths,
+                                            config, None)
+        else:
+            # the layout index is stored in the working directory, so the
+            # next runs on the same data do not walk it again
+            (file_paths, scan_params) = \
+                collect_bids_files_params(subject_list_file,
+                                          c.workingDirectory)
+            sublist = bids_gen_cpac_sublist(subject_list_file, file_paths,
+                                            None, None,
+                                            scan_params=scan_params)
+        if not sublist:
+            import sys
+            print("Did not find data in {0}".format(subject_list_file))
+            sys.exit(1)
+
     # Get the pipeline name
     p_name = p_name or c.pipelineName
 
@@ -346,54 +590,43 @@ def run(subject_list_file, config_file=None, p_name=None, plugin=None,
                 
         pid = open(os.path.join(c.workingDirectory, 'pid.txt'), 'w')
 
-        # Init job queue
-        job_queue = []
-
-        # Allocate processes
-        processes = [
-            Process(target=prep_workflow,
-                    args=(sub, c, True, pipeline_timing_info,
-                          p_name, plugin, plugin_args, test_config))
-            for sub in sublist
-        ]
-
-        # If we're allocating more processes than are subjects, run them all
-        if len(sublist) <= c.numParticipantsAtOnce:
-            for p in processes:
-                p.start()
-                print >>pid, p.pid
+        import psutil
+        from multiprocessing import cpu_count
+        from CPAC.utils.utils import check_config_resources
+
+        # The configured per-participant resources times the number of
+        # participants at once make the budget of the run, and participants
+        # are admitted by the peak usage observed in previous runs, and
+        # given pools of that size
+        sub_mem_gb, num_cores_per_sub, num_ants_cores = \
+            check_config_resources(c)
+        sys_mem_gb = psutil.virtual_memory().total / (1024.0 ** 3)
+
+        cores_budget = min(cpu_count(),
+                           num_cores_per_sub * c.numParticipantsAtOnce)
+        memory_budget = min(sys_mem_gb,
+                            sub_mem_gb * c.numParticipantsAtOnce)
+
+        cores_demand, memory_demand = num_cores_per_sub, sub_mem_gb
+        peak_cores, peak_memory = participant_peak_usage(
+            os.path.join(c.logDirectory, 'pipeline_%s' % c.pipelineName)
+        )
+        if peak_cores:
+            # the pool still has to run the ANTs nodes, with their threads
+            cores_demand = min(cores_demand,
+                               max(int(math.ceil(peak_cores)),
+                                   num_ants_cores))
+        if peak_memory:
+            memory_demand = min(memory_demand, peak_memory)
+
+        schedule_participants(sublist, run_participant,
+                              args=(c, pipeline_timing_info, p_name, plugin,
+                                    plugin_args, test_config),
+                              cores_budget=cores_budget,
+                              memory_budget=memory_budget,
+                              cores_demand=cores_demand,
+                              memory_demand=memory_demand,
+                              pid_file=pid)
 
-        # Otherwise manage resources to run processes incrementally
-        else:
-            idx = 0
-            while idx < len(sublist):
-                # If the job queue is empty and we haven't started indexing
-                if len(job_queue) == 0 and idx == 0:
-                    # Init subject process index
-                    idc = idx
-                    # Launch processes (one for each subject)
-                    for p in processes[idc: idc+c.numParticipantsAtOnce]:
-                        p.start()
-                        print >>pid, p.pid
-                        job_queue.append(p)
-                        idx += 1
-                # Otherwise, jobs are running - check them
-                else:
-                    # Check every job in the queue's status
-                    for job in job_queue:
-                        # If the job is not alive
-                        if not job.is_alive():
-                            # Find job and delete it from queue
-                            print 'found dead job ', job
-                            loc = job_queue.index(job)
-                            del job_queue[loc]
-                            # ...and start the next available process
-                            # (subject)
-                            processes[idx].start()
-                            # Append this to job queue and increment index
-                            job_queue.append(processes[idx])
-                            idx += 1
-                    # Add sleep so while loop isn't consuming 100% of CPU
-                    time.sleep(2)
         # Close PID txt file to indicate finish
         pid.close()
@@ -0,0 +1,363 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+import nibabel as nb
+
+
+def _volumes(img):
+    # number of volumes of a 3D or 4D image
+    return int(np.prod(img.shape[3:])) if len(img.shape) > 3 else 1
+
+
+def _block(img, shape):
+    # the volumes of an image, as a 4D float32 array
+    data = np.asarray(img.dataobj).astype(np.float32, copy=False)
+    return data.reshape(shape + (-1,), order='F')
+
+
+def block_hash(data):
+    """
+    Hashes some volumes, to check the order of the volumes of a merged file
+    without comparing their contents.
+
+    Parameters
+    ----------
+    data : numpy array
+        Volumes, as float32 values.
+
+    Returns
+    -------
+    hash : str
+        SHA-1 of the volumes.
+    """
+
+    data = np.asarray(data).astype(np.float32, copy=False)
+    return hashlib.sha1(data.tobytes(order='F')).hexdigest()
+
+
+def merged_block_hashes(merged_file, volumes):
+    """
+    Hashes the volumes of a merged file, reading them in order.
+
+    Parameters
+    ----------
+    merged_file : str
+        Path of the 4D merged file.
+    volumes : list
+        Number of volumes of each of the merged files.
+
+    Returns
+    -------
+    hashes : list
+        Hash of the volumes of each of the merged files, see block_hash.
+    """
+
+    # the file is kept open, so the volumes of a compressed file are read
+    # sequentially instead of from its start
+    img = nb.load(merged_file, keep_file_open=True)
+    if len(img.shape) < 4:
+        img = nb.Nifti1Image(np.asarray(img.dataobj)[..., np.newaxis],
+                             img.affine)
+
+    hashes = []
+    start = 0
+    for count in volumes:
+        hashes.append(block_hash(img.dataobj[..., start:start + count]))
+        start += count
+
+    return hashes
+
+
+def save_mask(mask, affine, header, mask_outfile):
+    """
+    Writes a binary mask, as float values like fslmaths -bin does.
+    """
+
+    header = header.copy()
+    header.set_data_dtype(np.float32)
+    img = nb.Nifti1Image(mask.astype(np.float32), affine, header)
+    img.to_filename(mask_outfile)
+    return mask_outfile
+
+
+def nonzero_mask(image_file):
+    """
+    Computes the voxels which are non-zero in every volume of an image, as
+    fslmaths -abs -Tmin -bin does, reading the volumes one at a time.
+
+    Parameters
+    ----------
+    image_file : str
+        Path of the 3D or 4D image.
+
+    Returns
+    -------
+    mask : numpy array
+        Boolean 3D mask.
+    img : nibabel image
+        The image.
+    """
+
+    img = nb.load(image_file, keep_file_open=True)
+    shape = img.shape[:3]
+
+    mask = np.ones(shape, dtype=bool)
+    if len(img.shape) == 3:
+        mask &= np.abs(np.asarray(img.dataobj)) > 0
+    else:
+        for volume in range(img.shape[3]):
+            mask &= np.abs(np.asarray(img.dataobj[..., volume])) > 0
+
+    return mask, img
+
+
+class GroupMerge(object):
+    """
+    Merges the participant maps of a group model in a single pass over the
+    files, as fslmerge -t does, computing along the way the joint mask of
+    the maps, the hashes of their volumes and, optionally, the masks of the
+    individual maps.
+
+    The volumes are streamed into a preallocated memory-mapped 4D array, in
+    the working directory, so the maps of thousands of participants are
+    never all in memory. The raw maps, whose means are part of the model,
+    can be kept the same way.
+    """
+
+    def __init__(self, filepaths, raw_filepaths=None, work_dir=None):
+        """
+        Parameters
+        ----------
+        filepaths : list
+            Paths of the maps to merge, 3D or 4D.
+        raw_filepaths : list, optional
+            Paths of the raw maps, one per map, to keep for the measure and
+            custom ROI means; the raw maps are not kept by default.
+        work_dir : str, optional
+            Directory of the memory-mapped arrays, the temporary directory
+            by default.
+        """
+
+        self.filepaths = list(filepaths)
+        self.raw_filepaths = None
+        if raw_filepaths is not None:
+            self.raw_filepaths = list(raw_filepaths)
+            if len(self.raw_filepaths) != len(self.filepaths):
+                raise ValueError('There should be one raw map per map.')
+
+        self.work_dir = work_dir
+        self.data = None
+        self.raw = None
+        self.mask = None
+        self.hashes = []
+        self.volumes = []
+        self.affine = None
+        self.header = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _memmap(self, shape):
+        fd, path = tempfile.mkstemp(suffix='.dat', prefix='group_merge_',
+                                    dir=self.work_dir)
+        os.close(fd)
+        try:
+            data = np.memmap(path, dtype=np.float32, mode='w+',
+                             shape=shape, order='F')
+        finally:
+            # the mapping keeps the data of the file, which is deleted
+            # when the array is released, even after an error
+            os.remove(path)
+        return data
+
+    def close(self):
+        """
+        Releases the memory-mapped arrays.
+        """
+
+        self.data = None
+        self.raw = None
+
+    def merge(self, individual_mask_paths=None):
+        """
+        Reads each of the maps once, filling the merged array, the joint
+        mask, the hashes and the kept raw maps.
+
+        Parameters
+        ----------
+        individual_mask_paths : list, optional
+            Paths to write the non-zero mask of each raw map to, or of each
+            map if the raw maps are not kept, as fslmaths -abs -Tmin -bin
+            does.
+
+        Returns
+        -------
+        self : GroupMerge
+        """
+
+        imgs = [nb.load(path) for path in self.filepaths]
+        reference = imgs[0]
+        shape = reference.shape[:3]
+
+        for path, img in zip(self.filepaths, imgs):
+            if img.shape[:3] != shape:
+                raise Exception('The map {0} has dimensions {1}, but the '
+                                'first map to merge, {2}, has dimensions '
+                                '{3}.'.format(path, img.shape[:3],
+                                              self.filepaths[0], shape))
+
+        self.affine = reference.affine
+        self.header = reference.header.copy()
+        self.volumes = [_volumes(img) for img in imgs]
+
+        self.data = self._memmap(shape + (sum(self.volumes),))
+        if self.raw_filepaths is not None:
+            if self.raw_filepaths == self.filepaths:
+                self.raw = self.data
+            else:
+                self.raw = self._memmap(shape + (len(self.raw_filepaths),))
+
+        self.mask = np.ones(shape, dtype=bool)
+        self.hashes = []
+
+        start = 0
+        for i, (path, img) in enumerate(zip(self.filepaths, imgs)):
+            block = _block(img, shape)
+            stop = start + block.shape[3]
+
+            self.data[..., start:stop] = block
+            self.hashes.append(block_hash(block))
+            self.mask &= np.all(np.abs(block) > 0, axis=3)
+
+            raw = None
+            if self.raw is self.data:
+                raw = block[..., 0]
+            elif self.raw is not None:
+                raw_img = nb.load(self.raw_filepaths[i])
+                if raw_img.shape[:3] != shape:
+                    raise Exception('The raw map {0} does not have the '
+                                    'dimensions of the map {1}.'.format(
+                                        self.raw_filepaths[i], path))
+                raw = _block(raw_img, shape)[..., 0]
+                self.raw[..., i] = raw
+
+            if individual_mask_paths:
+                save_mask(np.abs(block[..., 0] if raw is None else raw) > 0,
+                          img.affine, img.header, individual_mask_paths[i])
+
+            start = stop
+
+        self.data.flush()
+        return self
+
+    def write_merged(self, merged_outfile):
+        """
+        Writes the merged maps, then checks that each of the volumes of the
+        written file has the hash of its map.
+
+        Parameters
+        ----------
+        merged_outfile : str
+            Path of the 4D merged file.
+
+        Returns
+        -------
+        merged_outfile : str
+            Path of the 4D merged file.
+        """
+
+        header = self.header.copy()
+        header.set_data_dtype(np.float32)
+        img = nb.Nifti1Image(self.data, self.affine, header)
+        img.to_filename(merged_outfile)
+
+        self.check_merged_file(merged_outfile)
+
+        return merged_outfile
+
+    def check_merged_file(self, merged_outfile):
+        """
+        Checks that the volumes of a merged file are the maps, in order.
+        """
+
+        hashes = merged_block_hashes(merged_outfile, self.volumes)
+        for i, (expected, found) in enumerate(zip(self.hashes, hashes)):
+            if expected != found:
+                raise Exception('Mismatch between the volumes of the merged '
+                                'file {0} and the map {1} ({2}).'.format(
+                                    merged_outfile, i, self.filepaths[i]))
+
+    def write_mask(self, mask_outfile):
+        """
+        Writes the joint mask of the maps, the voxels which are non-zero in
+        all of them.
+        """
+
+        return save_mask(self.mask, self.affine, self.header, mask_outfile)
+
+    def _raw_rows(self):
+        # each raw map, as a flat array in the order of the mask voxels
+        for i in range(self.raw.shape[3]):
+            yield np.asarray(self.raw[..., i]).ravel(order='F')
+
+    def _load_mask(self, mask_file):
+        data = np.asarray(nb.load(mask_file).dataobj)
+        if data.shape[:3] != self.raw.shape[:3]:
+            raise Exception('The mask {0} has dimensions {1}, but the maps '
+                            'have dimensions {2}.'.format(
+                                mask_file, data.shape[:3],
+                                self.raw.shape[:3]))
+        return data.reshape(data.shape[:3] + (-1,), order='F')[..., 0] \
+                   .ravel(order='F')
+
+    def measure_means(self, mask_file):
+        """
+        Computes the mean of each raw map in a mask, as 3dmaskave does.
+
+        Parameters
+        ----------
+        mask_file : str
+            Path of the mask; its non-zero voxels are averaged.
+
+        Returns
+        -------
+        means : numpy array
+            Mean of each raw map.
+        """
+
+        mask = self._load_mask(mask_file) != 0
+        return np.array([row[mask].mean(dtype=np.float64)
+                         for row in self._raw_rows()])
+
+    def roi_means(self, roi_mask_file):
+        """
+        Computes the mean of each raw map in each of the ROIs of a mask, as
+        3dROIstats does.
+
+        Parameters
+        ----------
+        roi_mask_file : str
+            Path of the ROI mask; each non-zero integer value is an ROI.
+
+        Returns
+        -------
+        means : numpy array
+            Means, participants by ROIs in the increasing order of their
+            values.
+        """
+
+        rois = np.rint(self._load_mask(roi_mask_file)).astype(np.int64)
+        labels, index = np.unique(rois, return_inverse=True)
+        counts = np.bincount(index, minlength=len(labels)).astype(np.float64)
+        keep = labels != 0
+
+        return np.array([
+            (np.bincount(index, weights=row, minlength=len(labels)) /
+             counts)[keep]
+            for row in self._raw_rows()
+        ]).reshape(self.raw.shape[3], keep.sum())
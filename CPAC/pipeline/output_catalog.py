@@ -0,0 +1,243 @@
+import os
+import sqlite3
+
+CATALOG_FILENAME = 'cpac_output_catalog.db'
+
+# version of the layout of the catalog tables, older catalogs are indexed
+# again from scratch
+CATALOG_VERSION = 1
+
+
+def output_catalog_path(pipeline_output_folder):
+    """Return the path of the output catalog of a pipeline output folder."""
+    return os.path.join(pipeline_output_folder.rstrip('/'), CATALOG_FILENAME)
+
+
+def connect_output_catalog(pipeline_output_folder):
+
+    # opens the SQLite output catalog of a pipeline output folder, creating
+    # it if needed. participants writing their outputs at the same time wait
+    # for each other's transactions to complete
+    #
+    # input
+    #   pipeline_output_folder: path to the pipeline_<id> output folder
+    #
+    # output
+    #   connection: sqlite3 connection to the catalog
+
+    connection = sqlite3.connect(output_catalog_path(pipeline_output_folder),
+                                 timeout=60)
+    connection.text_factory = str
+
+    with connection:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != CATALOG_VERSION:
+            # the file paths of the first catalogs were absolute
+            connection.execute('DROP TABLE IF EXISTS outputs')
+            connection.execute('DROP TABLE IF EXISTS participants')
+            connection.execute(
+                'PRAGMA user_version = {0}'.format(CATALOG_VERSION)
+            )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS participants ('
+            'participant_session_id TEXT PRIMARY KEY)'
+        )
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS outputs ('
+            'participant_session_id TEXT, '
+            'resource TEXT, '
+            'series TEXT, '
+            'strategy TEXT, '
+            'filepath TEXT PRIMARY KEY)'
+        )
+        connection.execute(
+            'CREATE INDEX IF NOT EXISTS outputs_resource '
+            'ON outputs (resource, participant_session_id)'
+        )
+
+    return connection
+
+
+def catalog_participant_outputs(pipeline_output_folder,
+                                participant_session_id):
+    """
+    Lists the outputs of a participant, as the rows of the output catalog.
+
+    Outputs are laid out in the pipeline output folder as
+    <participant_session_id>/<resource>/<series>/<strategy>/.../<file>.
+
+    Parameters
+    ----------
+    pipeline_output_folder : str
+        Path to the pipeline_<id> output folder.
+    participant_session_id : str
+        Name of the participant output folder.
+
+    Returns
+    -------
+    rows : list
+        (participant_session_id, resource, series, strategy, filepath)
+        tuples, the strategy being the underscore-joined directories and
+        file name below the series directory, and the file path being
+        relative to the pipeline output folder, so that the catalog stays
+        valid when the folder is moved or mounted elsewhere.
+    """
+
+    pipeline_output_folder = pipeline_output_folder.rstrip('/')
+    participant_folder = os.path.join(pipeline_output_folder,
+                                      participant_session_id)
+
+    rows = []
+    for root, _, files in os.walk(participant_folder):
+        for filename in files:
+            filepath = os.path.relpath(os.path.join(root, filename),
+                                       pipeline_output_folder)
+            pieces = filepath.split('/')
+            if len(pieces) < 3:
+                continue
+            rows.append((participant_session_id, pieces[1], pieces[2],
+                         '_'.join(pieces[3:]), filepath))
+
+    return rows
+
+
+def update_output_catalog(pipeline_output_folder,
+                          participant_session_ids=None):
+    """
+    Indexes the outputs of some participants in the output catalog,
+    replacing what was previously indexed for them.
+
+    Parameters
+    ----------
+    pipeline_output_folder : str
+        Path to the pipeline_<id> output folder.
+    participant_session_ids : list, optional
+        Names of the participant output folders to index, all of them by
+        default.
+    """
+
+    pipeline_output_folder = pipeline_output_folder.rstrip('/')
+
+    if participant_session_ids is None:
+        participant_session_ids = [
+            entry for entry in os.listdir(pipeline_output_folder)
+            if os.path.isdir(os.path.join(pipeline_output_folder, entry))
+        ]
+    elif isinstance(participant_session_ids, basestring):
+        participant_session_ids = [participant_session_ids]
+
+    connection = connect_output_catalog(pipeline_output_folder)
+    try:
+        for participant_session_id in participant_session_ids:
+            rows = catalog_participant_outputs(pipeline_output_folder,
+                                               participant_session_id)
+            with connection:
+                connection.execute(
+                    'DELETE FROM outputs WHERE participant_session_id = ?',
+                    (participant_session_id,)
+                )
+                connection.executemany(
+                    'INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+                connection.execute(
+                    'INSERT OR REPLACE INTO participants VALUES (?)',
+                    (participant_session_id,)
+                )
+    finally:
+        connection.close()
+
+
+def select_outputs(connection, pipeline_output_folder, resources):
+
+    # reads the rows of some resources from the output catalog, with their
+    # file paths resolved in the pipeline output folder
+
+    rows = []
+    # stay below the SQLite limit of host parameters
+    for i in range(0, len(resources), 500):
+        chunk = resources[i:i + 500]
+        rows += connection.execute(
+            'SELECT participant_session_id, resource, series, strategy, '
+            'filepath FROM outputs WHERE resource IN ({0})'.format(
+                ', '.join('?' * len(chunk))
+            ),
+            chunk
+        ).fetchall()
+
+    return [row[:4] + (os.path.join(pipeline_output_folder, row[4]),)
+            for row in rows]
+
+
+def query_output_catalog(pipeline_output_folder, resources):
+    """
+    Returns the outputs of some resources from the output catalog.
+
+    Participant folders that were never indexed, e.g. outputs written
+    before the catalog existed, are indexed first. Participants whose
+    folder was removed are dropped from the catalog, and participants with
+    indexed files which no longer exist are indexed again.
+
+    Parameters
+    ----------
+    pipeline_output_folder : str
+        Path to the pipeline_<id> output folder.
+    resources : list
+        Names of the resources.
+
+    Returns
+    -------
+    rows : list
+        (participant_session_id, resource, series, strategy, filepath)
+        tuples, sorted by file path, the file paths being resolved in the
+        pipeline output folder.
+    """
+
+    pipeline_output_folder = pipeline_output_folder.rstrip('/')
+    resources = list(set(resources))
+
+    connection = connect_output_catalog(pipeline_output_folder)
+    try:
+        indexed = set(row[0] for row in connection.execute(
+            'SELECT participant_session_id FROM participants'
+        ))
+        present = set(
+            entry for entry in os.listdir(pipeline_output_folder)
+            if os.path.isdir(os.path.join(pipeline_output_folder, entry))
+        )
+
+        removed = sorted(indexed - present)
+        if removed:
+            with connection:
+                for participant_session_id in removed:
+                    connection.execute(
+                        'DELETE FROM outputs '
+                        'WHERE participant_session_id = ?',
+                        (participant_session_id,)
+                    )
+                    connection.execute(
+                        'DELETE FROM participants '
+                        'WHERE participant_session_id = ?',
+                        (participant_session_id,)
+                    )
+
+        missing = sorted(present - indexed)
+        if missing:
+            update_output_catalog(pipeline_output_folder, missing)
+
+        rows = select_outputs(connection, pipeline_output_folder,
+                              resources)
+
+        # participants with indexed outputs removed since, indexed again
+        # rather than dropping their rows, in case only part of their
+        # outputs is missing
+        stale = sorted(set(row[0] for row in rows
+                           if not os.path.isfile(row[4])))
+        if stale:
+            update_output_catalog(pipeline_output_folder, stale)
+            rows = select_outputs(connection, pipeline_output_folder,
+                                  resources)
+    finally:
+        connection.close()
+
+    return sorted(rows, key=lambda row: row[4])
@@ -6,3 +6,144 @@ def run_gather_outputs_func(pipeline_out_dir):
                                 None, False, False, get_func=True)
     print(df_dct)
 
+
+
+def write_pipeline_outputs(pipeline_dir, participants, sessions=('1',)):
+    import os
+
+    strategy = os.path.join('_compcor_ncomponents_5_selector_pc10.linear1',
+                            '_fwhm_6')
+
+    for participant in participants:
+        for session in sessions:
+            unique_id = '{0}_{1}'.format(participant, session)
+            for resource, filename in [
+                ('alff_to_standard_smooth_zstd', 'alff_zstd.nii.gz'),
+                ('reho_to_standard_smooth_zstd', 'reho_zstd.nii.gz'),
+                ('functional_to_standard', 'func.nii.gz'),
+                ('power_params', 'pow_params.txt'),
+            ]:
+                out_dir = os.path.join(pipeline_dir, unique_id, resource,
+                                       '_scan_rest_1', strategy)
+                os.makedirs(out_dir)
+                with open(os.path.join(out_dir, filename), 'w') as f:
+                    if resource == 'power_params':
+                        f.write('Subject,Scan,MeanFD_Power,'
+                                'MeanFD_Jenkinson,rootMeanSquareFD,'
+                                'FDquartile(top1/4thFD),MeanDVARS\n')
+                        f.write('{0},rest_1,0.1,0.2,0.3,0.4,0.5\n'
+                                .format(unique_id))
+
+
+def sorted_output_dict_list(output_dict_list):
+    return dict(
+        (key, sorted(rows, key=lambda row: row['Filepath']))
+        for key, rows in output_dict_list.items()
+    )
+
+
+def test_output_catalog(tmpdir):
+    import os
+    import shutil
+    from CPAC.pipeline import cpac_group_runner as cgr
+    from CPAC.pipeline.output_catalog import (
+        output_catalog_path,
+        query_output_catalog,
+        update_output_catalog
+    )
+
+    pipeline_dir = str(tmpdir.join('pipeline_test'))
+    write_pipeline_outputs(pipeline_dir, ['sub-1', 'sub-2'], ['1', '2'])
+
+    resources = ['alff', 'reho']
+
+    nifti_globs, _ = cgr.gather_nifti_globs(pipeline_dir, resources)
+    expected = cgr.create_output_dict_list(nifti_globs, pipeline_dir,
+                                           resources, get_motion=True)
+
+    output_dict_list = cgr.create_output_dict_list_from_catalog(
+        pipeline_dir, resources, get_motion=True
+    )
+    assert os.path.exists(output_catalog_path(pipeline_dir))
+    assert sorted_output_dict_list(output_dict_list) == \
+        sorted_output_dict_list(expected)
+
+    # a new participant is indexed at the end of its run
+    write_pipeline_outputs(pipeline_dir, ['sub-3'])
+    update_output_catalog(pipeline_dir, ['sub-3_1'])
+
+    nifti_globs, _ = cgr.gather_nifti_globs(pipeline_dir, resources)
+    expected = cgr.create_output_dict_list(nifti_globs, pipeline_dir,
+                                           resources, get_motion=True)
+    output_dict_list = cgr.create_output_dict_list_from_catalog(
+        pipeline_dir, resources, get_motion=True
+    )
+    assert sorted_output_dict_list(output_dict_list) == \
+        sorted_output_dict_list(expected)
+
+    output_df_dict = cgr.gather_outputs(pipeline_dir, resources,
+                                        ['sub-1', 'sub-3'], False, False)
+    for output_df in output_df_dict.values():
+        assert sorted(output_df.participant_session_id) == \
+            ['sub-1_1', 'sub-1_2', 'sub-3_1']
+
+    # removed participant folders and files are dropped from the catalog
+    shutil.rmtree(os.path.join(pipeline_dir, 'sub-2_1'))
+    power_file = [row[4] for row in query_output_catalog(pipeline_dir,
+                                                        ['power_params'])
+                 if row[0] == 'sub-1_2'][0]
+    os.remove(power_file)
+
+    rows = query_output_catalog(pipeline_dir, ['power_params'])
+    assert sorted(row[0] for row in rows) == \
+        ['sub-1_1', 'sub-2_2', 'sub-3_1']
+    assert all(os.path.isfile(row[4]) for row in rows)
+
+
+def test_output_catalog_participants(tmpdir):
+    from CPAC.pipeline import cpac_group_runner as cgr
+    from CPAC.pipeline.output_catalog import update_output_catalog
+
+    pipeline_dir = str(tmpdir.join('pipeline_test'))
+    participants = ['sub-%d' % i for i in range(50)]
+    write_pipeline_outputs(pipeline_dir, participants)
+    update_output_catalog(pipeline_dir)
+
+    nifti_globs, _ = cgr.gather_nifti_globs(pipeline_dir, ['alff'])
+    expected = cgr.create_output_dict_list(nifti_globs, pipeline_dir,
+                                           ['alff'])
+    output_dict_list = cgr.create_output_dict_list_from_catalog(
+        pipeline_dir, ['alff']
+    )
+
+    assert sorted_output_dict_list(output_dict_list) == \
+        sorted_output_dict_list(expected)
+
+
+def test_output_catalog_relocation(tmpdir):
+    import os
+    from CPAC.pipeline.output_catalog import query_output_catalog
+
+    pipeline_dir = str(tmpdir.join('pipeline_test'))
+    write_pipeline_outputs(pipeline_dir, ['sub-1', 'sub-2'])
+    resources = ['alff_to_standard_smooth_zstd']
+    rows = query_output_catalog(pipeline_dir, resources)
+    assert len(rows) == 2
+
+    # the pipeline folder read from another mount point, and back
+    moved_dir = str(tmpdir.join('outputs'))
+    for folder, previous in [(moved_dir, pipeline_dir),
+                             (pipeline_dir, moved_dir)]:
+        os.rename(previous, folder)
+        moved_rows = query_output_catalog(folder, resources)
+        assert [row[:4] for row in moved_rows] == [row[:4] for row in rows]
+        assert all(row[4].startswith(folder) and os.path.isfile(row[4])
+                   for row in moved_rows)
+
+    # participants with missing files are indexed again
+    os.remove(rows[0][4])
+    write_pipeline_outputs(pipeline_dir, ['sub-3'])
+    assert [row[0] for row in query_output_catalog(pipeline_dir,
+                                                   resources)] == \
+        ['sub-2_1', 'sub-3_1']
+
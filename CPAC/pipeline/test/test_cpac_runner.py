@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import tempfile
+
+from CPAC.pipeline.cpac_runner import (
+    callback_peak_usage,
+    participant_peak_usage,
+    schedule_participants
+)
+
+
+def record_participant(participant, plugin_args, out_dir):
+    start = time.time()
+    time.sleep(0.2)
+    with open(os.path.join(out_dir, '%s.json' % participant), 'w') as f:
+        json.dump({
+            'start': start,
+            'finish': time.time(),
+            'n_procs': plugin_args['n_procs'],
+            'memory_gb': plugin_args['memory_gb'],
+        }, f)
+
+
+def read_participants(out_dir, participants):
+    records = []
+    for participant in participants:
+        with open(os.path.join(out_dir, '%s.json' % participant)) as f:
+            records.append(json.load(f))
+    return records
+
+
+def max_concurrent(records, key):
+    return max(
+        sum(r[key] for r in records
+            if r['start'] <= record['start'] < r['finish'])
+        for record in records
+    )
+
+
+def test_schedule_participants():
+
+    out_dir = tempfile.mkdtemp()
+    participants = ['sub-%d' % i for i in range(6)]
+
+    exitcodes = schedule_participants(participants, record_participant,
+                                      args=(out_dir,), cores_budget=4,
+                                      memory_budget=8., cores_demand=1,
+                                      memory_demand=3.)
+    assert exitcodes == [0] * len(participants)
+
+    records = read_participants(out_dir, participants)
+    assert max_concurrent(records, 'n_procs') <= 4
+    assert max_concurrent(records, 'memory_gb') <= 8.
+
+    # the last participants share the idle resources
+    assert records[-1]['n_procs'] > 1
+    assert records[-1]['memory_gb'] > 3.
+
+
+def test_schedule_participants_split():
+
+    out_dir = tempfile.mkdtemp()
+    participants = ['sub-%d' % i for i in range(3)]
+
+    schedule_participants(participants, record_participant,
+                          args=(out_dir,), cores_budget=8, cores_demand=2)
+
+    records = read_participants(out_dir, participants)
+    assert [r['n_procs'] for r in records] == [2, 3, 3]
+    assert all(r['memory_gb'] is None for r in records)
+
+
+def test_workflow_resource_demand():
+
+    import nipype.pipeline.engine as pe
+    import nipype.interfaces.utility as util
+    from CPAC.utils.utils import workflow_resource_demand
+
+    wf = pe.Workflow(name='wf')
+    sub_wf = pe.Workflow(name='sub_wf')
+    inputnode = pe.Node(util.IdentityInterface(fields=['a']),
+                        name='inputnode')
+    ants = pe.Node(util.IdentityInterface(fields=['a']), name='ants',
+                   n_procs=3)
+    unet = pe.Node(util.IdentityInterface(fields=['a']), name='unet',
+                   mem_gb=5.)
+    sub_wf.connect(inputnode, 'a', unet, 'a')
+    wf.connect(sub_wf, 'unet.a', ants, 'a')
+
+    assert workflow_resource_demand(wf) == (3, 5.)
+
+
+def test_participant_peak_usage():
+
+    log_dir = tempfile.mkdtemp()
+
+    nodes = {
+        'sub-1': [
+            ('2019-01-01T10:00:00', '2019-01-01T10:10:00', 1, 2.),
+            ('2019-01-01T10:05:00', '2019-01-01T10:20:00', 4, 1.),
+            ('2019-01-01T10:10:00', '2019-01-01T10:15:00.5', 2, 3.),
+        ],
+        'sub-2': [
+            ('2019-01-01T10:00:00', '2019-01-01T10:10:00', 3, 5.),
+        ],
+    }
+
+    for participant, runtimes in nodes.items():
+        os.makedirs(os.path.join(log_dir, participant))
+        with open(os.path.join(log_dir, participant, 'callback.log'),
+                  'w') as f:
+            f.write(json.dumps({'id': 'wf.node', 'hash': 'x'}) + '\n')
+            for start, finish, threads, memory in runtimes:
+                f.write(json.dumps({
+                    'id': 'wf.node',
+                    'start': start,
+                    'finish': finish,
+                    'runtime_threads': 'N/A',
+                    'runtime_memory_gb': memory,
+                    'estimated_memory_gb': 1.,
+                    'num_threads': threads,
+                }) + '\n')
+
+    assert callback_peak_usage(
+        os.path.join(log_dir, 'sub-1', 'callback.log')
+    ) == (6, 4.)
+    assert participant_peak_usage(log_dir) == (6, 5.)
+    assert participant_peak_usage(tempfile.mkdtemp()) == (None, None)
@@ -0,0 +1,140 @@
+import os
+
+import numpy as np
+import nibabel as nb
+import pandas as pd
+import pytest
+
+from CPAC.pipeline.group_merge import GroupMerge
+from CPAC.pipeline.cpac_ga_model_generator import (
+    calculate_custom_roi_mean_in_df,
+    calculate_measure_mean_in_df,
+    check_merged_file,
+    check_merged_order,
+    create_merge_mask,
+    create_merged_copefile,
+)
+
+
+def write_maps(out_dir, count, shape=(12, 14, 10), seed=0):
+    random = np.random.RandomState(seed)
+    affine = np.diag([3., 3., 3., 1.])
+
+    paths = []
+    maps = []
+    for i in range(count):
+        data = random.randn(*shape).astype(np.float32)
+        # each map misses a different part of the brain
+        data[i % shape[0], :, :] = 0
+        data[:2] = 0
+        path = os.path.join(out_dir, 'map_%d.nii.gz' % i)
+        nb.Nifti1Image(data, affine).to_filename(path)
+        paths.append(path)
+        maps.append(data)
+
+    return paths, np.stack(maps, axis=3)
+
+
+def test_group_merge(tmpdir):
+
+    tmp_dir = str(tmpdir)
+    paths, maps = write_maps(tmp_dir, 40)
+    os.makedirs(os.path.join(tmp_dir, 'raw'))
+    raw_paths, raw_maps = write_maps(os.path.join(tmp_dir, 'raw'), 40,
+                                     seed=1)
+
+    merged_file = os.path.join(tmp_dir, 'merged.nii.gz')
+    mask_file = os.path.join(tmp_dir, 'merged_mask.nii.gz')
+
+    # reference: the maps all in memory
+    reference = np.stack([nb.load(path).get_data() for path in paths],
+                         axis=3)
+    reference_mask = np.abs(reference).min(axis=3) > 0
+    reference_raw = np.stack([nb.load(path).get_data()
+                              for path in raw_paths], axis=3)
+    reference_means = reference_raw[reference_mask].mean(axis=0)
+
+    with GroupMerge(paths, raw_paths, work_dir=tmp_dir) as merge:
+        merge.merge()
+        merge.write_merged(merged_file)
+        merge.write_mask(mask_file)
+        means = merge.measure_means(mask_file)
+        merged_filepaths = list(merge.filepaths)
+
+    # the memory-mapped arrays are not left in the working directory
+    assert not [f for f in os.listdir(tmp_dir) if f.endswith('.dat')]
+
+    np.testing.assert_array_equal(nb.load(merged_file).get_data(), maps)
+    np.testing.assert_array_equal(nb.load(mask_file).get_data() > 0,
+                                  reference_mask)
+    np.testing.assert_allclose(means, reference_means, rtol=1e-5)
+
+    check_merged_file(paths, merged_file)
+    with pytest.raises(Exception):
+        check_merged_file(paths[::-1], merged_file)
+
+    check_merged_order(paths, merged_filepaths, merged_file)
+    with pytest.raises(Exception):
+        check_merged_order(paths[::-1], merged_filepaths, merged_file)
+    with pytest.raises(Exception):
+        check_merged_order(paths[:-1], merged_filepaths, merged_file)
+
+
+def test_merge_functions(tmpdir):
+
+    tmp_dir = str(tmpdir)
+    # 4D files are merged along time, as for CWAS
+    paths, maps = write_maps(tmp_dir, 6)
+    functional = []
+    for i in range(3):
+        path = os.path.join(tmp_dir, 'func_%d.nii.gz' % i)
+        nb.Nifti1Image(maps[..., 2 * i:2 * i + 2], np.eye(4)) \
+            .to_filename(path)
+        functional.append(path)
+
+    merged_file = create_merged_copefile(
+        functional, os.path.join(tmp_dir, 'joint_cope.nii.gz'))
+    mask_file = create_merge_mask(
+        merged_file, os.path.join(tmp_dir, 'joint_mask.nii.gz'))
+
+    np.testing.assert_array_equal(nb.load(merged_file).get_data(), maps)
+    np.testing.assert_array_equal(nb.load(mask_file).get_data() > 0,
+                                  np.abs(maps).min(axis=3) > 0)
+
+
+def test_means_in_df(tmpdir):
+
+    tmp_dir = str(tmpdir)
+    paths, maps = write_maps(tmp_dir, 10)
+
+    shape = maps.shape[:3]
+    rois = np.zeros(shape, dtype=np.int16)
+    rois[2:6] = 1
+    rois[6:9, :5] = 3
+    roi_file = os.path.join(tmp_dir, 'rois.nii.gz')
+    nb.Nifti1Image(rois, np.eye(4)).to_filename(roi_file)
+
+    mask = np.abs(maps).min(axis=3) > 0
+    mask_file = os.path.join(tmp_dir, 'mask.nii.gz')
+    nb.Nifti1Image(mask.astype(np.float32), np.eye(4)).to_filename(mask_file)
+
+    model_df = pd.DataFrame({'participant_id': ['sub-%d' % i
+                                                for i in range(10)],
+                             'Raw_Filepath': paths})
+
+    means = maps[mask].mean(axis=0)
+    roi_means = np.array([maps[rois == 1].mean(axis=0),
+                          maps[rois == 3].mean(axis=0)]).T
+
+    for group_merge in (None, GroupMerge(paths, paths).merge()):
+        df = calculate_measure_mean_in_df(model_df, mask_file, group_merge)
+        np.testing.assert_allclose(df['Measure_Mean'],
+                                   means - means.mean(), atol=1e-6)
+
+        df = calculate_custom_roi_mean_in_df(model_df, roi_file,
+                                             group_merge)
+        assert 'Custom_ROI_Mean_3' not in df.columns
+        np.testing.assert_allclose(
+            df[['Custom_ROI_Mean_1', 'Custom_ROI_Mean_2']].values,
+            roi_means - roi_means.mean(axis=0), atol=1e-6)
+        assert list(df['participant_id']) == list(model_df['participant_id'])
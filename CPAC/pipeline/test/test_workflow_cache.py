@@ -0,0 +1,253 @@
+import os
+
+import yaml
+import pkg_resources as p
+import nipype.pipeline.engine as pe
+import nipype.interfaces.utility as util
+
+import CPAC.pipeline.workflow_cache as workflow_cache
+from CPAC.pipeline.workflow_cache import (
+    bind_value,
+    bind_workflow,
+    code_digest,
+    load_workflow_template,
+    participant_template,
+    save_workflow_template,
+    workflow_template_path
+)
+from CPAC.utils import Configuration
+from CPAC.utils.datasource import (
+    create_anat_datasource,
+    create_func_datasource
+)
+from CPAC.utils.interfaces.datasink import DataSink
+
+
+def participant(subject_id, unique_id, scans=('rest_run-1', 'rest_run-2')):
+    sub_dir = '/data/sub-{0}/ses-{1}'.format(subject_id, unique_id)
+    return {
+        'subject_id': subject_id,
+        'unique_id': unique_id,
+        'creds_path': None,
+        'site': 'site-1',
+        'anat': os.path.join(sub_dir, 'anat', 'T1w.nii.gz'),
+        'brain_mask': 'None',
+        'func': dict(
+            (scan, {
+                'scan': os.path.join(sub_dir, 'func', scan + '.nii.gz'),
+                'scan_parameters': {'TR': 2.0, 'SliceTiming': [0.0, 1.0]},
+            })
+            for scan in scans
+        ),
+    }
+
+
+def build(sub_dict, n_strats=2):
+    # the participant-specific parts of the pipeline construction
+    subject_id = sub_dict['subject_id']
+    if sub_dict['unique_id']:
+        subject_id += '_' + sub_dict['unique_id']
+
+    sub_ses_id = subject_id.split('_')
+    sub_tag = sub_ses_id[0]
+    if 'sub-' not in sub_tag:
+        sub_tag = 'sub-{0}'.format(sub_tag)
+
+    workflow = pe.Workflow(name='resting_preproc_' + subject_id)
+
+    for num_strat in range(n_strats):
+        anat_flow = create_anat_datasource('anat_gather_%d' % num_strat)
+        anat_flow.inputs.inputnode.subject = subject_id
+        anat_flow.inputs.inputnode.anat = sub_dict['anat']
+        anat_flow.inputs.inputnode.dl_dir = '/working'
+
+        func_wf = create_func_datasource(sub_dict['func'],
+                                         'func_gather_%d' % num_strat)
+        func_wf.inputs.inputnode.set(subject=subject_id, dl_dir='/working')
+        func_wf.get_node('inputnode').iterables = \
+            ('scan', sorted(sub_dict['func'].keys()))
+
+        rename = pe.Node(util.Rename(), name='rename_%d' % num_strat)
+        rename.inputs.format_string = '{0}_T1w_preproc'.format(sub_tag)
+
+        ds = pe.Node(DataSink(), name='sinker_%d' % num_strat)
+        ds.inputs.container = os.path.join('pipeline_cpac', subject_id)
+
+        workflow.connect(anat_flow, 'outputspec.anat', rename, 'in_file')
+        workflow.connect(rename, 'out_file', ds, 'anatomical')
+        workflow.connect(func_wf, 'outputspec.rest', ds, 'functional')
+
+    return workflow
+
+
+def node_inputs(workflow):
+    return dict(
+        (node.fullname, node.inputs.get())
+        for node in workflow._get_all_nodes()
+    )
+
+
+def test_participant_template():
+
+    sub_dict = participant('sub-0001', 'ses-1')
+    template_sub_dict, bindings = participant_template(sub_dict)
+
+    assert template_sub_dict['subject_id'].startswith('sub-cpactemplate')
+    assert template_sub_dict['unique_id'].startswith('ses-cpactemplate')
+    assert bind_value(template_sub_dict, bindings) == sub_dict
+    assert template_sub_dict['creds_path'] is None
+    assert template_sub_dict['brain_mask'] == 'None'
+    assert sorted(template_sub_dict['func']) == sorted(sub_dict['func'])
+
+    # participants with the same structure share their template
+    other_sub_dict, other_bindings = \
+        participant_template(participant('sub-0002', 'ses-2'))
+    assert other_sub_dict == template_sub_dict
+    assert other_bindings != bindings
+
+    # but not participants with other scans
+    assert participant_template(
+        participant('sub-0002', 'ses-2', scans=('rest_run-1',))
+    )[0] != template_sub_dict
+
+    # the labels without prefix are split as the pipeline splits them
+    template_sub_dict, bindings = \
+        participant_template(participant('0003_a', 'b'))
+    subject_id = template_sub_dict['subject_id'].split('_')
+    assert len(subject_id) == 2
+    assert [bind_value(label, bindings) for label in subject_id] == \
+        ['0003', 'a']
+
+
+def test_bind_workflow(tmpdir):
+
+    cache_dir = str(tmpdir)
+    c = Configuration({'pipelineName': 'cpac'})
+
+    for sub_dict in [participant('sub-0001', 'ses-1'),
+                     participant('0002', '2'),
+                     participant('0003_a', 'b')]:
+
+        template_sub_dict, bindings = participant_template(sub_dict)
+        template_path = workflow_template_path(cache_dir, c,
+                                               template_sub_dict, run=1)
+
+        template = build(template_sub_dict)
+        assert save_workflow_template(template_path, template)
+
+        workflow = load_workflow_template(template_path)
+        assert bind_workflow(workflow, bindings) > 0
+
+        expected = build(sub_dict)
+        assert workflow.name == expected.name
+        assert node_inputs(workflow) == node_inputs(expected)
+        assert workflow.get_node('func_gather_0.inputnode').iterables == \
+            expected.get_node('func_gather_0.inputnode').iterables
+
+    assert load_workflow_template(os.path.join(cache_dir, 'none.pkl')) is None
+
+
+def test_workflow_template_path(tmpdir, monkeypatch):
+
+    cache_dir = str(tmpdir)
+    template_sub_dict, _ = participant_template(participant('0001', '1'))
+
+    c = Configuration({'pipelineName': 'cpac', 'runNuisance': [1]})
+    path = workflow_template_path(cache_dir, c, template_sub_dict, run=1)
+
+    assert path == workflow_template_path(
+        cache_dir, Configuration({'pipelineName': 'cpac',
+                                  'runNuisance': [1]}),
+        template_sub_dict, run=1
+    )
+    assert path != workflow_template_path(
+        cache_dir, Configuration({'pipelineName': 'cpac',
+                                  'runNuisance': [0]}),
+        template_sub_dict, run=1
+    )
+    assert path != workflow_template_path(cache_dir, c, template_sub_dict,
+                                          run=0)
+
+    # templates built by other code are not used
+    assert code_digest() == code_digest()
+    monkeypatch.setattr(workflow_cache, '_code_digest', 'edited')
+    assert path != workflow_template_path(cache_dir, c, template_sub_dict,
+                                          run=1)
+
+
+def test_workflow_template_shared(tmpdir):
+
+    cache_dir = str(tmpdir)
+    c = Configuration({'pipelineName': 'cpac'})
+    participants = [participant('%04d' % i, '1') for i in range(5)]
+
+    workflows = []
+    for sub_dict in participants:
+        template_sub_dict, bindings = participant_template(sub_dict)
+        template_path = workflow_template_path(cache_dir, c,
+                                               template_sub_dict, run=1)
+        workflow = load_workflow_template(template_path)
+        if workflow is None:
+            workflow = build(template_sub_dict)
+            save_workflow_template(template_path, workflow)
+        bind_workflow(workflow, bindings)
+        workflows.append(workflow)
+
+    assert len(os.listdir(cache_dir)) == 1
+    for sub_dict, workflow in zip(participants, workflows):
+        assert node_inputs(workflow) == node_inputs(build(sub_dict))
+
+
+def test_bind_build_workflow(tmpdir, monkeypatch):
+
+    # a template built by the pipeline, bound to a participant, is the
+    # workflow built for the participant, down to the types of the inputs
+    import CPAC.utils.utils
+    from CPAC.pipeline.cpac_pipeline import build_workflow
+
+    # only the graph is built, the software packages are not needed
+    monkeypatch.setattr(CPAC.utils.utils, 'check_system_deps',
+                        lambda *args, **kwargs: None)
+
+    def config():
+        # the pipeline construction modifies the configuration
+        with open(p.resource_filename(
+                'CPAC', 'resources/configs/pipeline_config_template.yml'
+        ), 'r') as f:
+            c = Configuration(yaml.load(f))
+        for key in ('workingDirectory', 'outputDirectory', 'logDirectory',
+                    'crashLogDirectory'):
+            setattr(c, key, str(tmpdir.join(key)))
+        return c
+
+    sub_dict = participant('sub-0001', 'ses-1', scans=('rest_run-1',))
+    sub_dict['func']['rest_run-1']['scan_parameters'] = {
+        'TR': 2, 'EchoTime': 0.03, 'tpattern': 'alt+z',
+        'first_TR': 4, 'last_TR': None,
+    }
+
+    template_sub_dict, bindings = participant_template(sub_dict)
+    workflow = build_workflow(template_sub_dict, config(),
+                              log_dir=str(tmpdir))[0]
+    assert bind_workflow(workflow, bindings) > 0
+
+    expected = build_workflow(sub_dict, config(), log_dir=str(tmpdir))[0]
+
+    assert workflow.name == expected.name
+    inputs, expected_inputs = node_inputs(workflow), node_inputs(expected)
+    assert sorted(inputs) == sorted(expected_inputs)
+    for name in expected_inputs:
+        assert repr(inputs[name]) == repr(expected_inputs[name]), name
+    assert sorted(
+        (node.fullname, repr(node.iterables))
+        for node in workflow._get_all_nodes() if node.iterables
+    ) == sorted(
+        (node.fullname, repr(node.iterables))
+        for node in expected._get_all_nodes() if node.iterables
+    )
+
+    scan_params = workflow.get_node('func_gather_0.selectrest').inputs \
+        .rest_dict['rest_run-1']['scan_parameters']
+    assert scan_params == sub_dict['func']['rest_run-1']['scan_parameters']
+    assert type(scan_params['TR']) is int
+    assert type(scan_params['EchoTime']) is float
@@ -0,0 +1,300 @@
+import os
+import re
+import pickle
+import hashlib
+
+import CPAC
+
+TEMPLATE_VERSION = 1
+
+PLACEHOLDER = 'cpactemplate{0}x'
+PLACEHOLDER_REGEX = re.compile(r'cpactemplate(\d+)x')
+
+# the prefixes of the participant and session labels are kept in the
+# placeholders, as the outputs are named after them
+LABEL_REGEX = re.compile(r'^(.*(?:sub|ses)-)?(.*)$')
+
+
+def participant_template(sub_dict):
+    """
+    Replaces the participant-specific values of a data configuration entry
+    by placeholders.
+
+    The keys of the entry, e.g. the scan names, and its empty values are
+    kept, as they define the structure of the participant workflow. The
+    participant and session labels are split into the same underscore
+    separated pieces, with the same sub-/ses- prefixes, so the names
+    derived from them have the same structure too.
+
+    Parameters
+    ----------
+    sub_dict : dict
+        Data configuration entry of the participant.
+
+    Returns
+    -------
+    template_sub_dict : dict
+        Data configuration entry with placeholders.
+    bindings : list
+        Participant values of the placeholders, by placeholder number.
+    """
+
+    bindings = []
+
+    def placeholder(value):
+        bindings.append(value)
+        return PLACEHOLDER.format(len(bindings) - 1)
+
+    def label(value):
+        pieces = []
+        for piece in value.split('_'):
+            prefix, rest = LABEL_REGEX.match(piece).groups()
+            pieces.append((prefix or '') + (placeholder(rest) if rest else ''))
+        return '_'.join(pieces)
+
+    def template(value):
+        if isinstance(value, dict):
+            return dict((key, template(value[key]))
+                        for key in sorted(value.keys()))
+        if isinstance(value, (list, tuple)):
+            return type(value)(template(item) for item in value)
+        if isinstance(value, bool) or not value or \
+                (isinstance(value, basestring) and value.lower() == 'none'):
+            return value
+        return placeholder(value)
+
+    template_sub_dict = {}
+    for key in sorted(sub_dict.keys()):
+        value = sub_dict[key]
+        if key == 'creds_path':
+            template_sub_dict[key] = value
+        elif key in ('subject_id', 'unique_id') and value and \
+                isinstance(value, basestring):
+            template_sub_dict[key] = label(value)
+        else:
+            template_sub_dict[key] = template(value)
+
+    return template_sub_dict, bindings
+
+
+def bind_value(value, bindings):
+    """
+    Replaces the placeholders in a value by their participant values.
+
+    Parameters
+    ----------
+    value : object
+        Node input, possibly nested in lists, tuples and dictionaries.
+    bindings : list
+        Participant values of the placeholders.
+
+    Returns
+    -------
+    value : object
+        The value with the placeholders replaced; a value which is a
+        placeholder is replaced by the participant value itself, keeping
+        its type.
+    """
+
+    if isinstance(value, basestring):
+        match = PLACEHOLDER_REGEX.match(value)
+        if match and match.end() == len(value):
+            return bindings[int(match.group(1))]
+        return PLACEHOLDER_REGEX.sub(
+            lambda m: str(bindings[int(m.group(1))]), value
+        )
+    if isinstance(value, dict):
+        return dict((bind_value(k, bindings), bind_value(v, bindings))
+                    for k, v in value.items())
+    if isinstance(value, tuple):
+        return tuple(bind_value(item, bindings) for item in value)
+    if isinstance(value, list):
+        return [bind_value(item, bindings) for item in value]
+    return value
+
+
+def bind_workflow(workflow, bindings):
+    """
+    Binds a participant to a workflow built from its template data
+    configuration entry, replacing the placeholders in the names of the
+    workflows and in the inputs of the nodes.
+
+    Parameters
+    ----------
+    workflow : nipype Workflow
+        Workflow built from the template data configuration entry.
+    bindings : list
+        Participant values of the placeholders.
+
+    Returns
+    -------
+    bound_nodes : int
+        Number of nodes with bound inputs.
+    """
+
+    import nipype.pipeline.engine as pe
+
+    bound_nodes = 0
+
+    workflows = [workflow]
+    while workflows:
+        wf = workflows.pop()
+        if PLACEHOLDER_REGEX.search(wf.name):
+            wf.name = bind_value(wf.name, bindings)
+            wf._id = wf.name
+
+        for node in wf._graph.nodes():
+            # the names of the parent workflows
+            if node._hierarchy:
+                node._hierarchy = bind_value(node._hierarchy, bindings)
+
+            if isinstance(node, pe.Workflow):
+                workflows.append(node)
+                continue
+
+            bound = False
+            for name, value in node.inputs.get().items():
+                new_value = bind_value(value, bindings)
+                if new_value != value:
+                    setattr(node.inputs, name, new_value)
+                    bound = True
+            bound_nodes += bound
+
+    return bound_nodes
+
+
+_code_digest = None
+
+
+def code_digest():
+    """
+    Returns a digest of the source code of the CPAC package, so that the
+    workflow templates built by another version of the code, e.g. an edited
+    or updated development install with the same version number, are not
+    used. The digest is computed once per process.
+
+    Returns
+    -------
+    digest : str
+        SHA-1 hex digest of the paths and contents of the CPAC modules.
+    """
+
+    global _code_digest
+
+    if _code_digest is None:
+        package_dir = os.path.dirname(os.path.abspath(CPAC.__file__))
+        digest = hashlib.sha1()
+        for root, dirs, files in os.walk(package_dir):
+            dirs.sort()
+            for f in sorted(files):
+                if not f.endswith('.py'):
+                    continue
+                path = os.path.join(root, f)
+                digest.update(os.path.relpath(path, package_dir))
+                with open(path, 'rb') as module:
+                    digest.update(module.read())
+        _code_digest = digest.hexdigest()
+
+    return _code_digest
+
+
+def workflow_template_path(cache_dir, c, template_sub_dict, **kwargs):
+    """
+    Returns the path of the workflow template of a pipeline configuration
+    and a participant structure. The path also depends on the source code of
+    CPAC (see code_digest) and on the nipype version, so that templates
+    built by other code are never loaded.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory of the workflow templates.
+    c : Configuration
+        Pipeline configuration.
+    template_sub_dict : dict
+        Data configuration entry with placeholders, see participant_template.
+    kwargs : dict
+        Other arguments of the workflow construction.
+
+    Returns
+    -------
+    template_path : str
+        Path of the pickled workflow template.
+    """
+
+    import nipype
+
+    key = repr((
+        TEMPLATE_VERSION,
+        CPAC.__version__,
+        code_digest(),
+        nipype.__version__,
+        sorted((key, value) for key, value in vars(c).items()
+               if not callable(value)),
+        sorted(template_sub_dict.items()),
+        sorted(kwargs.items()),
+    ))
+
+    return os.path.join(
+        cache_dir, 'workflow_{0}.pkl'.format(hashlib.sha1(key).hexdigest())
+    )
+
+
+def load_workflow_template(template_path):
+    """
+    Loads a pickled workflow template.
+
+    Parameters
+    ----------
+    template_path : str
+        Path of the workflow template.
+
+    Returns
+    -------
+    template : object
+        The workflow template, or None if it does not exist or cannot be
+        loaded.
+    """
+
+    try:
+        with open(template_path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        return None
+
+
+def save_workflow_template(template_path, template):
+    """
+    Pickles a workflow template. The template is written to a temporary
+    file first, so participants loading it never see a partial file.
+
+    Parameters
+    ----------
+    template_path : str
+        Path of the workflow template.
+    template : object
+        The workflow template, which is not modified.
+
+    Returns
+    -------
+    saved : bool
+        Whether the template was saved.
+    """
+
+    cache_dir = os.path.dirname(template_path)
+    tmp_path = '{0}.{1}.tmp'.format(template_path, os.getpid())
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(template, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, template_path)
+    except Exception as e:
+        print('Could not save the workflow template {0}: {1}'.format(
+            template_path, e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return False
+
+    return True
@@ -1,15 +1,17 @@
 from .peer import (
     pypeer_eye_masking,
     pypeer_zscore,
-    pypeer_ravel_data,
+    pypeer_global_signal_regression,
+    pypeer_calibration_data,
     motion_scrub,
-    prep_for_pypeer
+    run_pypeer
 )
 
 __all__ = [
     'pypeer_eye_masking',
     'pypeer_zscore',
-    'pypeer_ravel_data',
+    'pypeer_global_signal_regression',
+    'pypeer_calibration_data',
     'motion_scrub',
-    'prep_for_pypeer'
+    'run_pypeer'
 ]
\ No newline at end of file
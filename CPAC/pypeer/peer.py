@@ -1,26 +1,11 @@
 import os
 import csv
-import glob
 import nibabel as nb
 import numpy as np
 
-# check if they have PyPEER installed
-try:
-    import PyPEER
-    from PyPEER.peer_func import \
-        global_signal_regression, \
-        prepare_data_for_svr, \
-        train_model, \
-        save_model, \
-        load_model, \
-        predict_fixations, \
-        save_fixations, \
-        estimate_em, \
-        load_data
-except ImportError:
-    raise ImportError("\n\n[!] PyPEER is not installed. Please double-"
-                      "check your Python environment and ensure that the "
-                      "PyPEER package is available.")
+# the PEER calibration shows each of its fixation targets for this many
+# volumes
+VOLUMES_PER_POINT = 5
 
 
 def make_pypeer_dir(dirpath):
@@ -33,42 +18,145 @@ def make_pypeer_dir(dirpath):
                         "directory path:\n{0}\n".format(dirpath))
 
 
+def import_pypeer():
+    # check if they have PyPEER installed
+    try:
+        import PyPEER.peer_func
+    except ImportError:
+        raise ImportError("\n\n[!] PyPEER is not installed. Please double-"
+                          "check your Python environment and ensure that the "
+                          "PyPEER package is available.")
+    return PyPEER.peer_func
+
+
 def pypeer_eye_masking(data_path, eye_mask_path):
-    eye_mask = nb.load(eye_mask_path).get_data()
+    """
+    Extracts the eye-region voxels of a scan, one volume at a time.
+
+    Parameters
+    ----------
+    data_path : str
+        Path of the 4D scan, in template space.
+    eye_mask_path : str
+        Path of the template eye mask.
 
-    data = load_data(data_path)
+    Returns
+    -------
+    data : numpy array
+        Volumes by eye voxels, as float32 values.
+    weights : numpy array
+        Value of the eye mask at each of the eye voxels.
+    """
 
-    for vol in range(data.shape[3]):
-        output = np.multiply(eye_mask, data[:, :, :, vol])
-        data[:, :, :, vol] = output
+    eye_mask = np.asarray(nb.load(eye_mask_path).dataobj)
+    eye_mask = eye_mask.reshape(eye_mask.shape[:3] + (-1,))[..., 0]
 
-    return data
+    # the file is kept open, so the volumes of a compressed scan are read
+    # sequentially instead of from its start
+    img = nb.load(data_path, keep_file_open=True)
+    if img.shape[:3] != eye_mask.shape:
+        raise Exception("\n\n[!] The scan {0} has dimensions {1}, but the "
+                        "eye mask {2} has dimensions {3}.\n\n".format(
+                            data_path, img.shape[:3], eye_mask_path,
+                            eye_mask.shape))
+
+    mask = eye_mask != 0
+    volumes = img.shape[3] if len(img.shape) > 3 else 1
+
+    data = np.empty((volumes, mask.sum()), dtype=np.float32)
+    for vol in range(volumes):
+        data[vol] = np.asarray(img.dataobj[..., vol])[mask]
+
+    return data, eye_mask[mask].astype(np.float32)
 
 
 def pypeer_zscore(data):
-    volumes = data.shape[3]
-
-    for x in range(data.shape[0]):
-        for y in range(data.shape[1]):
-            for z in range(data.shape[2]):
-                vmean = np.mean(np.array(data[x, y, z, :]))
-                vstdv = np.std(np.array(data[x, y, z, :]))
-
-                for time in range(volumes):
-                    if vstdv != 0:
-                        data[x, y, z, time] = (float(
-                            data[x, y, z, time]) - float(vmean)) / vstdv
-                    else:
-                        data[x, y, z, time] = float(
-                            data[x, y, z, time]) - float(vmean)
+    """
+    Z-scores the time series of each voxel of masked data, in place; the
+    constant time series are only centered.
+
+    Parameters
+    ----------
+    data : numpy array
+        Volumes by voxels.
+
+    Returns
+    -------
+    data : numpy array
+        The z-scored data.
+    """
+
+    mean = data.mean(axis=0, dtype=np.float64)
+    stdv = data.std(axis=0, dtype=np.float64)
+    stdv[stdv == 0] = 1
+
+    data -= mean
+    data /= stdv
+
+    return data
+
+
+def pypeer_global_signal_regression(data):
+    """
+    Regresses a constant and the global signal, the mean of the voxels, out
+    of the time series of each voxel of masked data, in place.
+
+    Parameters
+    ----------
+    data : numpy array
+        Volumes by voxels.
+
+    Returns
+    -------
+    data : numpy array
+        The residuals.
+    """
+
+    regressors = np.column_stack([np.ones(len(data)),
+                                  data.mean(axis=1, dtype=np.float64)])
+    data -= regressors.dot(np.linalg.pinv(regressors).dot(data))
 
     return data
 
 
-def pypeer_ravel_data(data):
-    raveled_data = [data[:, :, :, vol].ravel() for vol in
-                    np.arange(data.shape[3])]
-    return raveled_data
+def pypeer_calibration_data(data, removed_indices=None,
+                            volumes_per_point=VOLUMES_PER_POINT):
+    """
+    Averages the volumes of each calibration point of a PEER scan, leaving
+    out the scrubbed volumes.
+
+    Parameters
+    ----------
+    data : numpy array
+        Volumes by voxels.
+    removed_indices : list, optional
+        Volumes removed by motion scrubbing.
+    volumes_per_point : int, optional
+        Number of volumes of each calibration point.
+
+    Returns
+    -------
+    points : numpy array
+        Calibration points by voxels.
+    removed_points : list
+        Calibration points whose volumes were all removed.
+    """
+
+    removed = set(removed_indices or [])
+
+    points = []
+    removed_points = []
+    for point in range(len(data) // volumes_per_point):
+        volumes = [vol for vol in range(point * volumes_per_point,
+                                        (point + 1) * volumes_per_point)
+                   if vol not in removed]
+        if volumes:
+            points.append(data[volumes].mean(axis=0))
+        else:
+            removed_points.append(point)
+
+    return np.array(points, dtype=np.float32).reshape(-1, data.shape[1]), \
+        removed_points
 
 
 def motion_scrub(_ms_filename, _motion_threshold):
@@ -103,117 +191,207 @@ def motion_scrub(_ms_filename, _motion_threshold):
     return _removed_indices
 
 
-def prep_for_pypeer(peer_scan_names, data_scan_names, eye_mask_path,
-                    output_dir, sub_id, pipeline_ids, stim_path, gsr=False, 
-                    scrub=False, scrub_thresh=None):
+def prepare_scan(args):
+    """
+    Masks, z-scores and optionally regresses the global signal out of a
+    scan, then weights its voxels by the eye mask.
 
-    print("\n\n=== C-PAC now executing PyPEER for {0}. ===\n\n".format(sub_id))
-    print("PEER scans for training model:\n{0}"
-          "\n\n".format(str(peer_scan_names)))
-    print("Data scans to estimate eye movements for:\n{0}"
-          "\n\n".format(str(data_scan_names)))
+    Parameters
+    ----------
+    args : tuple
+        Path of the scan, path of the eye mask and whether to regress the
+        global signal.
+
+    Returns
+    -------
+    data : numpy array
+        Volumes by eye voxels, as float32 values.
+    """
+
+    func_path, eye_mask_path, gsr = args
+
+    data, weights = pypeer_eye_masking(func_path, eye_mask_path)
+    data = pypeer_zscore(data)
+    if gsr:
+        data = pypeer_global_signal_regression(data)
+    data *= weights
 
-    # note these are non-nuisance-regression strategy paths
-    cpac_func_standard_paths = os.path.join(output_dir,
-                                            "pipeline_*",
-                                            sub_id,
-                                            "functional_to_standard",
-                                            "_scan_*", "*.nii*")
-    func_standard_paths = glob.glob(cpac_func_standard_paths)
+    return data
 
-    if not func_standard_paths:
-        raise Exception("\n\n[!] Could not find any 'functional_to_standard' "
-                        "file paths in your output directory - did your "
-                        "C-PAC run complete successfully?\n\n")
 
-    eye_mask_glob = os.path.join(output_dir,
-                                 "pipeline_*",
-                                 sub_id,
-                                 "template_eye_mask",
-                                 "*")
-    eye_mask_path = glob.glob(eye_mask_glob)[0]
+def train_peer_model(args):
+    """
+    Trains the eye estimation models of a PEER scan, and saves them.
 
-    if not os.path.isfile(eye_mask_path):
-        raise Exception("\n\n[!] Could not find the template eye mask "
-                        "file path in your output directory - did your "
-                        "C-PAC run complete successfully?\n\n")
+    Parameters
+    ----------
+    args : tuple
+        Prepared data of the scan, its volumes removed by motion scrubbing,
+        path of the stimulus file, path of the scan, whether the scan was
+        scrubbed, whether its global signal was regressed and the directory
+        of the models.
 
-    print("Found input files:\n{0}\n".format(func_standard_paths))
+    Returns
+    -------
+    model_dir : str
+        Directory of the models.
+    """
 
-    pypeer_outdir = func_standard_paths[0].split("functional_to_standard")[0]
-    pypeer_outdir = os.path.join(pypeer_outdir, "PyPEER")
+    data, removed_indices, stim_path, func_path, scrub, gsr, model_dir = args
+    peer_func = import_pypeer()
+
+    data_for_training, calibration_points_removed = \
+        pypeer_calibration_data(data, removed_indices)
+    xmodel, ymodel = peer_func.train_model(data_for_training,
+                                           calibration_points_removed,
+                                           stim_path)
+
+    make_pypeer_dir(model_dir)
+    peer_func.save_model(xmodel, ymodel, os.path.basename(func_path),
+                         str(scrub), str(gsr), model_dir)
+
+    return model_dir
+
+
+def estimate_eye_movements(args):
+    """
+    Estimates the eye movements of a scan with the models of a PEER scan.
+
+    Parameters
+    ----------
+    args : tuple
+        Directory of the models, prepared data of the scan and the
+        directory of the estimations.
+
+    Returns
+    -------
+    estimate_dir : str
+        Directory of the estimations.
+    """
 
+    model_dir, data, estimate_dir = args
+    peer_func = import_pypeer()
+
+    xmodel, ymodel, xname, yname = peer_func.load_model(model_dir)
+    xfix, yfix = peer_func.predict_fixations(xmodel, ymodel, data)
+
+    make_pypeer_dir(estimate_dir)
+    fix_xname, fix_yname = peer_func.save_fixations(xfix, yfix, xname, yname,
+                                                    estimate_dir)
+    peer_func.estimate_em(xfix, yfix, fix_xname, fix_yname, estimate_dir)
+
+    return estimate_dir
+
+
+def _map(function, args, processes):
+    # runs the function on each of the arguments, in a pool of processes
+    if processes > 1 and len(args) > 1:
+        from multiprocessing import Pool
+
+        pool = Pool(min(processes, len(args)))
+        try:
+            return pool.map(function, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [function(arg) for arg in args]
+
+
+def run_pypeer(func_files, scan_labels, eye_mask_path, stim_path,
+               peer_scan_names, data_scan_names, fd_files=None, gsr=False,
+               scrub=False, scrub_thresh=None, processes=1, out_dir=None):
+    """
+    Trains the eye estimation models of the PEER scans of a participant, and
+    estimates the eye movements of its data scans with each of them.
+
+    Parameters
+    ----------
+    func_files : list
+        Paths of the scans, in template space and without nuisance
+        regression.
+    scan_labels : list
+        Label of each of the scans.
+    eye_mask_path : str
+        Path of the template eye mask.
+    stim_path : str
+        Path of the stimulus file of the calibration sequence.
+    peer_scan_names : list
+        Labels of the PEER scans, to train the models with.
+    data_scan_names : list
+        Labels of the scans to estimate the eye movements of.
+    fd_files : list, optional
+        Paths of the framewise displacement of each of the scans, for the
+        motion scrubbing.
+    gsr : bool, optional
+        Whether to regress the global signal.
+    scrub : bool, optional
+        Whether to scrub the volumes with high motion from the PEER scans.
+    scrub_thresh : float, optional
+        Framewise displacement threshold of the motion scrubbing.
+    processes : int, optional
+        Number of processes preparing the scans, training the models and
+        estimating the eye movements.
+    out_dir : str, optional
+        Directory of the outputs, the current directory by default.
+
+    Returns
+    -------
+    pypeer_outdir : str
+        Directory of the models and estimations.
+    """
+
+    import_pypeer()
+
+    if out_dir is None:
+        out_dir = os.getcwd()
+    pypeer_outdir = os.path.join(out_dir, "PyPEER")
     make_pypeer_dir(pypeer_outdir)
 
-    peer_scans = {}
-    data_scans = {}
-
-    for func_path in func_standard_paths:
-        scan_label = func_path.split("/")[-2].replace("_scan_", "")
-
-        if scan_label in peer_scan_names or scan_label in data_scan_names:
-            print("Eye-masking and z-score standardizing "
-                  "{0}..".format(scan_label))
-            masked_data = pypeer_eye_masking(func_path, eye_mask_path)
-            data = pypeer_zscore(masked_data)
-
-        if gsr:
-            print("Global signal regression for {0}..".format(scan_label))
-            data = global_signal_regression(data, eye_mask_path)
-
-        removed_indices = None
-        if scrub and scan_label in peer_scan_names:
-            print("Motion scrubbing (Power 2012) for "
-                  "{0}..".format(scan_label))
-            fd_path = func_path.replace("functional_to_standard",
-                                        "frame_wise_displacement_power")
-            fd_path = fd_path.replace(fd_path.split("/")[-1], "FD.1D")
-
-            if not os.path.isfile(fd_path):
-                raise Exception("\n\n[!] Could not find the mean framewise "
-                                "displacement 1D file in your C-PAC output "
-                                "directory.")
-
-            removed_indices = motion_scrub(fd_path, scrub_thresh)
-
-        if scan_label in peer_scan_names:
-            peer_scans[func_path] = [data, scan_label, removed_indices]
-        elif scan_label in data_scan_names:
-            raveled_data = pypeer_ravel_data(data)
-            data_scans[func_path] = [raveled_data, scan_label]
-
-    for peer_scan_path in peer_scans.keys():
-        print("Training the eye estimation model using:\n{0}"
-              "\n\n".format(peer_scan_path))
-        data = peer_scans[peer_scan_path][0]
-        peername = peer_scans[peer_scan_path][1]
-        removed_indices = peer_scans[peer_scan_path][2]
-        data_for_training, calibration_points_removed = prepare_data_for_svr(data,
-                                                                             removed_indices,
-                                                                             eye_mask_path)
-        xmodel, ymodel = train_model(data_for_training,
-                                     calibration_points_removed,
-                                     stim_path)
-
-        model_dir = os.path.join(pypeer_outdir, "peer_model-{0}".format(peername))
-        make_pypeer_dir(model_dir)
-
-        save_model(xmodel, ymodel, os.path.basename(peer_scan_path), str(scrub), 
-                   str(gsr), model_dir)
-
-        for data_scan_path in data_scans.keys():
-            print("Estimating eye movements for:\n{0}"
-                  "\n\n".format(data_scan_path))
-            data = data_scans[data_scan_path][0]
-            name = data_scans[data_scan_path][1]
-
-            xmodel, ymodel, xname, yname = load_model(model_dir)
-            xfix, yfix = predict_fixations(xmodel, ymodel, data)
-
-            estimate_dir = os.path.join(pypeer_outdir, 
-                                        "estimations-{0}_model-{1}".format(name, peername))
-            make_pypeer_dir(estimate_dir)
-
-            fix_xname, fix_yname = save_fixations(xfix, yfix, xname, yname,
-                                                  estimate_dir)
-            estimate_em(xfix, yfix, fix_xname, fix_yname, estimate_dir)
+    if not fd_files:
+        fd_files = [None] * len(func_files)
+
+    scans = [(func_path, label, fd_path)
+             for func_path, label, fd_path
+             in zip(func_files, scan_labels, fd_files)
+             if label in peer_scan_names or label in data_scan_names]
+
+    print("PEER scans for training model:\n{0}"
+          "\n\n".format(str(peer_scan_names)))
+    print("Data scans to estimate eye movements for:\n{0}"
+          "\n\n".format(str(data_scan_names)))
+
+    data = _map(prepare_scan, [(func_path, eye_mask_path, gsr)
+                               for func_path, _, _ in scans], processes)
+
+    models = []
+    estimations = []
+    for (func_path, label, fd_path), scan_data in zip(scans, data):
+        if label in peer_scan_names:
+            removed_indices = None
+            if scrub:
+                if not fd_path or not os.path.isfile(fd_path):
+                    raise Exception("\n\n[!] Could not find the framewise "
+                                    "displacement 1D file of the scan "
+                                    "{0}.".format(label))
+                removed_indices = motion_scrub(fd_path, scrub_thresh)
+
+            model_dir = os.path.join(pypeer_outdir,
+                                     "peer_model-{0}".format(label))
+            models.append((label, (scan_data, removed_indices, stim_path,
+                                   func_path, scrub, gsr, model_dir)))
+        elif label in data_scan_names:
+            estimations.append((label, scan_data))
+
+    model_dirs = _map(train_peer_model, [args for _, args in models],
+                      processes)
+
+    _map(estimate_eye_movements, [
+        (model_dir, scan_data,
+         os.path.join(pypeer_outdir, "estimations-{0}_model-{1}".format(
+             name, peername)))
+        for (peername, _), model_dir in zip(models, model_dirs)
+        for name, scan_data in estimations
+    ], processes)
+
+    return pypeer_outdir
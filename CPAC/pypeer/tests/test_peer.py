@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import nibabel as nb
+import pytest
+
+from CPAC.pypeer.peer import (
+    prepare_scan,
+    pypeer_calibration_data,
+    pypeer_eye_masking,
+    pypeer_zscore,
+    run_pypeer,
+)
+
+
+def write_scan(out_dir, shape=(12, 14, 10), volumes=60, seed=0):
+    random_state = np.random.RandomState(seed)
+
+    data = random_state.randn(*(shape + (volumes,))) * 50 + 1000
+    data[..., :] += random_state.randn(volumes) * 20
+    # a voxel of the eyes without signal
+    data[3, 4, 5] = 1000
+    data_path = os.path.join(out_dir, 'func.nii.gz')
+    nb.Nifti1Image(data.astype(np.int16), np.eye(4)).to_filename(data_path)
+
+    eye_mask = np.zeros(shape, dtype=np.float32)
+    eye_mask[2:6, 3:8, 4:7] = 1
+    eye_mask[2, 3:8, 4:7] = 0.5
+    eye_mask_path = os.path.join(out_dir, 'eye_mask.nii.gz')
+    nb.Nifti1Image(eye_mask, np.eye(4)).to_filename(eye_mask_path)
+
+    return data_path, eye_mask_path
+
+
+def reference_prepare(data_path, eye_mask_path, gsr):
+    # the volume by volume masking and voxel by voxel z-scoring, then the
+    # global signal regression and masking of PyPEER
+    eye_mask = nb.load(eye_mask_path).get_data()
+    data = nb.load(data_path).get_data().astype(np.float64)
+
+    for vol in range(data.shape[3]):
+        data[:, :, :, vol] = np.multiply(eye_mask, data[:, :, :, vol])
+
+    for x in range(data.shape[0]):
+        for y in range(data.shape[1]):
+            for z in range(data.shape[2]):
+                vmean = np.mean(np.array(data[x, y, z, :]))
+                vstdv = np.std(np.array(data[x, y, z, :]))
+                for t in range(data.shape[3]):
+                    if vstdv != 0:
+                        data[x, y, z, t] = (float(data[x, y, z, t]) -
+                                            float(vmean)) / vstdv
+                    else:
+                        data[x, y, z, t] = float(data[x, y, z, t]) - \
+                            float(vmean)
+
+    global_mask = np.array(eye_mask, dtype=bool)
+    if gsr:
+        X = np.column_stack([np.ones(data.shape[3]),
+                             data[global_mask].mean(0)])
+        Y = data[global_mask].T
+        B = np.linalg.inv(X.T.dot(X)).dot(X.T).dot(Y)
+        data[global_mask] = (Y - X.dot(B)).T
+
+    for vol in range(data.shape[3]):
+        data[:, :, :, vol] = np.multiply(eye_mask, data[:, :, :, vol])
+
+    return data[global_mask].T
+
+
+@pytest.mark.parametrize('gsr', [False, True])
+def test_prepare_scan(tmpdir, gsr):
+
+    data_path, eye_mask_path = write_scan(str(tmpdir))
+
+    expected = reference_prepare(data_path, eye_mask_path, gsr)
+    data = prepare_scan((data_path, eye_mask_path, gsr))
+
+    assert data.dtype == np.float32
+    assert data.shape == (60, 4 * 5 * 3)
+    np.testing.assert_allclose(data, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_masking_and_zscore(tmpdir):
+
+    data_path, eye_mask_path = write_scan(str(tmpdir))
+
+    data, weights = pypeer_eye_masking(data_path, eye_mask_path)
+    assert data.shape == (60, 60)
+    assert sorted(set(weights)) == [0.5, 1]
+
+    expected = nb.load(data_path).get_data()[
+        nb.load(eye_mask_path).get_data() > 0].T
+    np.testing.assert_array_equal(data, expected)
+
+    data = pypeer_zscore(data)
+    np.testing.assert_allclose(data.mean(axis=0), 0, atol=1e-4)
+    std = data.std(axis=0)
+    assert np.sum(std == 0) == 1
+    np.testing.assert_allclose(std[std > 0], 1, rtol=1e-4)
+
+
+def test_calibration_data():
+
+    data = np.arange(23 * 3, dtype=np.float32).reshape(23, 3)
+
+    points, removed_points = pypeer_calibration_data(data)
+    assert removed_points == []
+    np.testing.assert_array_equal(points,
+                                  data[:20].reshape(4, 5, 3).mean(axis=1))
+
+    removed_indices = [0, 5, 6, 7, 8, 9, 12]
+    points, removed_points = pypeer_calibration_data(data, removed_indices)
+    assert removed_points == [1]
+    np.testing.assert_array_equal(points[0], data[1:5].mean(axis=0))
+    np.testing.assert_array_equal(points[1], data[[10, 11, 13, 14]]
+                                  .mean(axis=0))
+    assert points.shape == (3, 3)
+
+
+def test_run_pypeer(tmpdir):
+
+    pytest.importorskip('PyPEER')
+
+    data_path, eye_mask_path = write_scan(str(tmpdir), volumes=135)
+    stim_path = str(tmpdir.join('stim.csv'))
+    with open(stim_path, 'w') as f:
+        f.write('pos_x,pos_y\n')
+        for point in range(27):
+            f.write('{0},{1}\n'.format(np.cos(point), np.sin(point)))
+
+    out_dir = str(tmpdir.join('out'))
+    pypeer_outdir = run_pypeer([data_path, data_path], ['peer', 'movie'],
+                               eye_mask_path, stim_path, ['peer'], ['movie'],
+                               processes=2, out_dir=out_dir)
+
+    assert sorted(os.listdir(pypeer_outdir)) == \
+        ['estimations-movie_model-peer', 'peer_model-peer']
@@ -18,9 +18,9 @@ def detect_qpp(datasets,
                window_length, permutations,
                lower_correlation_threshold, higher_correlation_threshold,
                correlation_threshold_iteration,
-               iterations, convergence_iterations):
+               iterations, convergence_iterations, processes=1):
     
-    from CPAC.qpp.qpp import detect_qpp
+    from CPAC.qpp.qpp import detect_qpp_vectorized
 
     joint_mask_img = nb.load(joint_mask)
     joint_mask = joint_mask_img.get_data().astype(bool)
@@ -32,14 +32,15 @@ def detect_qpp(datasets,
         if i > correlation_threshold_iteration else \
         lower_correlation_threshold
 
-    best_template_segment, _, _ = detect_qpp(
+    best_template_segment, _, _ = detect_qpp_vectorized(
         joint_datasets,
         datasets,
         window_length,
         permutations,
         correlation_threshold,
         iterations,
-        convergence_iterations
+        convergence_iterations,
+        processes=processes
     )
 
     qpp = np.zeros(joint_datasets_img.shape[0:3] + (window_length,))
@@ -72,6 +73,7 @@ def create_qpp(name='qpp', working_dir=None, crash_dir=None):
         'correlation_threshold_iteration',
         'iterations',
         'convergence_iterations',
+        'processes',
     ]), name='inputspec')
 
     outputspec = pe.Node(util.IdentityInterface(fields=['qpp']),
@@ -93,7 +95,8 @@ def create_qpp(name='qpp', working_dir=None, crash_dir=None):
                                            'higher_correlation_threshold',
                                            'correlation_threshold_iteration',
                                            'iterations',
-                                           'convergence_iterations'],
+                                           'convergence_iterations',
+                                           'processes'],
                                 output_names=['qpp'],
                                 function=detect_qpp,
                                 as_module=True),
@@ -113,6 +116,7 @@ def create_qpp(name='qpp', working_dir=None, crash_dir=None):
             ('correlation_threshold_iteration' ,'correlation_threshold_iteration'),
             ('iterations' ,'iterations'),
             ('convergence_iterations' ,'convergence_iterations'),
+            ('processes' ,'processes'),
         ]),
         (detect, outputspec, [('qpp', 'qpp')]),
     ])
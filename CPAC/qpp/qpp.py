@@ -2,14 +2,14 @@ import numpy as np
 import nibabel as nib
 import os
 from numpy import ndarray
-import matplotlib.pyplot as plt
 from scipy.signal import find_peaks
-from nilearn.masking import apply_mask
-from nilearn.masking import compute_epi_mask
-import numpy.matlib
 
 from CPAC.utils import check_random_state, correlation
 
+# largest size of the initial templates correlated in one matrix product,
+# in bytes
+TEMPLATE_CHUNK_BYTES = 256 * 1024 ** 2
+
 
 def smooth(x):
     """
@@ -132,12 +132,25 @@ def detect_qpp(data, num_scans, window_length,
         len(best_selected_peaks),
     ]
 
+    best_template_segment = qpp_template_segment(data, best_selected_peaks,
+                                                 window_length)
+
+    return best_template_segment, best_selected_peaks, best_template_metrics
+
+
+def qpp_template_segment(data, peaks, window_length):
+    """
+    Average of the data segments centered on the peaks of the QPP template
+    """
+
+    voxels, trs = data.shape
+
     window_length_start = round(window_length / 2)
     window_length_end = window_length_start - window_length % 2
 
     best_template_segment = np.zeros((voxels, window_length))
 
-    for best_peak in best_selected_peaks:
+    for best_peak in peaks:
         start_tr = int(best_peak - np.ceil(window_length / 2.))
         end_tr = int(best_peak + np.floor(window_length / 2.))
 
@@ -159,6 +172,219 @@ def detect_qpp(data, num_scans, window_length,
             end_segment,
         ], axis=1)
 
-    best_template_segment /= len(best_selected_peaks)
+    best_template_segment /= len(peaks)
+
+    return best_template_segment
+
+
+def window_norms(data, window_length, positions):
+    """
+    Norms of the centered, flattened windows of the data starting at each
+    position, from cumulative sums over the timepoints
+    """
+
+    voxels, trs = data.shape
+    df = voxels * window_length
+
+    # shifting the data by its mean does not change the centered windows,
+    # but keeps the cumulative sums well conditioned
+    shift = data.mean()
+    column_sums = data.sum(axis=0)
+    column_squares = np.einsum('ij,ij->j', data, data) \
+        - 2 * shift * column_sums + voxels * shift ** 2
+    column_sums = column_sums - voxels * shift
+
+    sums = np.concatenate([[0], np.cumsum(column_sums)])
+    squares = np.concatenate([[0], np.cumsum(column_squares)])
+
+    s1 = sums[positions + window_length] - sums[positions]
+    s2 = squares[positions + window_length] - squares[positions]
+
+    return np.sqrt(np.maximum(s2 - s1 ** 2 / df, 0))
+
+
+def normalize_template(segment):
+    """
+    Centers a (voxels, window_length) segment and scales it to unit norm,
+    like normalize_segment does for flattened segments
+    """
+
+    segment = segment - segment.mean()
+    return segment / np.sqrt(np.sum(segment ** 2))
+
+
+def sliding_template_correlation(templates, data, positions, norms):
+    """
+    Correlations between normalized templates and the data windows starting
+    at each position
+
+    As a template sums to zero, its correlation with a window only needs the
+    window norm, and the dot products with every window are diagonal sums of
+    a single (templates * window_length, trs) matrix product.
+
+    Parameters
+    ----------
+    templates : ndarray
+        (templates, voxels, window_length) output of normalize_template
+    data : ndarray
+        (voxels, trs) data
+    positions : ndarray
+        first TR of each window
+    norms : ndarray
+        output of window_norms for the positions
+
+    Returns
+    -------
+    correlations : ndarray
+        (templates, positions) correlations
+
+    """
+
+    n_templates, voxels, window_length = templates.shape
+
+    products = templates.transpose(0, 2, 1) \
+                        .reshape((n_templates * window_length, voxels)) \
+                        .dot(data) \
+                        .reshape((n_templates, window_length, -1))
+
+    lags = np.arange(window_length)
+    dots = products[:, lags[np.newaxis, :],
+                    positions[:, np.newaxis] + lags[np.newaxis, :]] \
+        .sum(axis=2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return dots / norms
+
+
+def detect_qpp_vectorized(data, num_scans, window_length,
+                          permutations, correlation_threshold,
+                          iterations, convergence_iterations=1,
+                          random_state=None, processes=1):
+    """
+    Same detection as detect_qpp, with the correlations of a template with
+    every window computed by sliding_template_correlation instead of
+    renormalizing each window for every TR, iteration and permutation
+
+    The window norms are computed once, the correlations of the random
+    initial windows in a matrix product per chunk of them (at most
+    TEMPLATE_CHUNK_BYTES of templates at a time), and the permutations are
+    then iterated by a pool of `processes` threads (numpy releases the GIL
+    in the matrix products, and the data is shared between threads).
+    """
+
+    from multiprocessing.pool import ThreadPool
+
+    random_state = check_random_state(random_state)
+
+    voxels, trs = data.shape
+
+    iterations = int(max(1, iterations))
+    convergence_iterations = int(max(1, convergence_iterations))
+
+    if callable(correlation_threshold):
+        correlation_thresholds = [correlation_threshold(i) for i in range(iterations)]
+    else:
+        correlation_thresholds = [correlation_threshold for _ in range(iterations)]
+
+    trs_per_scan = int(trs / num_scans)
+    inpectable_trs = np.arange(trs) % trs_per_scan
+    inpectable_trs = np.where(inpectable_trs < trs_per_scan - window_length + 1)[0]
+    inpectable_trs = inpectable_trs[inpectable_trs <= trs - window_length]
+
+    initial_trs = random_state.choice(inpectable_trs, permutations)
+
+    norms = window_norms(data, window_length, inpectable_trs)
+
+    def segment(tr):
+        return data[:, tr:tr + window_length]
+
+    chunk_size = max(1, int(TEMPLATE_CHUNK_BYTES //
+                            (8 * voxels * window_length)))
+    initial_correlations = np.empty((permutations, len(inpectable_trs)))
+    for start in range(0, permutations, chunk_size):
+        initial_templates = np.array([
+            normalize_template(segment(tr))
+            for tr in initial_trs[start:start + chunk_size]
+        ])
+        initial_correlations[start:start + chunk_size] = \
+            sliding_template_correlation(initial_templates, data,
+                                         inpectable_trs, norms)
+        del initial_templates
+
+    def run_permutation(perm):
+
+        template_holder = np.zeros(trs)
+        template_holder[inpectable_trs] = initial_correlations[perm]
+
+        template_holder_convergence = np.zeros((convergence_iterations, trs))
+
+        for iteration in range(iterations):
+
+            peak_threshold = correlation_thresholds[iteration]
+
+            peaks, _ = find_peaks(template_holder, height=peak_threshold, distance=window_length)
+            peaks = np.delete(peaks, np.where(~np.isin(peaks, inpectable_trs))[0])
+
+            template_holder = smooth(template_holder)
+
+            found_peaks = np.size(peaks)
+            if found_peaks < 1:
+                break
+
+            peaks_segments = np.mean([segment(peak) for peak in peaks], axis=0)
+            peaks_segments = normalize_template(peaks_segments)
+
+            template_holder[inpectable_trs] = sliding_template_correlation(
+                peaks_segments[np.newaxis], data, inpectable_trs, norms
+            )[0]
+
+            if np.all(correlation(template_holder, template_holder_convergence) > 0.9999):
+                break
+
+            if convergence_iterations > 1:
+                template_holder_convergence[1:] = template_holder_convergence[0:-1]
+            template_holder_convergence[0] = template_holder
+
+        if found_peaks > 1:
+            return {
+                'template': template_holder,
+                'peaks': peaks,
+                'final_iteration': iteration,
+                'correlation_score': np.sum(template_holder[peaks]),
+            }
+
+        return {}
+
+    processes = max(int(processes), 1)
+    if processes > 1:
+        pool = ThreadPool(processes)
+        try:
+            permutation_result = pool.map(run_permutation, range(permutations))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        permutation_result = [run_permutation(perm) for perm in range(permutations)]
+
+    # Retrieve max correlation of template from permutations
+    correlation_scores = np.array([
+        r['correlation_score'] if r else 0.0 for r in permutation_result
+    ])
+    if not np.any(correlation_scores):
+        raise Exception("C-PAC could not find QPP in your data. "
+                        "Please lower your correlation threshold and try again.")
+
+    max_correlation = np.argsort(correlation_scores)[-1]
+    best_template = permutation_result[max_correlation]['template']
+    best_selected_peaks = permutation_result[max_correlation]['peaks']
+
+    best_template_metrics = [
+        np.median(best_template[best_selected_peaks]),
+        np.median(np.diff(best_selected_peaks)),
+        len(best_selected_peaks),
+    ]
+
+    best_template_segment = qpp_template_segment(data, best_selected_peaks,
+                                                 window_length)
 
     return best_template_segment, best_selected_peaks, best_template_metrics
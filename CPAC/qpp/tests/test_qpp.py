@@ -2,7 +2,8 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import scipy.io
-from CPAC.qpp.qpp import detect_qpp
+from CPAC.qpp import qpp
+from CPAC.qpp.qpp import detect_qpp, detect_qpp_vectorized
 
 np.random.seed(10)
 
@@ -55,4 +56,47 @@ def test_qpp():
     for xc in best_selected_peaks:
         plt.axvline(x=xc, color='r')
     plt.legend()
-    plt.show()
\ No newline at end of file
+    plt.show()
+
+
+def test_detect_qpp_vectorized(monkeypatch):
+
+    voxels, trs = 200, 240
+    window_length = 12
+
+    random_state = np.random.RandomState(3)
+    x1 = np.sin(2 * np.pi * 8 * np.linspace(0, 1, trs))
+    x = np.tile(x1, (voxels, 1)) + random_state.uniform(0, 1, (voxels, trs))
+    x -= x.mean()
+    x /= x.std()
+
+    parameters = dict(
+        data=x,
+        num_scans=2,
+        window_length=window_length,
+        permutations=6,
+        correlation_threshold=lambda i: 0.1 if i < 2 else 0.2,
+        iterations=4,
+        convergence_iterations=2,
+    )
+
+    segment, peaks, metrics = detect_qpp(random_state=7, **parameters)
+
+    for processes in [1, 3]:
+        vectorized_segment, vectorized_peaks, vectorized_metrics = \
+            detect_qpp_vectorized(random_state=7, processes=processes,
+                                  **parameters)
+
+        np.testing.assert_array_equal(vectorized_peaks, peaks)
+        np.testing.assert_allclose(vectorized_metrics, metrics)
+        np.testing.assert_allclose(vectorized_segment, segment)
+
+    # the initial templates correlated two at a time
+    monkeypatch.setattr(qpp, 'TEMPLATE_CHUNK_BYTES',
+                        2 * 8 * voxels * window_length)
+    chunked_segment, chunked_peaks, chunked_metrics = \
+        detect_qpp_vectorized(random_state=7, **parameters)
+
+    np.testing.assert_array_equal(chunked_peaks, peaks)
+    np.testing.assert_allclose(chunked_metrics, metrics)
+    np.testing.assert_allclose(chunked_segment, segment)
@@ -0,0 +1,634 @@
+import os
+import hashlib
+
+import numpy as np
+import nibabel as nb
+
+# TFCE parameters of randomise -T: height and extent exponents, number of
+# threshold steps up to the maximum of the unpermuted statistic, and face
+# connectivity
+TFCE_H = 2.0
+TFCE_E = 0.5
+TFCE_STEPS = 100
+
+# permutations computed together, and permutations of each of the shards
+# run by the processes
+BATCH_SIZE = 16
+SHARD_SIZE = 250
+
+
+def read_vest(path):
+    """
+    Reads the matrix of an FSL VEST file, as written for FLAME (.mat, .con,
+    .grp, .fts).
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+
+    Returns
+    -------
+    matrix : numpy array
+        The matrix, as a 2D array.
+    """
+
+    rows = []
+    in_matrix = False
+
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith('/Matrix'):
+                in_matrix = True
+            elif in_matrix and line:
+                rows.append([float(value) for value in line.split()])
+
+    if not rows:
+        raise Exception('No matrix found in the file {0}.'.format(path))
+
+    return np.array(rows, ndmin=2)
+
+
+def load_design(mat_file, con_file, grp_file=None):
+    """
+    Loads the design of a group model from its FLAME files.
+
+    Parameters
+    ----------
+    mat_file : str
+        Path of the design matrix (.mat).
+    con_file : str
+        Path of the t contrasts (.con).
+    grp_file : str, optional
+        Path of the groups (.grp); the participants are permuted within
+        their group.
+
+    Returns
+    -------
+    design : numpy array
+        Design matrix, participants by regressors.
+    contrasts : numpy array
+        Contrasts, contrasts by regressors.
+    groups : numpy array
+        Group of each participant.
+    """
+
+    design = read_vest(mat_file)
+    contrasts = read_vest(con_file)
+
+    if contrasts.shape[1] != design.shape[1]:
+        raise Exception('The contrasts of {0} have {1} regressors, but the '
+                        'design matrix {2} has {3}.'.format(
+                            con_file, contrasts.shape[1], mat_file,
+                            design.shape[1]))
+
+    if grp_file:
+        groups = read_vest(grp_file)[:, 0].astype(int)
+        if len(groups) != design.shape[0]:
+            raise Exception('The groups of {0} have {1} participants, but '
+                            'the design matrix {2} has {3}.'.format(
+                                grp_file, len(groups), mat_file,
+                                design.shape[0]))
+    else:
+        groups = np.ones(design.shape[0], dtype=int)
+
+    return design, contrasts, groups
+
+
+def contrast_model(design, contrast):
+    """
+    Precomputes the projections of the GLM for a contrast, so the t
+    statistics of all the permutations are matrix products.
+
+    The design is split into the effect of the contrast and the nuisance
+    regressors, as randomise does, and the data are permuted after the
+    nuisance is regressed out (Freedman-Lane).
+
+    Parameters
+    ----------
+    design : numpy array
+        Design matrix, participants by regressors.
+    contrast : numpy array
+        Contrast vector.
+
+    Returns
+    -------
+    model : dict
+        'weights', the contrast of the pseudo-inverse of the design;
+        'basis', an orthonormal basis of the design; 'dof', the degrees of
+        freedom of the residuals; 'nuisance', the residual-forming matrix of
+        the nuisance regressors, or None.
+    """
+
+    design = np.asarray(design, dtype=np.float64)
+    contrast = np.asarray(contrast, dtype=np.float64).ravel()
+
+    weights = np.dot(contrast, np.linalg.pinv(design))
+
+    u, s, _ = np.linalg.svd(design, full_matrices=False)
+    rank = int((s > s.max() * max(design.shape) * np.finfo(float).eps).sum())
+    basis = u[:, :rank]
+
+    # the nuisance regressors span the design under the null hypothesis
+    _, s_c, vt_c = np.linalg.svd(contrast[np.newaxis, :])
+    null_space = vt_c[int((s_c > 0).sum()):].T
+    nuisance = None
+    if null_space.shape[1]:
+        nuisance_design = np.dot(design, null_space)
+        nuisance = np.eye(design.shape[0]) - np.dot(
+            nuisance_design, np.linalg.pinv(nuisance_design))
+
+    return {
+        'weights': weights,
+        'basis': basis,
+        'dof': design.shape[0] - rank,
+        'nuisance': nuisance,
+    }
+
+
+def is_one_sample(design):
+    """
+    Whether a design is a one-sample t-test, which randomise tests by sign
+    flipping instead of permutations.
+    """
+
+    return design.shape[1] == 1 and np.allclose(design, design[0, 0]) and \
+        design[0, 0] != 0
+
+
+def random_shuffles(groups, count, random_state, sign_flip=False):
+    """
+    Draws random shuffles of the participants: permutations within their
+    groups, or sign flips.
+
+    Returns
+    -------
+    shuffles : list
+        (index, signs) tuples; a shuffled dataset is signs * data[index].
+    """
+
+    n = len(groups)
+    members = [np.flatnonzero(groups == group) for group in np.unique(groups)]
+
+    shuffles = []
+    for _ in range(count):
+        if sign_flip:
+            index = np.arange(n)
+            signs = random_state.choice([-1.0, 1.0], n)
+        else:
+            index = np.arange(n)
+            for member in members:
+                index[member] = member[random_state.permutation(len(member))]
+            signs = np.ones(n)
+        shuffles.append((index, signs))
+
+    return shuffles
+
+
+def t_statistics(data, model, shuffles):
+    """
+    Computes the t statistics of a contrast for a batch of shuffles.
+
+    With Y_b = signs * Y[index], the effect is w Y_b and the explained sum
+    of squares is |U' Y_b|^2, so shuffling the rows of the data amounts to
+    shuffling the entries of w and the rows of U: the batch is two matrix
+    products with the data.
+
+    Parameters
+    ----------
+    data : numpy array
+        Data, participants by voxels, with the nuisance regressed out.
+    model : dict
+        See contrast_model.
+    shuffles : list
+        See random_shuffles.
+
+    Returns
+    -------
+    t : numpy array
+        t statistics, shuffles by voxels.
+    """
+
+    weights = model['weights']
+    basis = model['basis']
+    n, rank = basis.shape
+    count = len(shuffles)
+
+    shuffled_weights = np.zeros((count, n), dtype=data.dtype)
+    shuffled_basis = np.zeros((count, rank, n), dtype=data.dtype)
+    for b, (index, signs) in enumerate(shuffles):
+        shuffled_weights[b, index] = weights * signs
+        shuffled_basis[b][:, index] = (basis * signs[:, np.newaxis]).T
+
+    effect = np.dot(shuffled_weights, data)
+    explained = np.dot(shuffled_basis.reshape(count * rank, n), data)
+    explained = (explained.reshape(count, rank, -1).astype(np.float64) ** 2) \
+        .sum(axis=1)
+
+    total = np.einsum('ij,ij->j', data, data, dtype=np.float64)
+    residuals = np.maximum(total - explained, 0)
+    scale = np.sqrt(residuals / max(model['dof'], 1) * weights.dot(weights))
+
+    t = np.zeros_like(effect)
+    np.divide(effect, scale, out=t, where=scale > 0)
+    return t
+
+
+def connectivity_structure(batch=True):
+    """
+    Face connectivity of the voxels, as randomise uses for TFCE and
+    clusters; with batch, the first axis indexes separate maps.
+    """
+
+    from scipy import ndimage
+
+    structure = ndimage.generate_binary_structure(3, 1)
+    if batch:
+        structure = np.stack([np.zeros_like(structure), structure,
+                              np.zeros_like(structure)])
+    return structure
+
+
+def _volumes(stats, mask):
+    # the masked statistics of a batch, as volumes
+    volumes = np.zeros((stats.shape[0],) + mask.shape, dtype=stats.dtype)
+    volumes[:, mask] = stats
+    return volumes
+
+
+def tfce(stats, mask, step, h=TFCE_H, e=TFCE_E):
+    """
+    Computes the threshold-free cluster enhancement of a batch of maps.
+
+    Each threshold step is a single connected-component labelling of all
+    the maps of the batch, whose cluster sizes are looked up per voxel.
+
+    Parameters
+    ----------
+    stats : numpy array
+        Statistics, maps by voxels in the mask.
+    mask : numpy array
+        Boolean 3D mask.
+    step : float
+        Height of the threshold steps.
+    h, e : float, optional
+        Height and extent exponents.
+
+    Returns
+    -------
+    enhanced : numpy array
+        TFCE, maps by voxels in the mask.
+    """
+
+    from scipy import ndimage
+
+    structure = connectivity_structure()
+    volumes = _volumes(stats, mask)
+    enhanced = np.zeros(stats.shape, dtype=np.float64)
+
+    if step <= 0:
+        return enhanced
+
+    height = step
+    while True:
+        above = volumes >= height
+        if not above.any():
+            break
+        labels, _ = ndimage.label(above, structure)
+        sizes = np.bincount(labels.ravel()).astype(np.float64)
+        sizes[0] = 0
+        enhanced += sizes[labels[:, mask]] ** e * height ** h * step
+        height += step
+
+    return enhanced
+
+
+def cluster_extent(stats, mask, threshold):
+    """
+    Computes the size of the cluster of each voxel above a threshold.
+
+    Returns
+    -------
+    extent : numpy array
+        Cluster sizes, maps by voxels in the mask; 0 below the threshold.
+    """
+
+    from scipy import ndimage
+
+    labels, _ = ndimage.label(_volumes(stats, mask) > threshold,
+                              connectivity_structure())
+    sizes = np.bincount(labels.ravel()).astype(np.float64)
+    sizes[0] = 0
+    return sizes[labels[:, mask]]
+
+
+def _statistics(data, model, shuffles, mask, settings):
+    # the statistics of a batch of shuffles, by name
+    t = t_statistics(data, model, shuffles)
+    stats = {'vox': t}
+    if settings['tfce']:
+        stats['tfce'] = tfce(t, mask, settings['tfce_steps'][model['index']])
+    if settings['c_thresh']:
+        stats['clustere'] = cluster_extent(t, mask, settings['c_thresh'])
+    return stats
+
+
+def run_shard(work_dir, shard, count):
+    """
+    Runs a shard of the permutations, in a process of the pool. The null
+    distributions of the shard are saved in the working directory, so an
+    interrupted run resumes from the shards already done.
+
+    Parameters
+    ----------
+    work_dir : str
+        Working directory of the run, see randomise.
+    shard : int
+        Index of the shard, which seeds its permutations.
+    count : int
+        Number of permutations of the shard.
+
+    Returns
+    -------
+    shard_file : str
+        Path of the null distributions of the shard: for each statistic
+        and contrast, the maximum of each permutation ('max_<stat>_<n>')
+        and the number of permutations exceeding the unpermuted statistic
+        at each voxel ('count_<stat>_<n>').
+    """
+
+    shard_file = os.path.join(work_dir, 'shard_{0:05d}.npz'.format(shard))
+    if os.path.exists(shard_file):
+        return shard_file
+
+    inputs = np.load(os.path.join(work_dir, 'inputs.npz'), allow_pickle=True)
+    settings = inputs['settings'].item()
+    data = np.load(os.path.join(work_dir, 'data.npy'), mmap_mode='r')
+    mask = inputs['mask']
+    design = inputs['design']
+
+    random_state = np.random.RandomState([settings['seed'], shard])
+    shuffles = random_shuffles(inputs['groups'], count, random_state,
+                               is_one_sample(design))
+
+    nulls = {}
+    for index, contrast in enumerate(inputs['contrasts']):
+        model = contrast_model(design, contrast)
+        model['index'] = index
+
+        contrast_data = np.asarray(data)
+        if model['nuisance'] is not None:
+            contrast_data = np.dot(
+                model['nuisance'].astype(data.dtype), contrast_data)
+
+        for start in range(0, count, settings['batch_size']):
+            batch = shuffles[start:start + settings['batch_size']]
+            stats = _statistics(contrast_data, model, batch, mask, settings)
+
+            for name, values in stats.items():
+                observed = inputs['observed_{0}_{1}'.format(name, index)]
+                key = '{0}_{1}'.format(name, index)
+                nulls.setdefault('max_' + key, []).extend(values.max(axis=1))
+                nulls['count_' + key] = nulls.get('count_' + key, 0) + \
+                    (values >= observed).sum(axis=0)
+
+    tmp_file = shard_file + '.{0}.tmp.npz'.format(os.getpid())
+    np.savez(tmp_file, **dict((key, np.asarray(value))
+                              for key, value in nulls.items()))
+    os.rename(tmp_file, shard_file)
+
+    return shard_file
+
+
+def _run_shard(args):
+    return run_shard(*args)
+
+
+def merge_shards(shard_files):
+    """
+    Merges the null distributions of shards: the maxima are concatenated
+    and the exceedance counts are summed.
+
+    Returns
+    -------
+    nulls : dict
+        Merged null distributions, see run_shard.
+    """
+
+    nulls = {}
+    for shard_file in shard_files:
+        shard = np.load(shard_file)
+        for key in shard.files:
+            if key.startswith('max_'):
+                nulls[key] = np.concatenate([nulls.get(key, []), shard[key]])
+            else:
+                nulls[key] = nulls.get(key, 0) + shard[key]
+    return nulls
+
+
+def _save(values, mask, reference, path):
+    volume = np.zeros(mask.shape, dtype=np.float32)
+    volume[mask] = values
+
+    header = reference.header.copy()
+    header.set_data_dtype(np.float32)
+    # randomise sets the display range, which select relies on
+    header['cal_min'] = volume.min()
+    header['cal_max'] = volume.max()
+
+    nb.Nifti1Image(volume, reference.affine, header).to_filename(path)
+    return path
+
+
+def randomise(merged_file, mask_file, mat_file, con_file, grp_file=None,
+              base_name='randomise', num_perm=5000, demean=False,
+              c_thresh=None, tfce=True, processes=1, out_dir=None,
+              work_dir=None, batch_size=BATCH_SIZE, seed=0):
+    """
+    Permutation inference on a group model, as FSL randomise does, from the
+    files written for FLAME.
+
+    The permutations are split into shards, run by a pool of processes;
+    each shard keeps the maxima of the statistics, for the family-wise
+    error corrected p-values, and the voxelwise exceedance counts, which
+    are merged once all the shards are done.
+
+    Parameters
+    ----------
+    merged_file : str
+        Path of the 4D merged maps of the participants.
+    mask_file : str
+        Path of the group mask.
+    mat_file, con_file, grp_file : str
+        Paths of the FLAME model files; the participants are permuted
+        within the groups of the .grp file.
+    base_name : str, optional
+        Prefix of the output files.
+    num_perm : int, optional
+        Number of permutations, including the unpermuted data.
+    demean : bool, optional
+        Demean the data and the design, as randomise -D. One-sample designs
+        are not demeaned.
+    c_thresh : float, optional
+        Cluster-forming threshold of the cluster extent statistic, as
+        randomise -c.
+    tfce : bool, optional
+        Compute the TFCE statistic, as randomise -T.
+    processes : int, optional
+        Number of processes.
+    out_dir : str, optional
+        Output directory, the current directory by default.
+    work_dir : str, optional
+        Working directory, where the shards are saved; the run resumes
+        from the shards of an earlier run with the same inputs.
+    batch_size : int, optional
+        Number of permutations computed together.
+    seed : int, optional
+        Seed of the permutations.
+
+    Returns
+    -------
+    outputs : dict
+        Paths of the output files, named as the randomise outputs:
+        'tstat_files', and the '<stat>_p_files' and '<stat>_corrp_files'
+        of the 'vox', 'tfce' and 'clustere' statistics, which hold 1 - p.
+        't_corrected_p_files' are the corrected p-values of TFCE, or else
+        of cluster extent, or else voxelwise.
+    """
+
+    from multiprocessing import Pool
+
+    out_dir = os.path.abspath(out_dir or os.getcwd())
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    design, contrasts, groups = load_design(mat_file, con_file, grp_file)
+
+    mask_img = nb.load(mask_file)
+    mask = np.asarray(mask_img.dataobj) > 0
+    img = nb.load(merged_file)
+    if img.shape[:3] != mask.shape:
+        raise Exception('The merged file {0} and the mask {1} have '
+                        'different dimensions.'.format(merged_file,
+                                                       mask_file))
+
+    # the data are read one volume at a time, keeping the mask voxels
+    data = np.empty((img.shape[3], mask.sum()), dtype=np.float32)
+    for volume in range(img.shape[3]):
+        data[volume] = np.asarray(img.dataobj[..., volume])[mask]
+
+    if data.shape[0] != design.shape[0]:
+        raise Exception('The merged file {0} has {1} volumes, but the design '
+                        'matrix {2} has {3} rows.'.format(
+                            merged_file, data.shape[0], mat_file,
+                            design.shape[0]))
+
+    # demeaning would zero a one-sample design and the effect it tests, so
+    # it is left out for them
+    if demean and not is_one_sample(design):
+        data -= data.mean(axis=0)
+        design = design - design.mean(axis=0)
+
+    settings = {
+        'tfce': bool(tfce),
+        'c_thresh': float(c_thresh) if c_thresh else None,
+        'batch_size': max(int(batch_size), 1),
+        'seed': int(seed),
+        'tfce_steps': [],
+    }
+
+    # the unpermuted statistics
+    identity = [(np.arange(len(groups)), np.ones(len(groups)))]
+    observed = {}
+    for index, contrast in enumerate(contrasts):
+        model = contrast_model(design, contrast)
+        model['index'] = index
+        t = t_statistics(data, model, identity)
+        # the TFCE steps are set by the maximum of the unpermuted statistic
+        settings['tfce_steps'].append(max(t.max(), 0) / TFCE_STEPS)
+        for name, values in _statistics(data, model, identity, mask,
+                                        settings).items():
+            observed['{0}_{1}'.format(name, index)] = values[0]
+
+    key = hashlib.sha1(repr((
+        os.path.abspath(merged_file), os.path.getmtime(merged_file),
+        os.path.abspath(mask_file), design.tolist(), contrasts.tolist(),
+        groups.tolist(), num_perm, sorted(settings.items())
+    ))).hexdigest()
+    work_dir = os.path.join(os.path.abspath(work_dir or out_dir),
+                            'permutations_{0}'.format(key[:12]))
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    np.save(os.path.join(work_dir, 'data.npy'), data)
+    np.savez(os.path.join(work_dir, 'inputs.npz'), mask=mask, design=design,
+             contrasts=contrasts, groups=groups,
+             settings=np.array(settings, dtype=object),
+             **dict(('observed_' + name, values)
+                    for name, values in observed.items()))
+
+    # the unpermuted data count as one of the permutations
+    permutations = max(int(num_perm), 1) - 1
+    shards = [(work_dir, shard, min(SHARD_SIZE,
+                                    permutations - shard * SHARD_SIZE))
+              for shard in range(-(-permutations // SHARD_SIZE))]
+
+    if processes > 1 and len(shards) > 1:
+        pool = Pool(min(processes, len(shards)))
+        try:
+            shard_files = pool.map(_run_shard, shards)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        shard_files = [run_shard(*shard) for shard in shards]
+
+    nulls = merge_shards(shard_files)
+
+    outputs = {'tstat_files': []}
+    names = ['vox'] + (['tfce'] if settings['tfce'] else []) + \
+        (['clustere'] if settings['c_thresh'] else [])
+
+    for index in range(len(contrasts)):
+        number = index + 1
+        outputs['tstat_files'].append(_save(
+            observed['vox_{0}'.format(index)], mask, img,
+            os.path.join(out_dir, '{0}_tstat{1}.nii.gz'.format(base_name,
+                                                               number))))
+
+        for name in names:
+            stat = observed['{0}_{1}'.format(name, index)]
+            maxima = np.concatenate([
+                [stat.max()], nulls.get('max_{0}_{1}'.format(name, index), [])
+            ])
+            exceed = 1 + nulls.get('count_{0}_{1}'.format(name, index), 0)
+
+            p = exceed / float(len(maxima))
+            maxima.sort()
+            corrp = (len(maxima) - np.searchsorted(maxima, stat)) / \
+                float(len(maxima))
+
+            if name != 'clustere':
+                outputs.setdefault(name + '_p_files', []).append(_save(
+                    1 - p, mask, img, os.path.join(
+                        out_dir, '{0}_{1}_p_tstat{2}.nii.gz'.format(
+                            base_name, name, number))))
+
+            # voxels outside the clusters are not significant
+            if name == 'clustere':
+                corrp[stat == 0] = 1
+            outputs.setdefault(name + '_corrp_files', []).append(_save(
+                1 - corrp, mask, img, os.path.join(
+                    out_dir, '{0}_{1}_corrp_tstat{2}.nii.gz'.format(
+                        base_name, name, number))))
+
+    if settings['tfce']:
+        corrected = 'tfce'
+    elif settings['c_thresh']:
+        corrected = 'clustere'
+    else:
+        corrected = 'vox'
+    outputs['t_corrected_p_files'] = outputs[corrected + '_corrp_files']
+
+    return outputs
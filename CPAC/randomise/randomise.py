@@ -18,10 +18,24 @@ def select(input_list):
     return i
 
 
+def native_randomise(in_file, mask, design_mat, tcon, grp_file, base_name,
+                     num_perm, demean, c_thresh, tfce, processes, work_dir):
+
+    from CPAC.randomise.permutation_glm import randomise
+
+    outputs = randomise(in_file, mask, design_mat, tcon, grp_file,
+                        base_name=base_name, num_perm=num_perm,
+                        demean=demean, c_thresh=c_thresh, tfce=tfce,
+                        processes=processes, work_dir=work_dir)
+
+    return outputs['tstat_files'], outputs['t_corrected_p_files']
+
+
 def prep_randomise_workflow(c, merged_file, mask_file, f_test, mat_file,
                             con_file, grp_file, output_dir, working_dir,
                             log_dir, model_name, fts_file=None):
 
+    import os
     import nipype.interfaces.utility as util
     import nipype.interfaces.fsl as fsl
     import nipype.interfaces.io as nio
@@ -29,8 +43,33 @@ def prep_randomise_workflow(c, merged_file, mask_file, f_test, mat_file,
     wf = pe.Workflow(name='randomise_workflow')
     wf.base_dir = c.work_dir
 
-    randomise = pe.Node(interface=fsl.Randomise(),
-                        name='fsl-randomise_{0}'.format(model_name))
+    if getattr(c, 'randomise_native', False):
+        # the permutations are run in process, sharded across processes;
+        # the shards are kept in the working directory to resume the run
+        randomise = pe.Node(util.Function(input_names=['in_file',
+                                                       'mask',
+                                                       'design_mat',
+                                                       'tcon',
+                                                       'grp_file',
+                                                       'base_name',
+                                                       'num_perm',
+                                                       'demean',
+                                                       'c_thresh',
+                                                       'tfce',
+                                                       'processes',
+                                                       'work_dir'],
+                                          output_names=['tstat_files',
+                                                        't_corrected_p_files'],
+                                          function=native_randomise),
+                            name='randomise_{0}'.format(model_name))
+        randomise.inputs.grp_file = grp_file
+        randomise.inputs.processes = getattr(c, 'randomise_processes', 1)
+        randomise.inputs.work_dir = os.path.join(
+            os.path.abspath(c.work_dir), 'randomise_shards', model_name)
+    else:
+        randomise = pe.Node(interface=fsl.Randomise(),
+                            name='fsl-randomise_{0}'.format(model_name))
+
     randomise.inputs.base_name = model_name
     randomise.inputs.in_file = merged_file
     randomise.inputs.mask = mask_file
@@ -42,7 +81,7 @@ def prep_randomise_workflow(c, merged_file, mask_file, f_test, mat_file,
     randomise.inputs.design_mat = mat_file
     randomise.inputs.tcon = con_file
 
-    if fts_file:
+    if fts_file and not getattr(c, 'randomise_native', False):
         randomise.inputs.fcon = fts_file
 
     select_tcorrp_files = pe.Node(util.Function(input_names=['input_list'],
@@ -0,0 +1,204 @@
+import os
+
+import numpy as np
+import nibabel as nb
+from scipy import ndimage
+
+from CPAC.randomise.permutation_glm import (
+    contrast_model,
+    random_shuffles,
+    randomise,
+    read_vest,
+    t_statistics,
+    tfce,
+)
+
+
+def reference_t(data, design, contrast, index, signs):
+    # Freedman-Lane, one least squares fit per permutation
+    null_space = np.linalg.svd(contrast[np.newaxis, :])[2][1:].T
+    nuisance = np.dot(design, null_space)
+    residuals = data - np.dot(nuisance, np.linalg.lstsq(nuisance, data)[0])
+    shuffled = signs[:, np.newaxis] * residuals[index]
+
+    beta = np.linalg.lstsq(design, shuffled)[0]
+    error = shuffled - np.dot(design, beta)
+    dof = design.shape[0] - np.linalg.matrix_rank(design)
+    variance = (error ** 2).sum(axis=0) / dof
+    scale = contrast.dot(np.linalg.pinv(np.dot(design.T, design))) \
+        .dot(contrast)
+    return contrast.dot(beta) / np.sqrt(variance * scale)
+
+
+def reference_tfce(volume, step):
+    structure = ndimage.generate_binary_structure(3, 1)
+    enhanced = np.zeros(volume.shape)
+    for height in step * np.arange(1, int(volume.max() / step) + 1):
+        labels, _ = ndimage.label(volume >= height, structure)
+        sizes = np.bincount(labels.ravel())
+        sizes[0] = 0
+        enhanced += sizes[labels] ** 0.5 * height ** 2 * step
+    return enhanced
+
+
+def test_t_statistics():
+
+    random_state = np.random.RandomState(0)
+    n = 30
+    design = np.column_stack([np.ones(n), random_state.randn(n),
+                              np.repeat([0., 1.], n // 2)])
+    contrast = np.array([0., 1., -0.5])
+    data = random_state.randn(n, 500)
+
+    model = contrast_model(design, contrast)
+    residuals = np.dot(model['nuisance'], data)
+
+    shuffles = random_shuffles(np.repeat([1, 2], n // 2), 20, random_state)
+    shuffles += random_shuffles(np.ones(n), 5, random_state, sign_flip=True)
+
+    expected = np.array([reference_t(data, design, contrast, index, signs)
+                         for index, signs in shuffles])
+    t = t_statistics(residuals, model, shuffles)
+    np.testing.assert_allclose(t, expected, rtol=1e-6, atol=1e-8)
+
+    # the permutations stay within the groups
+    for index, _ in shuffles[:20]:
+        assert set(index[:n // 2]) == set(range(n // 2))
+
+
+def test_tfce():
+
+    random_state = np.random.RandomState(0)
+    mask = np.zeros((10, 12, 8), dtype=bool)
+    mask[1:9, 1:11, 1:7] = True
+
+    volumes = ndimage.gaussian_filter(random_state.randn(3, 10, 12, 8),
+                                      (0, 1, 1, 1)) * 10
+    stats = volumes[:, mask]
+    step = stats[0].max() / 100
+
+    enhanced = tfce(stats, mask, step)
+    for b in range(3):
+        volume = np.where(mask, volumes[b], 0)
+        np.testing.assert_allclose(enhanced[b],
+                                   reference_tfce(volume, step)[mask])
+
+
+def test_randomise(tmpdir):
+
+    tmp_dir = str(tmpdir)
+    random_state = np.random.RandomState(0)
+    n = 20
+    shape = (8, 8, 6)
+
+    design = np.column_stack([np.ones(n), np.repeat([0., 1.], n // 2)])
+    effect = np.zeros(shape)
+    effect[2:5, 2:5, 2:4] = 3.0
+
+    data = random_state.randn(*(shape + (n,)))
+    data += effect[..., np.newaxis] * design[:, 1]
+
+    merged_file = os.path.join(tmp_dir, 'merged.nii.gz')
+    mask_file = os.path.join(tmp_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(
+        merged_file)
+    nb.Nifti1Image(np.ones(shape, dtype=np.float32), np.eye(4)).to_filename(
+        mask_file)
+
+    mat_file = os.path.join(tmp_dir, 'model.mat')
+    with open(mat_file, 'w') as f:
+        f.write('/NumWaves\t2\n/NumPoints\t%d\n/PPheights\t1\t1\n\n'
+                'Intercept\tGroup\t\n\n/Matrix\n' % n)
+        np.savetxt(f, design, fmt='%1.5e', delimiter='\t')
+
+    con_file = os.path.join(tmp_dir, 'model.con')
+    with open(con_file, 'w') as f:
+        f.write('/ContrastName1\tGroup\n/ContrastName2\t-Group\n'
+                '/NumWaves\t2\n/NumContrasts\t2\n\n/Matrix\n'
+                '0.00000e+00\t1.00000e+00\t\n0.00000e+00\t-1.00000e+00\t\n')
+
+    assert read_vest(con_file).shape == (2, 2)
+
+    outputs = {}
+    for processes in (1, 2):
+        out_dir = os.path.join(tmp_dir, 'out_%d' % processes)
+        outputs[processes] = randomise(
+            merged_file, mask_file, mat_file, con_file, num_perm=300,
+            c_thresh=2.0, tfce=True, processes=processes, out_dir=out_dir,
+            batch_size=8)
+
+    assert len(outputs[1]['tstat_files']) == 2
+    assert outputs[1]['t_corrected_p_files'] == \
+        outputs[1]['tfce_corrp_files']
+
+    # the shards are seeded, so the processes do not change the results
+    for key in outputs[1]:
+        for one, two in zip(outputs[1][key], outputs[2][key]):
+            np.testing.assert_array_equal(nb.load(one).get_data(),
+                                          nb.load(two).get_data())
+
+    tstat = nb.load(outputs[1]['tstat_files'][0]).get_data()
+    corrp = nb.load(outputs[1]['tfce_corrp_files'][0]).get_data()
+    negative = nb.load(outputs[1]['tfce_corrp_files'][1]).get_data()
+
+    assert tstat[effect > 0].min() > 2
+    assert corrp[effect > 0].min() > 0.95
+    assert corrp[effect == 0].mean() < 0.5
+    assert negative.max() < 0.95
+
+    # a second run resumes from the saved shards
+    out_dir = os.path.join(tmp_dir, 'out_1')
+    shard_dir = [d for d in os.listdir(out_dir)
+                 if d.startswith('permutations_')][0]
+    shard_file = os.path.join(out_dir, shard_dir, 'shard_00000.npz')
+    mtime = os.path.getmtime(shard_file)
+    randomise(merged_file, mask_file, mat_file, con_file, num_perm=300,
+              c_thresh=2.0, tfce=True, out_dir=out_dir, batch_size=8)
+    assert os.path.getmtime(shard_file) == mtime
+
+
+def test_randomise_one_sample_demean(tmpdir):
+
+    random_state = np.random.RandomState(0)
+    n = 16
+    shape = (6, 6, 4)
+
+    effect = np.zeros(shape)
+    effect[1:4, 1:4, 1:3] = 2.0
+    data = random_state.randn(*(shape + (n,))) + effect[..., np.newaxis]
+
+    merged_file = str(tmpdir.join('merged.nii.gz'))
+    mask_file = str(tmpdir.join('mask.nii.gz'))
+    nb.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(
+        merged_file)
+    nb.Nifti1Image(np.ones(shape, dtype=np.float32), np.eye(4)).to_filename(
+        mask_file)
+
+    mat_file = str(tmpdir.join('model.mat'))
+    with open(mat_file, 'w') as f:
+        f.write('/NumWaves\t1\n/NumPoints\t%d\n/PPheights\t1\n\n'
+                'Intercept\t\n\n/Matrix\n' % n)
+        np.savetxt(f, np.ones((n, 1)), fmt='%1.5e', delimiter='\t')
+
+    con_file = str(tmpdir.join('model.con'))
+    with open(con_file, 'w') as f:
+        f.write('/ContrastName1\tMean\n/NumWaves\t1\n/NumContrasts\t1\n\n'
+                '/Matrix\n1.00000e+00\t\n')
+
+    # demeaning is left out for a one-sample design, which is tested by
+    # sign flipping
+    outputs = {}
+    for demean in (False, True):
+        outputs[demean] = randomise(
+            merged_file, mask_file, mat_file, con_file, num_perm=100,
+            demean=demean, out_dir=str(tmpdir.join('out_%d' % demean)))
+
+    for key in outputs[False]:
+        for one, two in zip(outputs[False][key], outputs[True][key]):
+            np.testing.assert_array_equal(nb.load(one).get_data(),
+                                          nb.load(two).get_data())
+
+    tstat = nb.load(outputs[True]['tstat_files'][0]).get_data()
+    corrp = nb.load(outputs[True]['t_corrected_p_files'][0]).get_data()
+    assert tstat[effect > 0].min() > 2
+    assert corrp[effect > 0].min() > 0.95
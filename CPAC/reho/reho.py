@@ -43,6 +43,10 @@ def create_reho():
             For a brain voxel the number of neighbouring brain voxels to use for KCC.
             Possible values are 27, 19, 7. Recommended value 27
 
+        inputspec.chunk_size : integer (optional)
+            Number of z slices ranked and held in memory at once.
+            Defaults to the whole volume.
+
 
     Workflow Outputs: ::
 
@@ -56,6 +60,9 @@ def create_reho():
     1. Generate ReHo map from the input EPI 4D volume, EPI mask and cluster_size
     2. Compute Z score of the ReHo map by subtracting mean and dividing by standard deviation
 
+    The ReHo map is computed with compute_reho_vectorized, which ranks the
+    timepoints and computes KCC for all voxels of a z slab at once.
+
 
     Workflow Graph:
 
@@ -83,6 +90,7 @@ def create_reho():
 
     reHo = pe.Workflow(name='reHo')
     inputNode = pe.Node(util.IdentityInterface(fields=['cluster_size',
+                                                       'chunk_size',
                                                        'rest_res_filt',
                                                        'rest_mask']),
                         name='inputspec')
@@ -92,17 +100,20 @@ def create_reho():
 
     reho_imports = ['import os', 'import sys', 'import nibabel as nb',
                     'import numpy as np',
-                    'from CPAC.reho.utils import f_kendall']
+                    'from CPAC.reho.utils import tied_ranks, '
+                    'reho_neighbourhood']
     raw_reho_map = pe.Node(util.Function(input_names=['in_file', 'mask_file',
-                                                      'cluster_size'],
+                                                      'cluster_size',
+                                                      'chunk_size'],
                                          output_names=['out_file'],
-                                         function=compute_reho,
+                                         function=compute_reho_vectorized,
                                          imports=reho_imports),
                            name='reho_map')
 
     reHo.connect(inputNode, 'rest_res_filt', raw_reho_map, 'in_file')
     reHo.connect(inputNode, 'rest_mask', raw_reho_map, 'mask_file')
     reHo.connect(inputNode, 'cluster_size', raw_reho_map, 'cluster_size')
+    reHo.connect(inputNode, 'chunk_size', raw_reho_map, 'chunk_size')
     reHo.connect(raw_reho_map, 'out_file', outputNode, 'raw_reho_map')
 
     return reHo
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import numpy as np
+import nibabel as nb
+import pytest
+from CPAC.reho.utils import compute_reho, compute_reho_vectorized, \
+                            tied_ranks
+
+
+def _write_inputs(out_dir, shape=(9, 8, 7), n_t=30):
+
+    np.random.seed(42)
+
+    data = np.random.randn(*(shape + (n_t,)))
+    mask = np.zeros(shape)
+    mask[1:-2, 2:-1, 1:-1] = 1
+    mask[4, 4, 3] = 0
+
+    affine = np.eye(4)
+    in_file = os.path.join(out_dir, 'func.nii.gz')
+    mask_file = os.path.join(out_dir, 'mask.nii.gz')
+    nb.Nifti1Image(data, affine).to_filename(in_file)
+    nb.Nifti1Image(mask, affine).to_filename(mask_file)
+
+    return in_file, mask_file
+
+
+def test_tied_ranks():
+
+    data = np.array([[3., 1., 2., 2., 5., 2.],
+                     [1., 1., 1., 1., 1., 1.]]).T
+
+    ranks = tied_ranks(data, axis=0)
+
+    np.testing.assert_array_equal(ranks[:, 0], [5., 1., 3., 3., 6., 3.])
+    np.testing.assert_array_equal(ranks[:, 1], [3.5] * 6)
+
+
+@pytest.mark.parametrize('cluster_size', [7, 19, 27])
+@pytest.mark.parametrize('chunk_size', [None, 1, 2])
+def test_compute_reho_vectorized(cluster_size, chunk_size):
+
+    out_dir = tempfile.mkdtemp()
+    os.chdir(out_dir)
+
+    in_file, mask_file = _write_inputs(out_dir)
+
+    reference = nb.load(compute_reho(in_file, mask_file,
+                                     cluster_size)).get_data().copy()
+    os.remove(os.path.join(out_dir, 'ReHo.nii.gz'))
+
+    reho = nb.load(compute_reho_vectorized(in_file, mask_file, cluster_size,
+                                           chunk_size)).get_data()
+
+    np.testing.assert_allclose(reho, reference, rtol=1e-10, atol=1e-12)
+
+
+def test_create_reho(tmpdir):
+
+    from CPAC.reho.reho import create_reho
+
+    out_dir = str(tmpdir)
+    os.chdir(out_dir)
+
+    in_file, mask_file = _write_inputs(out_dir)
+
+    reference = nb.load(compute_reho(in_file, mask_file,
+                                     27)).get_data().copy()
+
+    wf = create_reho()
+    wf.base_dir = out_dir
+    wf.inputs.inputspec.rest_res_filt = in_file
+    wf.inputs.inputspec.rest_mask = mask_file
+    wf.inputs.inputspec.cluster_size = 27
+    wf.inputs.inputspec.chunk_size = 2
+    wf.run()
+
+    reho_file = os.path.join(out_dir, 'reHo', 'reho_map', 'ReHo.nii.gz')
+    np.testing.assert_allclose(nb.load(reho_file).get_data(), reference,
+                               rtol=1e-10, atol=1e-12)
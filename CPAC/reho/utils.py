@@ -1,3 +1,8 @@
+import os
+import sys
+import numpy as np
+import nibabel as nb
+from CPAC.utils import slab_dataobj
 
 
 def getOpString(mean, std_dev):
@@ -281,3 +286,213 @@ def compute_reho(in_file, mask_file, cluster_size):
 
     return out_file
 
+
+
+def tied_ranks(data, axis=0):
+
+    """
+    Computes the tied (average) ranks of an array along one axis, without
+    looping over the series
+
+    Parameters
+    ----------
+
+    data : ndarray
+        Array of values to rank, e.g. a (timepoints, voxels) matrix
+
+    axis : integer
+        Axis along which the values are ranked
+
+    Returns
+    -------
+
+    ranks : ndarray
+        Float64 array with the same shape as data, holding the 1-based
+        ranks of each value, with tied values sharing their average rank
+
+    """
+
+    import numpy as np
+
+    data = np.moveaxis(np.asarray(data), axis, 0)
+    shape = data.shape
+    n = shape[0]
+
+    # work on a (n, series) matrix
+    data = data.reshape((n, -1))
+    columns = np.arange(data.shape[1])
+
+    order = np.argsort(data, axis=0, kind='mergesort')
+    sorted_data = data[order, columns]
+
+    index = np.arange(n)[:, np.newaxis]
+
+    # a tie group starts where the sorted value changes and ends right
+    # before the next change
+    changes = np.diff(sorted_data, axis=0) != 0
+    edge = np.ones((1, data.shape[1]), dtype=bool)
+    starts = np.concatenate([edge, changes], axis=0)
+    ends = np.concatenate([changes, edge], axis=0)
+
+    first = np.maximum.accumulate(np.where(starts, index, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, index, n)[::-1],
+                                 axis=0)[::-1]
+
+    ranks = np.empty(data.shape, dtype=np.float64)
+    ranks[order, columns] = (first + last) / 2.0 + 1.0
+    ranks = ranks.reshape(shape)
+
+    return np.moveaxis(ranks, 0, axis)
+
+
+def reho_neighbourhood(cluster_size):
+
+    """
+    Lists the voxel offsets of the ReHo neighbourhood for a cluster size
+
+    Parameters
+    ----------
+
+    cluster_size : integer
+        7 (faces), 19 (faces and edges) or 27 (faces, edges and corners);
+        any other value falls back to 27
+
+    Returns
+    -------
+
+    offsets : list of tuples
+        (di, dj, dk) offsets, including the centre voxel (0, 0, 0)
+
+    """
+
+    import itertools
+
+    if cluster_size not in (7, 19, 27):
+        cluster_size = 27
+
+    offsets = []
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        nonzero = sum(1 for d in offset if d != 0)
+        if cluster_size == 7 and nonzero > 1:
+            continue
+        if cluster_size == 19 and nonzero > 2:
+            continue
+        offsets.append(offset)
+
+    return offsets
+
+
+def compute_reho_vectorized(in_file, mask_file, cluster_size,
+                            chunk_size=None):
+
+    """
+    Computes the ReHo Map like compute_reho, but ranks the timepoints with
+    tied_ranks and computes Kendall's coefficient of concordance (KCC) for
+    every in-mask voxel at once from shifted sums of the rank volume
+
+    The volume is processed in slabs along z so that only chunk_size slices
+    (plus one slice of neighbours on each side) are ranked and held in
+    memory at a time. As in compute_reho, voxels on the border of the
+    volume are left at zero and neighbours outside the mask are ignored.
+    Tied timepoints share their average rank, so the map only differs from
+    compute_reho for timeseries with ties.
+
+    Parameters
+    ----------
+
+    in_file : nifti file
+        4D EPI File
+
+    mask_file : nifti file
+        Mask of the EPI File(Only Compute ReHo of voxels in the mask)
+
+    cluster_size : integer
+        for a brain voxel the number of neighbouring brain voxels to use for
+        KCC.
+
+    chunk_size : integer
+        number of z slices to compute at once; all slices when None
+
+
+    Returns
+    -------
+
+    out_file : nifti file
+        ReHo map of the input EPI image
+
+    """
+
+    import os
+    import numpy as np
+    import nibabel as nb
+    from CPAC.reho.utils import tied_ranks, reho_neighbourhood
+    from CPAC.utils import slab_dataobj
+
+    offsets = reho_neighbourhood(cluster_size)
+
+    res_img = nb.load(in_file)
+    res_data = slab_dataobj(res_img)
+    full_mask = nb.load(mask_file).get_data() > 0
+
+    (n_x, n_y, n_z, n_t) = res_img.shape
+
+    # only interior voxels are computed, matching compute_reho
+    mask_data = full_mask.copy()
+    mask_data[[0, -1], :, :] = False
+    mask_data[:, [0, -1], :] = False
+    mask_data[:, :, [0, -1]] = False
+
+    if not chunk_size:
+        chunk_size = n_z
+    chunk_size = max(int(chunk_size), 1)
+
+    K = np.zeros((n_x, n_y, n_z))
+
+    for z_start in range(1, n_z - 1, chunk_size):
+
+        z_stop = min(z_start + chunk_size, n_z - 1)
+
+        if not mask_data[:, :, z_start:z_stop].any():
+            continue
+
+        # slab with one slice of neighbours on each side
+        slab = np.asarray(res_data[:, :, z_start - 1:z_stop + 1, :])
+        slab_mask = full_mask[:, :, z_start - 1:z_stop + 1]
+
+        ranks = tied_ranks(slab, axis=3)
+        ranks[~slab_mask] = 0
+        del slab
+
+        n_slab = z_stop - z_start
+        rank_sum = np.zeros((n_x - 2, n_y - 2, n_slab, n_t))
+        count = np.zeros((n_x - 2, n_y - 2, n_slab))
+
+        for di, dj, dk in offsets:
+            rank_sum += ranks[1 + di:n_x - 1 + di,
+                              1 + dj:n_y - 1 + dj,
+                              1 + dk:1 + dk + n_slab]
+            count += slab_mask[1 + di:n_x - 1 + di,
+                               1 + dj:n_y - 1 + dj,
+                               1 + dk:1 + dk + n_slab]
+        del ranks
+
+        center = mask_data[1:n_x - 1, 1:n_y - 1, z_start:z_stop]
+
+        sr = rank_sum[center]
+        k = count[center]
+        del rank_sum
+
+        s = np.sum(sr ** 2, axis=1) - n_t * np.mean(sr, axis=1) ** 2
+        kcc = 12 * s / k ** 2 / (n_t ** 3 - n_t)
+
+        K_slab = np.zeros(center.shape)
+        K_slab[center] = kcc
+        K[1:n_x - 1, 1:n_y - 1, z_start:z_stop] = K_slab
+
+    img = nb.Nifti1Image(K, header=res_img.header,
+                         affine=res_img.affine)
+    reho_file = os.path.join(os.getcwd(), 'ReHo.nii.gz')
+    img.to_filename(reho_file)
+    out_file = reho_file
+
+    return out_file
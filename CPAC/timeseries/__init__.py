@@ -4,6 +4,8 @@ from timeseries_analysis import get_voxel_timeseries, \
                                 gen_vertices_timeseries, \
                                 gen_voxel_timeseries, \
                                 gen_roi_timeseries, \
+                                gen_roi_means, \
+                                gen_roi_timeseries_binary, \
                                 get_spatial_map_timeseries
 
 __all__ = ['get_voxel_timeseries', \
@@ -12,4 +14,6 @@ __all__ = ['get_voxel_timeseries', \
            'gen_vertices_timeseries', \
            'gen_voxel_timeseries', \
            'gen_roi_timeseries', \
+           'gen_roi_means', \
+           'gen_roi_timeseries_binary', \
            'get_spatial_map_timeseries']
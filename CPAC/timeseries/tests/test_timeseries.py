@@ -0,0 +1,75 @@
+import os
+import numpy as np
+import nibabel as nib
+from CPAC.timeseries.timeseries_analysis import (
+    gen_roi_means,
+    gen_roi_timeseries,
+    gen_roi_timeseries_binary,
+    write_roi_npz
+)
+
+
+def roi_data(dl_dir, shape=(9, 8, 7), timepoints=20, seed=42):
+
+    rng = np.random.RandomState(seed)
+
+    data = rng.randn(*(shape + (timepoints,))).astype(np.float32)
+    atlas = rng.randint(0, 12, size=shape).astype(np.float32)
+    atlas[atlas == 5] = 0
+    parcels = rng.randint(0, 200, size=shape).astype(np.int16)
+
+    data_file = os.path.join(dl_dir, 'data.nii.gz')
+    atlas_file = os.path.join(dl_dir, 'atlas.nii.gz')
+    parcels_file = os.path.join(dl_dir, 'parcels.nii.gz')
+    nib.Nifti1Image(data, np.eye(4)).to_filename(data_file)
+    nib.Nifti1Image(atlas - 0.5, np.eye(4)).to_filename(atlas_file)
+    nib.Nifti1Image(parcels, np.eye(4)).to_filename(parcels_file)
+
+    return data, data_file, [(atlas, atlas_file), (parcels, parcels_file)]
+
+
+def test_gen_roi_means(tmpdir):
+
+    data, data_file, atlases = roi_data(str(tmpdir))
+
+    for chunk_size in [1, 100, 50000]:
+        for atlas, atlas_file in atlases:
+            nodes, means = gen_roi_means(data_file, atlas_file,
+                                         chunk_size=chunk_size)
+            expected_nodes = [n for n in np.unique(atlas) if n > 0]
+            assert np.all(nodes == expected_nodes)
+            assert means.shape == (data.shape[3], len(nodes))
+            for n, mean in zip(nodes, means.T):
+                assert np.allclose(mean, data[atlas == n].mean(0))
+
+
+def test_gen_roi_timeseries_binary(tmpdir, monkeypatch):
+
+    monkeypatch.chdir(str(tmpdir))
+    data, data_file, atlases = roi_data(str(tmpdir))
+
+    for atlas, atlas_file in atlases:
+        npz_file = gen_roi_timeseries_binary(data_file, atlas_file)
+        npy_file = gen_roi_timeseries_binary(data_file, atlas_file, 'npy')
+        assert os.path.dirname(npz_file) == str(tmpdir)
+
+        npz = np.load(npz_file)
+        assert np.allclose(npz['roi_data'], np.load(npy_file))
+        for n, mean in zip(npz['roi_numbers'], npz['roi_data'].T):
+            assert np.allclose(mean, data[atlas == n].mean(0))
+
+    # the npz output of the roi timeseries workflow
+    atlas_file = atlases[0][1]
+    roi_csv = [str(tmpdir.join('roi_stats.csv'))]
+    assert write_roi_npz(roi_csv, [True, False], data_file,
+                         atlas_file) == roi_csv
+    roi_outputs = write_roi_npz(roi_csv, [True, True], data_file, atlas_file)
+    assert roi_outputs == roi_csv + [gen_roi_timeseries_binary(data_file,
+                                                               atlas_file)]
+
+    out_list = gen_roi_timeseries(data_file, atlas_file, [True, True])
+    assert all(os.path.exists(f) for f in out_list)
+    csv_data = np.genfromtxt(out_list[2], delimiter=',', skip_header=1)
+    npz = np.load(roi_outputs[1])
+    assert np.all(csv_data[:, 0] == npz['roi_numbers'])
+    assert np.allclose(csv_data[:, 1:], npz['roi_data'].T, atol=1e-6)
@@ -3,6 +3,7 @@ import nipype.interfaces.fsl as fsl
 import nipype.interfaces.utility as util
 import nipype.interfaces.afni as afni
 from nipype import logging
+from CPAC.utils import slab_dataobj
 
 
 def get_voxel_timeseries(wf_name='voxel_timeseries'):
@@ -133,19 +134,35 @@ def clean_roi_csv(roi_csv):
     return roi_array, edited_roi_csv
 
 
-def write_roi_npz(roi_csv, out_type=None):
+def write_roi_npz(roi_csv, out_type=None, data_file=None, template=None):
+    """
+    Adds the npz file of the mean timeseries of each roi to the outputs, if
+    requested. The timeseries are computed from the functional data and the
+    roi mask, and written as numpy binaries, rather than parsed back from
+    the text output of 3dROIstats.
+
+    Parameters
+    ----------
+    roi_csv : list
+        text output of 3dROIstats, see clean_roi_csv
+    out_type : list, optional
+        two boolean values for the csv and npz outputs
+    data_file : string, optional
+        path to input functional data, needed for the npz output
+    template : string, optional
+        path to input roi mask, needed for the npz output
+
+    Returns
+    -------
+    roi_outputs : list
+        the text output, and the npz file if requested
+    """
+    from CPAC.timeseries.timeseries_analysis import gen_roi_timeseries_binary
 
-    roi_npz = None
     roi_outputs = [roi_csv[0]]
 
-    if not out_type:
-        return roi_outputs
-    elif out_type[1]:
-        np_roi_data = genfromtxt(roi_csv[0], delimiter=',')
-        roi_npz = os.path.join(os.getcwd(), 'roi_stats.npz')
-        with open(roi_npz, 'wt') as f:
-            np.savez(f, np_roi_data)
-        roi_outputs.append(roi_npz)
+    if out_type and out_type[1]:
+        roi_outputs.append(gen_roi_timeseries_binary(data_file, template))
 
     return roi_outputs
 
@@ -237,15 +254,15 @@ def get_roi_timeseries(wf_name='roi_timeseries'):
 
     wflow.connect(timeseries_roi, 'stats', clean_csv, 'roi_csv')
 
-    write_npz_imports = ['import os', 'import numpy as np',
-                         'from numpy import genfromtxt']
-    write_npz = pe.Node(util.Function(input_names=['roi_csv', 'out_type'],
+    write_npz = pe.Node(util.Function(input_names=['roi_csv', 'out_type',
+                                                   'data_file', 'template'],
                                       output_names=['roi_output_npz'],
-                                      function=write_roi_npz,
-                                      imports=write_npz_imports),
+                                      function=write_roi_npz),
                         name='write_roi_npz')
     wflow.connect(clean_csv, 'edited_roi_csv', write_npz, 'roi_csv')
     wflow.connect(inputNode, 'output_type', write_npz, 'out_type')
+    wflow.connect(inputNode, 'rest', write_npz, 'data_file')
+    wflow.connect(inputnode_roi, 'roi', write_npz, 'template')
     wflow.connect(clean_csv, 'roi_array', outputNode, 'roi_ts')
     wflow.connect(write_npz, 'roi_output_npz', outputNode, 'roi_outputs')
 
@@ -454,6 +471,162 @@ def get_normalized_moments(wf_name='normalized_moments'):
     return wflow
 
 
+def roi_label_indices(template):
+    """
+    Maps each voxel of a parcellation to the index of its ROI.
+
+    Parameters
+    ----------
+    template : string or ndarray
+        path to roi mask, or its data
+
+    Returns
+    -------
+    nodes : ndarray
+        sorted positive labels of the roi mask
+    indices : ndarray
+        index of the label of each voxel in nodes, -1 for background
+
+    """
+    import nibabel as nib
+    import numpy as np
+
+    if not isinstance(template, np.ndarray):
+        template = nib.load(template).get_data()
+
+    # Cast as rounded-up integer
+    unit_data = np.int64(np.ceil(template))
+
+    nodes, indices = np.unique(unit_data, return_inverse=True)
+    indices = indices.reshape(unit_data.shape)
+
+    positive = nodes > 0
+    indices = np.where(positive[indices],
+                       indices - np.count_nonzero(~positive), -1)
+
+    return nodes[positive], indices
+
+
+def gen_roi_means(data_file, template, chunk_size=50000):
+    """
+    Computes the mean timeseries of every roi of a roi mask in a single read
+    of the functional data.
+
+    The data is read in slabs of about chunk_size voxels, and the sums of
+    the voxels of each slab are reduced into their rois with a sparse
+    label-indexed product, so each voxel is visited once whatever the
+    number of rois.
+
+    Parameters
+    ----------
+    data_file : string
+        path to input functional data
+    template : string
+        path to input roi mask in functional native space
+    chunk_size : int, optional
+        approximate number of voxels read at once
+
+    Returns
+    -------
+    nodes : ndarray
+        sorted positive labels of the roi mask
+    means : ndarray
+        timepoints x nodes array of the mean timeseries
+
+    Raises
+    ------
+    Exception
+
+    """
+    import nibabel as nib
+    import numpy as np
+    from scipy import sparse
+    from CPAC.timeseries.timeseries_analysis import roi_label_indices
+    from CPAC.utils import slab_dataobj
+
+    datafile = nib.load(data_file)
+    data = slab_dataobj(datafile)
+    shape = datafile.shape
+    vol = shape[3]
+
+    nodes, indices = roi_label_indices(template)
+    if indices.shape != shape[:3]:
+        raise Exception('\n\n[!] CPAC says: Invalid Shape Error.'
+                        'Please check the voxel dimensions. '
+                        'Data and roi should have the same shape.\n\n')
+    counts = np.bincount(indices[indices >= 0], minlength=len(nodes))
+    sums = np.zeros((len(nodes), vol))
+
+    slab = max(int(chunk_size) // (shape[0] * shape[1]), 1)
+    for z0 in range(0, shape[2], slab):
+        z1 = min(z0 + slab, shape[2])
+
+        slab_indices = indices[:, :, z0:z1]
+        slab_mask = slab_indices >= 0
+        if not slab_mask.any():
+            continue
+
+        slab_data = np.asarray(data[:, :, z0:z1, :])
+        slab_data = slab_data[slab_mask].astype(np.float64)
+        slab_indices = slab_indices[slab_mask]
+
+        reduction = sparse.csr_matrix(
+            (np.ones(len(slab_indices)),
+             (slab_indices, np.arange(len(slab_indices)))),
+            shape=(len(nodes), len(slab_indices))
+        )
+        sums += reduction.dot(slab_data)
+
+    return nodes, (sums / counts[:, np.newaxis]).T
+
+
+def gen_roi_timeseries_binary(data_file, template, out_format='npz',
+                              chunk_size=50000):
+    """
+    Method to extract the mean timeseries of each node of a roi mask,
+    written directly as a numpy binary.
+
+    Parameters
+    ----------
+    data_file : string
+        path to input functional data
+    template : string
+        path to input roi mask in functional native space
+    out_format : string, optional
+        'npz' to store the timeseries (roi_data, timepoints x nodes) with
+        the node labels (roi_numbers), or 'npy' for the timeseries only
+    chunk_size : int, optional
+        approximate number of voxels read at once
+
+    Returns
+    -------
+    out_file : string
+        npy or npz file of the timeseries
+
+    """
+    import os
+    import numpy as np
+    from CPAC.timeseries.timeseries_analysis import gen_roi_means
+
+    if out_format not in ('npz', 'npy'):
+        raise ValueError('Invalid output format {0}, should be npz or '
+                         'npy.'.format(out_format))
+
+    nodes, means = gen_roi_means(data_file, template, chunk_size)
+
+    tmp_file = os.path.splitext(os.path.basename(template))[0]
+    tmp_file = os.path.splitext(tmp_file)[0]
+    out_file = os.path.abspath(
+        'roi_{0}_timeseries.{1}'.format(tmp_file, out_format)
+    )
+    if out_format == 'npz':
+        np.savez(out_file, roi_data=means, roi_numbers=nodes)
+    else:
+        np.save(out_file, means)
+
+    return out_file
+
+
 def gen_roi_timeseries(data_file, template, output_type):
     """
     Method to extract mean of voxel across
@@ -482,25 +655,15 @@ def gen_roi_timeseries(data_file, template, output_type):
     Exception
 
     """
-    import nibabel as nib
     import csv
     import numpy as np
     import os
     import shutil
+    from CPAC.timeseries.timeseries_analysis import gen_roi_means
 
-    unit_data = nib.load(template).get_data()
-    # Cast as rounded-up integer
-    unit_data = np.int64(np.ceil(unit_data))
-    datafile = nib.load(data_file)
-    img_data = datafile.get_data()
-    vol = img_data.shape[3]
-
-    if unit_data.shape != img_data.shape[:3]:
-        raise Exception('\n\n[!] CPAC says: Invalid Shape Error.'
-                        'Please check the voxel dimensions. '
-                        'Data and roi should have the same shape.\n\n')
+    nodes, means = gen_roi_means(data_file, template)
+    vol = means.shape[0]
 
-    nodes = np.unique(unit_data).tolist()
     sorted_list = []
     node_dict = {}
     out_list = []
@@ -514,16 +677,12 @@ def gen_roi_timeseries(data_file, template, output_type):
     csv_file = os.path.abspath('roi_' + tmp_file + '.csv')
     numpy_file = os.path.abspath('roi_' + tmp_file + '.npz')
     
-    nodes.sort()
-    for n in nodes:
-        if n > 0:
-            node_array = img_data[unit_data == n]
-            node_str = 'node_{0}'.format(n)
-            avg = np.mean(node_array, axis=0)
-            avg = np.round(avg, 6)
-            list1 = [n] + avg.tolist()
-            sorted_list.append(list1)
-            node_dict[node_str] = avg.tolist()
+    for n, avg in zip(nodes.tolist(), means.T):
+        node_str = 'node_{0}'.format(n)
+        avg = np.round(avg, 6)
+        list1 = [n] + avg.tolist()
+        sorted_list.append(list1)
+        node_dict[node_str] = avg.tolist()
 
     # writing to 1Dfile
     print("writing 1D file..")
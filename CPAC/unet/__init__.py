@@ -1,13 +1,41 @@
-from function import write_nifti, estimate_dice, extract_large_comp, predict_volumes, MyParser
+from CPAC.utils.lazy_import import lazy_module, lazy_attributes
 
-from model import weigths_init, Conv3dBlock, UpConv3dBlock, Conv2dBlock, UpConv2dBlock, UNet3d, UNet2d, MultiSliceBcUNet, MultiSliceSsUNet, MultiSliceModel
+_attributes = lazy_attributes('CPAC.unet.function', [
+    'write_nifti',
+    'estimate_dice',
+    'extract_large_comp',
+    'predict_axis',
+    'predict_in_worker',
+    'predict_volumes',
+    'MyParser',
+])
+
+_attributes.update(lazy_attributes('CPAC.unet.model', [
+    'weigths_init',
+    'Conv3dBlock',
+    'UpConv3dBlock',
+    'Conv2dBlock',
+    'UpConv2dBlock',
+    'UNet3d',
+    'UNet2d',
+    'MultiSliceBcUNet',
+    'MultiSliceSsUNet',
+    'MultiSliceModel',
+]))
+
+_attributes.update(lazy_attributes('CPAC.unet.dataset', [
+    'VolumeDataset',
+    'BlockDataset',
+]))
 
-from dataset import VolumeDataset, BlockDataset
+lazy_module(__name__, _attributes)
 
 __all__ = [
     'write_nifti',
     'estimate_dice',
     'extract_large_comp',
+    'predict_axis',
+    'predict_in_worker',
     'predict_volumes',
     'MyParser',
     'weigths_init',
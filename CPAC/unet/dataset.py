@@ -214,7 +214,7 @@ class BlockDataset(data.Dataset):
     def get_rescale_dim(self):
         return self.rescale_dim
 
-    def get_one_directory(self, axis=0):
+    def get_one_directory_index(self, axis=0):
         if axis==0:
             ind=range(0, len(self.slist0))
             slist=self.slist0
@@ -225,7 +225,12 @@ class BlockDataset(data.Dataset):
             ind=range(len(self.slist0)+len(self.slist1), 
                 len(self.slist0)+len(self.slist1)+len(self.slist2))
             slist=self.slist2
-        
+
+        return ind, slist
+
+    def get_one_directory(self, axis=0):
+        ind, slist=self.get_one_directory_index(axis=axis)
+
         slice_weight=np.zeros(slist[-1][-1]+1)
         for l in slist:
             slice_weight[l]+=1
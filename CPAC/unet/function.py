@@ -45,15 +45,116 @@ def extract_large_comp(prt_msk):
 
     return prt_msk
 
+def predict_axis(model, block_dataset, axis, batch_size=1, use_gpu=False):
+    """
+    Predicts the mask of one direction of a volume, pushing the slice blocks
+    of the direction through the model in batches.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        Model, in evaluation mode when the batches have more than one
+        block.
+    block_dataset : BlockDataset
+        Slice blocks of the rescaled volume.
+    axis : int
+        Direction of the slices.
+    batch_size : int
+        Number of slice blocks per forward pass.
+    use_gpu : bool
+        Whether to run the model on the GPU.
+
+    Returns
+    -------
+    pr_bmsk : torch.Tensor
+        Brain probability of each slice of the direction, the direction
+        first.
+    """
+
+    import torch
+
+    ind, slice_list=block_dataset.get_one_directory_index(axis=axis)
+    rescale_dim=block_dataset.get_rescale_dim()
+
+    pr_bmsk=torch.zeros([slice_list[-1][-1]+1, rescale_dim, rescale_dim])
+
+    with torch.no_grad():
+        for start in range(0, len(ind), batch_size):
+            stop=min(start+batch_size, len(ind))
+
+            # only the image of the blocks is fed to the model
+            blocks=[block_dataset[i] for i in ind[start:stop]]
+            blocks=[blk[0] if isinstance(blk, tuple) else blk for blk in blocks]
+            rimg_blk=torch.stack(blocks)
+            if use_gpu:
+                rimg_blk=rimg_blk.cuda()
+
+            pr_bmsk_blk=model(rimg_blk)
+
+            # the prediction of a block is the one of its middle slice
+            centers=torch.tensor([s[1] for s in slice_list[start:stop]])
+            pr_bmsk[centers]=pr_bmsk_blk[:, 1, :, :].cpu()
+
+    return pr_bmsk
+
+def predict_in_worker(model, cimg_in, suffix="unet_pre_mask", nii_outdir=None,
+        rescale_dim=256, num_slice=3, batch_size=1, num_threads=1):
+    """
+    Runs predict_volumes in a new Python process, so the intra-op threads of
+    torch are never started in a process forked by the MultiProc plugin,
+    which hangs.
+
+    Returns
+    -------
+    out_path : str
+        Path of the predicted mask.
+    """
+
+    import os
+    import sys
+    import shutil
+    import tempfile
+    import subprocess
+    import torch
+
+    if nii_outdir is None:
+        nii_outdir=os.getcwd()
+
+    model_dir=tempfile.mkdtemp(dir=nii_outdir)
+    try:
+        model_path=os.path.join(model_dir, "model.pt")
+        torch.save(model, model_path)
+
+        env=dict(os.environ)
+        env["OMP_NUM_THREADS"]=str(num_threads)
+        env["MKL_NUM_THREADS"]=str(num_threads)
+
+        output=subprocess.check_output([
+            sys.executable, "-m", "CPAC.unet.function",
+            model_path, cimg_in,
+            "--suffix", suffix,
+            "--out_dir", nii_outdir,
+            "--rescale_dim", str(rescale_dim),
+            "--num_slice", str(num_slice),
+            "--batch_size", str(batch_size),
+            "--num_threads", str(num_threads),
+        ], env=env)
+    finally:
+        shutil.rmtree(model_dir)
+
+    # the path of the mask is the last line of the output
+    return output.strip().splitlines()[-1]
+
 def predict_volumes(model, rimg_in=None, cimg_in=None, bmsk_in=None, suffix="unet_pre_mask",
         save_dice=False, save_nii=True, nii_outdir=None, verbose=False, 
-        rescale_dim=256, num_slice=3):
+        rescale_dim=256, num_slice=3, batch_size=1, num_threads=None,
+        worker=False):
 
     import torch
     import torch.nn as nn
     import numpy as np
-    from torch.autograd import Variable
-    from CPAC.unet.function import extract_large_comp, estimate_dice, write_nifti
+    from CPAC.unet.function import extract_large_comp, estimate_dice, \
+        write_nifti, predict_axis, predict_in_worker
     from CPAC.unet.model import UNet2d
     from CPAC.unet.dataset import VolumeDataset, BlockDataset
     from torch.utils.data import DataLoader
@@ -61,6 +162,16 @@ def predict_volumes(model, rimg_in=None, cimg_in=None, bmsk_in=None, suffix="une
     import nibabel as nib
     import pickle
 
+    if worker:
+        return predict_in_worker(model, cimg_in, suffix=suffix,
+                                 nii_outdir=nii_outdir,
+                                 rescale_dim=rescale_dim,
+                                 num_slice=num_slice, batch_size=batch_size,
+                                 num_threads=num_threads or 1)
+
+    if num_threads:
+        torch.set_num_threads(int(num_threads))
+
     use_gpu=torch.cuda.is_available()
     model_on_gpu=next(model.parameters()).is_cuda
     use_bn=True
@@ -71,6 +182,13 @@ def predict_volumes(model, rimg_in=None, cimg_in=None, bmsk_in=None, suffix="une
         if model_on_gpu:
             model.cpu()
 
+    # one slice block at a time, the model runs as it was built, and its
+    # batch normalization uses the statistics of each block; batches of
+    # blocks would mix those statistics, so they use the statistics of the
+    # training instead
+    if batch_size > 1:
+        model.eval()
+
     NoneType=type(None)
     if isinstance(rimg_in, NoneType) and isinstance(cimg_in, NoneType):
         print("Input rimg_in or cimg_in")
@@ -105,48 +223,23 @@ def predict_volumes(model, rimg_in=None, cimg_in=None, bmsk_in=None, suffix="une
         
         rescale_shape=block_dataset.get_rescale_shape()
         raw_shape=block_dataset.get_raw_shape()
-        
+
+        # the predictions of the three directions
+        pr_3_bmsk=torch.zeros(tuple(raw_shape)+(3,))
+
         for od in range(3):
             backard_ind=np.arange(3)
             backard_ind=np.insert(np.delete(backard_ind, 0), od, 0)
 
-            block_data, slice_list, slice_weight=block_dataset.get_one_directory(axis=od)
-            pr_bmsk=torch.zeros([len(slice_weight), rescale_dim, rescale_dim])
-            if use_gpu:
-                pr_bmsk=pr_bmsk.cuda()
-            for (i, ind) in enumerate(slice_list):
-                if ptype==1:
-                    rimg_blk=block_data[i]
-                    if use_gpu:
-                        rimg_blk=rimg_blk.cuda()
-                elif ptype==2:
-                    rimg_blk, bmsk_blk=block_data[i]
-                    if use_gpu:
-                        rimg_blk=rimg_blk.cuda()
-                        bmsk_blk=bmsk_blk.cuda()
-                else:
-                    rimg_blk, bfld_blk, bmsk_blk=block_data[i]
-                    if use_gpu:
-                        rimg_blk=rimg_blk.cuda()
-                        bfld_blk=bfld_blk.cuda()
-                        bmsk_blk=bmsk_blk.cuda()
-                pr_bmsk_blk=model(torch.unsqueeze(Variable(rimg_blk), 0))
-                pr_bmsk[ind[1], :, :]=pr_bmsk_blk.data[0][1, :, :]
-            
-            if use_gpu:
-                pr_bmsk=pr_bmsk.cpu()
+            pr_bmsk=predict_axis(model, block_dataset, od,
+                                 batch_size=batch_size, use_gpu=use_gpu)
             
             pr_bmsk=pr_bmsk.permute(backard_ind[0], backard_ind[1], backard_ind[2])
             pr_bmsk=pr_bmsk[:rescale_shape[0], :rescale_shape[1], :rescale_shape[2]]
             uns_pr_bmsk=torch.unsqueeze(pr_bmsk, 0)
             uns_pr_bmsk=torch.unsqueeze(uns_pr_bmsk, 0)
             uns_pr_bmsk=nn.functional.interpolate(uns_pr_bmsk, size=raw_shape, mode="trilinear", align_corners=False)
-            pr_bmsk=torch.squeeze(uns_pr_bmsk)
-
-            if od==0:
-                pr_3_bmsk=torch.unsqueeze(pr_bmsk, 3)
-            else:
-                pr_3_bmsk=torch.cat((pr_3_bmsk, torch.unsqueeze(pr_bmsk, 3)), dim=3)
+            pr_3_bmsk[..., od]=torch.squeeze(uns_pr_bmsk)
         
         pr_bmsk=pr_3_bmsk.mean(dim=3)
         
@@ -184,3 +277,26 @@ def predict_volumes(model, rimg_in=None, cimg_in=None, bmsk_in=None, suffix="une
     # return output mask
     return out_path
 
+if __name__ == "__main__":
+
+    import torch
+
+    parser=MyParser(description="Predicts the brain mask of a T1 with a "
+                                "saved U-Net model.")
+    parser.add_argument("model", help="saved model")
+    parser.add_argument("cimg_in", help="T1 image")
+    parser.add_argument("--suffix", default="unet_pre_mask")
+    parser.add_argument("--out_dir", default=None)
+    parser.add_argument("--rescale_dim", type=int, default=256)
+    parser.add_argument("--num_slice", type=int, default=3)
+    parser.add_argument("--batch_size", type=int, default=1)
+    parser.add_argument("--num_threads", type=int, default=1)
+    args=parser.parse_args()
+
+    model=torch.load(args.model, map_location="cpu")
+    print(predict_volumes(model, cimg_in=args.cimg_in, suffix=args.suffix,
+                          nii_outdir=args.out_dir,
+                          rescale_dim=args.rescale_dim,
+                          num_slice=args.num_slice,
+                          batch_size=args.batch_size,
+                          num_threads=args.num_threads))
@@ -0,0 +1,143 @@
+import os
+import time
+
+import numpy as np
+import nibabel as nb
+import pytest
+import torch
+import torch.nn as nn
+from scipy import ndimage
+
+from CPAC.unet.dataset import BlockDataset
+from CPAC.unet.function import predict_axis, predict_volumes
+from CPAC.unet.model import UNet2d
+
+
+def unet_model(seed=0):
+    torch.manual_seed(seed)
+    model = nn.Sequential(UNet2d(dim_in=3, num_conv_block=3, kernel_root=4),
+                          nn.Softmax2d())
+    return model.eval()
+
+
+def write_t1(path, shape, seed=0):
+    random_state = np.random.RandomState(seed)
+    grid = np.indices(shape).astype(np.float32)
+    center = np.array(shape, dtype=np.float32).reshape(3, 1, 1, 1) / 2
+    head = np.sqrt(((grid - center) ** 2).sum(axis=0)) < min(shape) / 3.
+    data = ndimage.gaussian_filter(head * 100. + random_state.rand(*shape),
+                                   2).astype(np.float32)
+    nb.Nifti1Image(data, np.eye(4)).to_filename(path)
+    return path
+
+
+def reference_axis(model, block_dataset, axis):
+    # one slice block at a time, as predict_volumes did
+    block_data, slice_list, slice_weight = \
+        block_dataset.get_one_directory(axis=axis)
+    rescale_dim = block_dataset.get_rescale_dim()
+    pr_bmsk = torch.zeros([len(slice_weight), rescale_dim, rescale_dim])
+    for (i, ind) in enumerate(slice_list):
+        pr_bmsk_blk = model(torch.unsqueeze(block_data[i], 0))
+        pr_bmsk[ind[1], :, :] = pr_bmsk_blk.data[0][1, :, :]
+    return pr_bmsk
+
+
+@pytest.mark.parametrize('shape,rescale_dim', [((40, 48, 36), 48),
+                                               ((256, 256, 256), 256)])
+def test_predict_axis(tmpdir, shape, rescale_dim):
+
+    torch.set_num_threads(1)
+    model = unet_model()
+
+    t1_file = write_t1(str(tmpdir.join('t1.nii.gz')), shape)
+    data = nb.load(t1_file).get_data()
+    cimg = torch.from_numpy((data - data.min()) / (data.max() - data.min()))
+    block_dataset = BlockDataset(rimg=torch.unsqueeze(cimg, 0),
+                                 rescale_dim=rescale_dim)
+
+    start = time.time()
+    expected = reference_axis(model, block_dataset, 0)
+    reference_time = time.time() - start
+
+    start = time.time()
+    pr_bmsk = predict_axis(model, block_dataset, 0, batch_size=4)
+    batch_time = time.time() - start
+
+    print('\n{0}: one slice at a time: {1:.2f}s, batched: {2:.2f}s'.format(
+        shape, reference_time, batch_time))
+
+    assert not pr_bmsk.requires_grad
+    np.testing.assert_allclose(pr_bmsk.numpy(), expected.detach().numpy(),
+                               atol=1e-5)
+
+
+def test_predict_axis_training_mode(tmpdir):
+
+    # one slice block at a time, a model in training mode predicts as before,
+    # with the batch normalization statistics of each block
+    model = unet_model().train()
+
+    t1_file = write_t1(str(tmpdir.join('t1.nii.gz')), (40, 48, 36))
+    data = nb.load(t1_file).get_data()
+    cimg = torch.from_numpy((data - data.min()) / (data.max() - data.min()))
+    block_dataset = BlockDataset(rimg=torch.unsqueeze(cimg, 0),
+                                 rescale_dim=48)
+
+    expected = reference_axis(model, block_dataset, 1)
+    pr_bmsk = predict_axis(model, block_dataset, 1)
+
+    np.testing.assert_allclose(pr_bmsk.numpy(), expected.detach().numpy(),
+                               atol=1e-5)
+
+    out_dir = str(tmpdir.join('out'))
+    os.makedirs(out_dir)
+    predict_volumes(model, cimg_in=t1_file, nii_outdir=out_dir,
+                    rescale_dim=48)
+    assert model.training
+
+
+def test_predict_volumes(tmpdir):
+
+    model = unet_model()
+    t1_file = write_t1(str(tmpdir.join('t1.nii.gz')), (40, 48, 36))
+
+    out_dir = str(tmpdir.join('out'))
+    os.makedirs(out_dir)
+    out_path = predict_volumes(model, cimg_in=t1_file, nii_outdir=out_dir,
+                               rescale_dim=48, batch_size=7, num_threads=1)
+    assert out_path == os.path.join(out_dir, 't1_unet_pre_mask.nii.gz')
+
+    worker_dir = str(tmpdir.join('worker'))
+    os.makedirs(worker_dir)
+    worker_path = predict_volumes(model, cimg_in=t1_file,
+                                  nii_outdir=worker_dir, rescale_dim=48,
+                                  batch_size=7, num_threads=1, worker=True)
+    assert worker_path == os.path.join(worker_dir, 't1_unet_pre_mask.nii.gz')
+    assert os.listdir(worker_dir) == ['t1_unet_pre_mask.nii.gz']
+
+    np.testing.assert_array_equal(nb.load(out_path).get_data(),
+                                  nb.load(worker_path).get_data())
+
+
+def test_predict_volumes_batched_masks(tmpdir):
+
+    # the model is built in training mode; in batches, its batch
+    # normalization uses the statistics of the training, as in evaluation
+    # mode, so the masks differ from the ones predicted one block at a time
+    t1_file = write_t1(str(tmpdir.join('t1.nii.gz')), (40, 48, 36))
+
+    masks = {}
+    for batch_size, training in [(1, True), (4, True), (1, False)]:
+        model = unet_model()
+        if training:
+            model.train()
+        out_dir = str(tmpdir.join('{0}_{1}'.format(batch_size, training)))
+        os.makedirs(out_dir)
+        out_path = predict_volumes(model, cimg_in=t1_file,
+                                   nii_outdir=out_dir, rescale_dim=48,
+                                   batch_size=batch_size)
+        masks[batch_size, training] = nb.load(out_path).get_data()
+
+    assert (masks[4, True] != masks[1, True]).any()
+    np.testing.assert_array_equal(masks[4, True], masks[1, False])
@@ -1,45 +1,74 @@
-import extract_data_multiscan
-import create_fsl_model
-import extract_parameters
-import build_data_config
-from .interfaces import function, masktool
-from .extract_data import run
-from .datasource import create_anat_datasource
-from .datasource import create_func_datasource
-from .datasource import create_fmap_datasource
-from .datasource import create_roi_mask_dataflow
-from .datasource import create_grp_analysis_dataflow
-from .datasource import create_spatial_map_dataflow
-from .configuration import Configuration
-from .strategy import Strategy
-from .outputs import Outputs
-from CPAC.func_preproc.utils import add_afni_prefix
-from .utils import (
-    get_zscore,
-    get_fisher_zscore,
-    compute_fisher_z_score,
-    get_operand_string,
-    get_roi_num_list,
-    safe_shape,
-    extract_one_d,
-    extract_txt,
-    zscore,
-    correlation,
-    check,
-    check_random_state,
-    try_fetch_parameter,
-    get_scan_params,
-    get_tr,
-    check_tr,
-    find_files,
-    extract_output_mean,
-    create_output_mean_csv,
-    pick_wm,
-    check_command_path,
-    check_system_deps,
-    check_config_resources,
-)
+"""
+C-PAC utilities.
+
+The utilities are imported the first time they are accessed, so importing
+one of them does not import the whole scientific stack.
+"""
+
+from .lazy_import import lazy_module, lazy_attributes
+
+_attributes = {
+    'extract_data_multiscan': ('CPAC.utils.extract_data_multiscan', None),
+    'create_fsl_model': ('CPAC.utils.create_fsl_model', None),
+    'extract_parameters': ('CPAC.utils.extract_parameters', None),
+    'build_data_config': ('CPAC.utils.build_data_config', None),
+    'function': ('CPAC.utils.interfaces.function', None),
+    'masktool': ('CPAC.utils.interfaces.masktool', None),
+    'run': ('CPAC.utils.extract_data', 'run'),
+    'add_afni_prefix': ('CPAC.func_preproc.utils', 'add_afni_prefix'),
+}
+
+_attributes.update(lazy_attributes('CPAC.utils.datasource', [
+    'create_anat_datasource',
+    'create_func_datasource',
+    'create_fmap_datasource',
+    'create_roi_mask_dataflow',
+    'create_grp_analysis_dataflow',
+    'create_spatial_map_dataflow',
+]))
+
+_attributes.update(lazy_attributes('CPAC.utils.configuration', [
+    'Configuration',
+]))
+
+_attributes.update(lazy_attributes('CPAC.utils.strategy', [
+    'Strategy',
+]))
+
+_attributes.update(lazy_attributes('CPAC.utils.outputs', [
+    'Outputs',
+]))
+
+_attributes.update(lazy_attributes('CPAC.utils.utils', [
+    'get_zscore',
+    'get_fisher_zscore',
+    'compute_fisher_z_score',
+    'get_operand_string',
+    'get_roi_num_list',
+    'safe_shape',
+    'slab_dataobj',
+    'extract_one_d',
+    'extract_txt',
+    'zscore',
+    'correlation',
+    'check',
+    'check_random_state',
+    'try_fetch_parameter',
+    'get_scan_params',
+    'get_tr',
+    'check_tr',
+    'find_files',
+    'extract_output_mean',
+    'create_output_mean_csv',
+    'pick_wm',
+    'check_command_path',
+    'check_system_deps',
+    'check_config_resources',
+    'workflow_resource_demand',
+]))
 
 __all__ = [
     'function'
 ]
+
+lazy_module(__name__, _attributes)
@@ -310,7 +310,8 @@ def gen_bids_outputs_sublist(base_path, paths_list, key_list, creds_path):
     return sublist
 
 
-def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=False):
+def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=False,
+                          scan_params=None):
     """
     Generates a CPAC formatted subject list from information contained in a
     BIDS formatted set of data.
@@ -329,6 +330,9 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
        to None
     :param dbg: boolean indicating whether or not the debug statements should
        be printed
+    :param scan_params: dictionary that maps the paths in paths_list to
+       their parameters, already resolved from the json sidecars (see
+       collect_bids_files_params), used instead of config_dict
     :return: a list of dictionaries suitable for use by CPAC to specify data
        to be processed
     """
@@ -341,10 +345,12 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
         print( "  creds_path: {0}".format(creds_path))
 
     # if configuration information is not desired, config_dict will be empty,
-    # otherwise parse the information in the sidecar json files into a dict
-    # we can use to extract data for our nifti files
-    if config_dict:
-        bids_config_dict = bids_parse_sidecar(config_dict)
+    # otherwise resolve the parameters of our nifti files from the sidecar
+    # json files, the same way as for the layout index of a local directory
+    if config_dict and scan_params is None:
+        scan_params = bids_scan_params(paths_list, config_dict)
+
+    with_params = scan_params is not None
 
     subdict = {}
 
@@ -356,9 +362,8 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
 
             f_dict = bids_decode_fname(p)
 
-            if config_dict:
-                t_params = bids_retrieve_params(bids_config_dict,
-                                                f_dict)
+            if with_params:
+                t_params = scan_params.get(p, {})
                 if not t_params:
                     print f_dict
                     print("Did not receive any parameters for %s," % (p) +
@@ -403,7 +408,7 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
                 # TODO deal with scan parameters anatomical
                 elif "anat" not in subdict[f_dict["sub"]][f_dict["ses"]]:
                     subdict[f_dict["sub"]][f_dict["ses"]]["anat"] = \
-                        task_info["scan"] if config_dict else task_info
+                        task_info["scan"] if with_params else task_info
                 else:
                     print("Anatomical file (%s) already found" %
                           (subdict[f_dict["sub"]][f_dict["ses"]]["anat"]) +
@@ -522,6 +527,354 @@ def collect_bids_files_configs(bids_dir, aws_input_creds=''):
     return file_paths, config_dict
 
 
+BIDS_INDEX_VERSION = 1
+
+# the scan types kept in the BIDS layout index
+BIDS_INDEX_SUFFIXES = ['T1w', 'bold', 'epi', 'phasediff', 'phase1', 'phase2',
+                       'magnitude', 'fieldmap', 'dwi']
+
+
+def bids_index_path(bids_dir, cache_dir=None):
+    """
+    Returns the path of the layout index of a BIDS directory.
+
+    :param bids_dir: local BIDS directory
+    :param cache_dir: directory holding the layout indices, named after
+      the path of each BIDS directory. If None, the index is stored in the
+      current working directory (never in or beside the BIDS directory,
+      which may be read-only or shared)
+    :return: path of the layout index
+    """
+    import hashlib
+
+    bids_dir = os.path.realpath(bids_dir)
+
+    if not cache_dir:
+        cache_dir = os.getcwd()
+
+    return os.path.join(cache_dir, "bids_index_{0}.json".format(
+        hashlib.sha1(bids_dir).hexdigest()[:16]))
+
+
+def bids_inherit_params(sidecars, file_path, f_dict):
+    """
+    Resolves the parameters of a BIDS file following the inheritance
+    principle: the sidecar json files of the same scan type, in the
+    directory of the file or in any of its parent directories, and whose
+    entities are all entities of the file, apply to it. The sidecar files
+    deeper in the tree, and then the ones with more entities, override the
+    others.
+
+    :param sidecars: dictionary that maps directories, relative to the BIDS
+      directory, to the (f_dict, contents) pairs of their sidecar json files
+    :param file_path: path of the file, relative to the BIDS directory
+    :param f_dict: dictionary built from the name of the file, see
+      bids_decode_fname
+    :return: returns a dictionary that contains the BIDS parameters
+    """
+
+    directory = os.path.dirname(file_path)
+    levels = directory.split('/') if directory else []
+
+    applicable = []
+    for depth in range(len(levels) + 1):
+        for s_dict, contents in sidecars.get('/'.join(levels[:depth]), []):
+            if s_dict["scantype"] != f_dict["scantype"]:
+                continue
+            entities = [k for k in s_dict if k not in ("site", "scantype")]
+            if all(f_dict.get(k) == s_dict[k] for k in entities):
+                applicable.append((depth, len(entities), contents))
+
+    params = {}
+    for _, _, contents in sorted(applicable, key=lambda a: a[:2]):
+        params.update(contents)
+
+    for k, v in params.items():
+        if isinstance(v, unicode):
+            params[k] = v.encode('ascii', errors='ignore')
+
+    return params
+
+
+def bids_add_sidecar(sidecars, path, contents):
+    """
+    Adds a sidecar json file to the sidecar files of its directory, to be
+    used by bids_inherit_params.
+
+    :param sidecars: dictionary that maps directories, relative to the BIDS
+      directory, to the (f_dict, contents) pairs of their sidecar json files
+    :param path: path of the sidecar json file, relative to the BIDS
+      directory
+    :param contents: contents of the sidecar json file
+    """
+
+    if isinstance(contents, list):
+        contents = contents[0]
+    try:
+        s_dict = bids_decode_fname(path)
+    except (KeyError, ValueError) as e:
+        print("Could not decode the BIDS entities of %s (%s), its "
+              "parameters are not used" % (path, e))
+    else:
+        sidecars.setdefault(os.path.dirname(path), []).append(
+            (s_dict, contents)
+        )
+
+
+def bids_scan_params(paths_list, config_dict):
+    """
+    Resolves the parameters of BIDS files from the contents of the sidecar
+    json files, following the inheritance principle (see
+    bids_inherit_params).
+
+    :param paths_list: paths of the image files, relative to the BIDS
+      directory
+    :param config_dict: dictionary that maps the paths of the sidecar json
+      files, relative to the BIDS directory, to their contents (see
+      collect_bids_files_configs)
+    :return: a dictionary of the parameters of the image files, keyed by
+      path, to pass to bids_gen_cpac_sublist
+    """
+
+    sidecars = {}
+    for path in sorted(config_dict):
+        bids_add_sidecar(sidecars, path, config_dict[path])
+
+    scan_params = {}
+    for path in paths_list:
+        path = path.rstrip()
+        try:
+            f_dict = bids_decode_fname(path)
+        except (KeyError, ValueError):
+            continue
+        scan_params[path] = bids_inherit_params(sidecars, path, f_dict)
+
+    return scan_params
+
+
+def build_bids_layout_index(bids_dir, suffixes=None):
+    """
+    Walks a local BIDS directory and indexes its image files, with the BIDS
+    entities decoded from their names and their parameters, resolved from
+    the sidecar json files following the inheritance principle (see
+    bids_inherit_params). The derivatives directory is left out, so that
+    writing derivatives does not invalidate the index.
+
+    :param bids_dir: local BIDS directory
+    :param suffixes: scan types to index, defaults to BIDS_INDEX_SUFFIXES
+    :return: the layout index, a dictionary with the modification times of
+      the directories and sidecar json files it was built from ("directories"
+      and "sidecars"), and the entities and parameters of each image file
+      ("files"), keyed by paths relative to bids_dir
+    """
+
+    if suffixes is None:
+        suffixes = BIDS_INDEX_SUFFIXES
+
+    bids_dir = os.path.realpath(bids_dir)
+
+    directories = {}
+    sidecars = {}
+    dir_sidecars = {}
+    image_paths = []
+
+    for root, dirs, files in os.walk(bids_dir):
+        rel_root = root.replace(bids_dir, '', 1).lstrip('/')
+        directories[rel_root] = os.stat(root).st_mtime
+        if not rel_root:
+            dirs[:] = [d for d in dirs if d != 'derivatives']
+
+        for f in files:
+            if not any(suffix in f for suffix in suffixes):
+                continue
+            if 'nii' in f:
+                image_paths.append(os.path.join(rel_root, f))
+            elif f.endswith('json'):
+                with open(os.path.join(root, f), 'r') as json_file:
+                    bids_add_sidecar(dir_sidecars, os.path.join(rel_root, f),
+                                     json.load(json_file))
+                sidecars[os.path.join(rel_root, f)] = \
+                    os.stat(os.path.join(root, f)).st_mtime
+
+    index_files = {}
+    for path in image_paths:
+        try:
+            f_dict = bids_decode_fname(path)
+        except (KeyError, ValueError) as e:
+            print("Could not decode the BIDS entities of %s (%s), it is "
+                  "left out of the layout index" % (path, e))
+            continue
+
+        index_files[path] = {
+            "entities": f_dict,
+            "params": bids_inherit_params(dir_sidecars, path, f_dict)
+        }
+
+    return {"version": BIDS_INDEX_VERSION,
+            "bids_dir": bids_dir,
+            "suffixes": sorted(suffixes),
+            "directories": directories,
+            "sidecars": sidecars,
+            "files": index_files}
+
+
+def load_bids_layout_index(index_path, bids_dir, suffixes=None):
+    """
+    Loads the layout index of a BIDS directory, if it is still valid: none
+    of the directories and sidecar json files it was built from have been
+    modified since (adding or removing a file changes the modification time
+    of its directory).
+
+    :param index_path: path of the layout index
+    :param bids_dir: local BIDS directory
+    :param suffixes: scan types the index should hold, defaults to
+      BIDS_INDEX_SUFFIXES
+    :return: the layout index, or None if it is missing or out of date
+    """
+
+    if suffixes is None:
+        suffixes = BIDS_INDEX_SUFFIXES
+
+    bids_dir = os.path.realpath(bids_dir)
+
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return None
+
+    if index.get("version") != BIDS_INDEX_VERSION or \
+            index.get("bids_dir") != bids_dir or \
+            index.get("suffixes") != sorted(suffixes):
+        return None
+
+    for mtimes in (index["directories"], index["sidecars"]):
+        for path, mtime in mtimes.items():
+            try:
+                if os.stat(os.path.join(bids_dir, path)).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+
+    # json gives back unicode strings, where the paths and entities were
+    # str, and the parameters are converted as in bids_retrieve_params
+    index_files = {}
+    for path, entry in index["files"].items():
+        params = entry["params"]
+        for k, v in params.items():
+            if isinstance(v, unicode):
+                params[k] = v.encode('ascii', errors='ignore')
+        index_files[str(path)] = {
+            "entities": dict((str(k), str(v))
+                             for k, v in entry["entities"].items()),
+            "params": params
+        }
+    index["files"] = index_files
+
+    return index
+
+
+def bids_layout_index(bids_dir, cache_dir=None, suffixes=None, dbg=False):
+    """
+    Returns the layout index of a local BIDS directory, from the index
+    stored by a previous call if the directory has not changed since,
+    otherwise by walking the directory and storing the new index.
+
+    :param bids_dir: local BIDS directory
+    :param cache_dir: directory holding the layout indices, if None the
+      index is stored in the current working directory
+    :param suffixes: scan types to index, defaults to BIDS_INDEX_SUFFIXES
+    :param dbg: boolean flag that indicates whether or not debug statements
+      should be printed
+    :return: the layout index, see build_bids_layout_index
+    """
+
+    index_path = bids_index_path(bids_dir, cache_dir)
+
+    index = load_bids_layout_index(index_path, bids_dir, suffixes)
+    if index is not None:
+        if dbg:
+            print("Loaded the BIDS layout index %s" % index_path)
+        return index
+
+    index = build_bids_layout_index(bids_dir, suffixes)
+
+    # write to a temporary file first, so that concurrent launches never
+    # read a partial index
+    try:
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp_path = "{0}.{1}".format(index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.rename(tmp_path, index_path)
+    except (IOError, OSError) as e:
+        print("Could not store the BIDS layout index (%s), the directory "
+              "will be indexed again next time" % e)
+
+    return index
+
+
+def query_bids_layout(layout_index, **entities):
+    """
+    Returns the image files of a layout index with the given BIDS entities,
+    e.g. query_bids_layout(index, sub='0001', scantype='bold').
+
+    :param layout_index: layout index, see bids_layout_index
+    :param entities: BIDS entities (sub, ses, task, acq, run, dir, site or
+      scantype) and their value, or a list of accepted values
+    :return: sorted list of the paths of the matching files, relative to the
+      BIDS directory
+    """
+
+    for key, value in entities.items():
+        if not isinstance(value, (list, tuple, set)):
+            entities[key] = [value]
+
+    return sorted(
+        path for path, entry in layout_index["files"].items()
+        if all(entry["entities"].get(key) in values
+               for key, values in entities.items())
+    )
+
+
+def collect_bids_files_params(bids_dir, cache_dir=None, suffixes=None):
+    """
+    Same as collect_bids_files_configs for a local BIDS directory, from its
+    layout index, with the parameters of each image file already resolved.
+
+    :param bids_dir: local BIDS directory
+    :param cache_dir: directory holding the layout indices, if None the
+      index is stored in the current working directory
+    :param suffixes: scan types of the image files to return, defaults to
+      T1w and bold
+    :return: the paths of the image files, relative to bids_dir, and a
+      dictionary of their parameters keyed by path, to pass to
+      bids_gen_cpac_sublist
+    """
+
+    if suffixes is None:
+        suffixes = ['T1w', 'bold']
+
+    index = bids_layout_index(bids_dir, cache_dir)
+
+    file_paths = [
+        path for path in sorted(index["files"])
+        if any(suffix in os.path.basename(path) for suffix in suffixes)
+    ]
+
+    if not file_paths and not index["sidecars"]:
+        raise IOError("Didn't find any files in {0}. Please verify that the "
+                      "path is typed correctly, that you have read access to "
+                      "the directory, and that it is not "
+                      "empty.".format(bids_dir))
+
+    scan_params = dict((path, index["files"][path]["params"])
+                       for path in file_paths)
+
+    return file_paths, scan_params
+
+
 def test_gen_bids_sublist(bids_dir, test_yml, creds_path, dbg=False):
 
     (img_files, config) = collect_bids_files_configs(bids_dir, creds_path)
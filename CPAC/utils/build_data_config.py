@@ -499,10 +499,143 @@ def format_incl_excl_dct(incl_list, info_type='participants'):
     return incl_dct
 
 
+def template_glob(template):
+    """Return a file path template with its {site}, {participant},
+    {session} and {scan} keywords replaced by wildcards."""
+
+    for keyword in ['{site}', '{participant}', '{session}', '{scan}']:
+        template = template.replace(keyword, '*')
+
+    return template
+
+
+def compile_globs(globs):
+    """Compile shell-style file path patterns into a single regular
+    expression matching any of them, with the semantics of fnmatch (where
+    wildcards also match across directories)."""
+
+    import re
+    import fnmatch
+
+    return re.compile('|'.join(
+        '(?:{0})'.format(fnmatch.translate(glob_str)) for glob_str in globs
+    ))
+
+
+def _glob_segment(segment):
+    # compiles one path segment of a glob pattern, returning the regular
+    # expression and whether hidden names are skipped, as glob.glob does
+    # when the segment has wildcards that do not start with a dot
+    import re
+    import fnmatch
+
+    magic = re.search('[*?[]', segment) is not None
+    skip_hidden = magic and not segment.startswith('.')
+
+    return re.compile(fnmatch.translate(segment)), skip_hidden
+
+
+def _list_directory(directory):
+    import os
+
+    try:
+        return sorted(os.listdir(directory or os.curdir))
+    except OSError:
+        return []
+
+
+def scan_template_paths(globs, processes=1):
+    """Find the local file paths matching glob patterns, in a single walk
+    of the file system shared by all of the patterns.
+
+    The patterns are matched one directory level at a time, the way
+    glob.glob does, so that only the directories which can lead to a match
+    are listed. Each directory is listed once, whatever the number of
+    patterns going through it, and the directories of a level can be listed
+    by a pool of `processes` threads (which helps on network file systems).
+
+    Parameters
+    ----------
+    globs : dict
+        Glob patterns, keyed by name. Empty and AWS S3 patterns are skipped.
+    processes : int
+        Number of threads listing directories.
+
+    Returns
+    -------
+    pools : dict
+        Sorted lists of the matching paths, keyed by pattern name.
+    """
+
+    import re
+    from multiprocessing.pool import ThreadPool
+
+    pools = {}
+    segments = {}
+    frontier = {}
+
+    for name, glob_str in globs.items():
+        pools[name] = set()
+        if not glob_str or 's3://' in glob_str:
+            continue
+
+        root = '/' if glob_str.startswith('/') else ''
+        parts = [part for part in glob_str.split('/') if part]
+        if not parts:
+            continue
+
+        # the leading directories without wildcards are not listed
+        fixed = 0
+        while fixed < len(parts) - 1 and \
+                re.search('[*?[]', parts[fixed]) is None:
+            fixed += 1
+
+        directory = root + '/'.join(parts[:fixed])
+        segments[name] = [_glob_segment(part) for part in parts]
+        frontier.setdefault(directory, []).append((name, fixed))
+
+    pool = ThreadPool(processes) if processes > 1 else None
+
+    try:
+        while frontier:
+            directories = sorted(frontier)
+            if pool:
+                listings = pool.map(_list_directory, directories)
+            else:
+                listings = [_list_directory(d) for d in directories]
+
+            next_frontier = {}
+            for directory, entries in zip(directories, listings):
+                states = frontier[directory]
+                for entry in entries:
+                    path = directory + entry if directory.endswith('/') \
+                        or not directory else directory + '/' + entry
+                    for name, depth in states:
+                        regex, skip_hidden = segments[name][depth]
+                        if skip_hidden and entry.startswith('.'):
+                            continue
+                        if not regex.match(entry):
+                            continue
+                        if depth == len(segments[name]) - 1:
+                            pools[name].add(path)
+                        else:
+                            next_frontier.setdefault(path, []).append(
+                                (name, depth + 1)
+                            )
+
+            frontier = next_frontier
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    return dict((name, sorted(paths)) for name, paths in pools.items())
+
+
 def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
                       aws_creds_path=None, brain_mask_template=None,
                       inclusion_dct=None, exclusion_dct=None,
-                      config_dir=None):
+                      config_dir=None, processes=1):
     """Return a data dictionary mapping input file paths to participant,
     session, scan, and site IDs (where applicable) for a BIDS-formatted data
     directory.
@@ -514,11 +647,14 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
           specification is still in flux regarding how to handle anatomical
           derivatives. Thus, we allow users to modify what the expected BIDS
           layout is for their anatomical brain masks.
+
+    The participants.tsv and JSON sidecar files are found in a single pass
+    over the file list, or a single walk of the BIDS directory (listing
+    directories with a pool of `processes` threads).
     """
 
     import os
     import re
-    import glob
 
     if not config_dir:
         config_dir = os.getcwd()
@@ -614,21 +750,28 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
     jsons = []
 
     if file_list:
-        import fnmatch
+        site_dir_regex = compile_globs([site_dir_glob])
+        sess_regex = compile_globs([sess_glob])
+        fmap_phase_scan_regex = compile_globs([fmap_phase_scan_glob])
+        fmap_mag_scan_regex = compile_globs([fmap_mag_scan_glob])
+        part_tsv_regex = compile_globs([part_tsv_glob])
+        site_json_regex = compile_globs(site_json_globs)
+        json_regex = compile_globs(json_globs)
 
         for filepath in file_list:
-            if fnmatch.fnmatch(filepath, site_dir_glob) and \
+            if site_dir_regex.match(filepath) and \
                     "derivatives" not in filepath:
                 # check if there is a directory level encoding site ID, even
                 # though that is not BIDS format
                 site_dir = True
                 sess_glob = os.path.join(bids_base_dir, "*", "sub-*/ses-*/*")
+                sess_regex = compile_globs([sess_glob])
 
-            if fnmatch.fnmatch(filepath, sess_glob):
+            if sess_regex.match(filepath):
                 # check if there is a session level
                 ses = True
 
-            if fnmatch.fnmatch(filepath, fmap_phase_scan_glob):
+            if fmap_phase_scan_regex.match(filepath):
                 # check if there is a scan level for the fmap phase files
                 fmap_phase_sess = os.path.join(bids_base_dir,
                                                "sub-{participant}/ses-{session}/fmap/"
@@ -638,7 +781,7 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
                                           "sub-{participant}/fmap/sub-{participant}"
                                           "task-{scan}_phasediff.nii.gz")
 
-            if fnmatch.fnmatch(filepath, fmap_mag_scan_glob):
+            if fmap_mag_scan_regex.match(filepath):
                 # check if there is a scan level for the fmap magnitude files
                 fmap_mag_sess = os.path.join(bids_base_dir,
                                              "sub-{participant}/ses-{session}/fmap/"
@@ -658,41 +801,51 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
                                         "task-{scan}_magnitud*.nii.gz")
             '''
 
-            if fnmatch.fnmatch(filepath, part_tsv_glob):
+            if part_tsv_regex.match(filepath):
                 # check if there is a participants.tsv file
                 part_tsv = filepath
 
-            for glob_str in site_json_globs:
-                if fnmatch.fnmatch(filepath, glob_str):
-                    site_dir = True
-                    site_jsons.append(filepath)
+            if site_json_regex.match(filepath):
+                site_dir = True
+                site_jsons.append(filepath)
 
-            for glob_str in json_globs:
-                if fnmatch.fnmatch(filepath, glob_str):
-                    jsons.append(filepath)
+            if json_regex.match(filepath):
+                jsons.append(filepath)
 
     else:
-        if len(glob.glob(site_dir_glob)) > 0:
+        site_sess_glob = os.path.join(bids_base_dir, "*", "sub-*/ses-*/*")
+
+        globs = {'site_dir': site_dir_glob,
+                 'sess': sess_glob,
+                 'site_sess': site_sess_glob,
+                 'part_tsv': part_tsv_glob}
+        for idx, glob_str in enumerate(site_json_globs):
+            globs['site_json_{0}'.format(idx)] = glob_str
+        for idx, glob_str in enumerate(json_globs):
+            globs['json_{0}'.format(idx)] = glob_str
+
+        pools = scan_template_paths(globs, processes)
+
+        if len(pools['site_dir']) > 0:
             # check if there is a directory level encoding site ID, even
             # though that is not BIDS format
             site_dir = True
-            sess_glob = os.path.join(bids_base_dir, "*", "sub-*/ses-*/*")
+            sess_glob = site_sess_glob
 
         ses = False
-        if len(glob.glob(sess_glob)) > 0:
+        if len(pools['site_sess' if site_dir else 'sess']) > 0:
             # check if there is a session level
             ses = True
 
         # check if there is a participants.tsv file
-        part_tsv_finds = glob.glob(part_tsv_glob)
-        if part_tsv_finds:
-            part_tsv = part_tsv_finds[0]
+        if pools['part_tsv']:
+            part_tsv = pools['part_tsv'][0]
 
-        for glob_str in site_json_globs:
-            site_jsons = site_jsons + glob.glob(glob_str)
+        for idx in range(len(site_json_globs)):
+            site_jsons = site_jsons + pools['site_json_{0}'.format(idx)]
 
-        for glob_str in json_globs:
-            jsons = jsons + glob.glob(glob_str)
+        for idx in range(len(json_globs)):
+            jsons = jsons + pools['json_{0}'.format(idx)]
 
     sites_dct = {}
     sites_subs_dct = {}
@@ -888,6 +1041,8 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
 
             # scan_id can now be something like {All}_run-2, change other code
 
+    # a file list is the listing of the whole BIDS directory, which is not
+    # walked again
     if ses:
         # if there is a session level in the BIDS dataset
         data_dct = get_nonBIDS_data(anat_sess, func_sess, file_list=file_list,
@@ -900,7 +1055,9 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
                                     aws_creds_path=aws_creds_path,
                                     inclusion_dct=inclusion_dct,
                                     exclusion_dct=exclusion_dct,
-                                    sites_dct=sites_subs_dct)
+                                    sites_dct=sites_subs_dct,
+                                    processes=processes,
+                                    walk=not file_list)
     else:
         # no session level
         data_dct = get_nonBIDS_data(anat, func, file_list=file_list,
@@ -913,7 +1070,9 @@ def get_BIDS_data_dct(bids_base_dir, file_list=None, anat_scan=None,
                                     aws_creds_path=aws_creds_path,
                                     inclusion_dct=inclusion_dct,
                                     exclusion_dct=exclusion_dct,
-                                    sites_dct=sites_subs_dct)
+                                    sites_dct=sites_subs_dct,
+                                    processes=processes,
+                                    walk=not file_list)
 
     return data_dct
 
@@ -1374,12 +1533,15 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
                      brain_mask_template=None, fmap_phase_template=None,
                      fmap_mag_template=None, fmap_pedir_template=None,
                      aws_creds_path=None, inclusion_dct=None,
-                     exclusion_dct=None, sites_dct=None, verbose=False):
+                     exclusion_dct=None, sites_dct=None, verbose=False,
+                     processes=1, walk=True):
     """Prepare a data dictionary for the data configuration file when given
-    file path templates describing the input data directories."""
+    file path templates describing the input data directories.
 
-    import glob
-    import fnmatch
+    The paths matching the templates are gathered in a single pass over
+    the file list, and a single walk of the local file system (listing
+    directories with a pool of `processes` threads) unless `walk` is False
+    and the file list is the listing of the whole data set."""
 
     if not func_template:
         func_template = ''
@@ -1395,8 +1557,6 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
               "functional path template.\n"
         raise Exception(err)
 
-    keywords = ['{site}', '{participant}', '{session}', '{scan}']
-
     # make globby templates, to use them to filter down the path_list into
     # only paths that will work with the templates
     anat_glob = anat_template
@@ -1423,35 +1583,85 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
         if "None" in anat_scan or "none" in anat_scan:
             anat_scan = None
 
+    # backwards compatibility
+    if fmap_phase_template and '{series}' in fmap_phase_template:
+        fmap_phase_template = fmap_phase_template.replace('{series}', '{scan}')
+    if fmap_mag_template and '{series}' in fmap_mag_template:
+        fmap_mag_template = fmap_mag_template.replace('{series}', '{scan}')
+
     # replace the keywords with wildcards
-    for keyword in keywords:
-        if keyword in anat_glob:
-            anat_glob = anat_glob.replace(keyword, '*')
-        if keyword in func_glob:
-            func_glob = func_glob.replace(keyword, '*')
+    anat_glob = template_glob(anat_glob)
+    func_glob = template_glob(func_glob)
+
+    # the field map files are used only if both of them are provided
+    if not (fmap_phase_template and fmap_mag_template):
+        fmap_phase_template = fmap_mag_template = None
+
+    # make globby templates of the other files too, to use them to filter
+    # down the path_list into only paths that will work with the templates
+    other_globs = {}
+    for data_type, template in [('brain_mask', brain_mask_template),
+                                ('fmap_phase', fmap_phase_template),
+                                ('fmap_mag', fmap_mag_template),
+                                ('fmap_pedir', fmap_pedir_template)]:
+        if template:
+            other_globs[data_type] = template_glob(template)
 
     # presumably, the paths contained in each of these pools should be anat
     # and func files only, respectively, if the templates were set up properly
     anat_pool = []
     func_pool = []
+    other_pools = dict((data_type, []) for data_type in other_globs)
 
     if file_list:
         # mainly for AWS S3-stored data sets
+        anat_regex = compile_globs([anat_glob])
+        func_regex = compile_globs([func_glob])
+        other_regexes = dict((data_type, compile_globs([glob_str]))
+                             for data_type, glob_str in other_globs.items())
+
         for filepath in file_list:
-            if fnmatch.fnmatch(filepath, anat_glob):
+            if anat_regex.match(filepath):
                 anat_pool.append(filepath)
-            elif fnmatch.fnmatch(filepath, func_glob):
+            elif func_regex.match(filepath):
                 func_pool.append(filepath)
 
+            if 'brain_mask' in other_regexes and \
+                    other_regexes['brain_mask'].match(filepath):
+                other_pools['brain_mask'].append(filepath)
+
+            if 'fmap_phase' in other_regexes and \
+                    other_regexes['fmap_phase'].match(filepath):
+                other_pools['fmap_phase'].append(filepath)
+            elif 'fmap_mag' in other_regexes and \
+                    other_regexes['fmap_mag'].match(filepath):
+                other_pools['fmap_mag'].append(filepath)
+
+            if 'fmap_pedir' in other_regexes and \
+                    other_regexes['fmap_pedir'].match(filepath):
+                other_pools['fmap_pedir'].append(filepath)
+
     # run it anyway in case we're pulling anat from S3 and func from local or
-    # vice versa - and if there is no file_list, this will run normally
-    anat_local_pool = glob.glob(anat_glob)
-    func_local_pool = glob.glob(func_glob)
+    # vice versa - and if there is no file_list, this will run normally;
+    # unless the file list is the listing of the whole data set
+    local_globs = {}
+    if walk or not file_list:
+        local_globs = {'anat': anat_glob, 'func': func_glob}
+    if not file_list:
+        local_globs.update(other_globs)
+    local_pools = scan_template_paths(local_globs, processes)
 
     # anat_pool and func_pool are now lists with (presumably) all of the file
     # paths that match the templates entered
-    anat_pool = anat_pool + [x for x in anat_local_pool if x not in anat_pool]
-    func_pool = func_pool + [x for x in func_local_pool if x not in func_pool]
+    anat_paths = set(anat_pool)
+    anat_pool += [x for x in local_pools.get('anat', [])
+                  if x not in anat_paths]
+    func_paths = set(func_pool)
+    func_pool += [x for x in local_pools.get('func', [])
+                  if x not in func_paths]
+    if not file_list:
+        for data_type in other_pools:
+            other_pools[data_type] = local_pools[data_type]
 
     if not anat_pool:
         err = "\n\n[!] No anatomical input file paths found given the data " \
@@ -1524,26 +1734,7 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
                                    aws_creds_path)
 
     if brain_mask_template:
-        # make globby templates, to use them to filter down the path_list into
-        # only paths that will work with the templates
-        brain_mask_glob = brain_mask_template
-
-        for keyword in keywords:
-            if keyword in brain_mask_glob:
-                brain_mask_glob = brain_mask_glob.replace(keyword, '*')
-
-        # presumably, the paths contained in each of these pools should be
-        # field map files only, if the templates were set up properly
-        if file_list:
-            # mainly for AWS S3-stored data sets
-            brain_mask_pool = []
-            for filepath in file_list:
-                if fnmatch.fnmatch(filepath, brain_mask_glob):
-                    brain_mask_pool.append(filepath)
-        else:
-            brain_mask_pool = glob.glob(brain_mask_glob)
-
-        for brain_mask in brain_mask_pool:
+        for brain_mask in other_pools['brain_mask']:
             data_dct = update_data_dct(brain_mask, brain_mask_template,
                                        data_dct, "brain_mask", None,
                                        sites_dct, scan_params_dct,
@@ -1553,49 +1744,14 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
     # do the same for the fieldmap files, if applicable
     if fmap_phase_template and fmap_mag_template:
         # if we're doing the whole field map distortion correction thing
-
-        # make globby templates, to use them to filter down the path_list into
-        # only paths that will work with the templates
-        fmap_phase_glob = fmap_phase_template
-        fmap_mag_glob = fmap_mag_template
-
-        # backwards compatibility
-        if '{series}' in fmap_phase_glob:
-            fmap_phase_template = fmap_phase_template.replace('{series}', '{scan}')
-            fmap_phase_glob = fmap_phase_glob.replace('{series}', '{scan}')
-        if '{series}' in fmap_mag_glob:
-            fmap_mag_template = fmap_mag_template.replace('{series}', '{scan}')
-            fmap_mag_glob = fmap_mag_glob.replace('{series}', '{scan}')
-
-        for keyword in keywords:
-            if keyword in fmap_phase_glob:
-                fmap_phase_glob = fmap_phase_glob.replace(keyword, '*')
-            if keyword in fmap_mag_glob:
-                fmap_mag_glob = fmap_mag_glob.replace(keyword, '*')
-
-        # presumably, the paths contained in each of these pools should be
-        # field map files only, if the templates were set up properly
-        if file_list:
-            # mainly for AWS S3-stored data sets
-            fmap_phase_pool = []
-            fmap_mag_pool = []
-            for filepath in file_list:
-                if fnmatch.fnmatch(filepath, fmap_phase_glob):
-                    fmap_phase_pool.append(filepath)
-                elif fnmatch.fnmatch(filepath, fmap_mag_glob):
-                    fmap_mag_pool.append(filepath)
-        else:
-            fmap_phase_pool = glob.glob(fmap_phase_glob)
-            fmap_mag_pool = glob.glob(fmap_mag_glob)
-
-        for fmap_phase in fmap_phase_pool:
+        for fmap_phase in other_pools['fmap_phase']:
             data_dct = update_data_dct(fmap_phase, fmap_phase_template,
                                        data_dct, "fmap_phase", None,
                                        sites_dct, scan_params_dct,
                                        inclusion_dct, exclusion_dct,
                                        aws_creds_path)
 
-        for fmap_mag in fmap_mag_pool:
+        for fmap_mag in other_pools['fmap_mag']:
             data_dct = update_data_dct(fmap_mag, fmap_mag_template,
                                        data_dct, "fmap_mag", None,
                                        sites_dct, scan_params_dct,
@@ -1603,29 +1759,10 @@ def get_nonBIDS_data(anat_template, func_template, file_list=None,
                                        aws_creds_path)
 
     if fmap_pedir_template:
-        # make globby templates, to use them to filter down the path_list into
-        # only paths that will work with the templates
-        fmap_pedir_glob = fmap_phase_template
-
-        for keyword in keywords:
-            if keyword in fmap_pedir_glob:
-                fmap_pedir_glob = fmap_pedir_glob.replace(keyword, '*')
-
-        # presumably, the paths contained in each of these pools should be
-        # field map files only, if the templates were set up properly
-        if file_list:
-            # mainly for AWS S3-stored data sets
-            fmap_pedir_pool = []
-            for filepath in file_list:
-                if fnmatch.fnmatch(filepath, fmap_pedir_glob):
-                    fmap_pedir_pool.append(filepath)
-        else:
-            fmap_pedir_pool = glob.glob(fmap_pedir_glob)
-
         #TODO: must now deal with phase encoding direction!!!!
         #TODO: have to check scan params, first!!!
 
-        for fmap_pedir in fmap_pedir_pool:
+        for fmap_pedir in other_pools['fmap_pedir']:
             data_dct = update_data_dct(fmap_pedir, fmap_pedir_template,
                                        data_dct, "fmap_pedir", None,
                                        sites_dct, scan_params_dct,
@@ -1734,6 +1871,9 @@ def run(data_settings_yml):
     excl_dct.update(format_incl_excl_dct(settings_dct.get('exclusionScanList', None),
                                          'scans'))
 
+    # number of threads listing the directories of the data set
+    processes = int(settings_dct.get('numProcesses') or 1)
+
     if 'bids' in settings_dct['dataFormat'].lower():
 
         file_list = get_file_list(settings_dct["bidsBaseDir"],
@@ -1746,7 +1886,8 @@ def run(data_settings_yml):
                                      aws_creds_path=settings_dct['awsCredentialsFile'],
                                      inclusion_dct=incl_dct,
                                      exclusion_dct=excl_dct,
-                                     config_dir=settings_dct["outputSubjectListLocation"])
+                                     config_dir=settings_dct["outputSubjectListLocation"],
+                                     processes=processes)
 
     elif 'custom' in settings_dct['dataFormat'].lower():
 
@@ -1792,7 +1933,8 @@ def run(data_settings_yml):
                                     fmap_mag_template=settings_dct['fieldMapMagnitude'],
                                     aws_creds_path=settings_dct['awsCredentialsFile'],
                                     inclusion_dct=incl_dct,
-                                    exclusion_dct=excl_dct)
+                                    exclusion_dct=excl_dct,
+                                    processes=processes)
 
     else:
         err = "\n\n[!] You must select a data format- either 'BIDS' or " \
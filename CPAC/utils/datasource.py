@@ -417,6 +417,7 @@ def check_for_s3(file_path, creds_path=None, dl_dir=None, img_type='other',
     import botocore.exceptions
 
     from indi_aws import fetch_creds
+    from CPAC.utils.s3_transfer import TransferManager, CACHE_DIR
 
     # Init variables
     s3_str = 's3://'
@@ -462,11 +463,15 @@ def check_for_s3(file_path, creds_path=None, dl_dir=None, img_type='other',
         if os.path.exists(local_path):
             print("{0} already exists- skipping download.".format(local_path))
         else:
-            # Download file
+            # Download file, through the download cache shared by the
+            # participants of the download directory
             try:
                 bucket = fetch_creds.return_bucket(creds_path, bucket_name)
                 print("Attempting to download from AWS S3: {0}".format(file_path))
-                bucket.download_file(Key=s3_key, Filename=local_path)
+                with TransferManager(bucket.meta.client,
+                                     cache_dir=os.path.join(dl_dir, CACHE_DIR)
+                                     ) as manager:
+                    manager.download(bucket_name, s3_key, local_path)
             except botocore.exceptions.ClientError as exc:
                 error_code = int(exc.response['Error']['Code'])
 
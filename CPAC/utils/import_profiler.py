@@ -0,0 +1,146 @@
+import sys
+import time
+import __builtin__
+
+
+def profile_imports(module_name):
+    """
+    Imports a module, timing the import of each module it loads, as
+    python -X importtime does in Python 3.7+.
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the module to import.
+
+    Returns
+    -------
+    imports : list
+        (module name, self time, cumulative time) tuples of the loaded
+        modules, in seconds, in import order. The self time excludes the
+        time spent importing other modules.
+    total : float
+        Time to import the module, in seconds.
+    """
+
+    original_import = __builtin__.__import__
+
+    imports = []
+    # time spent in the nested imports of the imports being timed
+    children = [0.0]
+
+    def loaded(name):
+        return sys.modules.get(name) is not None
+
+    def timed_import(name, globals=None, locals=None, fromlist=None,
+                     level=-1):
+        # implicit relative imports are looked up in the package first
+        candidates = []
+        if level != 0 and globals and globals.get('__name__'):
+            package = globals.get('__package__')
+            if not package:
+                package = globals['__name__']
+                if '__path__' not in globals:
+                    package = package.rpartition('.')[0]
+            for _ in range(max(level - 1, 0)):
+                package = package.rpartition('.')[0]
+            if package:
+                candidates.append(package + '.' + name)
+        if level <= 0:
+            candidates.append(name)
+
+        new = [m for m in candidates if not loaded(m)]
+        if not new:
+            return original_import(name, globals, locals, fromlist, level)
+
+        children.append(0.0)
+        start = time.time()
+        try:
+            return original_import(name, globals, locals, fromlist, level)
+        finally:
+            cumulative = time.time() - start
+            nested = children.pop()
+            children[-1] += cumulative
+
+            new = [m for m in new if loaded(m)]
+            if new:
+                imports.append((new[0], cumulative - nested, cumulative))
+
+    __builtin__.__import__ = timed_import
+    start = time.time()
+    try:
+        __import__(module_name)
+    finally:
+        __builtin__.__import__ = original_import
+    total = time.time() - start
+
+    return imports, total
+
+
+def format_profile(imports, total, top=None):
+    """
+    Formats an import profile as a table, the most expensive imports first.
+
+    Parameters
+    ----------
+    imports : list
+        Import profile, see profile_imports.
+    total : float
+        Total import time, in seconds.
+    top : int, optional
+        Number of imports to list, all by default.
+
+    Returns
+    -------
+    table : str
+        The import profile table.
+    """
+
+    rows = sorted(imports, key=lambda row: row[2], reverse=True)[:top]
+
+    lines = ['{0:>10} | {1:>10} | {2}'.format('self [ms]', 'cumul [ms]',
+                                              'module')]
+    for module, self_time, cumulative in rows:
+        lines.append('{0:>10.1f} | {1:>10.1f} | {2}'.format(
+            self_time * 1000, cumulative * 1000, module))
+    lines.append('{0} modules imported in {1:.1f} ms'.format(
+        len(imports), total * 1000))
+
+    return '\n'.join(lines)
+
+
+def run_profile(module_name, top=None):
+    """
+    Profiles the import of a module in a new interpreter, so the modules it
+    loads are timed from a cold start.
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the module to import.
+    top : int, optional
+        Number of imports to list, all by default.
+
+    Returns
+    -------
+    table : str
+        The import profile table.
+    """
+
+    import os
+    import subprocess
+
+    # this file is loaded on its own, so the CPAC package is not imported
+    # before the profile starts
+    profiler = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+    command = [
+        sys.executable, '-c',
+        'import imp; '
+        'profiler = imp.load_source("import_profiler", {0!r}); '
+        'imports, total = profiler.profile_imports({1!r}); '
+        'print(profiler.format_profile(imports, total, {2!r}))'.format(
+            profiler, module_name, top
+        )
+    ]
+
+    return subprocess.check_output(command).rstrip('\n')
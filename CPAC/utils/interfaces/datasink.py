@@ -375,88 +375,73 @@ class DataSink(IOBase):
 
 
     # Send up to S3 method
-    def _upload_to_s3(self, bucket, src, dst):
+    def _upload_to_s3(self, bucket, uploads):
         '''
-        Method to upload outputs to S3 bucket instead of on local disk
+        Method to upload outputs to S3 bucket instead of on local disk;
+        uploads is a list of (src, dst) tuples, whose files are uploaded
+        concurrently
         '''
 
         # Import packages
-        import hashlib
         import os
 
-        from botocore.exceptions import ClientError
+        from CPAC.utils.s3_transfer import TransferManager
 
         # Init variables
         s3_str = 's3://'
         s3_prefix = s3_str + bucket.name
 
-        # Explicitly lower-case the "s3"
-        if dst[:len(s3_str)].lower() == s3_str:
-            dst = s3_str + dst[len(s3_str):]
-
-        # If src is a directory, collect files (this assumes dst is a dir too)
-        if os.path.isdir(src):
-            src_files = []
-            for root, dirs, files in os.walk(src):
-                src_files.extend([os.path.join(root, fil) for fil in files])
-            # Make the dst files have the dst folder as base dir
-            dst_files = [
-                os.path.join(dst,
-                             src_f.split(src)[1]) for src_f in src_files
-            ]
-        else:
-            src_files = [src]
-            dst_files = [dst]
+        src_files = []
+        dst_keys = []
+        for src, dst in uploads:
+            # Explicitly lower-case the "s3"
+            if dst[:len(s3_str)].lower() == s3_str:
+                dst = s3_str + dst[len(s3_str):]
+
+            # If src is a directory, collect files (this assumes dst is a
+            # dir too)
+            if os.path.isdir(src):
+                files = []
+                for root, dirs, fnames in os.walk(src):
+                    files.extend([os.path.join(root, fil) for fil in fnames])
+                # Make the dst files have the dst folder as base dir
+                dst_files = [
+                    os.path.join(dst, src_f.split(src)[1]) for src_f in files
+                ]
+            else:
+                files = [src]
+                dst_files = [dst]
 
-        # Iterate over src and copy to dst
-        for src_idx, src_f in enumerate(src_files):
+            src_files.extend(files)
             # Get destination filename/keyname
-            dst_f = dst_files[src_idx]
-            dst_k = dst_f.replace(s3_prefix, '').lstrip('/')
-
-            # See if same file is already up there
-            try:
-                dst_obj = bucket.Object(key=dst_k)
-                dst_md5 = dst_obj.e_tag.strip('"')
-
-                # See if same file is already there
-                src_read = open(src_f, 'rb').read()
-                src_md5 = hashlib.md5(src_read).hexdigest()
-                # Move to next loop iteration
-                if dst_md5 == src_md5:
-                    iflogger.info('File %s already exists on S3, skipping...',
-                                  dst_f)
-                    continue
-                else:
-                    iflogger.info('Overwriting previous S3 file...')
-
-            except ClientError:
-                iflogger.info('New file to S3')
+            dst_keys.extend([dst_f.replace(s3_prefix, '').lstrip('/')
+                             for dst_f in dst_files])
 
-            # Copy file up to S3 (either encrypted or not)
-            iflogger.info('Uploading %s to S3 bucket, %s, as %s...', src_f,
-                          bucket.name, dst_f)
-            if self.inputs.encrypt_bucket_keys:
-                extra_args = {'ServerSideEncryption': 'AES256'}
+        # Copy files up to S3 (either encrypted or not)
+        if self.inputs.encrypt_bucket_keys:
+            extra_args = {'ServerSideEncryption': 'AES256'}
+        else:
+            extra_args = {}
+
+        iflogger.info('Uploading %d files to S3 bucket, %s...',
+                      len(src_files), bucket.name)
+
+        with TransferManager(bucket.meta.client, retry=RETRY,
+                             retry_wait=RETRY_WAIT) as manager:
+            uploaded = manager.upload_files(
+                [(src_f, bucket.name, dst_k)
+                 for src_f, dst_k in zip(src_files, dst_keys)],
+                extra_args=extra_args,
+                callback=ProgressPercentage
+            )
+
+        for src_f, dst_k, up in zip(src_files, dst_keys, uploaded):
+            if up:
+                iflogger.info('Uploaded %s to S3 bucket, %s, as %s', src_f,
+                              bucket.name, dst_k)
             else:
-                extra_args = {}
-
-            retry_exc = None
-            for _ in range(RETRY):
-                try:
-                    bucket.upload_file(
-                        src_f,
-                        dst_k,
-                        ExtraArgs=extra_args,
-                        Callback=ProgressPercentage(src_f)
-                    )
-                    break
-                except Exception as exc:
-                    time.sleep(RETRY_WAIT)
-                    retry_exc = exc
-
-            if retry_exc is not None:
-                raise retry_exc
+                iflogger.info('File %s already exists on S3, skipping...',
+                              dst_k)
 
     # List outputs, main run routine
     def _list_outputs(self):
@@ -524,6 +509,9 @@ class DataSink(IOBase):
                     else:
                         raise (inst)
 
+        # Files to upload to S3, all at once
+        s3_uploads = []
+
         # Iterate through outputs attributes {key : path(s)}
         for key, files in list(self.inputs._outputs.items()):
             if not isdefined(files):
@@ -561,7 +549,7 @@ class DataSink(IOBase):
 
                 # If we're uploading to S3
                 if s3_flag:
-                    self._upload_to_s3(bucket, src, s3dst)
+                    s3_uploads.append((src, s3dst))
                     out_files.append(s3dst)
                 # Otherwise, copy locally src -> dst
                 if not s3_flag or isdefined(self.inputs.local_copy):
@@ -593,6 +581,9 @@ class DataSink(IOBase):
                         copytree(src, dst)
                         out_files.append(dst)
 
+        if s3_uploads:
+            self._upload_to_s3(bucket, s3_uploads)
+
         # Return outputs dictionary
         outputs['out_file'] = out_files
 
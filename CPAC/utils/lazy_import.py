@@ -0,0 +1,79 @@
+import sys
+import importlib
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Module whose attributes are imported from other modules the first time
+    they are accessed, so importing a package does not import all of its
+    submodules and their dependencies.
+    """
+
+    def __init__(self, module, attributes):
+        super(LazyModule, self).__init__(module.__name__, module.__doc__)
+        self.__dict__.update(module.__dict__)
+        self.__dict__['_lazy_attributes'] = attributes
+        # the globals of a Python 2 module are cleared when the module
+        # object is deleted
+        self.__dict__['_lazy_module'] = module
+
+    def __getattr__(self, name):
+        try:
+            module_name, attribute = self._lazy_attributes[name]
+        except KeyError:
+            raise AttributeError("'module' object has no attribute "
+                                 "'{0}'".format(name))
+
+        value = importlib.import_module(module_name)
+        if attribute:
+            value = getattr(value, attribute)
+
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(self._lazy_attributes))
+
+
+def lazy_module(name, attributes):
+    """
+    Replaces an imported module by a LazyModule in sys.modules.
+
+    Parameters
+    ----------
+    name : str
+        Name of the module, usually __name__.
+    attributes : dict
+        Lazy attributes of the module, as (module name, attribute name)
+        tuples; an empty attribute name stands for the module itself.
+
+    Returns
+    -------
+    module : LazyModule
+        The lazy module.
+    """
+
+    module = LazyModule(sys.modules[name], attributes)
+    sys.modules[name] = module
+    return module
+
+
+def lazy_attributes(module_name, names):
+    """
+    Returns the lazy attributes of some names defined in a module.
+
+    Parameters
+    ----------
+    module_name : str
+        Name of the module defining the attributes.
+    names : list
+        Names of the attributes.
+
+    Returns
+    -------
+    attributes : dict
+        (module name, attribute name) tuples, by attribute name.
+    """
+
+    return dict((name, (module_name, name)) for name in names)
@@ -0,0 +1,559 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+
+MB = 1024 ** 2
+
+# size of the reads when hashing files, so files are never loaded whole
+CHUNK_SIZE = MB
+
+# multipart settings of the uploads; the ETag of an object uploaded in
+# parts is derived from the part size, see file_etag
+MULTIPART_THRESHOLD = 8 * MB
+MULTIPART_CHUNKSIZE = 8 * MB
+
+# files transferred at once by a TransferManager, and threads used by each
+# multipart transfer
+MAX_CONCURRENCY = 8
+PART_CONCURRENCY = 4
+
+S3_STR = 's3://'
+
+# directory of the download cache, in the download directory
+CACHE_DIR = 's3_cache'
+
+
+def parse_s3_path(path):
+    """
+    Splits an S3 path into its bucket name and key.
+
+    Parameters
+    ----------
+    path : str
+        S3 path, as s3://bucket/key.
+
+    Returns
+    -------
+    bucket_name : str
+        Name of the bucket.
+    key : str
+        Key of the object.
+    """
+
+    bucket_name, _, key = path[len(S3_STR):].partition('/')
+    return bucket_name, key
+
+
+def local_s3_path(path, dl_dir):
+    """
+    Returns the path an S3 file is downloaded to by check_for_s3.
+
+    Parameters
+    ----------
+    path : str
+        S3 path, as s3://bucket/key.
+    dl_dir : str
+        Download directory.
+
+    Returns
+    -------
+    local_path : str
+        Local path of the file, as dl_dir/bucket/key.
+    """
+
+    bucket_name, key = parse_s3_path(path)
+    return os.path.join(dl_dir, bucket_name, key)
+
+
+def file_etag(path, part_size=None):
+    """
+    Computes the ETag S3 gives a file, reading it in chunks.
+
+    The ETag of a file uploaded in a single request is its MD5. The ETag of
+    a file uploaded in parts is the MD5 of the concatenated MD5 digests of
+    its parts, followed by the number of parts.
+
+    Parameters
+    ----------
+    path : str
+        Path of the file.
+    part_size : int, optional
+        Size of the parts of a multipart upload, in bytes; the file is
+        assumed to be uploaded in a single request by default.
+
+    Returns
+    -------
+    etag : str
+        ETag of the file, without quotes.
+    """
+
+    with open(path, 'rb') as f:
+        if not part_size:
+            md5 = hashlib.md5()
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                md5.update(chunk)
+            return md5.hexdigest()
+
+        digests = []
+        while True:
+            md5 = hashlib.md5()
+            remaining = part_size
+            while remaining:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                md5.update(chunk)
+                remaining -= len(chunk)
+            if remaining == part_size:
+                break
+            digests.append(md5.digest())
+
+    return '{0}-{1}'.format(hashlib.md5(b''.join(digests)).hexdigest(),
+                            len(digests))
+
+
+def part_sizes(size, parts):
+    """
+    Returns the likely part sizes of a file uploaded in some parts: the
+    part size of our uploads, then the sizes rounded to a whole number of
+    megabytes and to a byte which split the file in that many parts.
+
+    Parameters
+    ----------
+    size : int
+        Size of the file, in bytes.
+    parts : int
+        Number of parts.
+
+    Returns
+    -------
+    part_sizes : list
+        Candidate part sizes, in bytes.
+    """
+
+    smallest = -(-size // parts)
+    candidates = [
+        MULTIPART_CHUNKSIZE,
+        -(-smallest // MB) * MB,
+        smallest,
+    ]
+
+    sizes = []
+    for part_size in candidates:
+        if part_size > 0 and -(-size // part_size) == parts and \
+                part_size not in sizes:
+            sizes.append(part_size)
+    return sizes
+
+
+def etag_matches(path, etag, size=None):
+    """
+    Checks whether a local file has the content of an S3 object, given the
+    ETag of the object, whether it was uploaded in parts or not.
+
+    Parameters
+    ----------
+    path : str
+        Path of the local file.
+    etag : str
+        ETag of the S3 object, with or without quotes.
+    size : int, optional
+        Size of the S3 object, in bytes, compared before any hashing.
+
+    Returns
+    -------
+    matches : bool
+        Whether the file matches the object.
+    """
+
+    etag = etag.strip('"')
+    file_size = os.path.getsize(path)
+
+    if size is not None and file_size != size:
+        return False
+
+    if '-' not in etag:
+        return file_etag(path) == etag
+
+    try:
+        parts = int(etag.rsplit('-', 1)[1])
+    except ValueError:
+        return False
+
+    for part_size in part_sizes(file_size, parts):
+        if file_etag(path, part_size) == etag:
+            return True
+
+    return False
+
+
+def s3_paths(value):
+    """
+    Collects the S3 paths in a data configuration entry.
+
+    Parameters
+    ----------
+    value : object
+        Data configuration entry, or one of its values.
+
+    Returns
+    -------
+    paths : list
+        S3 paths, in order of appearance.
+    """
+
+    if isinstance(value, basestring):
+        if value.lower().startswith(S3_STR):
+            return [S3_STR + value[len(S3_STR):]]
+        return []
+    if isinstance(value, dict):
+        return [path for key in sorted(value.keys())
+                for path in s3_paths(value[key])]
+    if isinstance(value, (list, tuple)):
+        return [path for item in value for path in s3_paths(item)]
+    return []
+
+
+def _place(src, dst):
+    # hard links keep a single copy of the files shared with the cache
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy(src, dst)
+
+
+def _makedirs(path):
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+
+
+class TransferManager(object):
+    """
+    Transfers files to and from S3 with a bounded pool of threads.
+
+    Uploads are skipped when the object already has the content of the
+    file, comparing sizes then multipart-aware ETags. Downloads are stored
+    in a cache addressed by the ETag of the objects, so an object is
+    downloaded once for all the participants sharing a download directory.
+
+    The manager only uses the thread-safe boto3 client, so a local S3
+    stand-in can be used in its place.
+    """
+
+    def __init__(self, client, max_concurrency=MAX_CONCURRENCY,
+                 cache_dir=None, retry=1, retry_wait=0):
+        """
+        Parameters
+        ----------
+        client : boto3 S3 client
+            Client, e.g. bucket.meta.client.
+        max_concurrency : int, optional
+            Number of files transferred at once.
+        cache_dir : str, optional
+            Directory of the download cache; downloads are not cached by
+            default.
+        retry : int, optional
+            Number of attempts of each transfer.
+        retry_wait : float, optional
+            Seconds to wait between attempts.
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+        from boto3.s3.transfer import TransferConfig
+
+        self.client = client
+        self.cache_dir = cache_dir
+        self.retry = max(retry, 1)
+        self.retry_wait = retry_wait
+        self.config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=PART_CONCURRENCY
+        )
+        self.executor = ThreadPoolExecutor(max(max_concurrency, 1))
+        self._lock = threading.Lock()
+        # threads downloading the same content wait for one download
+        self._cache_locks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def _attempt(self, function, *args, **kwargs):
+        for attempt in range(self.retry):
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                if attempt == self.retry - 1:
+                    raise
+                time.sleep(self.retry_wait)
+
+    def head(self, bucket_name, key):
+        """
+        Returns the metadata of an object, or None if it does not exist.
+        """
+
+        from botocore.exceptions import ClientError
+
+        try:
+            return self.client.head_object(Bucket=bucket_name, Key=key)
+        except ClientError as exc:
+            if str(exc.response['Error']['Code']) in ('404', 'NoSuchKey'):
+                return None
+            raise
+
+    def upload(self, src, bucket_name, key, extra_args=None, callback=None):
+        """
+        Uploads a file, unless the object already has its content.
+
+        Parameters
+        ----------
+        src : str
+            Path of the file.
+        bucket_name : str
+            Name of the bucket.
+        key : str
+            Key of the object.
+        extra_args : dict, optional
+            Extra arguments of the upload, e.g. ServerSideEncryption.
+        callback : callable, optional
+            Called with the number of bytes transferred.
+
+        Returns
+        -------
+        uploaded : bool
+            Whether the file was uploaded.
+        """
+
+        head = self.head(bucket_name, key)
+        if head is not None and \
+                etag_matches(src, head['ETag'], head.get('ContentLength')):
+            return False
+
+        self._attempt(self.client.upload_file, src, bucket_name, key,
+                      ExtraArgs=extra_args or {}, Callback=callback,
+                      Config=self.config)
+        return True
+
+    def download(self, bucket_name, key, local_path):
+        """
+        Downloads an object, through the download cache if there is one.
+
+        Parameters
+        ----------
+        bucket_name : str
+            Name of the bucket.
+        key : str
+            Key of the object.
+        local_path : str
+            Path to download the object to.
+
+        Returns
+        -------
+        local_path : str
+            Path of the downloaded file.
+        """
+
+        _makedirs(os.path.dirname(local_path))
+
+        if not self.cache_dir:
+            self._fetch(bucket_name, key, local_path)
+            return local_path
+
+        from botocore.exceptions import ClientError
+
+        head = self.head(bucket_name, key)
+        if head is None:
+            raise ClientError({'Error': {'Code': '404',
+                                         'Message': 'Not Found'}},
+                              'HeadObject')
+
+        address = hashlib.sha1('{0}:{1}'.format(
+            head['ETag'].strip('"'), head.get('ContentLength'))).hexdigest()
+        cache_path = os.path.join(self.cache_dir, address[:2], address)
+
+        with self._lock:
+            cache_lock = self._cache_locks.setdefault(address,
+                                                      threading.Lock())
+        with cache_lock:
+            if not os.path.exists(cache_path):
+                _makedirs(os.path.dirname(cache_path))
+                self._fetch(bucket_name, key, cache_path)
+
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        _place(cache_path, local_path)
+
+        return local_path
+
+    def _fetch(self, bucket_name, key, path):
+        # downloads to a temporary file first, so other participants and
+        # threads never see a partial file
+        with self._lock:
+            tmp_path = '{0}.{1}.{2}.tmp'.format(
+                path, os.getpid(), threading.current_thread().ident)
+        try:
+            self._attempt(self.client.download_file, bucket_name, key,
+                          tmp_path, Config=self.config)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Runs a transfer method in the pool of threads.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future of the result.
+        """
+
+        return self.executor.submit(function, *args, **kwargs)
+
+    def upload_files(self, uploads, extra_args=None, callback=None):
+        """
+        Uploads files concurrently.
+
+        Parameters
+        ----------
+        uploads : list
+            (path, bucket name, key) tuples.
+        extra_args : dict, optional
+            Extra arguments of the uploads.
+        callback : callable, optional
+            Called with the path of each file, returning the progress
+            callback of its upload.
+
+        Returns
+        -------
+        uploaded : list
+            Whether each file was uploaded, see upload.
+        """
+
+        futures = [
+            self.submit(self.upload, src, bucket_name, key, extra_args,
+                        callback(src) if callback else None)
+            for src, bucket_name, key in uploads
+        ]
+        return wait_all(futures)
+
+    def download_files(self, downloads):
+        """
+        Downloads objects concurrently.
+
+        Parameters
+        ----------
+        downloads : list
+            (bucket name, key, local path) tuples.
+
+        Returns
+        -------
+        local_paths : list
+            Paths of the downloaded files.
+        """
+
+        futures = [self.submit(self.download, *download)
+                   for download in downloads]
+        return wait_all(futures)
+
+
+def wait_all(futures):
+    """
+    Waits for all the futures, then raises the first error if any.
+
+    Returns
+    -------
+    results : list
+        Results of the futures.
+    """
+
+    from concurrent.futures import wait
+
+    wait(futures)
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
+    return [future.result() for future in futures]
+
+
+class Prefetch(object):
+    """
+    Downloads the S3 inputs of a participant in the background, to the
+    paths check_for_s3 looks for them, while its workflow is built.
+    """
+
+    def __init__(self, sub_dict, dl_dir, max_concurrency=MAX_CONCURRENCY):
+        """
+        Parameters
+        ----------
+        sub_dict : dict
+            Data configuration entry of the participant.
+        dl_dir : str
+            Download directory, as given to check_for_s3.
+        max_concurrency : int, optional
+            Number of files downloaded at once.
+        """
+
+        from indi_aws import fetch_creds
+
+        self.manager = None
+        self.futures = []
+
+        downloads = []
+        for path in s3_paths(dict((key, value)
+                                  for key, value in sub_dict.items()
+                                  if key != 'creds_path')):
+            local_path = local_s3_path(path, dl_dir)
+            if not os.path.exists(local_path) and \
+                    local_path not in [d[2] for d in downloads]:
+                bucket_name, key = parse_s3_path(path)
+                downloads.append((bucket_name, key, local_path))
+
+        if not downloads:
+            return
+
+        creds_path = sub_dict.get('creds_path')
+        if not creds_path or 'none' in str(creds_path).lower() or \
+                'null' in str(creds_path).lower():
+            creds_path = None
+
+        bucket = fetch_creds.return_bucket(creds_path, downloads[0][0])
+        self.manager = TransferManager(
+            bucket.meta.client, max_concurrency,
+            cache_dir=os.path.join(dl_dir, CACHE_DIR)
+        )
+        self.futures = [self.manager.submit(self.manager.download, *d)
+                        for d in downloads]
+
+    def wait(self):
+        """
+        Waits for the downloads to finish. Failed downloads are left to
+        check_for_s3, which reports their errors.
+
+        Returns
+        -------
+        failed : int
+            Number of failed downloads.
+        """
+
+        if self.manager is None:
+            return 0
+
+        from concurrent.futures import wait
+
+        wait(self.futures)
+        self.manager.shutdown()
+        return sum(future.exception() is not None for future in self.futures)
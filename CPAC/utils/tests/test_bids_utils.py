@@ -0,0 +1,216 @@
+import os
+import json
+import pytest
+
+from CPAC.utils.bids_utils import (
+    bids_gen_cpac_sublist,
+    bids_index_path,
+    bids_layout_index,
+    collect_bids_files_configs,
+    collect_bids_files_params,
+    load_bids_layout_index,
+    query_bids_layout
+)
+
+
+def write_file(path, contents=None):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        if contents is not None:
+            json.dump(contents, f)
+
+
+def scans(sublist):
+    # the participant-sessions and their files, without the parameters
+    return sorted(
+        (s['subject_id'], s['unique_id'], s['anat'],
+         sorted((k, v['scan']) for k, v in s['func'].items()))
+        for s in sublist
+    )
+
+
+@pytest.fixture
+def work_dir(tmpdir, monkeypatch):
+    # the layout indices are stored in the working directory by default
+    work_dir = tmpdir.mkdir('work')
+    monkeypatch.chdir(str(work_dir))
+    return str(work_dir)
+
+
+def bids_dataset(base_dir, participants=3, sessions=2):
+
+    # BIDS dataset whose parameters are inherited from a top-level sidecar
+    # json file, and overridden for some participants and runs
+
+    bids_dir = os.path.join(base_dir, 'bids')
+
+    write_file(os.path.join(bids_dir, 'task-rest_bold.json'),
+               {'RepetitionTime': 2.0, 'SliceTiming': [0, 0.5, 1.0, 1.5],
+                'TaskName': 'rest'})
+    write_file(os.path.join(bids_dir, 'T1w.json'),
+               {'RepetitionTime': 2.3, 'EchoTime': 0.00232})
+
+    for sub in range(participants):
+        sub = 'sub-{0:04d}'.format(sub)
+        if sub == 'sub-0001':
+            write_file(os.path.join(bids_dir, sub,
+                                    '{0}_task-rest_bold.json'.format(sub)),
+                       {'RepetitionTime': 1.5})
+        for ses in range(sessions):
+            ses = 'ses-{0}'.format(ses + 1)
+            prefix = os.path.join(bids_dir, sub, ses)
+            name = '{0}_{1}'.format(sub, ses)
+            write_file(os.path.join(prefix, 'anat', name + '_T1w.nii.gz'))
+            for run in (1, 2):
+                write_file(os.path.join(
+                    prefix, 'func',
+                    '{0}_task-rest_run-{1}_bold.nii.gz'.format(name, run)
+                ))
+            write_file(os.path.join(prefix, 'func',
+                                    name + '_task-rest_run-2_bold.json'),
+                       {'RepetitionTime': 3.0})
+            write_file(os.path.join(prefix, 'fmap',
+                                    name + '_dir-AP_epi.nii.gz'))
+            write_file(os.path.join(prefix, 'fmap', name + '_dir-AP_epi.json'),
+                       {'PhaseEncodingDirection': 'j-',
+                        'TotalReadoutTime': 0.05})
+            write_file(os.path.join(prefix, 'dwi', name + '_dwi.nii.gz'))
+
+    return bids_dir
+
+
+def test_bids_layout_index(tmpdir, work_dir):
+
+    bids_dir = bids_dataset(str(tmpdir))
+
+    file_paths, config = collect_bids_files_configs(bids_dir)
+    expected = bids_gen_cpac_sublist(bids_dir, file_paths, config, None)
+
+    file_paths, scan_params = collect_bids_files_params(bids_dir)
+    assert os.path.dirname(bids_index_path(bids_dir)) == work_dir
+    assert os.path.isfile(bids_index_path(bids_dir))
+
+    # parameters resolved in the index, or from the stored index
+    for _ in range(2):
+        file_paths, scan_params = collect_bids_files_params(bids_dir)
+        sublist = bids_gen_cpac_sublist(bids_dir, file_paths, None, None,
+                                        scan_params=scan_params)
+        assert scans(sublist) == scans(expected)
+
+        session = dict((s['subject_id'], s) for s in sublist
+                       if s['unique_id'] == 'ses-2')
+        params = dict(
+            ((sub, scan), session[sub]['func'][scan]['scan_parameters'])
+            for sub in ('sub-0001', 'sub-0002')
+            for scan in ('rest_run-1', 'rest_run-2')
+        )
+
+        # the top-level sidecar, overridden by the participant and the run
+        # sidecars
+        assert params['sub-0002', 'rest_run-1'] == {
+            'RepetitionTime': 2.0, 'SliceTiming': [0, 0.5, 1.0, 1.5],
+            'TaskName': 'rest'
+        }
+        assert params['sub-0001', 'rest_run-1']['RepetitionTime'] == 1.5
+        assert params['sub-0001', 'rest_run-2']['RepetitionTime'] == 3.0
+        assert params['sub-0002', 'rest_run-2']['RepetitionTime'] == 3.0
+        assert params['sub-0002', 'rest_run-2']['TaskName'] == 'rest'
+        assert type(params['sub-0002', 'rest_run-2']['TaskName']) is str
+        assert session['sub-0002']['anat'] == os.path.join(
+            bids_dir, 'sub-0002/ses-2/anat/sub-0002_ses-2_T1w.nii.gz'
+        )
+
+    # field maps and diffusion images are indexed as well
+    index = bids_layout_index(bids_dir)
+    epis = query_bids_layout(index, sub='0002', scantype='epi')
+    assert epis == ['sub-0002/ses-1/fmap/sub-0002_ses-1_dir-AP_epi.nii.gz',
+                    'sub-0002/ses-2/fmap/sub-0002_ses-2_dir-AP_epi.nii.gz']
+    assert index['files'][epis[0]]['params']['PhaseEncodingDirection'] == 'j-'
+    assert len(query_bids_layout(index, scantype='dwi',
+                                 ses=['1', '2'])) == 6
+    assert query_bids_layout(index, sub='0003') == []
+
+
+def test_bids_layout_index_invalidation(tmpdir):
+
+    bids_dir = bids_dataset(str(tmpdir), participants=2, sessions=1)
+    derivative = os.path.join(bids_dir, 'derivatives', 'cpac',
+                              'sub-0000_ses-1_task-rest_bold.nii.gz')
+    write_file(derivative)
+    cache_dir = str(tmpdir.join('cache'))
+
+    bids_layout_index(bids_dir, cache_dir)
+    index_path = bids_index_path(bids_dir, cache_dir)
+    assert os.path.dirname(index_path) == cache_dir
+    assert load_bids_layout_index(index_path, bids_dir) is not None
+    assert load_bids_layout_index(index_path, bids_dir,
+                                  suffixes=['bold']) is None
+
+    # the derivatives are neither indexed nor checked
+    index = bids_layout_index(bids_dir, cache_dir)
+    assert not any(path.startswith('derivatives')
+                   for path in index['files'])
+    write_file(os.path.join(os.path.dirname(derivative),
+                            'sub-0001_ses-1_task-rest_bold.nii.gz'))
+    os.utime(os.path.dirname(derivative), (0, 0))
+    assert load_bids_layout_index(index_path, bids_dir) is not None
+
+    # new files change the modification time of their directory
+    new_run = os.path.join(bids_dir, 'sub-0000', 'ses-1', 'func',
+                           'sub-0000_ses-1_task-rest_run-3_bold.nii.gz')
+    write_file(new_run)
+    os.utime(os.path.dirname(new_run), (0, 0))
+    assert load_bids_layout_index(index_path, bids_dir) is None
+
+    index = bids_layout_index(bids_dir, cache_dir)
+    assert os.path.relpath(new_run, bids_dir) in index['files']
+    assert load_bids_layout_index(index_path, bids_dir) is not None
+
+    # edited sidecar files
+    sidecar = os.path.join(bids_dir, 'task-rest_bold.json')
+    write_file(sidecar, {'RepetitionTime': 2.5})
+    os.utime(sidecar, (0, 0))
+    assert load_bids_layout_index(index_path, bids_dir) is None
+
+    index = bids_layout_index(bids_dir, cache_dir)
+    assert index['files'][os.path.relpath(new_run, bids_dir)]['params'][
+        'RepetitionTime'] == 2.5
+
+
+
+def test_bids_scan_params(tmpdir, work_dir):
+
+    # the sidecar json files listed for an S3 bucket are resolved the same
+    # way as the ones of a local directory
+    bids_dir = bids_dataset(str(tmpdir), participants=2, sessions=1)
+    write_file(os.path.join(bids_dir, 'task-nback_bold.json'),
+               {'RepetitionTime': 1.5})
+    for sub in ('sub-0000', 'sub-0001'):
+        func = os.path.join(bids_dir, sub, 'ses-1', 'func')
+        write_file(os.path.join(
+            func, '{0}_ses-1_task-nback_acq-fast_bold.nii.gz'.format(sub)
+        ))
+    write_file(os.path.join(bids_dir, 'sub-0000', 'ses-1', 'func',
+                            'sub-0000_ses-1_task-nback_acq-fast_bold.json'),
+               {'RepetitionTime': 0.8})
+
+    file_paths, config = collect_bids_files_configs(bids_dir)
+    from_configs = bids_gen_cpac_sublist(bids_dir, file_paths, config, None)
+
+    file_paths, scan_params = collect_bids_files_params(bids_dir)
+    from_index = bids_gen_cpac_sublist(bids_dir, file_paths, None, None,
+                                       scan_params=scan_params)
+
+    key = lambda s: s['subject_id']
+    assert sorted(from_configs, key=key) == sorted(from_index, key=key)
+
+    func = dict((s['subject_id'], s['func']) for s in from_configs)
+    assert func['sub-0000']['nback_acq-fast']['scan_parameters'] == \
+        {'RepetitionTime': 0.8}
+    assert func['sub-0001']['nback_acq-fast']['scan_parameters'] == \
+        {'RepetitionTime': 1.5}
+    assert func['sub-0000']['rest_run-1']['scan_parameters'] == {
+        'RepetitionTime': 2.0, 'SliceTiming': [0, 0.5, 1.0, 1.5],
+        'TaskName': 'rest'
+    }
@@ -0,0 +1,239 @@
+import os
+import csv
+import glob
+import time
+import fnmatch
+
+import pytest
+
+from CPAC.utils import build_data_config
+from CPAC.utils.build_data_config import (
+    gather_file_paths,
+    get_BIDS_data_dct,
+    get_nonBIDS_data,
+    scan_template_paths,
+    template_glob
+)
+
+
+@pytest.fixture
+def base_dir(tmpdir):
+    yield str(tmpdir)
+    # the benchmark data set is large, so it is not left behind
+    tmpdir.remove(rec=1)
+
+
+def touch(path):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+
+def bids_dataset(base_dir, participants=4, sessions=2, derivatives=0):
+
+    # BIDS dataset with a session level, a participants.tsv file, a
+    # top-level sidecar JSON file and field maps, and a derivatives folder with
+    # `derivatives` files per participant-session which are not inputs
+
+    with open(os.path.join(base_dir, 'participants.tsv'), 'w') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(['participant_id', 'age'])
+        for sub in range(participants):
+            writer.writerow(['{0:04d}'.format(sub), 20 + sub])
+
+    touch(os.path.join(base_dir, 'task-rest_bold.json'))
+    touch(os.path.join(base_dir, '.hidden', 'sub-9999_T1w.nii.gz'))
+
+    for sub in range(participants):
+        sub = 'sub-{0:04d}'.format(sub)
+        for ses in range(sessions):
+            ses = 'ses-{0}'.format(ses + 1)
+            prefix = os.path.join(base_dir, sub, ses)
+            name = '{0}_{1}'.format(sub, ses)
+            touch(os.path.join(prefix, 'anat', name + '_T1w.nii.gz'))
+            touch(os.path.join(prefix, 'anat', name + '_T1w.json'))
+            for run in (1, 2):
+                touch(os.path.join(
+                    prefix, 'func',
+                    '{0}_task-rest_run-{1}_bold.nii.gz'.format(name, run)
+                ))
+            touch(os.path.join(prefix, 'fmap', name + '_phasediff.nii.gz'))
+            touch(os.path.join(prefix, 'fmap', name + '_magnitude1.nii.gz'))
+            for idx in range(derivatives):
+                touch(os.path.join(
+                    base_dir, 'derivatives', 'fmriprep', sub, ses, 'func',
+                    '{0}_task-rest_desc-{1}_bold.nii.gz'.format(name, idx)
+                ))
+
+    return base_dir
+
+
+def test_scan_template_paths(base_dir):
+
+    bids_dataset(base_dir)
+
+    globs = {
+        'anat': template_glob(os.path.join(
+            base_dir, 'sub-{participant}/ses-{session}/anat/'
+            'sub-{participant}_ses-{session}_*T1w.nii.gz'
+        )),
+        'func': template_glob(os.path.join(
+            base_dir, '{site}/*/func/*_task-{scan}_bold.nii.gz'
+        )),
+        'literal': os.path.join(base_dir, 'participants.tsv'),
+        'hidden': os.path.join(base_dir, '*/sub-*_T1w.nii.gz'),
+        'dot': os.path.join(base_dir, '.*/sub-*_T1w.nii.gz'),
+        'range': os.path.join(base_dir, 'sub-000[0-2]/ses-?/fmap/*'),
+        'missing': os.path.join(base_dir, 'nothing/*.nii.gz'),
+        's3': 's3://bucket/sub-*/anat/*.nii.gz',
+    }
+
+    for processes in (1, 3):
+        pools = scan_template_paths(globs, processes=processes)
+        for name, glob_str in globs.items():
+            assert pools[name] == sorted(glob.glob(glob_str)), name
+
+    # relative patterns give relative paths, as with glob
+    cwd = os.getcwd()
+    os.chdir(base_dir)
+    try:
+        pools = scan_template_paths({'anat': 'sub-*/*/anat/*.nii.gz'})
+        assert pools['anat'] == sorted(glob.glob('sub-*/*/anat/*.nii.gz'))
+    finally:
+        os.chdir(cwd)
+
+
+def test_get_BIDS_data_dct(base_dir, monkeypatch):
+
+    bids_dataset(base_dir)
+
+    data_dct = get_BIDS_data_dct(base_dir)
+    assert data_dct == get_BIDS_data_dct(base_dir, processes=3)
+
+    # the file list of the BIDS directory is not walked again
+    file_list = gather_file_paths(base_dir)
+    walks = []
+
+    def scan_template_paths(globs, processes=1):
+        walks.extend(globs.values())
+        return dict((name, []) for name in globs)
+
+    monkeypatch.setattr(build_data_config, 'scan_template_paths',
+                        scan_template_paths)
+    assert data_dct == get_BIDS_data_dct(base_dir, file_list=file_list)
+    assert walks == []
+
+    assert sorted(data_dct) == ['site-1']
+    assert len(data_dct['site-1']) == 4
+
+    entry = data_dct['site-1']['0001']['2']
+    assert entry['anat'] == os.path.join(
+        base_dir, 'sub-0001/ses-2/anat/sub-0001_ses-2_T1w.nii.gz'
+    )
+    assert sorted(entry['func']) == ['rest_run-1', 'rest_run-2']
+    scan = entry['func']['rest_run-2']
+    assert scan['scan'] == os.path.join(
+        base_dir,
+        'sub-0001/ses-2/func/sub-0001_ses-2_task-rest_run-2_bold.nii.gz'
+    )
+    assert scan['scan_parameters'] == os.path.join(base_dir,
+                                                   'task-rest_bold.json')
+    assert scan['fmap_phase'].endswith('sub-0001_ses-2_phasediff.nii.gz')
+    assert scan['fmap_mag'].endswith('sub-0001_ses-2_magnitude1.nii.gz')
+
+
+def test_get_nonBIDS_data(base_dir):
+
+    bids_dataset(base_dir)
+
+    anat_template = os.path.join(base_dir, 'sub-{participant}/{session}/'
+                                 'anat/*_T1w.nii.gz')
+    func_template = os.path.join(base_dir, 'sub-{participant}/{session}/'
+                                 'func/*_task-{series}_bold.nii.gz')
+
+    data_dct = get_nonBIDS_data(anat_template, func_template,
+                                exclusion_dct={'participants': ['0002']})
+    assert sorted(data_dct['site-1']) == ['0000', '0001', '0003']
+    assert sorted(data_dct['site-1']['0003']) == ['ses-1', 'ses-2']
+    assert sorted(data_dct['site-1']['0003']['ses-1']['func']) == \
+        ['rest_run-1', 'rest_run-2']
+
+    # paths from a file list (e.g. an AWS S3 bucket) are merged with the
+    # local ones
+    file_list = gather_file_paths(os.path.join(base_dir, 'sub-0000'))
+    assert data_dct == get_nonBIDS_data(
+        anat_template, func_template, file_list=file_list,
+        exclusion_dct={'participants': ['0002']}
+    )
+
+
+@pytest.mark.skip(reason="benchmark, writes more than 50k files")
+def test_get_BIDS_data_dct_benchmark(base_dir):
+
+    # 50k files, most of them in the derivatives folder
+    bids_dataset(base_dir, participants=250, sessions=2, derivatives=95)
+    file_list = gather_file_paths(base_dir)
+    assert len(file_list) > 50000
+
+    anat_glob = template_glob(os.path.join(
+        base_dir, 'sub-{participant}/ses-{session}/anat/'
+        'sub-{participant}_ses-{session}_T1w.nii.gz'
+    ))
+    func_glob = template_glob(os.path.join(
+        base_dir, 'sub-{participant}/ses-{session}/func/'
+        'sub-{participant}_ses-{session}_task-{scan}_bold.nii.gz'
+    ))
+
+    # the layout checks and file pools, as gathered with a fnmatch call per
+    # path and pattern, a glob per template, and deduplicated with list
+    # membership
+    layout_globs = [os.path.join(base_dir, glob_str) for glob_str in [
+        '*/sub-*/*/*.nii*', 'sub-*/ses-*/*', '*participants.tsv',
+        'sub-*fmap/sub-*_task-*_phasediff.nii.gz',
+        'sub-*fmap/sub-*_task-*_magnitud*.nii.gz',
+        'sub-*/ses-*/func/*bold.json', 'sub-*/ses-*/*bold.json',
+        'sub-*/func/*bold.json', 'sub-*/*bold.json', '*bold.json',
+        '*/sub-*/ses-*/func/*bold.json', '*/sub-*/ses-*/*bold.json',
+        '*/sub-*/func/*bold.json', '*/sub-*/*bold.json', '*/*bold.json',
+    ]]
+
+    start = time.time()
+    layout = set()
+    for filepath in file_list:
+        for glob_str in layout_globs:
+            if fnmatch.fnmatch(filepath, glob_str):
+                layout.add(glob_str)
+    anat_pool = []
+    func_pool = []
+    for filepath in file_list:
+        if fnmatch.fnmatch(filepath, anat_glob):
+            anat_pool.append(filepath)
+        elif fnmatch.fnmatch(filepath, func_glob):
+            func_pool.append(filepath)
+    anat_pool = anat_pool + [x for x in glob.glob(anat_glob)
+                             if x not in anat_pool]
+    func_pool = func_pool + [x for x in glob.glob(func_glob)
+                             if x not in func_pool]
+    pool_time = time.time() - start
+
+    start = time.time()
+    data_dct = get_BIDS_data_dct(base_dir, file_list=file_list)
+    bids_time = time.time() - start
+
+    print('Matching {0} files to the BIDS layout with fnmatch, glob and '
+          'list deduplication: {1:.2f}s, whole data configuration: '
+          '{2:.2f}s'.format(len(file_list), pool_time, bids_time))
+
+    assert len(data_dct['site-1']) == 250
+    scans = [
+        entry['func'][scan]['scan']
+        for sub in data_dct['site-1'].values()
+        for entry in sub.values()
+        for scan in entry['func']
+    ]
+    assert sorted(scans) == sorted(func_pool)
+    assert sorted(
+        entry['anat']
+        for sub in data_dct['site-1'].values()
+        for entry in sub.values()
+    ) == sorted(anat_pool)
@@ -0,0 +1,78 @@
+import sys
+import time
+import subprocess
+
+from CPAC.utils.import_profiler import profile_imports, format_profile, \
+    run_profile
+
+
+def loaded_modules(statement):
+    # the imports are checked in a new interpreter, so the modules already
+    # loaded by the test session do not count
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        statement + '; import sys; print(" ".join(sys.modules))'
+    ])
+    return set(output.split())
+
+
+def test_lazy_utils():
+
+    modules = loaded_modules(
+        'import CPAC.utils; from CPAC.utils import Configuration'
+    )
+
+    assert 'CPAC.utils.configuration' in modules
+    for heavy in ('nipype', 'matplotlib', 'nilearn', 'scipy'):
+        assert heavy not in modules
+
+
+def startup_time(args, runs=3):
+    # best wall time of a new interpreter, to smooth out the machine load
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_output([sys.executable] + args)
+        times.append(time.time() - start)
+    return min(times)
+
+
+def test_cli_startup_time():
+
+    # cpac --help must not load the scientific stack; the bound is relative
+    # to importing nipype alone, so that it holds on slow machines too
+    cli = startup_time(['-m', 'CPAC', '--help'])
+    nipype = startup_time(['-c', 'import nipype.pipeline.engine'])
+
+    assert cli < 0.5 * nipype, \
+        'cpac --help took {0:.2f}s, importing nipype {1:.2f}s'.format(
+            cli, nipype)
+
+
+def test_lazy_attribute():
+
+    import CPAC.utils
+    from CPAC.utils.configuration import Configuration
+
+    assert CPAC.utils.Configuration is Configuration
+    assert 'Configuration' in dir(CPAC.utils)
+
+
+def test_profile_imports():
+
+    imports, total = profile_imports('CPAC.utils.lazy_import')
+    assert total >= 0
+
+    table = format_profile([('a', 0.001, 0.003), ('b', 0.002, 0.002)],
+                           0.003, top=1)
+    lines = table.split('\n')
+    assert len(lines) == 3
+    assert lines[1].endswith('| a')
+    assert lines[2] == '2 modules imported in 3.0 ms'
+
+
+def test_run_profile():
+
+    table = run_profile('CPAC.utils.configuration')
+    assert 'CPAC.utils.configuration' in table
+    assert 'nipype' not in table
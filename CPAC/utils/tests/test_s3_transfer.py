@@ -0,0 +1,249 @@
+import os
+import time
+import shutil
+import hashlib
+import threading
+
+import pytest
+
+from CPAC.utils import s3_transfer
+from CPAC.utils.s3_transfer import (
+    TransferManager,
+    Prefetch,
+    etag_matches,
+    file_etag,
+    local_s3_path,
+    s3_paths,
+)
+
+MB = 1024 ** 2
+
+
+class LocalS3Client(object):
+    """
+    Stand-in for a boto3 S3 client, storing the objects in a directory and
+    giving them the ETags S3 would.
+    """
+
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.latency = latency
+        self.calls = {'upload_file': 0, 'download_file': 0}
+        self.lock = threading.Lock()
+
+    def _path(self, bucket, key):
+        return os.path.join(self.root, bucket, key)
+
+    def _count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+        time.sleep(self.latency)
+
+    def head_object(self, Bucket, Key):
+        from botocore.exceptions import ClientError
+
+        path = self._path(Bucket, Key)
+        if not os.path.exists(path):
+            raise ClientError({'Error': {'Code': '404',
+                                         'Message': 'Not Found'}},
+                              'HeadObject')
+        with open(path + '.etag') as f:
+            etag = f.read()
+        return {'ETag': '"%s"' % etag,
+                'ContentLength': os.path.getsize(path)}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None,
+                    Callback=None, Config=None):
+        self._count('upload_file')
+        path = self._path(Bucket, Key)
+        # concurrent uploads create the same directories
+        s3_transfer._makedirs(os.path.dirname(path))
+        shutil.copy(Filename, path)
+
+        part_size = None
+        if Config and os.path.getsize(path) >= Config.multipart_threshold:
+            part_size = Config.multipart_chunksize
+        with open(path + '.etag', 'w') as f:
+            f.write(file_etag(path, part_size))
+
+    def download_file(self, Bucket, Key, Filename, Config=None):
+        self._count('download_file')
+        shutil.copy(self._path(Bucket, Key), Filename)
+
+
+@pytest.fixture
+def tmpdir_path(tmpdir):
+    return str(tmpdir)
+
+
+def write_file(path, size, seed=0):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(hashlib.sha512(str(seed)).digest() * (size // 64) +
+                b'x' * (size % 64))
+    return path
+
+
+def test_etag(tmpdir_path):
+
+    path = write_file(os.path.join(tmpdir_path, 'data.nii.gz'),
+                      5 * MB // 2 + 7)
+    with open(path, 'rb') as f:
+        content = f.read()
+
+    assert file_etag(path) == hashlib.md5(content).hexdigest()
+
+    digests = [hashlib.md5(content[i:i + MB]).digest()
+               for i in range(0, len(content), MB)]
+    multipart = hashlib.md5(b''.join(digests)).hexdigest() + '-3'
+    assert file_etag(path, MB) == multipart
+
+    assert etag_matches(path, '"%s"' % file_etag(path), len(content))
+    assert etag_matches(path, multipart, len(content))
+    assert not etag_matches(path, multipart, len(content) + 1)
+    assert not etag_matches(path, hashlib.md5(b'').hexdigest() + '-3')
+
+
+def test_s3_paths():
+
+    sub_dict = {
+        'subject_id': '0001',
+        'anat': 's3://bucket/sub-0001/anat.nii.gz',
+        'func': {
+            'rest': {
+                'scan': 'S3://bucket/sub-0001/rest.nii.gz',
+                'scan_parameters': '/local/params.json',
+            }
+        },
+    }
+
+    paths = s3_paths(sub_dict)
+    assert paths == ['s3://bucket/sub-0001/anat.nii.gz',
+                     's3://bucket/sub-0001/rest.nii.gz']
+    assert local_s3_path(paths[0], '/working') == \
+        '/working/bucket/sub-0001/anat.nii.gz'
+
+
+def test_upload_skips_same_content(tmpdir_path):
+
+    client = LocalS3Client(os.path.join(tmpdir_path, 's3'))
+    small = write_file(os.path.join(tmpdir_path, 'out', 'small.1D'), 1000)
+    # above the multipart threshold, so its ETag has parts
+    large = write_file(os.path.join(tmpdir_path, 'out', 'large.nii.gz'),
+                       9 * MB)
+    uploads = [(small, 'bucket', 'out/small.1D'),
+               (large, 'bucket', 'out/large.nii.gz')]
+
+    with TransferManager(client) as manager:
+        assert manager.upload_files(uploads) == [True, True]
+        assert client.head_object('bucket', 'out/large.nii.gz')['ETag'] \
+            .endswith('-2"')
+
+        assert manager.upload_files(uploads) == [False, False]
+
+        write_file(small, 1000, seed=1)
+        assert manager.upload_files(uploads) == [True, False]
+
+    assert client.calls['upload_file'] == 3
+
+
+def test_download_cache(tmpdir_path):
+
+    client = LocalS3Client(os.path.join(tmpdir_path, 's3'))
+    src = write_file(os.path.join(tmpdir_path, 'template.nii.gz'), 2000)
+
+    dl_dir = os.path.join(tmpdir_path, 'working')
+    with TransferManager(client,
+                         cache_dir=os.path.join(dl_dir, 's3_cache')) \
+            as manager:
+        manager.upload(src, 'bucket', 'a/template.nii.gz')
+        manager.upload(src, 'other', 'b/template.nii.gz')
+
+        downloads = [
+            ('bucket', 'a/template.nii.gz',
+             local_s3_path('s3://bucket/a/template.nii.gz', dl_dir)),
+            ('other', 'b/template.nii.gz',
+             local_s3_path('s3://other/b/template.nii.gz', dl_dir)),
+        ]
+        local_paths = manager.download_files(downloads)
+
+        # the same content is downloaded once
+        assert client.calls['download_file'] == 1
+        for local_path in local_paths:
+            assert file_etag(local_path) == file_etag(src)
+
+        with pytest.raises(Exception):
+            manager.download('bucket', 'missing.nii.gz',
+                             os.path.join(dl_dir, 'missing.nii.gz'))
+
+
+def test_prefetch(tmpdir_path, monkeypatch):
+
+    from indi_aws import fetch_creds
+
+    client = LocalS3Client(os.path.join(tmpdir_path, 's3'), latency=0.05)
+
+    class Bucket(object):
+        class meta(object):
+            pass
+    Bucket.meta.client = client
+
+    monkeypatch.setattr(fetch_creds, 'return_bucket',
+                        lambda creds_path, bucket_name: Bucket)
+
+    sub_dict = {'subject_id': '0001', 'creds_path': None, 'func': {}}
+    for n in range(16):
+        src = write_file(os.path.join(tmpdir_path, 'in', '%d.nii.gz' % n),
+                         1000, seed=n)
+        client.upload_file(src, 'bucket', 'sub-0001/%d.nii.gz' % n)
+        sub_dict['func']['rest_%d' % n] = {
+            'scan': 's3://bucket/sub-0001/%d.nii.gz' % n
+        }
+
+    dl_dir = os.path.join(tmpdir_path, 'working')
+
+    prefetch = Prefetch(sub_dict, dl_dir)
+    assert prefetch.wait() == 0
+
+    for path in s3_paths(sub_dict):
+        assert os.path.isfile(local_s3_path(path, dl_dir))
+    assert os.path.isdir(os.path.join(dl_dir, s3_transfer.CACHE_DIR))
+
+    # the files already downloaded are not prefetched again
+    assert Prefetch(sub_dict, dl_dir).wait() == 0
+    assert client.calls['download_file'] == 16
+
+
+def test_datasink_upload(tmpdir_path):
+
+    from CPAC.utils.interfaces.datasink import DataSink
+
+    client = LocalS3Client(os.path.join(tmpdir_path, 's3'))
+
+    class Bucket(object):
+        name = 'bucket'
+
+        class meta(object):
+            pass
+    Bucket.meta.client = client
+
+    out_dir = os.path.join(tmpdir_path, 'outputs')
+    for n in range(3):
+        write_file(os.path.join(out_dir, 'qc', '%d.png' % n), 100, seed=n)
+    out_file = write_file(os.path.join(tmpdir_path, 'mean.nii.gz'), 100)
+
+    ds = DataSink()
+    ds._upload_to_s3(Bucket, [
+        (out_file, 's3://bucket/pipeline/sub-1/mean.nii.gz'),
+        (os.path.join(out_dir, ''), 'S3://bucket/pipeline/sub-1/qc/'),
+    ])
+
+    for key in ['pipeline/sub-1/mean.nii.gz', 'pipeline/sub-1/qc/qc/0.png',
+                'pipeline/sub-1/qc/qc/2.png']:
+        assert client.head_object('bucket', key)
+
+    ds._upload_to_s3(Bucket, [
+        (out_file, 's3://bucket/pipeline/sub-1/mean.nii.gz'),
+    ])
+    assert client.calls['upload_file'] == 4
@@ -340,6 +340,37 @@ def safe_shape(*vol_data):
     return same_volume
 
 
+def slab_dataobj(img):
+    """
+    Returns the data of a nifti image to read slabs of voxels from.
+
+    Slices of an uncompressed image are read from disk on demand, so only
+    the slab being processed is held in memory. A gzipped image would be
+    decompressed again for each slab of a 4D image, as the time points of a
+    slab span the whole file, so it is read into memory at once instead:
+    the memory bound of the slabs does not hold for gzipped images, which
+    take the size of the whole image. In both cases the scaling of the
+    header (scl_slope and scl_inter) is applied; the stored data type is
+    only kept when the image is not scaled, otherwise the data is float64,
+    e.g. four times the size of int16 data on disk.
+
+    Parameters
+    ----------
+    img : nibabel image
+        Loaded image.
+
+    Returns
+    -------
+    dataobj : array-like
+        Array proxy of an uncompressed image, or array of the whole data
+        of a gzipped image, with the header scaling applied.
+    """
+    filename = img.get_filename()
+    if filename and filename.endswith('.gz'):
+        return np.asanyarray(img.dataobj)
+    return img.dataobj
+
+
 def extract_one_d(list_timeseries):
     if isinstance(list_timeseries, basestring):
         if '.1D' in list_timeseries or '.csv' in list_timeseries:
@@ -1218,3 +1249,18 @@ def check_config_resources(c):
 
     # Return memory and cores
     return sub_mem_gb, num_cores_per_sub, num_ants_cores
+
+
+def workflow_resource_demand(workflow):
+    """
+    Returns the largest number of threads and memory (GB) declared by a node
+    of a workflow, which the MultiProc plugin needs at least to run it.
+    """
+
+    n_procs = 1
+    mem_gb = 0
+    for node in workflow._get_all_nodes():
+        n_procs = max(n_procs, node.n_procs or 1)
+        mem_gb = max(mem_gb, node.mem_gb or 0)
+
+    return n_procs, mem_gb
@@ -310,7 +310,8 @@ def gen_bids_outputs_sublist(base_path, paths_list, key_list, creds_path):
     return sublist
 
 
-def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=False):
+def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=False,
+                          scan_params=None):
     """
     Generates a CPAC formatted subject list from information contained in a
     BIDS formatted set of data.
@@ -329,6 +330,10 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
        to None
     :param dbg: boolean indicating whether or not the debug statements should
        be printed
+    :param scan_params: dictionary that maps the paths in paths_list to
+       their parameters, already resolved from the json sidecars (see
+       CPAC.utils.bids_utils.collect_bids_files_params), used instead of
+       config_dict
     :return: a list of dictionaries suitable for use by CPAC to specify data
        to be processed
     """
@@ -343,9 +348,11 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
     # if configuration information is not desired, config_dict will be empty,
     # otherwise parse the information in the sidecar json files into a dict
     # we can use to extract data for our nifti files
-    if config_dict:
+    if config_dict and scan_params is None:
         bids_config_dict = bids_parse_sidecar(config_dict)
 
+    with_params = bool(config_dict) or scan_params is not None
+
     subdict = {}
 
     for p in paths_list:
@@ -356,9 +363,12 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
 
             f_dict = bids_decode_fname(p)
 
-            if config_dict:
-                t_params = bids_retrieve_params(bids_config_dict,
-                                                f_dict)
+            if with_params:
+                if scan_params is not None:
+                    t_params = scan_params.get(p, {})
+                else:
+                    t_params = bids_retrieve_params(bids_config_dict,
+                                                    f_dict)
                 if not t_params:
                     print f_dict
                     print("Did not receive any parameters for %s," % (p) +
@@ -403,7 +413,7 @@ def bids_gen_cpac_sublist(bids_dir, paths_list, config_dict, creds_path, dbg=Fal
                 # TODO deal with scan parameters anatomical
                 elif "anat" not in subdict[f_dict["sub"]][f_dict["ses"]]:
                     subdict[f_dict["sub"]][f_dict["ses"]]["anat"] = \
-                        task_info["scan"] if config_dict else task_info
+                        task_info["scan"] if with_params else task_info
                 else:
                     print("Anatomical file (%s) already found" %
                           (subdict[f_dict["sub"]][f_dict["ses"]]["anat"]) +
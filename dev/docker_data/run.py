@@ -183,6 +183,13 @@ parser.add_argument('--mem_gb', type=float,
                     help='Amount of RAM available to the pipeline in gigabytes.'
                          ' if this is specified along with mem_mb, this flag will take precedence.')
 
+parser.add_argument('--bids_index_dir', help='Directory where the layout index'
+                                             ' of a local bids_dir is stored, so that the following'
+                                             ' launches on the same data do not walk it again. By'
+                                             ' default, the index is stored in output_dir, or in the'
+                                             ' working directory when output_dir is on S3.',
+                    default=None)
+
 parser.add_argument('--save_working_dir', nargs='?',
                     help='Save the contents of the working directory.', default=False)
 parser.add_argument('--disable_file_logging', action='store_true',
@@ -470,8 +477,30 @@ elif args.analysis_level in ["test_config", "participant"]:
 
         from bids_utils import collect_bids_files_configs, bids_gen_cpac_sublist
 
-        (file_paths, config) = collect_bids_files_configs(
-            args.bids_dir, args.aws_input_creds)
+        if args.bids_dir.lower().startswith("s3://"):
+            from CPAC.utils.bids_utils import bids_scan_params
+
+            # the parameters are resolved the same way as for a local
+            # directory
+            (file_paths, config) = collect_bids_files_configs(
+                args.bids_dir, args.aws_input_creds)
+            scan_params = bids_scan_params(file_paths, config)
+            config = None
+        else:
+            from CPAC.utils.bids_utils import collect_bids_files_params
+
+            bids_index_dir = args.bids_index_dir
+            if not bids_index_dir:
+                if "s3://" not in args.output_dir.lower():
+                    bids_index_dir = args.output_dir
+                else:
+                    bids_index_dir = c['workingDirectory']
+
+            (file_paths, scan_params) = collect_bids_files_params(
+                args.bids_dir, bids_index_dir,
+                suffixes=['T1w', 'bold', 'acq-fMRI_epi', 'phasediff',
+                          'magnitude'])
+            config = None
 
         if args.participant_label:
             file_paths = [
@@ -493,7 +522,8 @@ elif args.analysis_level in ["test_config", "participant"]:
             args.bids_dir,
             file_paths,
             config,
-            args.aws_input_creds
+            args.aws_input_creds,
+            scan_params=scan_params
         )
 
         if not sub_list: